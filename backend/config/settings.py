@@ -9,7 +9,51 @@ class Settings(BaseSettings):
     # Security
     jwt_secret: str = os.environ.get('JWT_SECRET', 'islamic-institute-secret-key-2025-secure')
     jwt_algorithm: str = "HS256"
-    access_token_expire_hours: int = 24
+    # The web app does not refresh tokens yet; shorten this only once it does
+    access_token_expire_minutes: int = int(os.environ.get('ACCESS_TOKEN_EXPIRE_MINUTES', '1440'))
+    refresh_token_expire_days: int = int(os.environ.get('REFRESH_TOKEN_EXPIRE_DAYS', '30'))
+    token_version_cache_size: int = int(os.environ.get('TOKEN_VERSION_CACHE_SIZE', '10000'))
+    token_version_cache_ttl_seconds: float = float(os.environ.get('TOKEN_VERSION_CACHE_TTL_SECONDS', '30'))
+    token_revocation_bloom_capacity: int = int(os.environ.get('TOKEN_REVOCATION_BLOOM_CAPACITY', '100000'))
+    token_revocation_bloom_error_rate: float = float(os.environ.get('TOKEN_REVOCATION_BLOOM_ERROR_RATE', '0.001'))
+    token_revocation_max_entries: int = int(os.environ.get('TOKEN_REVOCATION_MAX_ENTRIES', '100000'))
+    token_revocation_refresh_interval_seconds: float = float(os.environ.get('TOKEN_REVOCATION_REFRESH_INTERVAL_SECONDS', '1'))
+    
+    # Rate limiting of login and registration, per client IP and per email
+    rate_limit_enabled: bool = os.environ.get('RATE_LIMIT_ENABLED', 'True').lower() == 'true'
+    rate_limit_backend: str = os.environ.get('RATE_LIMIT_BACKEND', 'memory')  # "redis" shares buckets between workers
+    rate_limit_redis_url: str = os.environ.get('RATE_LIMIT_REDIS_URL', '')  # e.g. redis://localhost:6379/0
+    rate_limit_max_keys: int = int(os.environ.get('RATE_LIMIT_MAX_KEYS', '100000'))
+    rate_limit_shards: int = int(os.environ.get('RATE_LIMIT_SHARDS', '16'))
+    rate_limit_trust_forwarded_for: bool = os.environ.get('RATE_LIMIT_TRUST_FORWARDED_FOR', 'False').lower() == 'true'
+    rate_limit_trusted_proxies: str = os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', '127.0.0.1,::1')  # Comma separated
+    login_ip_per_minute: float = float(os.environ.get('LOGIN_IP_PER_MINUTE', '30'))
+    login_ip_burst: int = int(os.environ.get('LOGIN_IP_BURST', '60'))
+    login_email_per_minute: float = float(os.environ.get('LOGIN_EMAIL_PER_MINUTE', '5'))
+    login_email_burst: int = int(os.environ.get('LOGIN_EMAIL_BURST', '10'))
+    register_ip_per_minute: float = float(os.environ.get('REGISTER_IP_PER_MINUTE', '5'))
+    register_ip_burst: int = int(os.environ.get('REGISTER_IP_BURST', '20'))
+    register_email_per_minute: float = float(os.environ.get('REGISTER_EMAIL_PER_MINUTE', '2'))
+    register_email_burst: int = int(os.environ.get('REGISTER_EMAIL_BURST', '3'))
+    password_scrypt_n: int = int(os.environ.get('PASSWORD_SCRYPT_N', str(2 ** 14)))
+    password_scrypt_r: int = int(os.environ.get('PASSWORD_SCRYPT_R', '8'))
+    password_scrypt_p: int = int(os.environ.get('PASSWORD_SCRYPT_P', '1'))
+    password_hash_workers: int = int(os.environ.get('PASSWORD_HASH_WORKERS', str(min(4, os.cpu_count() or 1))))
+    password_hash_max_pending: int = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', '256'))
+    password_hash_queue_timeout_seconds: float = float(os.environ.get('PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS', '5'))
+    principal_cache_size: int = int(os.environ.get('PRINCIPAL_CACHE_SIZE', '10000'))
+    principal_cache_ttl_seconds: float = float(os.environ.get('PRINCIPAL_CACHE_TTL_SECONDS', '30'))
+    membership_cache_size: int = int(os.environ.get('MEMBERSHIP_CACHE_SIZE', '10000'))
+    membership_cache_ttl_seconds: float = float(os.environ.get('MEMBERSHIP_CACHE_TTL_SECONDS', '30'))
+    lesson_ids_cache_size: int = int(os.environ.get('LESSON_IDS_CACHE_SIZE', '10000'))
+    lesson_ids_cache_ttl_seconds: float = float(os.environ.get('LESSON_IDS_CACHE_TTL_SECONDS', '60'))
+    counter_flush_interval_seconds: float = float(os.environ.get('COUNTER_FLUSH_INTERVAL_SECONDS', '1'))
+    heartbeat_flush_interval_seconds: float = float(os.environ.get('HEARTBEAT_FLUSH_INTERVAL_SECONDS', '5'))
+    heartbeat_buffer_max_entries: int = int(os.environ.get('HEARTBEAT_BUFFER_MAX_ENTRIES', '50000'))
+    pending_enrollment_ttl_seconds: float = float(os.environ.get('PENDING_ENROLLMENT_TTL_SECONDS', '86400'))
+    pending_enrollment_sweep_interval_seconds: float = float(os.environ.get('PENDING_ENROLLMENT_SWEEP_INTERVAL_SECONDS', '300'))
+    bulk_enrollment_report_retention_seconds: int = int(os.environ.get('BULK_ENROLLMENT_REPORT_RETENTION_SECONDS', str(30 * 24 * 3600)))
+    reconciliation_report_retention_seconds: int = int(os.environ.get('RECONCILIATION_REPORT_RETENTION_SECONDS', str(90 * 24 * 3600)))
     
     # App
     app_name: str = "Islamic Institute Course Platform API"
@@ -22,6 +66,20 @@ class Settings(BaseSettings):
     sslcommerz_store_id: str = os.environ.get('SSLCOMMERZ_STORE_ID', '')
     sslcommerz_store_password: str = os.environ.get('SSLCOMMERZ_STORE_PASSWORD', '')
     sslcommerz_is_sandbox: bool = os.environ.get('SSLCOMMERZ_SANDBOX', 'True').lower() == 'true'
+    sslcommerz_base_url: str = os.environ.get('SSLCOMMERZ_BASE_URL', '')  # Overrides the sandbox/live URL
+    payment_gateway: str = os.environ.get('PAYMENT_GATEWAY', 'sslcommerz')  # "stub" runs without the network
+    payment_gateway_timeout_seconds: float = float(os.environ.get('PAYMENT_GATEWAY_TIMEOUT_SECONDS', '10'))
+    payment_gateway_max_retries: int = int(os.environ.get('PAYMENT_GATEWAY_MAX_RETRIES', '2'))
+    payment_gateway_max_connections: int = int(os.environ.get('PAYMENT_GATEWAY_MAX_CONNECTIONS', '100'))
+    public_api_url: str = os.environ.get('PUBLIC_API_URL', 'http://localhost:8001')  # Base of the IPN URL
+    payment_return_url: str = os.environ.get('PAYMENT_RETURN_URL', 'http://localhost:3000/payment')
+    payment_inbox_workers: int = int(os.environ.get('PAYMENT_INBOX_WORKERS', '2'))
+    payment_inbox_batch_size: int = int(os.environ.get('PAYMENT_INBOX_BATCH_SIZE', '100'))
+    payment_inbox_poll_interval_seconds: float = float(os.environ.get('PAYMENT_INBOX_POLL_INTERVAL_SECONDS', '1'))
+    payment_inbox_lease_seconds: float = float(os.environ.get('PAYMENT_INBOX_LEASE_SECONDS', '60'))
+    payment_inbox_max_attempts: int = int(os.environ.get('PAYMENT_INBOX_MAX_ATTEMPTS', '8'))
+    payment_inbox_retry_seconds: float = float(os.environ.get('PAYMENT_INBOX_RETRY_SECONDS', '30'))
+    payment_inbox_retention_seconds: int = int(os.environ.get('PAYMENT_INBOX_RETENTION_SECONDS', str(30 * 24 * 3600)))
     
     class Config:
         env_file = ".env"
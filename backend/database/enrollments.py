@@ -0,0 +1,477 @@
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta
+from collections import defaultdict
+from typing import Any, AsyncIterator, Dict, FrozenSet, List, Optional, Tuple
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from .connection import database
+from .rollups import record_enrollment_rollup
+from ..config.settings import settings
+from ..models import Enrollment
+from ..utils.cache import TTLCache
+from ..utils.counters import CounterFlusher
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_BATCH_SIZE = 100
+ARCHIVE_COLLECTION = "enrollments_archive"
+SWEEP_BATCH_SIZE = 500
+
+# Bulk cohort enrollment: one job document per upload plus one result row per input row
+BULK_JOB_COLLECTION = "bulk_enrollment_jobs"
+BULK_ROW_COLLECTION = "bulk_enrollment_rows"
+BULK_ENROLL_BATCH_SIZE = 1000
+BULK_ROW_STATUSES = ["enrolled", "already_enrolled", "user_not_found", "course_not_found", "invalid"]
+
+# Payment attempts that have not completed; they are reused by the next attempt and
+# archived once they expire
+OPEN_PAYMENT_STATUSES = ["pending", "failed"]
+
+# Course ids each user has a completed enrollment in, keyed by user id, with the
+# membership version they are known to be current for. The enrollments collection is
+# the source of truth (unique on user_id, course_id); every write that completes an
+# enrollment bumps users.membership_version and invalidates the local entry. Access
+# tokens carry the version they were issued at, so a token minted after an enrollment
+# on another worker reloads a stale entry instead of waiting out the TTL.
+membership_cache = TTLCache(maxsize=settings.membership_cache_size, ttl=settings.membership_cache_ttl_seconds)
+
+# Set once this process has moved legacy users.enrolled_courses arrays into enrollments
+# (backfill_enrolled_courses, run at startup); until then membership also reads the array
+enrolled_courses_migrated = False
+
+async def get_enrolled_course_ids(user_id: str, min_version: int = 0) -> FrozenSet[str]:
+    """Course ids the user has a completed enrollment in, as of at least `min_version`"""
+    cached = membership_cache.get(user_id)
+    if cached is not None and cached[0] >= min_version:
+        return cached[1]
+    enrollments = await database.enrollments.find(
+        {"user_id": user_id, "payment_status": "completed"}, {"_id": 0, "course_id": 1}
+    ).to_list(None)
+    course_ids = frozenset(enrollment["course_id"] for enrollment in enrollments)
+    if not enrolled_courses_migrated:
+        user = await database.users.find_one({"id": user_id}, {"_id": 0, "enrolled_courses": 1})
+        course_ids |= frozenset((user or {}).get("enrolled_courses") or [])
+    # Read after the token was issued, so current for (at least) its version
+    membership_cache.set(user_id, (min_version, course_ids))
+    return course_ids
+
+async def user_is_enrolled(user_id: str, course_id: str, min_version: int = 0) -> bool:
+    """Whether the user has a completed enrollment in the course"""
+    return course_id in await get_enrolled_course_ids(user_id, min_version)
+
+def invalidate_membership(user_id: str):
+    membership_cache.invalidate(user_id)
+
+async def bump_membership_versions(user_ids: List[str]):
+    """Record that these users' completed enrollments changed, for tokens issued from now on"""
+    if len(user_ids) == 1:
+        await database.users.update_one({"id": user_ids[0]}, {"$inc": {"membership_version": 1}})
+    elif user_ids:
+        await database.users.update_many({"id": {"$in": user_ids}}, {"$inc": {"membership_version": 1}})
+    for user_id in user_ids:
+        invalidate_membership(user_id)
+
+# courses.student_count increments, coalesced per course and flushed periodically
+student_count_flusher = CounterFlusher(
+    database.courses, "student_count", interval=settings.counter_flush_interval_seconds
+)
+
+async def complete_free_enrollment(user_id: str, course: Dict[str, Any]) -> bool:
+    """Enroll a user in a free course with a single atomic upsert.
+
+    The upsert is keyed by the unique (user_id, course_id) index, so
+    concurrent or retried requests settle on one enrollment document and only
+    the request that completed it counts it. Returns False if the user was
+    already enrolled.
+    """
+    enrollment = Enrollment(user_id=user_id, course_id=course["id"], payment_status="completed")
+    try:
+        await database.enrollments.update_one(
+            {"user_id": user_id, "course_id": course["id"], "payment_status": {"$ne": "completed"}},
+            {
+                "$set": {"payment_status": "completed", "completed_at": enrollment.enrolled_at},
+                "$setOnInsert": enrollment.dict(exclude={"user_id", "course_id", "payment_status", "completed_at"})
+            },
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Already completed, or a concurrent request inserted the enrollment first
+        return False
+    
+    await bump_membership_versions([user_id])
+    student_count_flusher.add(course["id"])
+    await record_enrollment_rollup(course, enrollment.enrolled_at)
+    return True
+
+async def open_pending_enrollment(user_id: str, course_id: str) -> Optional[Dict[str, Any]]:
+    """Return the user's open enrollment in a paid course, creating it if needed.
+
+    One upsert keyed by the unique (user_id, course_id) index reuses a pending
+    or failed attempt and pushes its expiry out, so repeated clicks never add
+    rows. Returns None if the user already has a completed enrollment.
+    """
+    enrollment = Enrollment(user_id=user_id, course_id=course_id)
+    for _ in range(2):
+        expires_at = datetime.utcnow() + timedelta(seconds=settings.pending_enrollment_ttl_seconds)
+        try:
+            return await database.enrollments.find_one_and_update(
+                {"user_id": user_id, "course_id": course_id, "payment_status": {"$in": OPEN_PAYMENT_STATUSES}},
+                {
+                    "$set": {"payment_status": "pending", "expires_at": expires_at},
+                    "$setOnInsert": enrollment.dict(exclude={"user_id", "course_id", "payment_status", "expires_at"})
+                },
+                projection={"_id": 0},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Either the enrollment is completed, or a concurrent click inserted the
+            # pending one first and the retry will match it
+            continue
+    return None
+
+class BulkEnrollment:
+    """One cohort enrollment upload, processed a batch of rows at a time.
+
+    Each batch resolves its emails and unseen course ids with one $in query
+    each and enrolls with one unordered bulk_write of upserts keyed by the
+    unique (user_id, course_id) index; a duplicate key error marks a row whose
+    enrollment was already completed. Result rows are written per batch, so
+    memory is bounded by the batch size and the number of distinct courses.
+    student_count and the daily rollups are updated once per course per batch,
+    and each enrollment records the job that granted it.
+    """
+
+    def __init__(self, job_id: str, batch_size: int = BULK_ENROLL_BATCH_SIZE):
+        self.job_id = job_id
+        self.batch_size = batch_size
+        self.created_at = datetime.utcnow()
+        self.counts: Dict[str, int] = {status: 0 for status in BULK_ROW_STATUSES}
+        self.rows = 0
+        self._courses: Dict[str, Optional[Dict[str, Any]]] = {}
+
+    async def run(self, records: AsyncIterator[Tuple[int, Dict[str, Any]]]) -> Dict[str, Any]:
+        batch: List[Tuple[int, Dict[str, Any]]] = []
+        async for row_number, record in records:
+            batch.append((row_number, record))
+            if len(batch) >= self.batch_size:
+                await self._process(batch)
+                batch = []
+        if batch:
+            await self._process(batch)
+        return {"job_id": self.job_id, "rows": self.rows, "results": self.counts}
+
+    async def _process(self, batch: List[Tuple[int, Dict[str, Any]]]):
+        pairs = [
+            (row_number, str(record.get("email") or "").strip(), str(record.get("course_id") or "").strip())
+            for row_number, record in batch
+        ]
+        emails = list({email for _, email, course_id in pairs if email and course_id})
+        users = {
+            user["email"]: user["id"]
+            for user in await database.users.find({"email": {"$in": emails}}, {"_id": 0, "id": 1, "email": 1}).to_list(None)
+        }
+        unseen = list({course_id for _, _, course_id in pairs if course_id and course_id not in self._courses})
+        if unseen:
+            found = await database.courses.find(
+                {"id": {"$in": unseen}, "is_active": True}, {"_id": 0, "id": 1, "course_type": 1, "price": 1}
+            ).to_list(None)
+            self._courses.update({course_id: None for course_id in unseen})
+            self._courses.update({course["id"]: course for course in found})
+        
+        completed_at = datetime.utcnow()
+        results: List[Dict[str, Any]] = []
+        operations: List[UpdateOne] = []
+        pending: List[Tuple[Dict[str, Any], str]] = []
+        for row_number, email, course_id in pairs:
+            result = {
+                "job_id": self.job_id, "row": row_number, "email": email, "course_id": course_id,
+                "created_at": self.created_at
+            }
+            results.append(result)
+            if not email or not course_id:
+                result["status"] = "invalid"
+            elif email not in users:
+                result["status"] = "user_not_found"
+            elif self._courses.get(course_id) is None:
+                result["status"] = "course_not_found"
+            else:
+                enrollment = Enrollment(user_id=users[email], course_id=course_id, enrolled_at=self.created_at)
+                operations.append(UpdateOne(
+                    {"user_id": enrollment.user_id, "course_id": course_id, "payment_status": {"$ne": "completed"}},
+                    {
+                        "$set": {"payment_status": "completed", "completed_at": completed_at, "bulk_job_id": self.job_id},
+                        "$unset": {"expires_at": ""},
+                        "$setOnInsert": enrollment.dict(
+                            exclude={"user_id", "course_id", "payment_status", "expires_at", "completed_at", "bulk_job_id"}
+                        )
+                    },
+                    upsert=True
+                ))
+                pending.append((result, enrollment.user_id))
+        
+        already_completed = set()
+        if operations:
+            try:
+                await database.enrollments.bulk_write(operations, ordered=False)
+            except BulkWriteError as exc:
+                errors = exc.details.get("writeErrors", [])
+                if any(error.get("code") != 11000 for error in errors):
+                    raise
+                already_completed = {error["index"] for error in errors}
+        
+        enrolled_users = set()
+        enrolled_per_course: Dict[str, int] = defaultdict(int)
+        for index, (result, user_id) in enumerate(pending):
+            if index in already_completed:
+                result["status"] = "already_enrolled"
+            else:
+                result["status"] = "enrolled"
+                enrolled_per_course[result["course_id"]] += 1
+                enrolled_users.add(user_id)
+        await bump_membership_versions(list(enrolled_users))
+        for course_id, enrolled in enrolled_per_course.items():
+            student_count_flusher.add(course_id, enrolled)
+            # Granted by an admin, so nothing was charged whatever the course's price
+            await record_enrollment_rollup(self._courses[course_id], completed_at, amount=0, count=enrolled)
+        
+        for result in results:
+            self.counts[result["status"]] += 1
+        self.rows += len(results)
+        await database[BULK_ROW_COLLECTION].insert_many(results)
+
+async def run_bulk_enrollment(records: AsyncIterator[Tuple[int, Dict[str, Any]]], created_by: str) -> Dict[str, Any]:
+    """Run a cohort upload as a recorded job; returns its summary.
+
+    The job document is marked failed (and the error re-raised) if the
+    upload cannot be read to the end; rows already processed stay enrolled.
+    """
+    job = BulkEnrollment(str(uuid.uuid4()))
+    await database[BULK_JOB_COLLECTION].insert_one({
+        "id": job.job_id, "created_by": created_by, "created_at": job.created_at, "status": "running"
+    })
+    try:
+        summary = await job.run(records)
+    except Exception as exc:
+        await database[BULK_JOB_COLLECTION].update_one(
+            {"id": job.job_id},
+            {"$set": {"status": "failed", "error": str(exc), "rows": job.rows, "results": job.counts}}
+        )
+        raise
+    await database[BULK_JOB_COLLECTION].update_one(
+        {"id": job.job_id},
+        {"$set": {"status": "completed", "finished_at": datetime.utcnow(), "rows": job.rows, "results": job.counts}}
+    )
+    return summary
+
+def expired_enrollment_query(now: datetime) -> Dict[str, Any]:
+    return {
+        "payment_status": {"$in": OPEN_PAYMENT_STATUSES},
+        "$or": [
+            {"expires_at": {"$lt": now}},
+            # Attempts created before expires_at was recorded
+            {"expires_at": None, "enrolled_at": {"$lt": now - timedelta(seconds=settings.pending_enrollment_ttl_seconds)}},
+        ]
+    }
+
+async def archive_expired_enrollments(batch_size: int = SWEEP_BATCH_SIZE) -> int:
+    """Move expired pending and failed enrollments into the archive collection.
+
+    Each batch is copied before it is deleted, and the delete re-checks the
+    expiry, so an attempt reopened or completed meanwhile stays live (its
+    archive copy is dropped). Safe to run from several workers at once.
+    Returns the number of enrollments archived.
+    """
+    archive = database[ARCHIVE_COLLECTION]
+    archived = 0
+    while True:
+        now = datetime.utcnow()
+        batch = await database.enrollments.find(expired_enrollment_query(now), {"_id": 0}).limit(batch_size).to_list(None)
+        if not batch:
+            return archived
+        
+        ids = [enrollment["id"] for enrollment in batch]
+        await archive.bulk_write([
+            ReplaceOne({"id": enrollment["id"]}, {**enrollment, "archived_at": now}, upsert=True)
+            for enrollment in batch
+        ], ordered=False)
+        result = await database.enrollments.delete_many({**expired_enrollment_query(now), "id": {"$in": ids}})
+        if result.deleted_count < len(ids):
+            still_live = await database.enrollments.distinct("id", {"id": {"$in": ids}})
+            await archive.delete_many({"id": {"$in": still_live}})
+        archived += result.deleted_count
+        
+        if len(batch) < batch_size:
+            return archived
+
+async def run_enrollment_sweeper(interval: float):
+    while True:
+        try:
+            archived = await archive_expired_enrollments()
+            if archived:
+                logger.info("Archived %d expired pending enrollments", archived)
+        except PyMongoError as exc:
+            logger.error("Could not archive expired enrollments: %s", exc)
+        await asyncio.sleep(interval)
+
+def schedule_enrollment_sweeper() -> asyncio.Task:
+    """Start archiving expired pending enrollments every sweep interval"""
+    return asyncio.get_running_loop().create_task(
+        run_enrollment_sweeper(settings.pending_enrollment_sweep_interval_seconds)
+    )
+
+async def rebuild_student_counts() -> int:
+    """Recount courses.student_count from completed enrollments; returns courses updated"""
+    counts = await database.enrollments.aggregate([
+        {"$match": {"payment_status": "completed"}},
+        {"$group": {"_id": "$course_id", "count": {"$sum": 1}}},
+    ]).to_list(None)
+    updated = 0
+    if counts:
+        result = await database.courses.bulk_write([
+            UpdateOne({"id": row["_id"]}, {"$set": {"student_count": row["count"]}}) for row in counts
+        ], ordered=False)
+        updated += result.modified_count
+    result = await database.courses.update_many(
+        {"id": {"$nin": [row["_id"] for row in counts]}, "student_count": {"$ne": 0}},
+        {"$set": {"student_count": 0}}
+    )
+    return updated + result.modified_count
+
+def enrollment_rank(enrollment: Dict[str, Any]):
+    # Completed enrollments win, then the oldest
+    return (enrollment.get("payment_status") != "completed", enrollment.get("enrolled_at") or datetime.max)
+
+def merge_duplicates_update(kept: Dict[str, Any], duplicates: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Update folding the duplicates' progress and payment reference into the kept enrollment"""
+    enrollments = [kept, *duplicates]
+    fields: Dict[str, Any] = {"progress": max(enrollment.get("progress") or 0.0 for enrollment in enrollments)}
+    latest = max(enrollments, key=lambda enrollment: enrollment.get("last_accessed_at") or datetime.min)
+    if latest.get("last_accessed_at") is not None:
+        for field in ("last_accessed_at", "last_lesson_id", "last_position_seconds"):
+            fields[field] = latest.get(field)
+    if not kept.get("transaction_id"):
+        paid = next((enrollment for enrollment in duplicates if enrollment.get("transaction_id")), None)
+        if paid is not None:
+            fields["transaction_id"] = paid["transaction_id"]
+            fields["payment_method"] = paid.get("payment_method")
+    completed_lessons = sorted({
+        lesson_id for enrollment in enrollments for lesson_id in enrollment.get("completed_lessons") or []
+    })
+    return {"$set": fields, "$addToSet": {"completed_lessons": {"$each": completed_lessons}}}
+
+async def merge_duplicate_enrollments() -> int:
+    """Merge duplicate (user_id, course_id) enrollments so their unique index can be built.
+
+    Keeps the completed enrollment if there is one, otherwise the oldest, and
+    folds the others into it: completed lessons are united, progress and the
+    last playback position take the furthest, and a missing transaction_id is
+    taken from a duplicate. Payments of a duplicate are pointed at the kept
+    enrollment. Each duplicate is copied into the archive collection (with
+    merged_into) before it is deleted. Returns the number of enrollments merged.
+    """
+    archive = database[ARCHIVE_COLLECTION]
+    pipeline = [
+        {"$group": {
+            "_id": {"user_id": "$user_id", "course_id": "$course_id"},
+            "ids": {"$push": "$id"},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+    merged = 0
+    async for group in database.enrollments.aggregate(pipeline, allowDiskUse=True):
+        enrollments = await database.enrollments.find({"id": {"$in": group["ids"]}}, {"_id": 0}).to_list(None)
+        kept, *duplicates = sorted(enrollments, key=enrollment_rank)
+        duplicate_ids = [enrollment["id"] for enrollment in duplicates]
+        now = datetime.utcnow()
+        await archive.bulk_write([
+            ReplaceOne(
+                {"id": enrollment["id"]},
+                {**enrollment, "archived_at": now, "archive_reason": "duplicate", "merged_into": kept["id"]},
+                upsert=True
+            )
+            for enrollment in duplicates
+        ], ordered=False)
+        await database.enrollments.update_one({"id": kept["id"]}, merge_duplicates_update(kept, duplicates))
+        await database.payments.update_many({"enrollment_id": {"$in": duplicate_ids}}, {"$set": {"enrollment_id": kept["id"]}})
+        result = await database.enrollments.delete_many({"id": {"$in": duplicate_ids}})
+        merged += result.deleted_count
+        logger.warning(
+            "Merged duplicate enrollments %s of user %s in course %s into %s",
+            duplicate_ids, group["_id"]["user_id"], group["_id"]["course_id"], kept["id"]
+        )
+    return merged
+
+async def migrate_enrolled_courses(batch_size: int = MIGRATION_BATCH_SIZE) -> int:
+    """Move users' embedded enrolled_courses arrays into completed enrollments.
+
+    Each listed course gets a completed enrollment (created if missing) before
+    the array is unset, so an interrupted run can simply be repeated. Returns
+    the number of users migrated.
+    """
+    migrated = 0
+    cursor = database.users.find(
+        {"enrolled_courses": {"$exists": True}}, {"_id": 0, "id": 1, "enrolled_courses": 1}
+    ).batch_size(batch_size)
+    async for user in cursor:
+        course_ids: List[str] = user.get("enrolled_courses") or []
+        if course_ids:
+            try:
+                await database.enrollments.bulk_write([
+                    UpdateOne(
+                        {"user_id": user["id"], "course_id": course_id},
+                        {
+                            "$set": {"payment_status": "completed"},
+                            "$setOnInsert": {
+                                "id": str(uuid.uuid4()),
+                                "enrolled_at": datetime.utcnow(),
+                                "progress": 0.0,
+                                "completed_lessons": []
+                            }
+                        },
+                        upsert=True
+                    )
+                    for course_id in course_ids
+                ], ordered=False)
+            except BulkWriteError as exc:
+                # Another worker's backfill created the same enrollment
+                if any(error.get("code") != 11000 for error in exc.details.get("writeErrors", [])):
+                    raise
+        await database.users.update_one({"id": user["id"]}, {"$unset": {"enrolled_courses": ""}})
+        migrated += 1
+    return migrated
+
+async def backfill_enrolled_courses():
+    """Move legacy enrolled_courses arrays into enrollments; runs in the background at startup"""
+    global enrolled_courses_migrated
+    try:
+        migrated = await migrate_enrolled_courses()
+        if migrated:
+            logger.info("Moved enrolled_courses of %d users into enrollments", migrated)
+            await rebuild_student_counts()
+    except PyMongoError as exc:
+        logger.error("Could not move enrolled_courses into enrollments: %s", exc)
+        return
+    enrolled_courses_migrated = True
+
+def schedule_enrolled_courses_backfill() -> asyncio.Task:
+    return asyncio.get_running_loop().create_task(backfill_enrolled_courses())
+
+async def migrate():
+    merged = await merge_duplicate_enrollments()
+    migrated = await migrate_enrolled_courses()
+    recounted = await rebuild_student_counts()
+    return merged, migrated, recounted
+
+if __name__ == "__main__":
+    # Usage: python -m backend.database.enrollments
+    # Merges duplicate enrollments (archiving them) so the unique (user_id, course_id)
+    # index can be built; run it when the index bootstrap reports that index failing
+    logging.basicConfig(level=logging.INFO)
+    duplicates_merged, users_migrated, courses_recounted = asyncio.run(migrate())
+    print(f"Merged {duplicates_merged} duplicate enrollments into enrollments_archive")
+    print(f"Moved enrolled_courses of {users_migrated} users into enrollments")
+    print(f"Recounted student_count on {courses_recounted} courses")
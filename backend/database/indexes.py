@@ -0,0 +1,193 @@
+import asyncio
+import logging
+from typing import Any, Dict, List
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import PyMongoError
+from .connection import database
+from ..config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Indexes every query path relies on, keyed by collection
+REQUIRED_INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel(
+            [("is_active", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+            name="is_active_created_at_id"
+        ),
+    ],
+    "courses": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel(
+            [("is_active", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+            name="is_active_created_at_id"
+        ),
+    ],
+    "enrollments": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("course_id", ASCENDING), ("payment_status", ASCENDING)], name="course_id_payment_status"),
+        IndexModel([("user_id", ASCENDING), ("payment_status", ASCENDING)], name="user_id_payment_status"),
+        IndexModel([("user_id", ASCENDING), ("course_id", ASCENDING)], name="user_id_course_id_unique", unique=True),
+        IndexModel([("payment_status", ASCENDING), ("enrolled_at", DESCENDING)], name="payment_status_enrolled_at"),
+        IndexModel([("enrolled_at", DESCENDING), ("id", DESCENDING)], name="enrolled_at_id"),
+        IndexModel([("payment_status", ASCENDING), ("expires_at", ASCENDING)], name="payment_status_expires_at"),
+        # Only paid enrollments carry a transaction_id; reconciliation scans them in its order
+        IndexModel(
+            [("transaction_id", ASCENDING)], name="transaction_id",
+            partialFilterExpression={"transaction_id": {"$type": "string"}}
+        ),
+    ],
+    "payments": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("transaction_id", ASCENDING)], name="transaction_id_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("idempotency_key", ASCENDING)], name="user_id_idempotency_key_unique", unique=True),
+    ],
+    # Gateway notification inbox: one callback per distinct body of a transaction, claimed by due time
+    "payment_callbacks": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel(
+            [("transaction_id", ASCENDING), ("form_digest", ASCENDING)], name="transaction_id_form_digest_unique", unique=True
+        ),
+        IndexModel([("status", ASCENDING), ("available_at", ASCENDING)], name="status_available_at"),
+        IndexModel(
+            [("processed_at", ASCENDING)], name="processed_at_ttl",
+            expireAfterSeconds=settings.payment_inbox_retention_seconds
+        ),
+    ],
+    # Revoked token ids, kept until the token itself expires
+    "revoked_tokens": [
+        IndexModel([("jti", ASCENDING)], name="jti_unique", unique=True),
+        IndexModel([("token_type", ASCENDING), ("revoked_at", ASCENDING)], name="token_type_revoked_at"),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "enrollments_archive": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    # Bulk enrollment reports expire after the retention period
+    "bulk_enrollment_jobs": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel(
+            [("created_at", ASCENDING)], name="created_at_ttl",
+            expireAfterSeconds=settings.bulk_enrollment_report_retention_seconds
+        ),
+    ],
+    "bulk_enrollment_rows": [
+        IndexModel([("job_id", ASCENDING), ("row", ASCENDING)], name="job_id_row"),
+        IndexModel(
+            [("created_at", ASCENDING)], name="created_at_ttl",
+            expireAfterSeconds=settings.bulk_enrollment_report_retention_seconds
+        ),
+    ],
+    # Reconciliation reports expire after the retention period
+    "reconciliation_runs": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel(
+            [("created_at", ASCENDING)], name="created_at_ttl",
+            expireAfterSeconds=settings.reconciliation_report_retention_seconds
+        ),
+    ],
+    "reconciliation_mismatches": [
+        IndexModel([("run_id", ASCENDING), ("kind", ASCENDING)], name="run_id_kind"),
+        IndexModel(
+            [("created_at", ASCENDING)], name="created_at_ttl",
+            expireAfterSeconds=settings.reconciliation_report_retention_seconds
+        ),
+    ],
+    "lessons": [
+        IndexModel([("course_id", ASCENDING), ("order", ASCENDING)], name="course_id_order"),
+        IndexModel([("course_id", ASCENDING), ("id", ASCENDING)], name="course_id_id_unique", unique=True),
+    ],
+    "daily_rollups": [
+        IndexModel(
+            [("day", ASCENDING), ("course_id", ASCENDING), ("course_type", ASCENDING)],
+            name="day_course_id_course_type_unique",
+            unique=True
+        ),
+    ],
+}
+
+# Migrations that clean up existing data a unique index would reject. They change or
+# archive documents, so they are never run implicitly; a failed build names the command.
+INDEX_MIGRATIONS = {
+    ("enrollments", "user_id_course_id_unique"): "python -m backend.database.enrollments",
+}
+
+# Indexes dropped at startup because a required index replaced them
+RETIRED_INDEXES: Dict[str, List[str]] = {
+    "payment_callbacks": ["transaction_id_unique"],
+}
+
+async def ensure_indexes() -> Dict[str, List[str]]:
+    """Create any required index that is missing.
+
+    Indexes are built one at a time, so one failure (for example duplicate
+    emails blocking the unique index) is logged without stopping the rest,
+    even on the same collection. A unique index that existing data violates
+    is left unbuilt until its migration in INDEX_MIGRATIONS has been run.
+    Indexes in RETIRED_INDEXES are dropped first.
+    Returns the names of the indexes created per collection.
+    """
+    created: Dict[str, List[str]] = {}
+    for collection_name, indexes in REQUIRED_INDEXES.items():
+        collection = database[collection_name]
+        try:
+            existing = await collection.index_information()
+        except PyMongoError as exc:
+            logger.error("Could not read indexes on %s: %s", collection_name, exc)
+            continue
+        for name in RETIRED_INDEXES.get(collection_name, []):
+            if name not in existing:
+                continue
+            try:
+                await collection.drop_index(name)
+                logger.info("Dropped retired index %s on %s", name, collection_name)
+            except PyMongoError as exc:
+                logger.error("Could not drop retired index %s on %s: %s", name, collection_name, exc)
+        for index in indexes:
+            name = index.document["name"]
+            if name in existing:
+                continue
+            try:
+                created.setdefault(collection_name, []).extend(await collection.create_indexes([index]))
+                logger.info("Created index %s on %s", name, collection_name)
+            except PyMongoError as exc:
+                logger.error("Could not create index %s on %s: %s", name, collection_name, exc)
+                migration = INDEX_MIGRATIONS.get((collection_name, name))
+                if migration is not None:
+                    logger.error("Run `%s` to migrate the data blocking index %s", migration, name)
+    return created
+
+async def report_indexes() -> Dict[str, Dict[str, List[str]]]:
+    """Report required indexes that are missing and existing indexes never used since server start"""
+    report: Dict[str, Dict[str, List[str]]] = {}
+    for collection_name, indexes in REQUIRED_INDEXES.items():
+        collection = database[collection_name]
+        try:
+            existing = await collection.index_information()
+            stats: List[Dict[str, Any]] = await collection.aggregate([{"$indexStats": {}}]).to_list(None)
+        except PyMongoError as exc:
+            logger.error("Could not read index stats for %s: %s", collection_name, exc)
+            continue
+        
+        missing = [index.document["name"] for index in indexes if index.document["name"] not in existing]
+        unused = [
+            stat["name"] for stat in stats
+            if stat["name"] != "_id_" and stat.get("accesses", {}).get("ops", 0) == 0
+        ]
+        report[collection_name] = {"missing": missing, "unused": unused}
+        if missing:
+            logger.warning("Missing indexes on %s: %s", collection_name, missing)
+        if unused:
+            logger.info("Unused indexes on %s: %s", collection_name, unused)
+    return report
+
+async def bootstrap_indexes():
+    """Ensure and report indexes; meant to run as a background task at startup"""
+    await ensure_indexes()
+    await report_indexes()
+
+def schedule_index_bootstrap() -> asyncio.Task:
+    """Start the index bootstrap without blocking application startup"""
+    return asyncio.get_running_loop().create_task(bootstrap_indexes())
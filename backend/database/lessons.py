@@ -0,0 +1,255 @@
+import asyncio
+from typing import Any, Dict, List, Optional
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from .connection import database
+from ..config.settings import settings
+from ..utils.cache import TTLCache
+from ..utils.helpers import get_video_embed_url
+
+# Lessons live in their own collection, one document per lesson carrying its
+# course_id, indexed on (course_id, order) and (course_id, id)
+LESSON_COLLECTION = "lessons"
+MIGRATION_BATCH_SIZE = 100
+MAX_LESSON_BATCH_SIZE = 500
+
+# Lesson documents as they appeared embedded in a course
+LESSON_PROJECTION = {"_id": 0, "course_id": 0}
+
+# Lesson ids of each course, so hot paths such as heartbeats check a lesson without
+# a read. Invalidated by this process's lesson writes; an id missing from a cached set
+# is re-read before it is rejected, so a lesson added by another worker is found at once.
+lesson_ids_cache = TTLCache(maxsize=settings.lesson_ids_cache_size, ttl=settings.lesson_ids_cache_ttl_seconds)
+
+# Course fields derived from its lessons, maintained by every lesson write:
+# lesson_count, total_duration and preview_lessons (the preview subset, in order)
+
+def lesson_document(lesson: Dict[Any, Any], course_id: str) -> Dict[Any, Any]:
+    """Stored form of a lesson: its fields plus course_id and a precomputed embed_url"""
+    return {
+        **lesson,
+        "embed_url": get_video_embed_url(lesson["video_url"], lesson["video_type"]),
+        "course_id": course_id
+    }
+
+def preview_entry(lesson_doc: Dict[Any, Any]) -> Dict[Any, Any]:
+    return {key: value for key, value in lesson_doc.items() if key not in ("_id", "course_id")}
+
+async def apply_lessons_added(course_id: str, lesson_docs: List[Dict[Any, Any]]):
+    """Fold newly inserted lessons into the course's derived fields with one update"""
+    update: Dict[str, Any] = {"$inc": {
+        "lesson_count": len(lesson_docs),
+        "total_duration": sum(lesson.get("duration") or 0 for lesson in lesson_docs)
+    }}
+    previews = [preview_entry(lesson) for lesson in lesson_docs if lesson.get("is_preview")]
+    if previews:
+        update["$push"] = {"preview_lessons": {"$each": previews, "$sort": {"order": 1}}}
+    await database.courses.update_one({"id": course_id}, update)
+    lesson_ids_cache.invalidate(course_id)
+
+async def refresh_preview_lessons(course_id: str):
+    """Rebuild preview_lessons after a lesson edit, delete or reorder"""
+    previews = await database[LESSON_COLLECTION].find(
+        {"course_id": course_id, "is_preview": True}, LESSON_PROJECTION
+    ).sort("order", 1).to_list(None)
+    await database.courses.update_one({"id": course_id}, {"$set": {"preview_lessons": previews}})
+
+async def recompute_course_lesson_fields(course_id: str):
+    """Recompute every derived field of one course from its lessons (backfill and repair)"""
+    lessons = await database[LESSON_COLLECTION].find({"course_id": course_id}, {"_id": 0}).sort("order", 1).to_list(None)
+    missing_embeds = [
+        UpdateOne(
+            {"course_id": course_id, "id": lesson["id"]},
+            {"$set": {"embed_url": get_video_embed_url(lesson["video_url"], lesson["video_type"])}}
+        )
+        for lesson in lessons if "embed_url" not in lesson
+    ]
+    if missing_embeds:
+        await database[LESSON_COLLECTION].bulk_write(missing_embeds, ordered=False)
+    lessons = [lesson_document(lesson, course_id) for lesson in lessons]
+    await database.courses.update_one({"id": course_id}, {"$set": {
+        "lesson_count": len(lessons),
+        "total_duration": sum(lesson.get("duration") or 0 for lesson in lessons),
+        "preview_lessons": [preview_entry(lesson) for lesson in lessons if lesson.get("is_preview")]
+    }})
+
+async def get_course_lessons(course: Dict[Any, Any]) -> List[Dict[Any, Any]]:
+    """Lessons of one course in order, via the (course_id, order) index"""
+    lessons = await database[LESSON_COLLECTION].find(
+        {"course_id": course["id"]}, LESSON_PROJECTION
+    ).sort("order", 1).to_list(None)
+    return lessons or course.get("lessons", [])
+
+async def attach_lessons(courses: List[Dict[Any, Any]]) -> List[Dict[Any, Any]]:
+    """Fill `lessons` on each course from the lessons collection in one query.
+
+    Keeps course responses shaped as they were when lessons were embedded;
+    a course whose lessons have not been migrated keeps its embedded array.
+    """
+    if not courses:
+        return courses
+    by_course: Dict[str, List[Dict[Any, Any]]] = {}
+    cursor = database[LESSON_COLLECTION].find(
+        {"course_id": {"$in": [course["id"] for course in courses]}},
+        {"_id": 0}
+    ).sort([("course_id", 1), ("order", 1)])
+    async for lesson in cursor:
+        by_course.setdefault(lesson.pop("course_id"), []).append(lesson)
+    for course in courses:
+        course["lessons"] = by_course.get(course["id"]) or course.get("lessons", [])
+    return courses
+
+async def find_lesson(course_id: str, lesson_id: str) -> Optional[Dict[Any, Any]]:
+    """Single lesson lookup through the (course_id, id) index.
+
+    Falls back to the embedded array of a course not migrated yet.
+    """
+    lesson = await database[LESSON_COLLECTION].find_one({"course_id": course_id, "id": lesson_id}, LESSON_PROJECTION)
+    if lesson is not None:
+        return lesson
+    course = await database.courses.find_one(
+        {"id": course_id, "lessons.id": lesson_id}, {"_id": 0, "lessons": {"$elemMatch": {"id": lesson_id}}}
+    )
+    return course["lessons"][0] if course else None
+
+async def course_has_lesson(course_id: str, lesson_id: str) -> bool:
+    """Whether the course has the lesson, from lesson_ids_cache when the id is cached"""
+    lesson_ids = lesson_ids_cache.get(course_id)
+    if lesson_ids is not None and lesson_id in lesson_ids:
+        return True
+    stored = await database[LESSON_COLLECTION].distinct("id", {"course_id": course_id})
+    course = await database.courses.find_one({"id": course_id}, {"_id": 0, "lessons.id": 1})  # Not migrated yet
+    lesson_ids = frozenset(stored) | frozenset(lesson["id"] for lesson in (course or {}).get("lessons", []))
+    lesson_ids_cache.set(course_id, lesson_ids)
+    return lesson_id in lesson_ids
+
+async def next_lesson_order(course_id: str) -> int:
+    """Order for a lesson appended to the course, read from the top of the (course_id, order) index"""
+    last = await database[LESSON_COLLECTION].find_one(
+        {"course_id": course_id}, {"_id": 0, "order": 1}, sort=[("order", -1)]
+    )
+    return last["order"] + 1 if last else 1
+
+def lesson_order_counter_id(course_id: str) -> str:
+    return f"lesson_order:{course_id}"
+
+async def reserve_lesson_orders(course_id: str, count: int = 1) -> int:
+    """Atomically reserve `count` contiguous lesson orders; returns the first one.
+
+    Backed by a per-course sequence in the `counters` collection, so concurrent
+    adds never share an order. A missing sequence is seeded from the current
+    highest order; the unique _id makes a concurrent seed a no-op.
+    """
+    counter_id = lesson_order_counter_id(course_id)
+    counter = await database.counters.find_one_and_update(
+        {"_id": counter_id}, {"$inc": {"value": count}}, return_document=ReturnDocument.AFTER
+    )
+    if counter is None:
+        try:
+            await database.counters.insert_one({"_id": counter_id, "value": await next_lesson_order(course_id) - 1})
+        except DuplicateKeyError:
+            pass
+        counter = await database.counters.find_one_and_update(
+            {"_id": counter_id}, {"$inc": {"value": count}}, return_document=ReturnDocument.AFTER
+        )
+    return counter["value"] - count + 1
+
+async def reorder_lessons(course_id: str, lesson_ids: List[str]) -> bool:
+    """Rewrite lesson orders to follow `lesson_ids` (1..n) in one bulk write.
+
+    Returns False without writing unless `lesson_ids` lists exactly the
+    course's lessons, each once.
+    """
+    existing = await database[LESSON_COLLECTION].distinct("id", {"course_id": course_id})
+    if len(lesson_ids) != len(set(lesson_ids)) or set(lesson_ids) != set(existing):
+        return False
+    if lesson_ids:
+        await database[LESSON_COLLECTION].bulk_write([
+            UpdateOne({"course_id": course_id, "id": lesson_id}, {"$set": {"order": order}})
+            for order, lesson_id in enumerate(lesson_ids, start=1)
+        ], ordered=False)
+    # Keep the sequence at or above the highest order now in use
+    await database.counters.update_one(
+        {"_id": lesson_order_counter_id(course_id)}, {"$max": {"value": len(lesson_ids)}}, upsert=True
+    )
+    await refresh_preview_lessons(course_id)
+    return True
+
+async def move_embedded_lessons(course_id: str, lessons: List[Dict[Any, Any]]):
+    """Move one course's embedded lessons into the lessons collection.
+
+    Embedded lessons keep their orders; lessons already in the collection
+    (appended before the course was migrated) are moved after them, and the
+    order sequence is raised past both. Idempotent: lessons are upserted by
+    (course_id, id) and the shift only touches orders still in the embedded
+    range, so an interrupted move can simply be repeated. The embedded array
+    is unset last.
+    """
+    embedded = [
+        {**lesson, "order": lesson.get("order") or position}
+        for position, lesson in enumerate(lessons, start=1)
+    ]
+    last_embedded = max(lesson["order"] for lesson in embedded)
+    await database[LESSON_COLLECTION].update_many(
+        {"course_id": course_id, "id": {"$nin": [lesson["id"] for lesson in embedded]}, "order": {"$lte": last_embedded}},
+        {"$inc": {"order": last_embedded}}
+    )
+    await database[LESSON_COLLECTION].bulk_write([
+        UpdateOne(
+            {"course_id": course_id, "id": lesson["id"]},
+            {"$setOnInsert": lesson_document(lesson, course_id)},
+            upsert=True
+        )
+        for lesson in embedded
+    ], ordered=False)
+    await database.counters.update_one(
+        {"_id": lesson_order_counter_id(course_id)}, {"$max": {"value": await next_lesson_order(course_id) - 1}}, upsert=True
+    )
+    await database.courses.update_one({"id": course_id}, {"$unset": {"lessons": ""}})
+    await recompute_course_lesson_fields(course_id)
+
+async def migrate_course_lessons(course_id: str) -> bool:
+    """Move the course's embedded lessons, if it still has any, before a lesson write.
+
+    Without this, the first lesson written to the collection would hide the
+    embedded ones and restart the order sequence. Returns True if lessons
+    were moved.
+    """
+    course = await database.courses.find_one(
+        {"id": course_id, "lessons.0": {"$exists": True}}, {"_id": 0, "lessons": 1}
+    )
+    if course is None:
+        return False
+    await move_embedded_lessons(course_id, course["lessons"])
+    return True
+
+async def migrate_embedded_lessons(batch_size: int = MIGRATION_BATCH_SIZE) -> int:
+    """Move embedded course lessons into the lessons collection; returns the number of courses migrated"""
+    migrated = 0
+    cursor = database.courses.find(
+        {"lessons.0": {"$exists": True}}, {"_id": 0, "id": 1, "lessons": 1}
+    ).batch_size(batch_size)
+    async for course in cursor:
+        await move_embedded_lessons(course["id"], course["lessons"])
+        migrated += 1
+    return migrated
+
+async def backfill_course_lesson_fields(batch_size: int = MIGRATION_BATCH_SIZE) -> int:
+    """Initialise derived lesson fields on courses that predate them"""
+    backfilled = 0
+    cursor = database.courses.find({"lesson_count": {"$exists": False}}, {"_id": 0, "id": 1}).batch_size(batch_size)
+    async for course in cursor:
+        await recompute_course_lesson_fields(course["id"])
+        backfilled += 1
+    return backfilled
+
+async def migrate():
+    migrated = await migrate_embedded_lessons()
+    backfilled = await backfill_course_lesson_fields()
+    return migrated, backfilled
+
+if __name__ == "__main__":
+    # Usage: python -m backend.database.lessons
+    courses_migrated, courses_backfilled = asyncio.run(migrate())
+    print(f"Migrated lessons of {courses_migrated} courses into {LESSON_COLLECTION}")
+    print(f"Backfilled derived lesson fields on {courses_backfilled} courses")
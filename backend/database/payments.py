@@ -0,0 +1,505 @@
+import asyncio
+import hashlib
+import json
+import logging
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+import httpx
+from fastapi import HTTPException
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from .connection import database
+from .enrollments import bump_membership_versions, open_pending_enrollment, student_count_flusher
+from .rollups import record_enrollment_rollup
+from ..config.settings import settings
+from ..external_integrations import gateway_stub
+from ..external_integrations.sslcommerz import (
+    FAILED_STATUSES, LIVE_URL, SANDBOX_URL, VALID_STATUSES, GatewayError, SSLCommerzClient
+)
+from ..models import Payment, PaymentCallback, PaymentMethod
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_COLLECTION = "payments"
+CALLBACK_COLLECTION = "payment_callbacks"
+
+# What a client may see of a payment; the raw gateway responses stay server-side
+PAYMENT_PROJECTION = {"_id": 0, "gateway_response": 0, "idempotency_key": 0}
+
+_gateway: Optional[SSLCommerzClient] = None
+
+def get_gateway() -> SSLCommerzClient:
+    """Shared gateway client, created on first use so its pool lives on the serving loop"""
+    global _gateway
+    if _gateway is None:
+        transport = None
+        base_url = settings.sslcommerz_base_url or (SANDBOX_URL if settings.sslcommerz_is_sandbox else LIVE_URL)
+        if settings.payment_gateway == "stub":
+            transport = httpx.ASGITransport(app=gateway_stub.app)
+            base_url = "http://gateway-stub"
+        _gateway = SSLCommerzClient(
+            settings.sslcommerz_store_id,
+            settings.sslcommerz_store_password,
+            base_url=base_url,
+            timeout=settings.payment_gateway_timeout_seconds,
+            max_retries=settings.payment_gateway_max_retries,
+            max_connections=settings.payment_gateway_max_connections,
+            transport=transport
+        )
+    return _gateway
+
+async def close_gateway():
+    global _gateway
+    if _gateway is not None:
+        await _gateway.aclose()
+        _gateway = None
+
+# Payments that can no longer be paid; their idempotency key may be reused for a retry
+RETRYABLE_PAYMENT_STATUSES = ("failed", "cancelled")
+
+async def find_idempotent_payment(user_id: str, idempotency_key: str) -> Optional[Dict[str, Any]]:
+    """The payment made under an idempotency key, or None if there is none or it failed.
+
+    A failed payment is moved off the key so the retry can take it; of
+    concurrent retries only one inserts, the others find its payment.
+    """
+    existing = await database[PAYMENT_COLLECTION].find_one(
+        {"user_id": user_id, "idempotency_key": idempotency_key}, PAYMENT_PROJECTION
+    )
+    if existing is None or existing["status"] not in RETRYABLE_PAYMENT_STATUSES:
+        return existing
+    await database[PAYMENT_COLLECTION].update_one(
+        {"id": existing["id"], "idempotency_key": idempotency_key},
+        {"$set": {"idempotency_key": f"{idempotency_key}:retried:{existing['id']}"}}
+    )
+    return None
+
+async def initiate_payment(
+    user: Dict[str, Any],
+    course: Dict[str, Any],
+    payment_method: PaymentMethod,
+    idempotency_key: Optional[str] = None
+) -> Dict[str, Any]:
+    """Open a gateway checkout session for a paid course.
+
+    Payments are unique on (user_id, idempotency_key): repeating a request
+    with the same key returns the payment it created instead of charging
+    again, unless that payment failed. Without a key the user's open
+    enrollment is the key, so repeated calls share one payable payment.
+    """
+    if idempotency_key:
+        existing = await find_idempotent_payment(user["id"], idempotency_key)
+        if existing:
+            return existing
+
+    enrollment = await open_pending_enrollment(user["id"], course["id"])
+    if enrollment is None:
+        raise HTTPException(status_code=400, detail="Already enrolled in this course")
+    if not idempotency_key:
+        idempotency_key = f"enrollment:{enrollment['id']}"
+        existing = await find_idempotent_payment(user["id"], idempotency_key)
+        if existing:
+            return existing
+
+    payment = Payment(
+        user_id=user["id"],
+        course_id=course["id"],
+        enrollment_id=enrollment["id"],
+        amount=course["price"],
+        payment_method=payment_method
+    )
+    payment.transaction_id = payment.id  # tran_id sent to the gateway
+    payment_doc = {**payment.dict(), "idempotency_key": idempotency_key}
+    try:
+        await database[PAYMENT_COLLECTION].insert_one(payment_doc)
+    except DuplicateKeyError:
+        # A concurrent request with the same key got there first
+        return await database[PAYMENT_COLLECTION].find_one(
+            {"user_id": user["id"], "idempotency_key": idempotency_key}, PAYMENT_PROJECTION
+        )
+
+    try:
+        session = await get_gateway().create_session({
+            "total_amount": f"{payment.amount:.2f}",
+            "currency": payment.currency,
+            "tran_id": payment.transaction_id,
+            "success_url": f"{settings.payment_return_url}?payment_id={payment.id}",
+            "fail_url": f"{settings.payment_return_url}?payment_id={payment.id}",
+            "cancel_url": f"{settings.payment_return_url}?payment_id={payment.id}",
+            "ipn_url": f"{settings.public_api_url}/api/payments/ipn",
+            "multi_card_name": payment.payment_method.value,
+            "product_name": course.get("title", "Course"),
+            "product_category": "Education",
+            "product_profile": "non-physical-goods",
+            "shipping_method": "NO",
+            "cus_name": user.get("full_name", ""),
+            "cus_email": user.get("email", ""),
+            "cus_phone": user.get("phone") or "N/A",
+            "cus_add1": "N/A",
+            "cus_city": "N/A",
+            "cus_country": "Bangladesh",
+            "value_a": payment.enrollment_id
+        })
+    except GatewayError as exc:
+        await database[PAYMENT_COLLECTION].update_one(
+            {"id": payment.id},
+            {"$set": {"status": "failed", "gateway_response": {"error": str(exc)}, "updated_at": datetime.utcnow()}}
+        )
+        raise HTTPException(status_code=502, detail="Payment gateway unavailable, please try again")
+
+    updates = {"gateway_session_key": session.get("sessionkey"), "gateway_url": session["GatewayPageURL"], "updated_at": datetime.utcnow()}
+    await database[PAYMENT_COLLECTION].update_one({"id": payment.id}, {"$set": updates})
+    return await database[PAYMENT_COLLECTION].find_one({"id": payment.id}, PAYMENT_PROJECTION)
+
+def validation_matches(payment: Dict[str, Any], validation: Dict[str, Any]) -> bool:
+    """Whether the gateway's validation answer confirms this payment as paid in full"""
+    try:
+        amount_matches = abs(float(validation.get("amount", 0)) - payment["amount"]) < 0.01
+    except (TypeError, ValueError):
+        return False
+    return (
+        validation.get("status") in VALID_STATUSES
+        and validation.get("tran_id") == payment["transaction_id"]
+        and amount_matches
+        and validation.get("currency", payment["currency"]) == payment["currency"]
+    )
+
+def validated_failure(payment: Dict[str, Any], validation: Dict[str, Any]) -> Optional[str]:
+    """"failed" or "cancelled" if the gateway's validation answer says this payment did not go through"""
+    if validation.get("tran_id") != payment["transaction_id"]:
+        return None
+    return FAILED_STATUSES.get(validation.get("status"))
+
+def callback_digest(form: Dict[str, str]) -> str:
+    """Stable digest of a notification body"""
+    return hashlib.sha256(json.dumps(form, sort_keys=True).encode()).hexdigest()
+
+async def record_callback(form: Dict[str, str]) -> bool:
+    """Append a gateway notification to the inbox; False if it is a duplicate.
+
+    Callbacks are unique on (transaction_id, body), so gateway retries of the
+    same notification are dropped here, as is anything for a transaction a
+    callback already completed. A different body for a transaction (a failed
+    attempt, or a forged body, followed by the genuine success) is queued as
+    its own callback and validated on its own; none ever replaces another, so
+    a forged body cannot displace the genuine notification.
+    """
+    callback = PaymentCallback(transaction_id=form["tran_id"], form_digest=callback_digest(form), form=form)
+    if await database[CALLBACK_COLLECTION].find_one(
+        {"transaction_id": callback.transaction_id, "outcome": "completed"}, {"_id": 1}
+    ) is not None:
+        payment_inbox.duplicates += 1
+        return False
+    try:
+        result = await database[CALLBACK_COLLECTION].update_one(
+            {"transaction_id": callback.transaction_id, "form_digest": callback.form_digest},
+            {"$setOnInsert": callback.dict(exclude={"transaction_id", "form_digest"})},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # A concurrent delivery of the same notification got there first
+        return False
+    if result.upserted_id is None:
+        payment_inbox.duplicates += 1
+        return False
+    
+    payment_inbox.notify()
+    return True
+
+class PaymentInbox:
+    """Worker pool draining the payment_callbacks inbox in batches.
+
+    Each worker claims up to `batch_size` due callbacks by pushing their
+    available_at out by `lease_seconds`, so a callback held by a worker that
+    died is picked up again once its lease runs out; a batch that raises is
+    released for a retry straight away. A batch reads its payments with one
+    $in query, validates every callback with the gateway concurrently, and
+    writes payments, enrollments and the callbacks themselves with one bulk
+    write each. Only the validation answer changes a payment: a callback
+    without a val_id, or whose validation neither confirms nor fails the
+    payment, is recorded as "unverified" and leaves the payment as it was.
+    Only enrollments that were not completed yet are counted. Callbacks whose
+    validation could not reach the gateway are retried later, up to
+    `max_attempts` claims.
+    """
+
+    def __init__(
+        self,
+        workers: int = 2,
+        batch_size: int = 100,
+        poll_interval: float = 1.0,
+        lease_seconds: float = 60.0,
+        max_attempts: int = 8,
+        retry_seconds: float = 30.0
+    ):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self.duplicates = 0
+        self.batches = 0
+        self.processed = 0
+        self.settled = 0
+        self.retried = 0
+        self.dead = 0
+        self.failures = 0
+    
+    def notify(self):
+        """Wake the workers of this process instead of waiting for the next poll"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+    
+    async def claim(self) -> List[Dict[str, Any]]:
+        now = datetime.utcnow()
+        due = {"status": {"$in": ["queued", "processing"]}, "available_at": {"$lte": now}}
+        candidates = await database[CALLBACK_COLLECTION].find(due, {"_id": 0, "id": 1}).sort(
+            "available_at", 1
+        ).limit(self.batch_size).to_list(None)
+        if not candidates:
+            return []
+        
+        token = uuid.uuid4().hex
+        await database[CALLBACK_COLLECTION].update_many(
+            {**due, "id": {"$in": [candidate["id"] for candidate in candidates]}},
+            {
+                "$set": {"status": "processing", "claim": token, "available_at": now + timedelta(seconds=self.lease_seconds)},
+                "$inc": {"attempts": 1}
+            }
+        )
+        return await database[CALLBACK_COLLECTION].find({"claim": token, "status": "processing"}, {"_id": 0}).to_list(None)
+    
+    async def process(self, callbacks: List[Dict[str, Any]]) -> Dict[str, str]:
+        """Settle one claimed batch; returns each callback's outcome by id"""
+        now = datetime.utcnow()
+        payments = {
+            payment["transaction_id"]: payment
+            for payment in await database[PAYMENT_COLLECTION].find(
+                {"transaction_id": {"$in": [callback["transaction_id"] for callback in callbacks]}}, {"_id": 0}
+            ).to_list(None)
+        }
+        
+        outcomes: Dict[str, str] = {}
+        failed: List[Tuple[Dict[str, Any], str, Dict[str, Any]]] = []
+        to_validate: List[Tuple[Dict[str, Any], Dict[str, Any]]] = []
+        resettled: List[Tuple[Dict[str, Any], None]] = []
+        for callback in callbacks:
+            payment = payments.get(callback["transaction_id"])
+            if payment is None:
+                outcomes[callback["id"]] = "unknown_transaction"
+            elif payment["status"] == "completed":
+                # A no-op unless an earlier attempt stopped before completing the enrollment
+                outcomes[callback["id"]] = "completed"
+                resettled.append((payment, None))
+            elif not callback["form"].get("val_id"):
+                outcomes[callback["id"]] = "unverified"
+            else:
+                to_validate.append((callback, payment))
+        
+        # The notification body is never trusted on its own, whatever status it claims
+        validations = await asyncio.gather(
+            *(get_gateway().validate(callback["form"].get("val_id", "")) for callback, _ in to_validate),
+            return_exceptions=True
+        )
+        settled: List[Tuple[Dict[str, Any], Dict[str, Any]]] = []
+        retry: Dict[str, str] = {}
+        for (callback, payment), validation in zip(to_validate, validations):
+            if isinstance(validation, GatewayError):
+                retry[callback["id"]] = str(validation)
+            elif isinstance(validation, BaseException):
+                raise validation
+            elif validation_matches(payment, validation):
+                outcomes[callback["id"]] = "completed"
+                settled.append((payment, validation))
+            elif validated_failure(payment, validation):
+                outcomes[callback["id"]] = validated_failure(payment, validation)
+                failed.append((payment, outcomes[callback["id"]], validation))
+            else:
+                outcomes[callback["id"]] = "unverified"
+        
+        await self._write_payments(settled, failed, now)
+        await self._complete_enrollments(settled + resettled, now)
+        if failed:
+            await database.enrollments.update_many(
+                {"id": {"$in": [payment["enrollment_id"] for payment, _, _ in failed]}, "payment_status": "pending"},
+                {"$set": {"payment_status": "failed"}}
+            )
+        await self._write_callbacks(callbacks, outcomes, retry, now)
+        return outcomes
+    
+    async def _write_payments(self, settled, failed, now: datetime):
+        operations = [
+            UpdateOne(
+                {"id": payment["id"], "status": {"$ne": "completed"}},
+                {"$set": {
+                    "status": "completed",
+                    "gateway_transaction_id": validation.get("bank_tran_id") or validation.get("val_id"),
+                    "gateway_response": validation,
+                    "completed_at": now,
+                    "updated_at": now
+                }}
+            )
+            for payment, validation in settled
+        ] + [
+            UpdateOne(
+                {"id": payment["id"], "status": "pending"},
+                {"$set": {"status": status, "gateway_response": response, "updated_at": now}}
+            )
+            for payment, status, response in failed
+        ]
+        if operations:
+            await database[PAYMENT_COLLECTION].bulk_write(operations, ordered=False)
+    
+    async def _complete_enrollments(self, settled, now: datetime):
+        """Complete the enrollment of each settled payment, recreating one archived meanwhile"""
+        if not settled:
+            return
+        operations = [
+            UpdateOne(
+                {"user_id": payment["user_id"], "course_id": payment["course_id"], "payment_status": {"$ne": "completed"}},
+                {
+                    "$set": {
+                        "payment_status": "completed",
+                        "completed_at": now,
+                        "transaction_id": payment["transaction_id"],
+                        "payment_method": payment["payment_method"]
+                    },
+                    "$unset": {"expires_at": ""},
+                    "$setOnInsert": {"id": payment["enrollment_id"], "enrolled_at": now, "progress": 0.0, "completed_lessons": []}
+                },
+                upsert=True
+            )
+            for payment, _ in settled
+        ]
+        already_completed = set()
+        try:
+            await database.enrollments.bulk_write(operations, ordered=False)
+        except BulkWriteError as exc:
+            # The upsert hits the unique (user_id, course_id) index when the
+            # enrollment is already completed
+            errors = exc.details.get("writeErrors", [])
+            if any(error.get("code") != 11000 for error in errors):
+                raise
+            already_completed = {error["index"] for error in errors}
+        
+        enrolled: Dict[Tuple[str, float], int] = defaultdict(int)
+        enrolled_users = set()
+        for index, (payment, _) in enumerate(settled):
+            if index in already_completed:
+                continue
+            enrolled_users.add(payment["user_id"])
+            student_count_flusher.add(payment["course_id"])
+            enrolled[(payment["course_id"], payment["amount"])] += 1
+        self.settled += sum(enrolled.values())
+        await bump_membership_versions(list(enrolled_users))
+        
+        courses = {
+            course["id"]: course
+            for course in await database.courses.find(
+                {"id": {"$in": list({course_id for course_id, _ in enrolled})}},
+                {"_id": 0, "id": 1, "course_type": 1, "price": 1}
+            ).to_list(None)
+        }
+        for (course_id, amount), count in enrolled.items():
+            if course_id in courses:
+                await record_enrollment_rollup(courses[course_id], now, amount=amount, count=count)
+    
+    async def _write_callbacks(self, callbacks, outcomes: Dict[str, str], retry: Dict[str, str], now: datetime):
+        operations = []
+        for callback in callbacks:
+            if callback["id"] in outcomes:
+                update = {"status": "processed", "outcome": outcomes[callback["id"]], "processed_at": now}
+            elif callback["attempts"] >= self.max_attempts:
+                update = {"status": "failed", "last_error": retry[callback["id"]], "processed_at": now}
+                self.dead += 1
+                logger.error("Giving up on payment callback for %s: %s", callback["transaction_id"], retry[callback["id"]])
+            else:
+                update = {
+                    "status": "queued",
+                    "last_error": retry[callback["id"]],
+                    "available_at": now + timedelta(seconds=self.retry_seconds * callback["attempts"])
+                }
+                self.retried += 1
+            operations.append(UpdateOne({"id": callback["id"], "claim": callback["claim"]}, {"$set": update}))
+        await database[CALLBACK_COLLECTION].bulk_write(operations, ordered=False)
+        self.processed += len(outcomes)
+    
+    async def _release(self, callbacks, exc: Exception):
+        """Queue a batch whose processing raised for a retry, counting the attempt"""
+        error = f"{type(exc).__name__}: {exc}"
+        try:
+            await self._write_callbacks(callbacks, {}, {callback["id"]: error for callback in callbacks}, datetime.utcnow())
+        except PyMongoError as release_error:
+            # They become due again once their lease runs out
+            logger.error("Could not release payment callbacks: %s", release_error)
+    
+    async def drain(self) -> int:
+        """Process batches until no callback is due; returns the callbacks processed"""
+        total = 0
+        while True:
+            callbacks = await self.claim()
+            if not callbacks:
+                return total
+            try:
+                await self.process(callbacks)
+            except Exception as exc:
+                await self._release(callbacks, exc)
+                raise
+            self.batches += 1
+            total += len(callbacks)
+    
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.drain()
+            except Exception as exc:  # The failed batch was released; keep the worker alive
+                self.failures += 1
+                logger.error("Could not process payment callbacks: %s", exc)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+    
+    def start(self) -> List[asyncio.Task]:
+        """Start the worker pool on the running loop"""
+        if not self._tasks:
+            self._wakeup = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            self._tasks = [loop.create_task(self._run()) for _ in range(self.workers)]
+        return self._tasks
+    
+    async def stop(self):
+        """Stop the workers; callbacks they held are retried after their lease"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._wakeup = None
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": len(self._tasks),
+            "duplicates": self.duplicates,
+            "batches": self.batches,
+            "processed": self.processed,
+            "settled": self.settled,
+            "retried": self.retried,
+            "dead": self.dead,
+            "failures": self.failures
+        }
+
+# Gateway notifications, acknowledged on receipt and settled by the workers
+payment_inbox = PaymentInbox(
+    workers=settings.payment_inbox_workers,
+    batch_size=settings.payment_inbox_batch_size,
+    poll_interval=settings.payment_inbox_poll_interval_seconds,
+    lease_seconds=settings.payment_inbox_lease_seconds,
+    max_attempts=settings.payment_inbox_max_attempts,
+    retry_seconds=settings.payment_inbox_retry_seconds
+)
@@ -0,0 +1,60 @@
+from datetime import datetime
+from typing import Any, Dict, Optional
+from pymongo import ReturnDocument
+from .connection import database
+from ..config.settings import settings
+from ..utils.heartbeats import HeartbeatBuffer
+
+# Playback heartbeats, coalesced per enrollment and flushed periodically
+heartbeat_buffer = HeartbeatBuffer(
+    database.enrollments,
+    interval=settings.heartbeat_flush_interval_seconds,
+    max_entries=settings.heartbeat_buffer_max_entries
+)
+
+PROGRESS_PROJECTION = {
+    "_id": 0,
+    "progress": 1,
+    "completed_lessons": 1,
+    "last_accessed_at": 1,
+    "last_lesson_id": 1,
+    "last_position_seconds": 1
+}
+
+async def complete_lesson(user_id: str, course_id: str, lesson_id: str, lesson_count: int) -> Optional[Dict[str, Any]]:
+    """Mark a lesson completed and recompute progress in the same update.
+
+    Progress is the size of completed_lessons against the course's stored
+    lesson_count, so no lesson documents are read. Returns the updated
+    progress fields, or None if the user has no completed enrollment.
+    """
+    now = datetime.utcnow()
+    return await database.enrollments.find_one_and_update(
+        {"user_id": user_id, "course_id": course_id, "payment_status": "completed"},
+        [
+            {"$set": {
+                "completed_lessons": {"$setUnion": [{"$ifNull": ["$completed_lessons", []]}, [lesson_id]]},
+                "last_accessed_at": {"$max": ["$last_accessed_at", now]},
+                "last_lesson_id": lesson_id
+            }},
+            {"$set": {"progress": {"$min": [
+                100,
+                {"$multiply": [100, {"$divide": [{"$size": "$completed_lessons"}, max(lesson_count, 1)]}]}
+            ]}}},
+        ],
+        projection=PROGRESS_PROJECTION,
+        return_document=ReturnDocument.AFTER
+    )
+
+async def get_progress(user_id: str, course_id: str) -> Optional[Dict[str, Any]]:
+    """Stored progress of an enrollment, overlaid with this worker's unflushed heartbeat"""
+    progress = await database.enrollments.find_one(
+        {"user_id": user_id, "course_id": course_id, "payment_status": "completed"}, PROGRESS_PROJECTION
+    )
+    if progress is None:
+        return None
+
+    pending = heartbeat_buffer.pending(user_id, course_id)
+    if pending and pending["last_accessed_at"] > (progress.get("last_accessed_at") or datetime.min):
+        progress.update(pending)
+    return progress
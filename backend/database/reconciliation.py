@@ -0,0 +1,282 @@
+import argparse
+import asyncio
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from .connection import database
+from .payments import PAYMENT_COLLECTION
+from ..external_integrations.sslcommerz import VALID_STATUSES
+from ..utils.ingest import iter_lines, parse_csv_records, read_file_chunks
+
+RUN_COLLECTION = "reconciliation_runs"
+MISMATCH_COLLECTION = "reconciliation_mismatches"
+REPORT_BATCH_SIZE = 1000
+CURSOR_BATCH_SIZE = 1000
+
+# Settlement files are CSV sorted by tran_id (e.g. `LC_ALL=C sort`), with a header naming
+# at least tran_id and amount, or headerless in this column order
+SETTLEMENT_COLUMNS = ["tran_id", "amount", "currency", "status"]
+SETTLEMENT_REQUIRED_COLUMNS = ["tran_id", "amount"]
+
+MISMATCH_KINDS = [
+    "invalid_settlement_row",      # no tran_id, or an amount that is not a number
+    "duplicate_transaction",       # a tran_id repeated in the file or in a collection
+    "unknown_transaction",         # settled by the gateway, no payment recorded
+    "payment_not_completed",       # settled by the gateway, payment still pending/failed
+    "payment_not_settled",         # payment completed, gateway reports another status
+    "missing_from_settlement",     # payment completed in the period, absent from the file
+    "amount_mismatch",             # gateway amount or currency differs from the payment
+    "enrollment_mismatch",         # enrollment of the transaction is for another user/course or not completed
+    "membership_missing",          # payment completed, user has no completed enrollment in the course
+    "duplicate_payment",           # payment completed, user enrolled through another transaction
+    "enrollment_without_payment",  # enrollment completed by a transaction with no completed payment
+]
+
+async def next_or_none(iterator: AsyncIterator) -> Optional[Any]:
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return None
+
+async def merge_join(*sources: AsyncIterator[Tuple[str, Dict[str, Any]]]) -> AsyncIterator[Tuple[str, List[Optional[Dict[str, Any]]]]]:
+    """Full outer join of (key, document) streams that are each sorted by a unique key.
+
+    Yields (key, [document or None per source]) in key order, holding only
+    the current head of each source.
+    """
+    heads = [await next_or_none(source) for source in sources]
+    while any(head is not None for head in heads):
+        key = min(head[0] for head in heads if head is not None)
+        documents: List[Optional[Dict[str, Any]]] = []
+        for index, head in enumerate(heads):
+            if head is not None and head[0] == key:
+                documents.append(head[1])
+                heads[index] = await next_or_none(sources[index])
+            else:
+                documents.append(None)
+        yield key, documents
+
+class Reconciliation:
+    """One run comparing payments and enrollments against a gateway settlement file.
+
+    Payments and enrollments are read as cursors sorted on their
+    transaction_id indexes and merge-joined with the sorted settlement rows,
+    so memory stays constant whatever the number of rows. Completed payments
+    whose enrollment is not found by transaction id are checked against the
+    user's membership in batches of $in queries. Mismatches are written to
+    reconciliation_mismatches in batches.
+
+    `since`/`until` bound the settlement period: a completed payment missing
+    from the file is only reported if it completed inside it.
+    """
+
+    def __init__(self, run_id: str, since: Optional[datetime] = None, until: Optional[datetime] = None):
+        self.run_id = run_id
+        self.since = since
+        self.until = until
+        self.created_at = datetime.utcnow()
+        self.counts = {"settlement_rows": 0, "payments": 0, "enrollments": 0}
+        self.mismatches: Dict[str, int] = defaultdict(int)
+        self._report: List[Dict[str, Any]] = []
+        self._unmatched: List[Dict[str, Any]] = []
+
+    async def report(self, kind: str, transaction_id: Optional[str], **details):
+        self.mismatches[kind] += 1
+        self._report.append({
+            "run_id": self.run_id, "kind": kind, "transaction_id": transaction_id,
+            "created_at": self.created_at, **details
+        })
+        if len(self._report) >= REPORT_BATCH_SIZE:
+            await self._flush_report()
+
+    async def _flush_report(self):
+        if self._report:
+            await database[MISMATCH_COLLECTION].insert_many(self._report, ordered=False)
+            self._report = []
+
+    async def _unique(self, source: str, items: AsyncIterator[Tuple[str, Dict[str, Any]]]):
+        """Drop repeats of a key (reporting them) and check the source is sorted"""
+        previous: Optional[str] = None
+        async for key, document in items:
+            if previous is not None and key < previous:
+                raise ValueError(f"{source} is not sorted by transaction id at {key!r}")
+            if key == previous:
+                await self.report("duplicate_transaction", key, source=source)
+                continue
+            previous = key
+            yield key, document
+
+    async def _settlement_rows(self, records: AsyncIterator[Tuple[int, Dict[str, Any]]]):
+        async for row_number, record in records:
+            self.counts["settlement_rows"] += 1
+            tran_id = (record.get("tran_id") or "").strip()
+            try:
+                amount = float(record.get("amount") or "")
+            except ValueError:
+                amount = None
+            if not tran_id or amount is None:
+                await self.report("invalid_settlement_row", tran_id or None, row=row_number)
+                continue
+            yield tran_id, {
+                "row": row_number,
+                "amount": amount,
+                "currency": (record.get("currency") or "").strip() or None,
+                "status": (record.get("status") or "VALID").strip().upper()
+            }
+
+    async def _payments(self):
+        cursor = database[PAYMENT_COLLECTION].find(
+            {"transaction_id": {"$type": "string"}},
+            {"_id": 0, "id": 1, "transaction_id": 1, "user_id": 1, "course_id": 1, "amount": 1, "currency": 1,
+             "status": 1, "completed_at": 1}
+        ).sort("transaction_id", 1).batch_size(CURSOR_BATCH_SIZE)
+        async for payment in cursor:
+            self.counts["payments"] += 1
+            yield payment["transaction_id"], payment
+
+    async def _enrollments(self):
+        cursor = database.enrollments.find(
+            {"transaction_id": {"$type": "string"}},
+            {"_id": 0, "id": 1, "transaction_id": 1, "user_id": 1, "course_id": 1, "payment_status": 1}
+        ).sort("transaction_id", 1).batch_size(CURSOR_BATCH_SIZE)
+        async for enrollment in cursor:
+            self.counts["enrollments"] += 1
+            yield enrollment["transaction_id"], enrollment
+
+    def _in_period(self, moment: Optional[datetime]) -> bool:
+        if moment is None:
+            return self.since is None and self.until is None
+        return (self.since is None or moment >= self.since) and (self.until is None or moment < self.until)
+
+    async def _compare(self, tran_id: str, payment, enrollment, settlement):
+        completed = payment is not None and payment["status"] == "completed"
+        ids = {"payment_id": payment["id"]} if payment else {}
+
+        if settlement is not None:
+            settled = settlement["status"] in VALID_STATUSES
+            if payment is None:
+                if settled:
+                    await self.report("unknown_transaction", tran_id, row=settlement["row"], amount=settlement["amount"])
+            elif settled and not completed:
+                await self.report("payment_not_completed", tran_id, **ids, row=settlement["row"], status=payment["status"])
+            elif completed and not settled:
+                await self.report("payment_not_settled", tran_id, **ids, row=settlement["row"], status=settlement["status"])
+            if payment is not None and settled and (
+                abs(settlement["amount"] - payment["amount"]) >= 0.01
+                or (settlement["currency"] or payment["currency"]) != payment["currency"]
+            ):
+                await self.report(
+                    "amount_mismatch", tran_id, **ids, row=settlement["row"],
+                    expected={"amount": payment["amount"], "currency": payment["currency"]},
+                    actual={"amount": settlement["amount"], "currency": settlement["currency"]}
+                )
+        elif completed and self._in_period(payment.get("completed_at")):
+            await self.report("missing_from_settlement", tran_id, **ids, amount=payment["amount"])
+
+        if enrollment is not None:
+            if not completed:
+                await self.report(
+                    "enrollment_without_payment", tran_id, enrollment_id=enrollment["id"],
+                    user_id=enrollment["user_id"], course_id=enrollment["course_id"], **ids
+                )
+            elif (
+                (enrollment["user_id"], enrollment["course_id"]) != (payment["user_id"], payment["course_id"])
+                or enrollment["payment_status"] != "completed"
+            ):
+                await self.report(
+                    "enrollment_mismatch", tran_id, **ids, enrollment_id=enrollment["id"],
+                    expected={"user_id": payment["user_id"], "course_id": payment["course_id"], "payment_status": "completed"},
+                    actual={key: enrollment.get(key) for key in ("user_id", "course_id", "payment_status")}
+                )
+        elif completed:
+            self._unmatched.append(payment)
+            if len(self._unmatched) >= REPORT_BATCH_SIZE:
+                await self._check_membership()
+
+    async def _check_membership(self):
+        """Resolve completed payments with no enrollment of their own against the user's membership"""
+        payments, self._unmatched = self._unmatched, []
+        if not payments:
+            return
+        enrolled = {
+            (enrollment["user_id"], enrollment["course_id"])
+            for enrollment in await database.enrollments.find(
+                {
+                    "user_id": {"$in": list({payment["user_id"] for payment in payments})},
+                    "course_id": {"$in": list({payment["course_id"] for payment in payments})},
+                    "payment_status": "completed"
+                },
+                {"_id": 0, "user_id": 1, "course_id": 1}
+            ).to_list(None)
+        }
+        for payment in payments:
+            kind = "duplicate_payment" if (payment["user_id"], payment["course_id"]) in enrolled else "membership_missing"
+            await self.report(
+                kind, payment["transaction_id"], payment_id=payment["id"],
+                user_id=payment["user_id"], course_id=payment["course_id"]
+            )
+
+    async def run(self, records: AsyncIterator[Tuple[int, Dict[str, Any]]]) -> Dict[str, Any]:
+        joined = merge_join(
+            self._unique("payments", self._payments()),
+            self._unique("enrollments", self._enrollments()),
+            self._unique("settlement file", self._settlement_rows(records))
+        )
+        async for tran_id, (payment, enrollment, settlement) in joined:
+            await self._compare(tran_id, payment, enrollment, settlement)
+        await self._check_membership()
+        await self._flush_report()
+        return self.summary()
+
+    def summary(self) -> Dict[str, Any]:
+        return {"run_id": self.run_id, **self.counts, "mismatches": dict(self.mismatches)}
+
+async def run_reconciliation(
+    records: AsyncIterator[Tuple[int, Dict[str, Any]]],
+    created_by: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+) -> Dict[str, Any]:
+    """Run a reconciliation as a recorded job; returns its summary.
+
+    `records` are settlement rows as parsed by parse_csv_records. The run is
+    marked failed (and the error re-raised) if the file cannot be read to the
+    end or is not sorted; mismatches found until then stay in the report.
+    """
+    job = Reconciliation(str(uuid.uuid4()), since=since, until=until)
+    await database[RUN_COLLECTION].insert_one({
+        "id": job.run_id, "created_by": created_by, "created_at": job.created_at,
+        "since": since, "until": until, "status": "running"
+    })
+    try:
+        summary = await job.run(records)
+    except Exception as exc:
+        await job._flush_report()
+        await database[RUN_COLLECTION].update_one(
+            {"id": job.run_id}, {"$set": {"status": "failed", "error": str(exc), **job.summary()}}
+        )
+        raise
+    await database[RUN_COLLECTION].update_one(
+        {"id": job.run_id}, {"$set": {"status": "completed", "finished_at": datetime.utcnow(), **summary}}
+    )
+    return summary
+
+def settlement_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+    """Settlement rows from a streamed CSV body or file"""
+    return parse_csv_records(iter_lines(chunks), columns=SETTLEMENT_COLUMNS, required=SETTLEMENT_REQUIRED_COLUMNS)
+
+if __name__ == "__main__":
+    # Usage: python -m backend.database.reconciliation settlement.csv [--since 2025-01-01] [--until 2025-01-02]
+    parser = argparse.ArgumentParser(description="Reconcile payments and enrollments against a settlement file")
+    parser.add_argument("settlement_file")
+    parser.add_argument("--since", type=datetime.fromisoformat)
+    parser.add_argument("--until", type=datetime.fromisoformat)
+    args = parser.parse_args()
+    result = asyncio.run(run_reconciliation(
+        settlement_records(read_file_chunks(args.settlement_file)), since=args.since, until=args.until
+    ))
+    print(f"Reconciliation {result['run_id']}: {result['settlement_rows']} settlement rows, "
+          f"{result['payments']} payments, {result['enrollments']} enrollments")
+    for kind, count in sorted(result["mismatches"].items()):
+        print(f"  {kind}: {count}")
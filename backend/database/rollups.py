@@ -0,0 +1,233 @@
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from .connection import database
+from .indexes import REQUIRED_INDEXES
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_COLLECTION = "daily_rollups"
+ROLLUP_JOURNAL_COLLECTION = "daily_rollup_journal"
+ROLLUP_LEASE_COLLECTION = "rollup_rebuild_leases"
+ROLLUP_BATCH_SIZE = 1000
+# Longer than any completion write takes to land, and than the clock skew between instances
+ROLLUP_REBUILD_GRACE_SECONDS = 30.0
+# Renewed after every batch; a rebuild that dies releases it once it runs out
+ROLLUP_REBUILD_LEASE_SECONDS = 600.0
+
+class RollupRebuildRunning(RuntimeError):
+    """Another instance holds the rebuild lease"""
+
+def rollup_day(moment: datetime) -> datetime:
+    """Truncate a timestamp to the UTC day it is rolled up under"""
+    return datetime(moment.year, moment.month, moment.day)
+
+def enrollment_revenue(course: Dict[Any, Any], amount: Optional[float] = None) -> float:
+    """Revenue contributed by one completed enrollment"""
+    if amount is not None:
+        return amount
+    if course.get("course_type") != "paid":
+        return 0
+    return course.get("price") or 0
+
+async def get_rebuild_lease() -> Optional[Dict[str, Any]]:
+    """The lease of the rebuild in progress, if any"""
+    return await database[ROLLUP_LEASE_COLLECTION].find_one(
+        {"_id": ROLLUP_COLLECTION, "expires_at": {"$gt": datetime.utcnow()}}
+    )
+
+async def record_enrollment_rollup(
+    course: Dict[Any, Any],
+    completed_at: Optional[datetime] = None,
+    amount: Optional[float] = None,
+    count: int = 1
+):
+    """Add completed enrollments to their day/course bucket.
+
+    Called from every write path that completes an enrollment (free enrollment,
+    payment settlement, bulk cohort enrollment) with the `completed_at` it
+    stamped on them; `amount` overrides the course list price when the payment
+    recorded what was actually charged, and `count` folds several enrollments
+    of the same course into one update. While a rebuild holds the lease,
+    enrollments completed before its cutoff are left to the rebuild and later
+    ones go to the journal it replays once the rebuilt buckets are live.
+    """
+    completed_at = completed_at or datetime.utcnow()
+    bucket = {"day": rollup_day(completed_at), "course_id": course["id"], "course_type": course["course_type"]}
+    increments = {"enrollments": count, "revenue": enrollment_revenue(course, amount) * count}
+
+    lease = await get_rebuild_lease()
+    if lease is None:
+        await database[ROLLUP_COLLECTION].update_one(bucket, {"$inc": increments}, upsert=True)
+    elif completed_at >= lease["cutoff"]:
+        await database[ROLLUP_JOURNAL_COLLECTION].insert_one({**bucket, **increments})
+
+async def get_rollup_totals(match: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Total completed enrollments and revenue across all rollup buckets"""
+    pipeline = [
+        {"$match": match or {}},
+        {"$group": {"_id": None, "enrollments": {"$sum": "$enrollments"}, "revenue": {"$sum": "$revenue"}}},
+    ]
+    rows = await database[ROLLUP_COLLECTION].aggregate(pipeline).to_list(None)
+    if not rows:
+        return {"enrollments": 0, "revenue": 0}
+    return {"enrollments": rows[0]["enrollments"], "revenue": rows[0]["revenue"]}
+
+async def paid_amounts(transaction_ids: List[str]) -> Dict[str, float]:
+    """Amount actually charged by each completed payment, keyed by transaction id"""
+    if not transaction_ids:
+        return {}
+    payments = await database.payments.find(
+        {"transaction_id": {"$in": transaction_ids}, "status": "completed"},
+        {"_id": 0, "transaction_id": 1, "amount": 1}
+    ).to_list(None)
+    return {payment["transaction_id"]: payment["amount"] for payment in payments}
+
+def rebuilt_revenue(course: Dict[Any, Any], enrollment: Dict[Any, Any], amounts: Dict[str, float]) -> float:
+    """Revenue of one historical enrollment: its completed payment, else nothing for a
+    bulk grant, else the course price (paid enrollments older than their payment records)"""
+    if enrollment.get("transaction_id") in amounts:
+        return amounts[enrollment["transaction_id"]]
+    if enrollment.get("bulk_job_id"):
+        return 0
+    return enrollment_revenue(course)
+
+async def replay_rollup_journal(batch_size: int = ROLLUP_BATCH_SIZE) -> int:
+    """Apply journaled increments to the live buckets; returns the number of entries replayed"""
+    journal = database[ROLLUP_JOURNAL_COLLECTION]
+    replayed = 0
+    while True:
+        entries = await journal.find({}).limit(batch_size).to_list(None)
+        if not entries:
+            return replayed
+        buckets: Dict[Tuple[datetime, str, str], Dict[str, float]] = defaultdict(lambda: {"enrollments": 0, "revenue": 0})
+        for entry in entries:
+            totals = buckets[(entry["day"], entry["course_id"], entry["course_type"])]
+            totals["enrollments"] += entry["enrollments"]
+            totals["revenue"] += entry["revenue"]
+        await database[ROLLUP_COLLECTION].bulk_write([
+            UpdateOne({"day": day, "course_id": course_id, "course_type": course_type}, {"$inc": totals}, upsert=True)
+            for (day, course_id, course_type), totals in buckets.items()
+        ], ordered=False)
+        await journal.delete_many({"_id": {"$in": [entry["_id"] for entry in entries]}})
+        replayed += len(entries)
+
+async def rebuild_daily_rollups(batch_size: int = ROLLUP_BATCH_SIZE, grace_seconds: Optional[float] = None) -> int:
+    """Recompute daily_rollups from the enrollment history without losing live writes.
+
+    The rebuild takes a lease whose cutoff is `grace_seconds` ahead and waits
+    until every enrollment completed before the cutoff has landed. Those are
+    streamed into a scratch collection, `batch_size` at a time with one
+    payments query per batch, and bucketed by the day they were completed.
+    Completions after the cutoff are journaled by the live path meanwhile.
+    The scratch collection then atomically replaces the live one, and the
+    journal is replayed into it until the lease has been released. Raises
+    RollupRebuildRunning while another rebuild holds the lease. Returns the
+    number of buckets written.
+    """
+    grace = timedelta(seconds=ROLLUP_REBUILD_GRACE_SECONDS if grace_seconds is None else grace_seconds)
+    leases = database[ROLLUP_LEASE_COLLECTION]
+    now = datetime.utcnow()
+    cutoff = now + grace
+    try:
+        await leases.find_one_and_update(
+            {"_id": ROLLUP_COLLECTION, "expires_at": {"$lte": now}},
+            {"$set": {"cutoff": cutoff, "expires_at": now + timedelta(seconds=ROLLUP_REBUILD_LEASE_SECONDS)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        raise RollupRebuildRunning(f"Another {ROLLUP_COLLECTION} rebuild is running")
+
+    async def renew_lease():
+        await leases.update_one(
+            {"_id": ROLLUP_COLLECTION, "cutoff": cutoff},
+            {"$set": {"expires_at": datetime.utcnow() + timedelta(seconds=ROLLUP_REBUILD_LEASE_SECONDS)}}
+        )
+
+    try:
+        # Left behind by a rebuild that died, and recounted below; nothing is journaled
+        # against this lease before its cutoff
+        await database[ROLLUP_JOURNAL_COLLECTION].delete_many({})
+        scratch = database[f"{ROLLUP_COLLECTION}_rebuild"]
+        await scratch.drop()
+        await scratch.create_indexes(REQUIRED_INDEXES[ROLLUP_COLLECTION])
+        await asyncio.sleep((cutoff + grace - datetime.utcnow()).total_seconds())
+
+        courses: Dict[str, Optional[Dict[str, Any]]] = {}
+        batch: List[Dict[Any, Any]] = []
+
+        async def flush():
+            amounts = await paid_amounts([
+                enrollment["transaction_id"] for enrollment in batch if enrollment.get("transaction_id")
+            ])
+            buckets: Dict[Tuple[datetime, str, str], Dict[str, float]] = defaultdict(lambda: {"enrollments": 0, "revenue": 0})
+            for enrollment in batch:
+                course = courses[enrollment["course_id"]]
+                totals = buckets[(
+                    rollup_day(enrollment.get("completed_at") or enrollment["enrolled_at"]),
+                    course["id"], course["course_type"]
+                )]
+                totals["enrollments"] += 1
+                totals["revenue"] += rebuilt_revenue(course, enrollment, amounts)
+            batch.clear()
+            if buckets:
+                await scratch.bulk_write([
+                    UpdateOne({"day": day, "course_id": course_id, "course_type": course_type}, {"$inc": totals}, upsert=True)
+                    for (day, course_id, course_type), totals in buckets.items()
+                ], ordered=False)
+            await renew_lease()
+
+        cursor = database.enrollments.find(
+            {"payment_status": "completed", "$or": [{"completed_at": {"$lt": cutoff}}, {"completed_at": None}]},
+            {"_id": 0, "course_id": 1, "enrolled_at": 1, "completed_at": 1, "transaction_id": 1, "bulk_job_id": 1}
+        ).batch_size(batch_size)
+        async for enrollment in cursor:
+            course_id = enrollment["course_id"]
+            if course_id not in courses:
+                courses[course_id] = await database.courses.find_one(
+                    {"id": course_id}, {"_id": 0, "id": 1, "course_type": 1, "price": 1}
+                )
+            if courses[course_id] is None:
+                continue
+            batch.append(enrollment)
+            if len(batch) >= batch_size:
+                await flush()
+        await flush()
+
+        written = await scratch.count_documents({})
+        await scratch.rename(ROLLUP_COLLECTION, dropTarget=True)
+        await replay_rollup_journal(batch_size)
+    finally:
+        await leases.delete_one({"_id": ROLLUP_COLLECTION, "cutoff": cutoff})
+    # Writers that read the lease just before it was released journal after the first replay
+    await asyncio.sleep(grace.total_seconds())
+    await replay_rollup_journal(batch_size)
+    return written
+
+async def backfill_daily_rollups():
+    """Rebuild daily_rollups when it is empty but completed enrollments exist; runs in the background at startup"""
+    try:
+        if await database[ROLLUP_COLLECTION].find_one({}) is not None:
+            return
+        if await database.enrollments.find_one({"payment_status": "completed"}) is None:
+            return
+        written = await rebuild_daily_rollups()
+        logger.info("Backfilled %s: %d buckets", ROLLUP_COLLECTION, written)
+    except RollupRebuildRunning:
+        return
+    except PyMongoError as exc:
+        logger.error("Could not backfill %s: %s", ROLLUP_COLLECTION, exc)
+
+def schedule_daily_rollups_backfill() -> asyncio.Task:
+    return asyncio.get_running_loop().create_task(backfill_daily_rollups())
+
+if __name__ == "__main__":
+    # Usage: python -m backend.database.rollups
+    # Safe while the API is serving; completions during the rebuild are replayed after the swap
+    logging.basicConfig(level=logging.INFO)
+    buckets_written = asyncio.run(rebuild_daily_rollups())
+    print(f"Rebuilt {ROLLUP_COLLECTION}: {buckets_written} buckets")
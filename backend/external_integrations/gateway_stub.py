@@ -0,0 +1,67 @@
+# Local stand-in for the SSLCommerz session and validation APIs.
+#
+# Lets the payment flow run end to end, including under load, without the
+# network: the payment service talks to it in process through an httpx ASGI
+# transport when PAYMENT_GATEWAY=stub, or it can be served on its own with
+# `uvicorn backend.external_integrations.gateway_stub:app` and reached through
+# SSLCOMMERZ_BASE_URL. Every session it opens is paid successfully; post
+# `ipn_payload(tran_id)` to the IPN endpoint to complete one.
+import asyncio
+import os
+import uuid
+from typing import Any, Dict
+from urllib.parse import parse_qsl
+from fastapi import FastAPI, Request
+
+STUB_LATENCY_SECONDS = float(os.environ.get('PAYMENT_STUB_LATENCY_MS', '0')) / 1000
+
+app = FastAPI(title="Payment gateway stub")
+
+# tran_id -> session fields, for the lifetime of the process
+sessions: Dict[str, Dict[str, Any]] = {}
+
+def stub_val_id(tran_id: str) -> str:
+    return f"stub-{tran_id}"
+
+def ipn_payload(tran_id: str) -> Dict[str, str]:
+    """The IPN form the gateway posts once the session for `tran_id` is paid"""
+    session = sessions[tran_id]
+    return {
+        "status": "VALID",
+        "tran_id": tran_id,
+        "val_id": stub_val_id(tran_id),
+        "amount": session["total_amount"],
+        "currency": session["currency"]
+    }
+
+@app.post("/gwprocess/v4/api.php")
+async def create_session(request: Request):
+    await asyncio.sleep(STUB_LATENCY_SECONDS)
+    fields = dict(parse_qsl((await request.body()).decode()))
+    if not fields.get("tran_id") or not fields.get("total_amount"):
+        return {"status": "FAILED", "failedreason": "tran_id and total_amount are required"}
+
+    session_key = uuid.uuid4().hex
+    sessions[fields["tran_id"]] = {**fields, "sessionkey": session_key}
+    return {
+        "status": "SUCCESS",
+        "sessionkey": session_key,
+        "GatewayPageURL": f"{request.base_url}pay/{session_key}"
+    }
+
+@app.get("/validator/api/validationserverAPI.php")
+async def validate(val_id: str):
+    await asyncio.sleep(STUB_LATENCY_SECONDS)
+    tran_id = val_id[len("stub-"):] if val_id.startswith("stub-") else None
+    session = sessions.get(tran_id)
+    if session is None:
+        return {"status": "INVALID_TRANSACTION", "val_id": val_id}
+    return {
+        "status": "VALID",
+        "tran_id": tran_id,
+        "val_id": val_id,
+        "amount": session["total_amount"],
+        "currency": session["currency"],
+        "bank_tran_id": f"stub-bank-{session['sessionkey']}",
+        "card_type": session.get("multi_card_name") or "STUB"
+    }
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import random
+from typing import Any, Dict, Optional
+import httpx
+
+logger = logging.getLogger(__name__)
+
+SANDBOX_URL = "https://sandbox.sslcommerz.com"
+LIVE_URL = "https://securepay.sslcommerz.com"
+SESSION_PATH = "/gwprocess/v4/api.php"
+VALIDATION_PATH = "/validator/api/validationserverAPI.php"
+VALID_STATUSES = ("VALID", "VALIDATED")
+# Validation statuses confirming a transaction did not go through, mapped to the payment status
+FAILED_STATUSES = {"FAILED": "failed", "CANCELLED": "cancelled"}
+
+class GatewayError(Exception):
+    """The payment gateway could not be reached or rejected the request"""
+
+class SSLCommerzClient:
+    """Async SSLCommerz client sharing one pooled HTTP client across requests.
+
+    Requests time out after `timeout` seconds and are retried with
+    exponential backoff and jitter on connection errors, timeouts and 5xx
+    responses, up to `max_retries` extra attempts. Pass an httpx transport
+    (such as one wrapping the local gateway stub) to run without the network.
+    """
+
+    def __init__(
+        self,
+        store_id: str,
+        store_password: str,
+        base_url: str = SANDBOX_URL,
+        timeout: float = 10.0,
+        max_retries: int = 2,
+        backoff: float = 0.25,
+        max_connections: int = 100,
+        transport: Optional[httpx.AsyncBaseTransport] = None
+    ):
+        self.store_id = store_id
+        self.store_password = store_password
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=httpx.Timeout(timeout, connect=min(timeout, 5.0)),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            transport=transport
+        )
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+
+    async def _request(self, method: str, path: str, **kwargs) -> Dict[str, Any]:
+        for attempt in range(self.max_retries + 1):
+            self.requests += 1
+            try:
+                response = await self._client.request(method, path, **kwargs)
+                if response.status_code < 500:
+                    response.raise_for_status()
+                    return response.json()
+                error: Exception = GatewayError(f"Gateway returned HTTP {response.status_code}")
+            except (httpx.TransportError, httpx.TimeoutException) as exc:
+                error = exc
+            except (httpx.HTTPStatusError, ValueError) as exc:
+                # 4xx or a body that is not JSON: retrying will not help
+                self.failures += 1
+                raise GatewayError(str(exc)) from exc
+
+            if attempt < self.max_retries:
+                self.retries += 1
+                await asyncio.sleep(self.backoff * (2 ** attempt) * (1 + random.random()))
+
+        self.failures += 1
+        logger.error("Gateway %s %s failed after %d attempts: %s", method, path, self.max_retries + 1, error)
+        raise GatewayError(str(error)) from error
+
+    async def create_session(self, fields: Dict[str, Any]) -> Dict[str, Any]:
+        """Open a hosted checkout session; returns the gateway response with GatewayPageURL"""
+        data = {"store_id": self.store_id, "store_passwd": self.store_password, **fields}
+        session = await self._request("POST", SESSION_PATH, data=data)
+        if session.get("status") != "SUCCESS" or not session.get("GatewayPageURL"):
+            raise GatewayError(session.get("failedreason") or "Gateway refused the session")
+        return session
+
+    async def validate(self, val_id: str) -> Dict[str, Any]:
+        """Look up a transaction by val_id with the gateway's validation API"""
+        return await self._request("GET", VALIDATION_PATH, params={
+            "val_id": val_id, "store_id": self.store_id, "store_passwd": self.store_password, "format": "json"
+        })
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"requests": self.requests, "retries": self.retries, "failures": self.failures}
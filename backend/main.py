@@ -1,4 +1,5 @@
-from fastapi import FastAPI
+import time
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 
@@ -6,11 +7,29 @@ import uvicorn
 from config.settings import settings
 
 # Import routes
-from routes import auth_router, courses_router, admin_router
+from routes import auth_router, courses_router, admin_router, payments_router
+from database.indexes import schedule_index_bootstrap
+from database.enrollments import schedule_enrolled_courses_backfill, schedule_enrollment_sweeper, student_count_flusher
+from database.progress import heartbeat_buffer
+from database.rollups import schedule_daily_rollups_backfill
+from database.payments import close_gateway, payment_inbox
+from routes.auth import AUTH_RATE_LIMITS, password_hasher, rate_limiter, revocation_list
+from utils.latency import request_latency
+from utils.ratelimit import RateLimitMiddleware
 
 # Create FastAPI app
 app = FastAPI(title=settings.app_name, debug=settings.debug)
 
+# Login and registration rate limits; added before CORS so 429s still carry CORS headers
+if settings.rate_limit_enabled:
+    app.add_middleware(
+        RateLimitMiddleware,
+        limiter=rate_limiter,
+        rules=AUTH_RATE_LIMITS,
+        trust_forwarded_for=settings.rate_limit_trust_forwarded_for,
+        trusted_proxies=[proxy.strip() for proxy in settings.rate_limit_trusted_proxies.split(",") if proxy.strip()]
+    )
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -20,6 +39,81 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    request_latency.record(f"{request.method} {route.path if route else 'unmatched'}", time.perf_counter() - started)
+    return response
+
+@app.on_event("startup")
+async def start_index_bootstrap():
+    # Runs in the background so a slow index build never delays startup
+    app.state.index_bootstrap = schedule_index_bootstrap()
+
+@app.on_event("startup")
+async def start_enrolled_courses_backfill():
+    app.state.enrolled_courses_backfill = schedule_enrolled_courses_backfill()
+
+@app.on_event("startup")
+async def start_daily_rollups_backfill():
+    app.state.daily_rollups_backfill = schedule_daily_rollups_backfill()
+
+@app.on_event("startup")
+async def start_counter_flusher():
+    student_count_flusher.start()
+
+@app.on_event("startup")
+async def start_heartbeat_buffer():
+    heartbeat_buffer.start()
+
+@app.on_event("startup")
+async def start_enrollment_sweeper():
+    app.state.enrollment_sweeper = schedule_enrollment_sweeper()
+
+@app.on_event("startup")
+async def start_payment_inbox():
+    payment_inbox.start()
+
+@app.on_event("startup")
+async def start_revocation_list():
+    revocation_list.start()
+
+@app.on_event("shutdown")
+async def stop_payment_inbox():
+    await payment_inbox.stop()
+
+@app.on_event("shutdown")
+async def stop_counter_flusher():
+    # Write increments still buffered in this worker before it exits
+    await student_count_flusher.stop()
+
+@app.on_event("shutdown")
+async def stop_heartbeat_buffer():
+    await heartbeat_buffer.stop()
+
+@app.on_event("shutdown")
+async def stop_enrollment_sweeper():
+    app.state.enrollment_sweeper.cancel()
+
+@app.on_event("shutdown")
+async def stop_revocation_list():
+    await revocation_list.stop()
+
+@app.on_event("shutdown")
+async def close_rate_limiter():
+    await rate_limiter.close()
+
+@app.on_event("shutdown")
+async def stop_password_hasher():
+    password_hasher.shutdown()
+
+@app.on_event("shutdown")
+async def close_payment_gateway():
+    # Release the pooled gateway connections
+    await close_gateway()
+
 # Health check endpoint
 @app.get("/api/health")
 async def health_check():
@@ -29,6 +123,7 @@ async def health_check():
 app.include_router(auth_router, prefix="/api")
 app.include_router(courses_router, prefix="/api")  
 app.include_router(admin_router, prefix="/api")
+app.include_router(payments_router, prefix="/api")
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
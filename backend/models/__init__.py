@@ -1,11 +1,11 @@
-from .user import User, UserRegister, UserLogin, UserRole
-from .course import Course, CourseCreate, CourseType, Lesson, LessonCreate
-from .enrollment import Enrollment
-from .payment import Payment, PaymentCreate, PaymentStatus
+from .user import LogoutRequest, RefreshRequest, User, UserRegister, UserLogin, UserRole
+from .course import Course, CourseCreate, CourseType, Lesson, LessonCreate, LessonReorder
+from .enrollment import Enrollment, LessonHeartbeat
+from .payment import Payment, PaymentCallback, PaymentCreate, PaymentMethod, PaymentStatus
 
 __all__ = [
-    "User", "UserRegister", "UserLogin", "UserRole",
-    "Course", "CourseCreate", "CourseType", "Lesson", "LessonCreate",
-    "Enrollment",
-    "Payment", "PaymentCreate", "PaymentStatus"
+    "LogoutRequest", "RefreshRequest", "User", "UserRegister", "UserLogin", "UserRole",
+    "Course", "CourseCreate", "CourseType", "Lesson", "LessonCreate", "LessonReorder",
+    "Enrollment", "LessonHeartbeat",
+    "Payment", "PaymentCallback", "PaymentCreate", "PaymentMethod", "PaymentStatus"
 ]
\ No newline at end of file
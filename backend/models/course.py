@@ -18,6 +18,7 @@ class Lesson(BaseModel):
     order: int
     is_preview: bool = False  # First lesson should be preview
     resources: List[str] = []  # Additional resources/attachments
+    embed_url: Optional[str] = None  # Precomputed from video_url when the lesson is written
 
 class LessonCreate(BaseModel):
     title: str
@@ -28,6 +29,9 @@ class LessonCreate(BaseModel):
     is_preview: bool = False
     resources: List[str] = []
 
+class LessonReorder(BaseModel):
+    lesson_ids: List[str]  # Every lesson of the course, in the new order
+
 class Course(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     title: str
@@ -38,7 +42,10 @@ class Course(BaseModel):
     price: Optional[float] = None  # BDT
     thumbnail_url: Optional[str] = None
     lessons: List[Lesson] = []
+    # Derived from the lessons collection, maintained by the lesson write paths
+    lesson_count: int = 0
     total_duration: Optional[int] = None  # in minutes
+    preview_lessons: List[Lesson] = []
     student_count: int = 0
     rating: Optional[float] = None
     rating_count: int = 0
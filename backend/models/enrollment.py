@@ -9,8 +9,16 @@ class Enrollment(BaseModel):
     course_id: str
     enrolled_at: datetime = Field(default_factory=datetime.utcnow)
     payment_status: str = "pending"  # pending, completed, failed
+    completed_at: Optional[datetime] = None  # Day it is rolled up under
+    bulk_job_id: Optional[str] = None  # Granted by a bulk enrollment job, so nothing was charged
+    expires_at: Optional[datetime] = None  # When an unpaid attempt is archived
     transaction_id: Optional[str] = None
     payment_method: Optional[str] = None  # bkash, nagad, card, etc.
     progress: float = 0.0  # 0-100 percentage
     completed_lessons: List[str] = []
-    last_accessed_at: Optional[datetime] = None
\ No newline at end of file
+    last_accessed_at: Optional[datetime] = None
+    last_lesson_id: Optional[str] = None  # Lesson of the latest playback heartbeat
+    last_position_seconds: Optional[int] = None
+
+class LessonHeartbeat(BaseModel):
+    position_seconds: int = Field(0, ge=0)  # Playback position within the lesson
\ No newline at end of file
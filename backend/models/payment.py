@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any
+from typing import Literal, Optional, Dict, Any
 from datetime import datetime
 from enum import Enum
 import uuid
@@ -37,4 +37,18 @@ class Payment(BaseModel):
 class PaymentCreate(BaseModel):
     course_id: str
     payment_method: PaymentMethod
-    amount: float
\ No newline at end of file
+    amount: float
+
+class PaymentCallback(BaseModel):
+    """A gateway notification waiting in the payment_callbacks inbox"""
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    transaction_id: str
+    form_digest: str  # Tells gateway retries of one notification from a different body
+    form: Dict[str, str]
+    status: Literal["queued", "processing", "processed", "failed"] = "queued"
+    outcome: Optional[str] = None
+    attempts: int = 0
+    last_error: Optional[str] = None
+    received_at: datetime = Field(default_factory=datetime.utcnow)
+    available_at: datetime = Field(default_factory=datetime.utcnow)
+    processed_at: Optional[datetime] = None
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Optional
 from datetime import datetime
 from enum import Enum
 import uuid
@@ -26,7 +26,14 @@ class User(BaseModel):
     email: str
     role: UserRole = UserRole.STUDENT
     phone: Optional[str] = None
-    enrolled_courses: List[str] = []
     created_at: datetime = Field(default_factory=datetime.utcnow)
     is_active: bool = True
-    avatar_url: Optional[str] = None
\ No newline at end of file
+    avatar_url: Optional[str] = None
+    token_version: int = 0  # Bumped on role or status changes; older tokens are rejected
+    membership_version: int = 0  # Bumped whenever an enrollment completes
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+class LogoutRequest(BaseModel):
+    refresh_token: Optional[str] = None
\ No newline at end of file
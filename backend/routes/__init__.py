@@ -1,5 +1,6 @@
 from .auth import router as auth_router
 from .courses import router as courses_router
 from .admin import router as admin_router
+from .payments import router as payments_router
 
-__all__ = ["auth_router", "courses_router", "admin_router"]
\ No newline at end of file
+__all__ = ["auth_router", "courses_router", "admin_router", "payments_router"]
\ No newline at end of file
@@ -1,6 +1,30 @@
-from fastapi import APIRouter, HTTPException, Depends
+import asyncio
+import json
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from datetime import datetime
+from typing import Literal, Optional
 from ..database import database
-from .auth import get_current_user
+from ..database.enrollments import (
+    BULK_JOB_COLLECTION, BULK_ROW_COLLECTION, membership_cache, run_bulk_enrollment, student_count_flusher
+)
+from ..database.indexes import report_indexes
+from ..database.payments import get_gateway, payment_inbox
+from ..database.progress import heartbeat_buffer
+from ..database.reconciliation import (
+    MISMATCH_COLLECTION, MISMATCH_KINDS, RUN_COLLECTION, run_reconciliation, settlement_records
+)
+from ..database.rollups import get_rollup_totals
+from ..utils.helpers import convert_objectid_to_string
+from ..utils.ingest import is_ndjson, iter_lines, parse_csv_records, parse_ndjson_records
+from ..utils.latency import request_latency
+from ..utils.loaders import DocumentLoader
+from ..utils.pagination import paginate, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from .auth import (
+    get_current_user, invalidate_user, password_hasher, principal_cache, rate_limiter, revocation_list, token_version_cache
+)
+from .courses import catalog_cache
 
 router = APIRouter(prefix="/admin", tags=["admin"])
 
@@ -10,20 +34,14 @@ async def admin_dashboard(current_user: dict = Depends(get_current_user)):
     if current_user["role"] not in ["admin", "super_admin"]:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    total_courses = await database.courses.count_documents({"is_active": True})
-    total_students = await database.users.count_documents({"role": "student", "is_active": True})
-    total_enrollments = await database.enrollments.count_documents({"payment_status": "completed"})
-    total_revenue = 0
-    
-    # Calculate total revenue from paid enrollments
-    paid_enrollments = await database.enrollments.find(
-        {"payment_status": "completed"}
-    ).to_list(None)
-    
-    for enrollment in paid_enrollments:
-        course = await database.courses.find_one({"id": enrollment["course_id"]})
-        if course and course.get("price"):
-            total_revenue += course["price"]
+    total_courses, total_students, rollup_totals = await asyncio.gather(
+        database.courses.count_documents({"is_active": True}),
+        database.users.count_documents({"role": "student", "is_active": True}),
+        get_rollup_totals(),
+    )
+    # Enrollment and revenue totals come from the daily rollups, not the raw enrollments
+    total_enrollments = rollup_totals["enrollments"]
+    total_revenue = rollup_totals["revenue"]
     
     return {
         "total_courses": total_courses,
@@ -33,17 +51,23 @@ async def admin_dashboard(current_user: dict = Depends(get_current_user)):
     }
 
 @router.get("/users")
-async def get_all_users(current_user: dict = Depends(get_current_user)):
-    """Get all users (admin only)"""
+async def get_all_users(
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    include_total: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get active users, newest first, one keyset page at a time (admin only)"""
     if current_user["role"] not in ["admin", "super_admin"]:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    users = await database.users.find(
-        {"is_active": True}, 
-        {"password": 0}  # Exclude password field
-    ).to_list(None)
-    
-    return {"users": users}
+    page = await paginate(
+        database.users, {"is_active": True}, "created_at", "users",
+        cursor=cursor, limit=limit, include_total=include_total,
+        projection={"password": 0}  # Exclude password field
+    )
+    convert_objectid_to_string(page["users"])
+    return page
 
 @router.put("/users/{user_id}/role")
 async def update_user_role(
@@ -59,31 +83,188 @@ async def update_user_role(
     if new_role not in ["student", "instructor", "admin", "super_admin"]:
         raise HTTPException(status_code=400, detail="Invalid role")
     
+    # Bumping the token version revokes tokens that carry the old role
     result = await database.users.update_one(
         {"id": user_id},
-        {"$set": {"role": new_role}}
+        {"$set": {"role": new_role}, "$inc": {"token_version": 1}}
     )
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    invalidate_user(user_id)
     
     return {"message": "User role updated successfully"}
 
 @router.get("/enrollments")
-async def get_all_enrollments(current_user: dict = Depends(get_current_user)):
-    """Get all enrollments (admin only)"""
+async def get_all_enrollments(
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    include_total: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get enrollments, newest first, one keyset page at a time (admin only)"""
     if current_user["role"] not in ["admin", "super_admin"]:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    enrollments = await database.enrollments.find({}).to_list(None)
+    page = await paginate(
+        database.enrollments, {}, "enrolled_at", "enrollments",
+        cursor=cursor, limit=limit, include_total=include_total
+    )
+    enrollments = convert_objectid_to_string(page["enrollments"])
+    
+    # Enrich with user and course information, resolved in batches
+    users = await DocumentLoader(
+        database.users, {"_id": 0, "id": 1, "full_name": 1, "email": 1}
+    ).load_many(e["user_id"] for e in enrollments)
+    courses = await DocumentLoader(
+        database.courses, {"_id": 0, "id": 1, "title": 1}
+    ).load_many(e["course_id"] for e in enrollments)
     
-    # Enrich with user and course information
     for enrollment in enrollments:
-        user = await database.users.find_one({"id": enrollment["user_id"]})
-        course = await database.courses.find_one({"id": enrollment["course_id"]})
+        user = users[enrollment["user_id"]]
+        course = courses[enrollment["course_id"]]
         
         enrollment["user_name"] = user["full_name"] if user else "Unknown User"
         enrollment["user_email"] = user["email"] if user else "Unknown Email"
         enrollment["course_title"] = course["title"] if course else "Unknown Course"
     
-    return {"enrollments": enrollments}
\ No newline at end of file
+    return page
+
+@router.post("/enrollments:bulk")
+async def bulk_enroll(request: Request, current_user: dict = Depends(get_current_user)):
+    """Enroll a cohort from a streamed CSV or NDJSON body of (email, course_id) rows (admin only).
+
+    Send text/csv (optionally with an `email,course_id` header line) or
+    application/x-ndjson. Returns the job summary; the per-row results are
+    read back from /admin/enrollments:bulk/{job_id}/rows.
+    """
+    if current_user["role"] not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    lines = iter_lines(request.stream())
+    parse = parse_ndjson_records if is_ndjson(request.headers.get("content-type")) else parse_csv_records
+    try:
+        return await run_bulk_enrollment(parse(lines), created_by=current_user["id"])
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+@router.get("/enrollments:bulk/{job_id}")
+async def get_bulk_enrollment_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """Get the summary of a bulk enrollment job (admin only)"""
+    if current_user["role"] not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    job = await database[BULK_JOB_COLLECTION].find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Bulk enrollment job not found")
+    return job
+
+@router.get("/enrollments:bulk/{job_id}/rows")
+async def get_bulk_enrollment_rows(
+    job_id: str,
+    status: Optional[Literal["enrolled", "already_enrolled", "user_not_found", "course_not_found", "invalid"]] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Stream the per-row results of a bulk enrollment job as NDJSON, in input order (admin only)"""
+    if current_user["role"] not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    query = {"job_id": job_id}
+    if status:
+        query["status"] = status
+    cursor = database[BULK_ROW_COLLECTION].find(
+        query, {"_id": 0, "job_id": 0, "created_at": 0}
+    ).sort("row", 1)
+    
+    async def stream_rows():
+        async for row in cursor:
+            yield json.dumps(jsonable_encoder(row)) + "\n"
+    
+    return StreamingResponse(stream_rows(), media_type="application/x-ndjson")
+
+@router.post("/reconciliations")
+async def reconcile_payments(
+    request: Request,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Reconcile payments and enrollments against a streamed settlement CSV (admin only).
+
+    The file must be sorted by tran_id. `since`/`until` bound its settlement
+    period. Returns the run summary; mismatches are read back from
+    /admin/reconciliations/{run_id}/mismatches. The nightly job runs the same
+    reconciliation with `python -m backend.database.reconciliation`.
+    """
+    if current_user["role"] not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    try:
+        return await run_reconciliation(
+            settlement_records(request.stream()), created_by=current_user["id"], since=since, until=until
+        )
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+@router.get("/reconciliations/{run_id}")
+async def get_reconciliation(run_id: str, current_user: dict = Depends(get_current_user)):
+    """Get the summary of a reconciliation run (admin only)"""
+    if current_user["role"] not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    run = await database[RUN_COLLECTION].find_one({"id": run_id}, {"_id": 0})
+    if not run:
+        raise HTTPException(status_code=404, detail="Reconciliation run not found")
+    return run
+
+@router.get("/reconciliations/{run_id}/mismatches")
+async def get_reconciliation_mismatches(
+    run_id: str,
+    kind: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Stream the mismatches of a reconciliation run as NDJSON, grouped by kind (admin only)"""
+    if current_user["role"] not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    if kind is not None and kind not in MISMATCH_KINDS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of {', '.join(MISMATCH_KINDS)}")
+    
+    query = {"run_id": run_id}
+    if kind:
+        query["kind"] = kind
+    cursor = database[MISMATCH_COLLECTION].find(query, {"_id": 0, "run_id": 0, "created_at": 0})
+    
+    async def stream_mismatches():
+        async for mismatch in cursor:
+            yield json.dumps(jsonable_encoder(mismatch)) + "\n"
+    
+    return StreamingResponse(stream_mismatches(), media_type="application/x-ndjson")
+
+@router.get("/indexes")
+async def get_index_report(current_user: dict = Depends(get_current_user)):
+    """Report missing and unused indexes (admin only)"""
+    if current_user["role"] not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return {"indexes": await report_indexes()}
+
+@router.get("/metrics")
+async def get_metrics(current_user: dict = Depends(get_current_user)):
+    """In-process cache and buffer metrics for this worker (admin only)"""
+    if current_user["role"] not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return {
+        "principal_cache": principal_cache.stats(),
+        "token_version_cache": token_version_cache.stats(),
+        "revocation_list": revocation_list.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "membership_cache": membership_cache.stats(),
+        "catalog_cache": catalog_cache.stats(),
+        "student_count_flusher": student_count_flusher.stats(),
+        "heartbeat_buffer": heartbeat_buffer.stats(),
+        "payment_gateway": get_gateway().stats(),
+        "payment_inbox": payment_inbox.stats(),
+        "password_hasher": password_hasher.stats(),
+        "request_latency": request_latency.stats()
+    }
\ No newline at end of file
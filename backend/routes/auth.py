@@ -1,28 +1,186 @@
-from fastapi import APIRouter, HTTPException, Depends
+from datetime import datetime
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import jwt
-from ..models import User, UserRegister, UserLogin
+from pymongo.errors import DuplicateKeyError
+from typing import Any, Dict, Optional
+from ..models import LogoutRequest, RefreshRequest, User, UserRegister, UserLogin
 from ..database import database
-from ..utils.auth import hash_password, verify_password, create_access_token
+from ..database.enrollments import get_enrolled_course_ids
+from ..utils.auth import create_access_token, create_refresh_token, decode_token
+from ..utils.cache import TTLCache
+from ..utils.passwords import PasswordHasher, PasswordHasherBusy
+from ..utils.ratelimit import RateLimit, RateLimiter, create_rate_limit_backend
+from ..utils.revocation import RevocationList
 from ..config.settings import settings
 
 router = APIRouter(prefix="/auth", tags=["authentication"])
 security = HTTPBearer()
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Get current authenticated user"""
+# User profiles (no password) keyed by user id, for the few endpoints that need more
+# than the token claims; invalidate on every user write
+principal_cache = TTLCache(maxsize=settings.principal_cache_size, ttl=settings.principal_cache_ttl_seconds)
+
+# (token_version, is_active) keyed by user id. Tokens carry the version they were
+# issued at; bumping users.token_version (role or status change) rejects them on
+# every worker within the TTL without a database read per request.
+token_version_cache = TTLCache(maxsize=settings.token_version_cache_size, ttl=settings.token_version_cache_ttl_seconds)
+
+# Individually revoked tokens (logout, used refresh tokens) by jti
+revocation_list = RevocationList(
+    database.revoked_tokens,
+    capacity=settings.token_revocation_bloom_capacity,
+    error_rate=settings.token_revocation_bloom_error_rate,
+    max_entries=settings.token_revocation_max_entries,
+    refresh_interval=settings.token_revocation_refresh_interval_seconds
+)
+
+# Password hashing and verification, off the event loop with bounded admission
+password_hasher = PasswordHasher(
+    workers=settings.password_hash_workers,
+    max_pending=settings.password_hash_max_pending,
+    queue_timeout=settings.password_hash_queue_timeout_seconds
+)
+
+# Login and registration attempts per client IP and per email, enforced by
+# RateLimitMiddleware before the endpoints run (see AUTH_RATE_LIMITS)
+rate_limiter = RateLimiter(create_rate_limit_backend(
+    settings.rate_limit_backend,
+    redis_url=settings.rate_limit_redis_url,
+    max_keys=settings.rate_limit_max_keys,
+    shards=settings.rate_limit_shards
+))
+
+AUTH_RATE_LIMITS = {
+    ("POST", "/api/auth/login"): (
+        RateLimit("login_ip", settings.login_ip_per_minute, settings.login_ip_burst),
+        RateLimit("login_email", settings.login_email_per_minute, settings.login_email_burst)
+    ),
+    ("POST", "/api/auth/register"): (
+        RateLimit("register_ip", settings.register_ip_per_minute, settings.register_ip_burst),
+        RateLimit("register_email", settings.register_email_per_minute, settings.register_email_burst)
+    )
+}
+
+def hasher_busy() -> HTTPException:
+    return HTTPException(status_code=503, detail="Too many sign-ins in progress, please retry", headers={"Retry-After": "1"})
+
+async def upgrade_password_hash(user_id: str, old_hash: str, password: str):
+    """Replace a legacy or outdated hash after a successful login, unless it changed meanwhile"""
     try:
-        payload = jwt.decode(credentials.credentials, settings.jwt_secret, algorithms=[settings.jwt_algorithm])
-        email: str = payload.get("sub")
-        if email is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        
-        user = await database.users.find_one({"email": email})
+        new_hash = await password_hasher.hash(password)
+    except PasswordHasherBusy:
+        return  # Upgraded on a later login
+    result = await database.users.update_one({"id": user_id, "password": old_hash}, {"$set": {"password": new_hash}})
+    password_hasher.upgrades += result.modified_count
+
+def issue_tokens(user: Dict[str, Any]) -> Dict[str, Any]:
+    """Access and refresh tokens for a user document"""
+    claims = {
+        "sub": user["email"],
+        "uid": user["id"],
+        "role": user["role"],
+        "tv": user.get("token_version", 0),
+        "mv": user.get("membership_version", 0)
+    }
+    return {
+        "access_token": create_access_token(claims),
+        "refresh_token": create_refresh_token({"sub": user["email"], "uid": user["id"], "tv": claims["tv"]}),
+        "token_type": "bearer",
+        "expires_in": settings.access_token_expire_minutes * 60
+    }
+
+async def get_token_version(user_id: str):
+    """The user's (token_version, is_active), or None if the user does not exist"""
+    state = token_version_cache.get(user_id)
+    if state is None:
+        user = await database.users.find_one({"id": user_id}, {"_id": 0, "token_version": 1, "is_active": 1})
+        if user is None:
+            return None
+        state = (user.get("token_version", 0), user.get("is_active", True))
+        token_version_cache.set(user_id, state)
+    return state
+
+def invalidate_user(user_id: str):
+    """Drop cached state for a user after a write to their document"""
+    token_version_cache.invalidate(user_id)
+    principal_cache.invalidate(user_id)
+
+async def get_user_profile(user_id: str) -> Dict[str, Any]:
+    """The user's document without the password, for endpoints that need more than the claims"""
+    user = principal_cache.get(user_id)
+    if user is None:
+        user = await database.users.find_one({"id": user_id}, {"_id": 0, "password": 0, "enrolled_courses": 0})
         if user is None:
             raise HTTPException(status_code=401, detail="User not found")
-        return user
+        principal_cache.set(user_id, user)
+    return user
+
+async def get_legacy_principal(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Principal for an access token issued before claims were added (only sub and exp).
+
+    Resolved from the user record so deploying claims signs nobody out. Such
+    tokens have no jti or token_version: they cannot be revoked one by one
+    and any token_version bump rejects them. They are gone once the last one
+    expires.
+    """
+    if not isinstance(payload.get("sub"), str) or "exp" not in payload:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    user = await database.users.find_one(
+        {"email": payload["sub"]},
+        {"_id": 0, "id": 1, "role": 1, "is_active": 1, "token_version": 1, "membership_version": 1}
+    )
+    if user is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    if not user.get("is_active", True):
+        raise HTTPException(status_code=401, detail="Account is disabled")
+    if user.get("token_version", 0) != 0:
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    return {
+        "id": user["id"],
+        "email": payload["sub"],
+        "role": user["role"],
+        "token_version": 0,
+        "membership_version": user.get("membership_version", 0),
+        "jti": None,
+        "expires_at": datetime.utcfromtimestamp(payload["exp"])
+    }
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Get the current principal from the access token's claims.
+
+    Returns id, email, role, token_version and membership_version; load the
+    full document with get_user_profile where it is needed.
+    """
+    try:
+        payload = decode_token(credentials.credentials, "access")
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    if "typ" not in payload:
+        return await get_legacy_principal(payload)
+    user_id = payload.get("uid")
+    if user_id is None or payload.get("sub") is None or payload.get("role") is None or payload.get("jti") is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if await revocation_list.is_revoked(payload["jti"]):
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    
+    state = await get_token_version(user_id)
+    if state is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    token_version, is_active = state
+    if not is_active:
+        raise HTTPException(status_code=401, detail="Account is disabled")
+    if payload.get("tv", 0) != token_version:
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    return {
+        "id": user_id,
+        "email": payload["sub"],
+        "role": payload["role"],
+        "token_version": token_version,
+        "membership_version": payload.get("mv", 0),
+        "jti": payload["jti"],
+        "expires_at": datetime.utcfromtimestamp(payload["exp"])
+    }
 
 @router.post("/register")
 async def register_user(user_data: UserRegister):
@@ -41,17 +199,20 @@ async def register_user(user_data: UserRegister):
     
     # Hash password and store separately
     user_dict = user.dict()
-    user_dict["password"] = hash_password(user_data.password)
-    
-    await database.users.insert_one(user_dict)
+    try:
+        user_dict["password"] = await password_hasher.hash(user_data.password)
+    except PasswordHasherBusy:
+        raise hasher_busy()
     
-    # Create access token
-    access_token = create_access_token(data={"sub": user.email})
+    try:
+        await database.users.insert_one(user_dict)
+    except DuplicateKeyError:
+        # A concurrent registration with the same email won the unique index
+        raise HTTPException(status_code=400, detail="Email already registered")
     
     return {
         "message": "User registered successfully",
-        "access_token": access_token,
-        "token_type": "bearer",
+        **issue_tokens(user_dict),
         "user": {
             "id": user.id,
             "full_name": user.full_name,
@@ -61,21 +222,30 @@ async def register_user(user_data: UserRegister):
     }
 
 @router.post("/login")
-async def login_user(login_data: UserLogin):
+async def login_user(login_data: UserLogin, background_tasks: BackgroundTasks):
     """Login user"""
     user = await database.users.find_one({"email": login_data.email})
-    if not user or not verify_password(login_data.password, user["password"]):
+    try:
+        if not user:
+            # Same scrypt work as a wrong password, so timing does not reveal registered emails
+            await password_hasher.verify_unknown(login_data.password)
+            raise HTTPException(status_code=401, detail="Invalid email or password")
+        valid, needs_rehash = await password_hasher.verify(login_data.password, user["password"])
+    except PasswordHasherBusy:
+        raise hasher_busy()
+    if not valid:
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
     if not user.get("is_active", True):
         raise HTTPException(status_code=401, detail="Account is disabled")
     
-    access_token = create_access_token(data={"sub": user["email"]})
+    if needs_rehash:
+        # After the response, so the upgrade never adds to this login's latency
+        background_tasks.add_task(upgrade_password_hash, user["id"], user["password"], login_data.password)
     
     return {
         "message": "Login successful",
-        "access_token": access_token,
-        "token_type": "bearer",
+        **issue_tokens(user),
         "user": {
             "id": user["id"],
             "full_name": user["full_name"],
@@ -84,13 +254,61 @@ async def login_user(login_data: UserLogin):
         }
     }
 
+@router.post("/refresh")
+async def refresh_tokens(refresh_data: RefreshRequest):
+    """Exchange a refresh token for a new access and refresh token pair.
+
+    Refresh tokens are single use: the presented one is revoked before the
+    new pair is issued. The user is read fresh, so the new access token
+    carries their current role and versions; refresh tokens from before a
+    role or status change are rejected.
+    """
+    try:
+        payload = decode_token(refresh_data.refresh_token, "refresh")
+    except jwt.PyJWTError:
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    if payload.get("jti") is None or not await revocation_list.revoke(
+        payload["jti"], payload.get("uid"), datetime.utcfromtimestamp(payload["exp"]), token_type="refresh"
+    ):
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    
+    user = await database.users.find_one(
+        {"id": payload.get("uid")},
+        {"_id": 0, "id": 1, "email": 1, "role": 1, "is_active": 1, "token_version": 1, "membership_version": 1}
+    )
+    if user is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    if not user.get("is_active", True):
+        raise HTTPException(status_code=401, detail="Account is disabled")
+    if payload.get("tv", 0) != user.get("token_version", 0):
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    return issue_tokens(user)
+
+@router.post("/logout")
+async def logout_user(logout_data: Optional[LogoutRequest] = None, current_user: dict = Depends(get_current_user)):
+    """Revoke the presented access token, and the refresh token if one is sent"""
+    if current_user["jti"] is not None:  # Tokens from before claims were added cannot be revoked
+        await revocation_list.revoke(current_user["jti"], current_user["id"], current_user["expires_at"])
+    if logout_data is not None and logout_data.refresh_token:
+        try:
+            payload = decode_token(logout_data.refresh_token, "refresh")
+        except jwt.PyJWTError:
+            raise HTTPException(status_code=400, detail="Invalid refresh token")
+        if payload.get("uid") != current_user["id"] or payload.get("jti") is None:
+            raise HTTPException(status_code=400, detail="Invalid refresh token")
+        await revocation_list.revoke(
+            payload["jti"], current_user["id"], datetime.utcfromtimestamp(payload["exp"]), token_type="refresh"
+        )
+    return {"message": "Logged out"}
+
 @router.get("/me")
 async def get_current_user_info(current_user: dict = Depends(get_current_user)):
     """Get current user information"""
+    profile = await get_user_profile(current_user["id"])
     return {
         "id": current_user["id"],
-        "full_name": current_user["full_name"],
+        "full_name": profile["full_name"],
         "email": current_user["email"],
         "role": current_user["role"],
-        "enrolled_courses": current_user.get("enrolled_courses", [])
-    }
\ No newline at end of file
+        "enrolled_courses": sorted(await get_enrolled_course_ids(current_user["id"], current_user["membership_version"]))
+    }
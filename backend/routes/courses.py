@@ -1,17 +1,55 @@
-from fastapi import APIRouter, HTTPException, Depends
-from typing import List
-from ..models import Course, CourseCreate, Lesson, LessonCreate, Enrollment
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
+from typing import List, Literal, Optional
+from ..models import Course, CourseCreate, Lesson, LessonCreate, LessonReorder, LessonHeartbeat
 from ..database import database
-from ..utils.helpers import convert_objectid_to_string, format_course_response
+from ..database.lessons import (
+    LESSON_COLLECTION, MAX_LESSON_BATCH_SIZE, apply_lessons_added, attach_lessons, course_has_lesson, find_lesson,
+    get_course_lessons, lesson_document, migrate_course_lessons, reserve_lesson_orders, reorder_lessons
+)
+from ..database.enrollments import complete_free_enrollment, open_pending_enrollment, user_is_enrolled
+from ..database.progress import complete_lesson, get_progress, heartbeat_buffer
+from ..utils.helpers import convert_objectid_to_string, format_course_response, CATALOG_SUMMARY_PROJECTION
+from ..utils.pagination import paginate, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from ..utils.catalog_cache import CatalogCache
 from .auth import get_current_user
 
 router = APIRouter(prefix="/courses", tags=["courses"])
 
+# Public catalog responses; bump on every course or lesson mutation
+catalog_cache = CatalogCache(database.counters)
+
 @router.get("")
-async def get_courses():
-    """Get all active courses"""
-    courses = await database.courses.find({"is_active": True}).to_list(None)
-    return {"courses": convert_objectid_to_string(courses)}
+async def get_courses(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    include_total: bool = False,
+    view: Literal["summary", "full"] = "summary"
+):
+    """Get active courses, newest first, one keyset page at a time.
+
+    The default summary view returns catalog card fields with derived
+    lesson_count/total_duration; view=full returns whole course documents.
+    Responses are cached per catalog version and revalidated with ETags.
+    """
+    async def load_page():
+        if view == "summary":
+            page = await paginate(
+                database.courses, {"is_active": True}, "created_at", "courses",
+                cursor=cursor, limit=limit, include_total=include_total,
+                projection=CATALOG_SUMMARY_PROJECTION
+            )
+        else:
+            page = await paginate(
+                database.courses, {"is_active": True}, "created_at", "courses",
+                cursor=cursor, limit=limit, include_total=include_total,
+                projection={"preview_lessons": 0}
+            )
+            await attach_lessons(page["courses"])
+        convert_objectid_to_string(page["courses"])
+        return page
+    
+    return await catalog_cache.respond(request, (view, cursor, limit, include_total), load_page)
 
 @router.get("/{course_id}")
 async def get_course(course_id: str, current_user: dict = Depends(get_current_user)):
@@ -21,7 +59,11 @@ async def get_course(course_id: str, current_user: dict = Depends(get_current_us
         raise HTTPException(status_code=404, detail="Course not found")
     
     # Check if user is enrolled
-    is_enrolled = course_id in current_user.get("enrolled_courses", [])
+    is_enrolled = await user_is_enrolled(current_user["id"], course_id, current_user["membership_version"])
+    
+    # Unenrolled users of paid courses get the precomputed preview subset instead
+    if is_enrolled or course["course_type"] != "paid" or "preview_lessons" not in course:
+        course["lessons"] = await get_course_lessons(course)
     
     return format_course_response(course, is_enrolled)
 
@@ -34,9 +76,11 @@ async def create_course(course_data: CourseCreate, current_user: dict = Depends(
     
     course = Course(**course_data.dict())
     course.instructor_id = current_user["id"]  # Set the instructor
-    course_dict = course.dict()
+    course_dict = course.dict(exclude={"lessons"})  # Lessons are stored in their own collection
+    course_dict["total_duration"] = 0
     
     await database.courses.insert_one(course_dict)
+    await catalog_cache.bump()
     return {"message": "Course created successfully", "course_id": course.id}
 
 @router.post("/{course_id}/lessons")
@@ -50,22 +94,74 @@ async def add_lesson_to_course(
     if current_user["role"] not in ["admin", "super_admin", "instructor"]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
-    course = await database.courses.find_one({"id": course_id})
+    course = await database.courses.find_one({"id": course_id}, {"_id": 0, "id": 1})
     if not course:
         raise HTTPException(status_code=404, detail="Course not found")
+    await migrate_course_lessons(course_id)  # The course may still embed its lessons
     
-    # Create lesson
-    lesson = Lesson(**lesson_data.dict())
-    lesson.order = len(course.get("lessons", [])) + 1
+    # Create lesson at the end of the course
+    lesson = Lesson(**lesson_data.dict(), order=await reserve_lesson_orders(course_id))
     
-    # Update course with new lesson
-    await database.courses.update_one(
-        {"id": course_id},
-        {"$push": {"lessons": lesson.dict()}}
-    )
+    lesson_doc = lesson_document(lesson.dict(), course_id)
+    await database[LESSON_COLLECTION].insert_one(lesson_doc)
+    await apply_lessons_added(course_id, [lesson_doc])
+    await catalog_cache.bump()
     
     return {"message": "Lesson added successfully", "lesson_id": lesson.id}
 
+@router.post("/{course_id}/lessons:bulk")
+async def bulk_add_lessons(
+    course_id: str,
+    lessons_data: List[LessonCreate],
+    current_user: dict = Depends(get_current_user)
+):
+    """Append a batch of lessons with contiguous orders in one write (admin/instructor only)"""
+    if current_user["role"] not in ["admin", "super_admin", "instructor"]:
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
+    
+    if not lessons_data:
+        raise HTTPException(status_code=400, detail="No lessons provided")
+    if len(lessons_data) > MAX_LESSON_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_LESSON_BATCH_SIZE} lessons per request")
+    
+    course = await database.courses.find_one({"id": course_id}, {"_id": 0, "id": 1})
+    if not course:
+        raise HTTPException(status_code=404, detail="Course not found")
+    await migrate_course_lessons(course_id)  # The course may still embed its lessons
+    
+    first_order = await reserve_lesson_orders(course_id, len(lessons_data))
+    lessons = [
+        Lesson(**lesson_data.dict(), order=first_order + offset)
+        for offset, lesson_data in enumerate(lessons_data)
+    ]
+    lesson_docs = [lesson_document(lesson.dict(), course_id) for lesson in lessons]
+    await database[LESSON_COLLECTION].insert_many(lesson_docs)
+    await apply_lessons_added(course_id, lesson_docs)
+    await catalog_cache.bump()
+    
+    return {"message": f"{len(lessons)} lessons added successfully", "lesson_ids": [lesson.id for lesson in lessons]}
+
+@router.put("/{course_id}/lessons:reorder")
+async def reorder_course_lessons(
+    course_id: str,
+    reorder_data: LessonReorder,
+    current_user: dict = Depends(get_current_user)
+):
+    """Rewrite the order of every lesson in a course in one pass (admin/instructor only)"""
+    if current_user["role"] not in ["admin", "super_admin", "instructor"]:
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
+    
+    course = await database.courses.find_one({"id": course_id}, {"_id": 0, "id": 1})
+    if not course:
+        raise HTTPException(status_code=404, detail="Course not found")
+    await migrate_course_lessons(course_id)  # The course may still embed its lessons
+    
+    if not await reorder_lessons(course_id, reorder_data.lesson_ids):
+        raise HTTPException(status_code=400, detail="lesson_ids must list every lesson of the course exactly once")
+    await catalog_cache.bump()
+    
+    return {"message": "Lessons reordered successfully"}
+
 @router.post("/{course_id}/enroll")
 async def enroll_in_course(course_id: str, current_user: dict = Depends(get_current_user)):
     """Enroll in a course"""
@@ -73,45 +169,26 @@ async def enroll_in_course(course_id: str, current_user: dict = Depends(get_curr
     if not course:
         raise HTTPException(status_code=404, detail="Course not found")
     
-    # Check if already enrolled
-    if course_id in current_user.get("enrolled_courses", []):
-        raise HTTPException(status_code=400, detail="Already enrolled in this course")
+    already_enrolled = await user_is_enrolled(current_user["id"], course_id, current_user["membership_version"])
     
-    # For free courses, enroll immediately
+    # For free courses, enroll immediately; retries and double clicks are no-ops
     if course["course_type"] == "free":
-        # Update user's enrolled courses
-        await database.users.update_one(
-            {"id": current_user["id"]},
-            {"$push": {"enrolled_courses": course_id}}
-        )
-        
-        # Update course student count
-        await database.courses.update_one(
-            {"id": course_id},
-            {"$inc": {"student_count": 1}}
-        )
-        
-        # Create enrollment record
-        enrollment = Enrollment(
-            user_id=current_user["id"],
-            course_id=course_id,
-            payment_status="completed"
-        )
-        await database.enrollments.insert_one(enrollment.dict())
-        
+        if not already_enrolled:
+            await complete_free_enrollment(current_user["id"], course)
         return {"message": "Successfully enrolled in course", "enrollment_status": "completed"}
     
-    # For paid courses, create pending enrollment
-    enrollment = Enrollment(
-        user_id=current_user["id"],
-        course_id=course_id,
-        payment_status="pending"
-    )
-    await database.enrollments.insert_one(enrollment.dict())
+    # Check if already enrolled
+    if already_enrolled:
+        raise HTTPException(status_code=400, detail="Already enrolled in this course")
+    
+    # For paid courses, open a pending enrollment or reuse the one already open
+    enrollment = await open_pending_enrollment(current_user["id"], course_id)
+    if enrollment is None:
+        raise HTTPException(status_code=400, detail="Already enrolled in this course")
     
     return {
         "message": "Enrollment initiated. Please complete payment.",
-        "enrollment_id": enrollment.id,
+        "enrollment_id": enrollment["id"],
         "payment_required": True,
         "amount": course["price"]
     }
@@ -123,24 +200,67 @@ async def get_lesson(
     current_user: dict = Depends(get_current_user)
 ):
     """Get specific lesson details"""
-    course = await database.courses.find_one({"id": course_id, "is_active": True})
+    course = await database.courses.find_one({"id": course_id, "is_active": True}, {"_id": 0, "id": 1})
     if not course:
         raise HTTPException(status_code=404, detail="Course not found")
     
-    # Find the lesson
-    lesson = None
-    for l in course.get("lessons", []):
-        if l["id"] == lesson_id:
-            lesson = l
-            break
-    
+    lesson = await find_lesson(course_id, lesson_id)
     if not lesson:
         raise HTTPException(status_code=404, detail="Lesson not found")
     
     # Check access permissions
-    is_enrolled = course_id in current_user.get("enrolled_courses", [])
+    is_enrolled = await user_is_enrolled(current_user["id"], course_id, current_user["membership_version"])
     
     if not is_enrolled and not lesson.get("is_preview", False):
         raise HTTPException(status_code=403, detail="Access denied. Please enroll in the course.")
     
-    return lesson
\ No newline at end of file
+    return lesson
+
+@router.post("/{course_id}/lessons/{lesson_id}/heartbeat")
+async def record_lesson_heartbeat(
+    course_id: str,
+    lesson_id: str,
+    heartbeat: LessonHeartbeat,
+    current_user: dict = Depends(get_current_user)
+):
+    """Record the playback position of an enrolled user.
+
+    Heartbeats are buffered in memory and written in periodic batches, so
+    last_accessed_at and the position may lag by the flush interval.
+    """
+    if not await user_is_enrolled(current_user["id"], course_id, current_user["membership_version"]):
+        raise HTTPException(status_code=403, detail="Access denied. Please enroll in the course.")
+    if not await course_has_lesson(course_id, lesson_id):
+        raise HTTPException(status_code=404, detail="Lesson not found")
+    
+    await heartbeat_buffer.record(current_user["id"], course_id, lesson_id, heartbeat.position_seconds)
+    return {"message": "Heartbeat recorded"}
+
+@router.post("/{course_id}/lessons/{lesson_id}/complete")
+async def complete_course_lesson(course_id: str, lesson_id: str, current_user: dict = Depends(get_current_user)):
+    """Mark a lesson completed and return the updated course progress"""
+    if not await user_is_enrolled(current_user["id"], course_id, current_user["membership_version"]):
+        raise HTTPException(status_code=403, detail="Access denied. Please enroll in the course.")
+    
+    course = await database.courses.find_one(
+        {"id": course_id, "is_active": True}, {"_id": 0, "lesson_count": 1, "lessons.id": 1}
+    )
+    if course is None:
+        raise HTTPException(status_code=404, detail="Course not found")
+    if not await find_lesson(course_id, lesson_id):
+        raise HTTPException(status_code=404, detail="Lesson not found")
+    
+    # A course not migrated yet has no lesson_count, only its embedded lessons
+    lesson_count = course.get("lesson_count", len(course.get("lessons", [])))
+    progress = await complete_lesson(current_user["id"], course_id, lesson_id, lesson_count)
+    if progress is None:
+        raise HTTPException(status_code=403, detail="Access denied. Please enroll in the course.")
+    return progress
+
+@router.get("/{course_id}/progress")
+async def get_course_progress(course_id: str, current_user: dict = Depends(get_current_user)):
+    """Get the current user's progress in a course"""
+    progress = await get_progress(current_user["id"], course_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Not enrolled in this course")
+    return progress
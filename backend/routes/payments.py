@@ -0,0 +1,59 @@
+from typing import Optional
+from urllib.parse import parse_qsl
+from fastapi import APIRouter, HTTPException, Depends, Header, Request
+from ..database import database
+from ..database.payments import PAYMENT_COLLECTION, PAYMENT_PROJECTION, initiate_payment, record_callback
+from ..models import PaymentCreate
+from .auth import get_current_user, get_user_profile
+
+router = APIRouter(prefix="/payments", tags=["payments"])
+
+@router.post("/initiate")
+async def initiate_course_payment(
+    payment_data: PaymentCreate,
+    idempotency_key: Optional[str] = Header(None, max_length=128),
+    current_user: dict = Depends(get_current_user)
+):
+    """Start paying for a course; returns the payment with the gateway_url to redirect to.
+
+    Send an Idempotency-Key header to make retries safe: the same key
+    returns the same payment. Without one, repeated calls return the open
+    payment for the user's pending enrollment.
+    """
+    course = await database.courses.find_one(
+        {"id": payment_data.course_id, "is_active": True}, {"_id": 0, "id": 1, "title": 1, "course_type": 1, "price": 1}
+    )
+    if not course:
+        raise HTTPException(status_code=404, detail="Course not found")
+    if course["course_type"] != "paid":
+        raise HTTPException(status_code=400, detail="Course is free, enroll directly")
+    if not isinstance(course.get("price"), (int, float)) or course["price"] <= 0:
+        raise HTTPException(status_code=400, detail="Course has no valid price")
+    if abs(payment_data.amount - course["price"]) >= 0.01:
+        raise HTTPException(status_code=400, detail="Amount does not match the course price")
+
+    profile = await get_user_profile(current_user["id"])
+    return await initiate_payment(profile, course, payment_data.payment_method, idempotency_key)
+
+@router.post("/ipn")
+async def payment_ipn(request: Request):
+    """Instant payment notification from the gateway (form encoded, unauthenticated).
+
+    The notification is only recorded in the payment_callbacks inbox and
+    acknowledged; the inbox workers validate and settle it shortly after.
+    """
+    form = dict(parse_qsl((await request.body()).decode()))
+    if not form.get("tran_id"):
+        raise HTTPException(status_code=400, detail="tran_id is required")
+    queued = await record_callback(form)
+    return {"status": "queued" if queued else "duplicate"}
+
+@router.get("/{payment_id}")
+async def get_payment_status(payment_id: str, current_user: dict = Depends(get_current_user)):
+    """Get a payment's status (its owner or an admin)"""
+    payment = await database[PAYMENT_COLLECTION].find_one({"id": payment_id}, PAYMENT_PROJECTION)
+    if not payment:
+        raise HTTPException(status_code=404, detail="Payment not found")
+    if payment["user_id"] != current_user["id"] and current_user["role"] not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Access denied")
+    return payment
@@ -1,150 +1,3247 @@
 import os
-from fastapi import FastAPI, HTTPException, Depends, status
+import asyncio
+import calendar
+from fastapi import FastAPI, BackgroundTasks, HTTPException, Depends, Header, Query, Request, Response, status
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Literal, Optional, Dict, Any, Tuple
 import motor.motor_asyncio
+import httpx
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 import uvicorn
 from datetime import datetime, timedelta
 import jwt
 import hashlib
+import hmac
+import math
+import csv
+import gzip
+import re
 import uuid
+import random
+import base64
+import json
+import time
+import logging
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
 from enum import Enum
 
+try:
+    import brotli
+except ImportError:  # Optional: without it clients fall back to gzip
+    brotli = None
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:  # Optional: only needed for RATE_LIMIT_BACKEND=redis
+    redis_asyncio = None
+
 # Environment variables
 MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
+# Access tokens carry the claims requests are authorized from; refresh tokens renew them.
+# The 24h default matches the lifetime clients were built around: the web app does not
+# refresh yet, so shorten it only once it does.
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get('ACCESS_TOKEN_EXPIRE_MINUTES', '1440'))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.environ.get('REFRESH_TOKEN_EXPIRE_DAYS', '30'))
+TOKEN_VERSION_CACHE_SIZE = int(os.environ.get('TOKEN_VERSION_CACHE_SIZE', '10000'))
+TOKEN_VERSION_CACHE_TTL_SECONDS = float(os.environ.get('TOKEN_VERSION_CACHE_TTL_SECONDS', '30'))
+TOKEN_REVOCATION_BLOOM_CAPACITY = int(os.environ.get('TOKEN_REVOCATION_BLOOM_CAPACITY', '100000'))
+TOKEN_REVOCATION_BLOOM_ERROR_RATE = float(os.environ.get('TOKEN_REVOCATION_BLOOM_ERROR_RATE', '0.001'))
+TOKEN_REVOCATION_MAX_ENTRIES = int(os.environ.get('TOKEN_REVOCATION_MAX_ENTRIES', '100000'))
+TOKEN_REVOCATION_REFRESH_INTERVAL_SECONDS = float(os.environ.get('TOKEN_REVOCATION_REFRESH_INTERVAL_SECONDS', '1'))
+# Rate limiting of login and registration, per client IP and per email; RATE_LIMIT_BACKEND=redis
+# shares the buckets between workers
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'True').lower() == 'true'
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL', '')  # e.g. redis://localhost:6379/0
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', '100000'))
+RATE_LIMIT_SHARDS = int(os.environ.get('RATE_LIMIT_SHARDS', '16'))
+RATE_LIMIT_TRUST_FORWARDED_FOR = os.environ.get('RATE_LIMIT_TRUST_FORWARDED_FOR', 'False').lower() == 'true'
+# Peers whose X-Real-IP / X-Forwarded-For are honoured; nginx proxies from loopback
+RATE_LIMIT_TRUSTED_PROXIES = [
+    proxy.strip() for proxy in os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', '127.0.0.1,::1').split(',') if proxy.strip()
+]
+LOGIN_IP_PER_MINUTE = float(os.environ.get('LOGIN_IP_PER_MINUTE', '30'))
+LOGIN_IP_BURST = int(os.environ.get('LOGIN_IP_BURST', '60'))
+LOGIN_EMAIL_PER_MINUTE = float(os.environ.get('LOGIN_EMAIL_PER_MINUTE', '5'))
+LOGIN_EMAIL_BURST = int(os.environ.get('LOGIN_EMAIL_BURST', '10'))
+REGISTER_IP_PER_MINUTE = float(os.environ.get('REGISTER_IP_PER_MINUTE', '5'))
+REGISTER_IP_BURST = int(os.environ.get('REGISTER_IP_BURST', '20'))
+REGISTER_EMAIL_PER_MINUTE = float(os.environ.get('REGISTER_EMAIL_PER_MINUTE', '2'))
+REGISTER_EMAIL_BURST = int(os.environ.get('REGISTER_EMAIL_BURST', '3'))
+# Passwords are hashed with salted scrypt in a bounded thread pool
+PASSWORD_SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', str(2 ** 14)))
+PASSWORD_SCRYPT_R = int(os.environ.get('PASSWORD_SCRYPT_R', '8'))
+PASSWORD_SCRYPT_P = int(os.environ.get('PASSWORD_SCRYPT_P', '1'))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', '256'))
+PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS = float(os.environ.get('PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS', '5'))
+PRINCIPAL_CACHE_SIZE = int(os.environ.get('PRINCIPAL_CACHE_SIZE', '10000'))
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.environ.get('PRINCIPAL_CACHE_TTL_SECONDS', '30'))
+MEMBERSHIP_CACHE_SIZE = int(os.environ.get('MEMBERSHIP_CACHE_SIZE', '10000'))
+MEMBERSHIP_CACHE_TTL_SECONDS = float(os.environ.get('MEMBERSHIP_CACHE_TTL_SECONDS', '30'))
+LESSON_IDS_CACHE_SIZE = int(os.environ.get('LESSON_IDS_CACHE_SIZE', '10000'))
+LESSON_IDS_CACHE_TTL_SECONDS = float(os.environ.get('LESSON_IDS_CACHE_TTL_SECONDS', '60'))
+COUNTER_FLUSH_INTERVAL_SECONDS = float(os.environ.get('COUNTER_FLUSH_INTERVAL_SECONDS', '1'))
+HEARTBEAT_FLUSH_INTERVAL_SECONDS = float(os.environ.get('HEARTBEAT_FLUSH_INTERVAL_SECONDS', '5'))
+HEARTBEAT_BUFFER_MAX_ENTRIES = int(os.environ.get('HEARTBEAT_BUFFER_MAX_ENTRIES', '50000'))
+PENDING_ENROLLMENT_TTL_SECONDS = float(os.environ.get('PENDING_ENROLLMENT_TTL_SECONDS', '86400'))
+PENDING_ENROLLMENT_SWEEP_INTERVAL_SECONDS = float(os.environ.get('PENDING_ENROLLMENT_SWEEP_INTERVAL_SECONDS', '300'))
+MIGRATION_BATCH_SIZE = 100
+SWEEP_BATCH_SIZE = 500
+BULK_ENROLL_BATCH_SIZE = 1000
+ROLLUP_BATCH_SIZE = 1000
+# Longer than any completion write takes to land, and than the clock skew between instances
+ROLLUP_REBUILD_GRACE_SECONDS = float(os.environ.get('ROLLUP_REBUILD_GRACE_SECONDS', '30'))
+ROLLUP_REBUILD_LEASE_SECONDS = 600  # Renewed after every batch
+BULK_ENROLLMENT_REPORT_RETENTION_SECONDS = int(os.environ.get('BULK_ENROLLMENT_REPORT_RETENTION_SECONDS', str(30 * 24 * 3600)))
+RECONCILIATION_REPORT_RETENTION_SECONDS = int(os.environ.get('RECONCILIATION_REPORT_RETENTION_SECONDS', str(90 * 24 * 3600)))
+MAX_LINE_BYTES = 4096
+
+# Payment gateway (SSLCommerz); PAYMENT_GATEWAY=stub serves it in process without the network
+SSLCOMMERZ_STORE_ID = os.environ.get('SSLCOMMERZ_STORE_ID', '')
+SSLCOMMERZ_STORE_PASSWORD = os.environ.get('SSLCOMMERZ_STORE_PASSWORD', '')
+SSLCOMMERZ_BASE_URL = os.environ.get('SSLCOMMERZ_BASE_URL') or (
+    "https://sandbox.sslcommerz.com" if os.environ.get('SSLCOMMERZ_SANDBOX', 'True').lower() == 'true'
+    else "https://securepay.sslcommerz.com"
+)
+PAYMENT_GATEWAY = os.environ.get('PAYMENT_GATEWAY', 'sslcommerz')
+PAYMENT_GATEWAY_TIMEOUT_SECONDS = float(os.environ.get('PAYMENT_GATEWAY_TIMEOUT_SECONDS', '10'))
+PAYMENT_GATEWAY_MAX_RETRIES = int(os.environ.get('PAYMENT_GATEWAY_MAX_RETRIES', '2'))
+PAYMENT_GATEWAY_MAX_CONNECTIONS = int(os.environ.get('PAYMENT_GATEWAY_MAX_CONNECTIONS', '100'))
+PAYMENT_STUB_LATENCY_SECONDS = float(os.environ.get('PAYMENT_STUB_LATENCY_MS', '0')) / 1000
+PUBLIC_API_URL = os.environ.get('PUBLIC_API_URL', 'http://localhost:8001')  # Base of the IPN URL
+PAYMENT_RETURN_URL = os.environ.get('PAYMENT_RETURN_URL', 'http://localhost:3000/payment')
+GATEWAY_VALID_STATUSES = ("VALID", "VALIDATED")
+# Validation statuses confirming a transaction did not go through, mapped to the payment status
+GATEWAY_FAILED_STATUSES = {"FAILED": "failed", "CANCELLED": "cancelled"}
+
+# Payment callback inbox: IPNs are acknowledged on receipt and settled in batches
+PAYMENT_INBOX_WORKERS = int(os.environ.get('PAYMENT_INBOX_WORKERS', '2'))
+PAYMENT_INBOX_BATCH_SIZE = int(os.environ.get('PAYMENT_INBOX_BATCH_SIZE', '100'))
+PAYMENT_INBOX_POLL_INTERVAL_SECONDS = float(os.environ.get('PAYMENT_INBOX_POLL_INTERVAL_SECONDS', '1'))
+PAYMENT_INBOX_LEASE_SECONDS = float(os.environ.get('PAYMENT_INBOX_LEASE_SECONDS', '60'))
+PAYMENT_INBOX_MAX_ATTEMPTS = int(os.environ.get('PAYMENT_INBOX_MAX_ATTEMPTS', '8'))
+PAYMENT_INBOX_RETRY_SECONDS = float(os.environ.get('PAYMENT_INBOX_RETRY_SECONDS', '30'))
+PAYMENT_INBOX_RETENTION_SECONDS = int(os.environ.get('PAYMENT_INBOX_RETENTION_SECONDS', str(30 * 24 * 3600)))
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+MAX_LESSON_BATCH_SIZE = 500
+CATALOG_CACHE_MAX_AGE_SECONDS = float(os.environ.get('CATALOG_CACHE_MAX_AGE_SECONDS', '60'))
+
+# Fields a catalog card needs, including the lesson aggregates maintained on the
+# course document, so lessons are never read or shipped for the listing
+CATALOG_SUMMARY_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "title": 1,
+    "description": 1,
+    "instructor_name": 1,
+    "course_type": 1,
+    "price": 1,
+    "thumbnail_url": 1,
+    "student_count": 1,
+    "created_at": 1,
+    "lesson_count": {"$ifNull": ["$lesson_count", 0]},
+    "total_duration": 1,
+}
+
+# Lessons live in their own collection, one document per lesson carrying its course_id,
+# indexed on (course_id, order) and (course_id, id). Courses carry fields derived from
+# them (lesson_count, total_duration, preview_lessons) that every lesson write keeps
+# current. Migrate embedded lessons and backfill with `python -m backend.database.lessons`.
+LESSON_PROJECTION = {"_id": 0, "course_id": 0}
+
+# MongoDB setup
+client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_URL)
+db = client.islamic_institute
+
+app = FastAPI(title="Islamic Institute Course Platform API")
+
+# Security
+security = HTTPBearer()
+
+logger = logging.getLogger(__name__)
+
+class UserRole(str, Enum):
+    STUDENT = "student"
+    INSTRUCTOR = "instructor"
+    ADMIN = "admin"
+    SUPER_ADMIN = "super_admin"
+
+class CourseType(str, Enum):
+    FREE = "free"
+    PAID = "paid"
+
+# Pydantic Models
+class UserRegister(BaseModel):
+    full_name: str
+    email: str
+    password: str
+    phone: Optional[str] = None
+
+class UserLogin(BaseModel):
+    email: str
+    password: str
+
+class User(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    full_name: str
+    email: str
+    role: UserRole = UserRole.STUDENT
+    phone: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    is_active: bool = True
+    token_version: int = 0  # Bumped on role or status changes; older tokens are rejected
+    membership_version: int = 0  # Bumped whenever an enrollment completes
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+class LogoutRequest(BaseModel):
+    refresh_token: Optional[str] = None
+
+class Lesson(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    title: str
+    description: str
+    video_url: str  # YouTube/Vimeo URL
+    video_type: str  # "youtube" or "vimeo"
+    duration: Optional[int] = None  # in minutes
+    order: int
+    is_preview: bool = False  # First lesson should be preview
+    embed_url: Optional[str] = None  # Precomputed from video_url when the lesson is written
+
+class Course(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    title: str
+    description: str
+    instructor_name: str
+    course_type: CourseType
+    price: Optional[float] = None  # BDT
+    thumbnail_url: Optional[str] = None
+    lessons: List[Lesson] = []
+    # Derived from the lessons collection, maintained by the lesson write paths
+    lesson_count: int = 0
+    total_duration: Optional[int] = None  # in minutes
+    preview_lessons: List[Lesson] = []
+    student_count: int = 0
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    is_active: bool = True
+
+class CourseCreate(BaseModel):
+    title: str
+    description: str
+    instructor_name: str
+    course_type: CourseType
+    price: Optional[float] = None
+    thumbnail_url: Optional[str] = None
+
+class LessonCreate(BaseModel):
+    title: str
+    description: str
+    video_url: str
+    video_type: str
+    duration: Optional[int] = None
+    is_preview: bool = False
+
+class LessonReorder(BaseModel):
+    lesson_ids: List[str]  # Every lesson of the course, in the new order
+
+class Enrollment(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    user_id: str
+    course_id: str
+    enrolled_at: datetime = Field(default_factory=datetime.utcnow)
+    payment_status: str = "pending"  # pending, completed, failed
+    completed_at: Optional[datetime] = None  # Day it is rolled up under
+    bulk_job_id: Optional[str] = None  # Granted by a bulk enrollment job, so nothing was charged
+    transaction_id: Optional[str] = None
+    expires_at: Optional[datetime] = None  # When an unpaid attempt is archived
+    progress: float = 0.0  # 0-100 percentage
+    completed_lessons: List[str] = []
+    last_accessed_at: Optional[datetime] = None
+    last_lesson_id: Optional[str] = None  # Lesson of the latest playback heartbeat
+    last_position_seconds: Optional[int] = None
+
+class PaymentStatus(str, Enum):
+    PENDING = "pending"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    REFUNDED = "refunded"
+
+class PaymentMethod(str, Enum):
+    BKASH = "bkash"
+    NAGAD = "nagad"
+    ROCKET = "rocket"
+    CARD = "card"
+    BANK = "bank"
+
+class Payment(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    user_id: str
+    course_id: str
+    enrollment_id: str
+    amount: float
+    currency: str = "BDT"
+    payment_method: PaymentMethod
+    status: PaymentStatus = PaymentStatus.PENDING
+    transaction_id: Optional[str] = None
+    gateway_transaction_id: Optional[str] = None
+    gateway_response: Optional[Dict[Any, Any]] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+    completed_at: Optional[datetime] = None
+
+class PaymentCreate(BaseModel):
+    course_id: str
+    payment_method: PaymentMethod
+    amount: float
+
+class PaymentCallback(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    transaction_id: str
+    form_digest: str  # Tells gateway retries of one notification from a different body
+    form: Dict[str, str]
+    status: Literal["queued", "processing", "processed", "failed"] = "queued"
+    outcome: Optional[str] = None
+    attempts: int = 0
+    last_error: Optional[str] = None
+    received_at: datetime = Field(default_factory=datetime.utcnow)
+    available_at: datetime = Field(default_factory=datetime.utcnow)
+    processed_at: Optional[datetime] = None
+
+class LessonHeartbeat(BaseModel):
+    position_seconds: int = Field(0, ge=0)  # Playback position within the lesson
+
+# Utility Functions
+# Passwords are stored as scrypt$<n>$<r>$<p>$<salt>$<hash> (base64); legacy hashes are
+# unsalted SHA-256 hex and are replaced on the next successful login. Both functions are
+# CPU and memory hard: call them through password_hasher, off the event loop.
+def scrypt_digest(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024, dklen=32)
+
+def hash_password(password: str) -> str:
+    salt = os.urandom(16)
+    digest = scrypt_digest(password, salt, PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+    return "$".join([
+        "scrypt", str(PASSWORD_SCRYPT_N), str(PASSWORD_SCRYPT_R), str(PASSWORD_SCRYPT_P),
+        base64.b64encode(salt).decode(), base64.b64encode(digest).decode()
+    ])
+
+def verify_password(password: str, hashed: str) -> bool:
+    if not hashed.startswith("scrypt$"):
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), hashed)
+    try:
+        _, n, r, p, salt, digest = hashed.split("$")
+        expected = base64.b64decode(digest)
+        actual = scrypt_digest(password, base64.b64decode(salt), int(n), int(r), int(p))
+    except ValueError:
+        return False
+    return hmac.compare_digest(actual, expected)
+
+# Legacy SHA-256, or scrypt with other parameters than configured
+def password_needs_rehash(hashed: str) -> bool:
+    return not hashed.startswith(f"scrypt${PASSWORD_SCRYPT_N}${PASSWORD_SCRYPT_R}${PASSWORD_SCRYPT_P}$")
+
+# Recent latencies per key (e.g. route) summarized as percentiles. Keeps the last `window`
+# samples of each key, for at most `max_keys` keys, so memory stays bounded.
+class LatencyRecorder:
+    def __init__(self, window: int = 1024, max_keys: int = 256):
+        self.window = window
+        self.max_keys = max_keys
+        self._samples: Dict[str, deque] = {}
+        self._counts: Dict[str, int] = {}
+
+    def record(self, key: str, seconds: float):
+        samples = self._samples.get(key)
+        if samples is None:
+            if len(self._samples) >= self.max_keys:
+                return
+            samples = self._samples[key] = deque(maxlen=self.window)
+            self._counts[key] = 0
+        samples.append(seconds)
+        self._counts[key] += 1
+
+    # Context manager recording the duration of its block under `key`
+    def time(self, key: str) -> "LatencyTimer":
+        return LatencyTimer(self, key)
+
+    @staticmethod
+    def _percentile(ordered, fraction: float) -> float:
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def stats(self) -> Dict[str, Any]:
+        summary = {}
+        for key, samples in self._samples.items():
+            ordered = sorted(samples)
+            summary[str(key)] = {
+                "count": self._counts[key],
+                "p50_ms": round(self._percentile(ordered, 0.50) * 1000, 2),
+                "p95_ms": round(self._percentile(ordered, 0.95) * 1000, 2),
+                "p99_ms": round(self._percentile(ordered, 0.99) * 1000, 2),
+                "max_ms": round(ordered[-1] * 1000, 2)
+            }
+        return summary
+
+class LatencyTimer:
+    def __init__(self, recorder: LatencyRecorder, key: str):
+        self.recorder = recorder
+        self.key = key
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.recorder.record(self.key, time.perf_counter() - self.started)
+
+class PasswordHasherBusy(Exception):
+    pass
+
+# Runs password hashing and verification in a bounded thread pool. scrypt releases the GIL
+# while it runs, so `workers` threads hash in parallel while the event loop keeps serving
+# other requests. At most `max_pending` operations are admitted (running or queued); a
+# caller not admitted within `queue_timeout` seconds gets PasswordHasherBusy instead of
+# piling more work onto an overloaded worker.
+class PasswordHasher:
+    def __init__(self, workers: int = 4, max_pending: int = 256, queue_timeout: float = 5.0):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.pending = 0
+        self.rejected = 0
+        self.upgrades = 0
+        self.latency = LatencyRecorder()
+        self._dummy_hash: Optional[str] = None
+
+    def _admit(self) -> asyncio.Semaphore:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hasher")
+        return self._slots
+
+    async def _run(self, operation: str, function, *args):
+        slots = self._admit()
+        with self.latency.time(operation):
+            try:
+                await asyncio.wait_for(slots.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise PasswordHasherBusy(f"More than {self.max_pending} password operations pending")
+            self.pending += 1
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+            finally:
+                self.pending -= 1
+                slots.release()
+
+    async def hash(self, password: str) -> str:
+        return await self._run("hash", hash_password, password)
+
+    # (valid, needs_rehash)
+    async def verify(self, password: str, hashed: str) -> Tuple[bool, bool]:
+        valid = await self._run("verify", verify_password, password, hashed)
+        return valid, valid and password_needs_rehash(hashed)
+
+    # Check a password for an unknown account against a hash of a random one (with the
+    # configured parameters), so logins for an email that does not exist cost the same
+    # scrypt work and their latency does not reveal which emails are registered
+    async def verify_unknown(self, password: str):
+        if self._dummy_hash is None or password_needs_rehash(self._dummy_hash):
+            self._dummy_hash = await self.hash(uuid.uuid4().hex)
+        await self._run("verify", verify_password, password, self._dummy_hash)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._slots = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "rejected": self.rejected,
+            "upgrades": self.upgrades,
+            "latency": self.latency.stats()
+        }
+
+# Fixed-size set membership test with false positives but no false negatives, sized for
+# `capacity` keys at `error_rate` false positives (more keys raise the rate, so callers
+# rebuild it). Probes come from Python's per-process salted str hash; never shared.
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.probes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def add(self, key: str):
+        digest = hash(key) & 0xFFFFFFFFFFFFFFFF
+        position, step = digest & 0xFFFFFFFF, (digest >> 32) | 1
+        for _ in range(self.probes):
+            position %= self.size
+            self._bits[position >> 3] |= 1 << (position & 7)
+            position += step
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        digest = hash(key) & 0xFFFFFFFFFFFFFFFF
+        position, step, size, bits = digest & 0xFFFFFFFF, (digest >> 32) | 1, self.size, self._bits
+        for _ in range(self.probes):
+            position %= size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+            position += step
+        return True
+
+# Revoked token ids (jti), one document each in `collection` until the token expires (TTL
+# on expires_at). Revoked access tokens are mirrored into an exact set of at most
+# `max_entries` ids plus a bloom filter, polled incrementally every `refresh_interval`
+# seconds, so checking a token is a set lookup with no I/O. Once the set has evicted ids a
+# miss is only trusted if the bloom filter agrees; a bloom hit the set cannot confirm falls
+# back to one indexed read. Revocations made in this process apply immediately, those made
+# elsewhere within `refresh_interval`. Refresh tokens are checked against the collection
+# when used, so their revocations are not mirrored.
+class RevocationList:
+    def __init__(self, collection, capacity: int = 100000, error_rate: float = 0.001, max_entries: int = 100000,
+                 refresh_interval: float = 1.0, overlap: float = 5.0):
+        self.collection = collection
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.max_entries = max_entries
+        self.refresh_interval = refresh_interval
+        # Re-read this far back on every poll, for writes committed out of revoked_at order
+        self.overlap = timedelta(seconds=overlap)
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._exact = OrderedDict()
+        self._since = None
+        self._overflowed = False
+        self._task = None
+        self.loaded = False
+        self.lookups = 0
+        self.bloom_negatives = 0
+        self.exact_hits = 0
+        self.evictions = 0
+        self.database_checks = 0
+        self.rebuilds = 0
+        self.failures = 0
+
+    def _remember(self, jti: str, expires_at: datetime):
+        if jti in self._exact:
+            return
+        self._bloom.add(jti)
+        self._exact[jti] = expires_at
+        if len(self._exact) > self.max_entries:
+            self._exact.popitem(last=False)  # Still in the bloom filter; confirmed from the collection
+            self._overflowed = True
+            self.evictions += 1
+
+    # Revoke a token until it expires; False if it was already revoked
+    async def revoke(self, jti: str, user_id: str, expires_at: datetime, token_type: str = "access") -> bool:
+        try:
+            await self.collection.insert_one({
+                "jti": jti,
+                "token_type": token_type,
+                "user_id": user_id,
+                "expires_at": expires_at,
+                "revoked_at": datetime.utcnow()
+            })
+        except DuplicateKeyError:
+            return False
+        if token_type == "access":
+            self._remember(jti, expires_at)
+        return True
+
+    async def is_revoked(self, jti: str) -> bool:
+        self.lookups += 1
+        if self.loaded:
+            if jti in self._exact:
+                self.exact_hits += 1
+                return True
+            if not self._overflowed:
+                return False
+            if jti not in self._bloom:
+                self.bloom_negatives += 1
+                return False
+        self.database_checks += 1
+        return await self.collection.find_one({"jti": jti}, {"_id": 1}) is not None
+
+    # Mirror revocations made since the last refresh, rebuilding the filter when it is full
+    async def refresh(self):
+        now = datetime.utcnow()
+        rebuild = not self.loaded or self._bloom.count >= self._bloom.capacity
+        query = {"token_type": "access", "expires_at": {"$gt": now}}
+        if not rebuild:
+            query["revoked_at"] = {"$gte": self._since - self.overlap}
+        try:
+            revoked = await self.collection.find(
+                query, {"_id": 0, "jti": 1, "expires_at": 1, "revoked_at": 1}
+            ).sort("revoked_at", ASCENDING).to_list(None)
+        except PyMongoError as exc:
+            self.failures += 1
+            logger.error("Could not refresh the token revocation list: %s", exc)
+            return
+
+        if rebuild:
+            # Expired ids are dropped here; the JWT expiry rejects those tokens anyway
+            self._bloom = BloomFilter(max(self.capacity, 2 * len(revoked)), self.error_rate)
+            self._exact = OrderedDict()
+            self._overflowed = False
+            self.rebuilds += 1
+        for entry in revoked:
+            self._remember(entry["jti"], entry["expires_at"])
+        if revoked:
+            self._since = max(revoked[-1]["revoked_at"], self._since or revoked[-1]["revoked_at"])
+        elif self._since is None:
+            self._since = now
+        while self._exact and next(iter(self._exact.values())) <= now:
+            self._exact.popitem(last=False)
+        self.loaded = True
+
+    async def _run(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "loaded": self.loaded,
+            "entries": len(self._exact),
+            "bloom_keys": self._bloom.count,
+            "bloom_bits": self._bloom.size,
+            "bloom_probes": self._bloom.probes,
+            "lookups": self.lookups,
+            "bloom_negatives": self.bloom_negatives,
+            "exact_hits": self.exact_hits,
+            "evictions": self.evictions,
+            "database_checks": self.database_checks,
+            "rebuilds": self.rebuilds,
+            "failures": self.failures
+        }
+
+# A token bucket: `burst` requests at once, refilled at `per_minute` per minute
+class RateLimit:
+
+    def __init__(self, name: str, per_minute: float, burst: int):
+        self.name = name
+        self.rate = per_minute / 60.0
+        self.burst = burst
+
+# Token buckets in this process, for a single worker. Buckets are spread over `shards` LRU
+# maps by key hash, each holding at most max_keys / shards buckets, so memory stays bounded
+# however many IPs or emails are seen. An evicted bucket starts full again, which only errs
+# towards allowing a request.
+class MemoryRateLimitBackend:
+    def __init__(self, max_keys: int = 100000, shards: int = 16):
+        self.shard_size = max(1, max_keys // shards)
+        self._shards = [OrderedDict() for _ in range(shards)]
+        self.evictions = 0
+
+    # Take one token; returns (allowed, seconds until one is available)
+    async def take(self, key: str, limit: RateLimit) -> Tuple[bool, float]:
+        shard = self._shards[hash(key) % len(self._shards)]
+        now = time.monotonic()
+        bucket = shard.get(key)
+        if bucket is None:
+            bucket = shard[key] = [float(limit.burst), now]
+            if len(shard) > self.shard_size:
+                shard.popitem(last=False)
+                self.evictions += 1
+        else:
+            shard.move_to_end(key)
+            bucket[0] = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True, 0.0
+        return False, (1 - bucket[0]) / limit.rate
+
+    async def close(self):
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "memory",
+            "buckets": sum(len(shard) for shard in self._shards),
+            "max_buckets": self.shard_size * len(self._shards),
+            "evictions": self.evictions
+        }
+
+# Refill and take one token atomically on the Redis server, timed by its own clock so
+# workers on different hosts agree. Buckets expire once they would be full again.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return {allowed, tostring(retry_after)}
+"""
+
+# Token buckets in Redis, shared by every worker; each take is one EVAL of
+# TOKEN_BUCKET_SCRIPT. If Redis cannot be reached the request is allowed and counted as a
+# failure: losing the limiter must not lock everyone out of signing in.
+class RedisRateLimitBackend:
+    def __init__(self, client, prefix: str = "ratelimit:"):
+        self.client = client
+        self.prefix = prefix
+        self.failures = 0
+
+    async def take(self, key: str, limit: RateLimit) -> Tuple[bool, float]:
+        try:
+            allowed, retry_after = await self.client.eval(
+                TOKEN_BUCKET_SCRIPT, 1, self.prefix + key, limit.rate, limit.burst
+            )
+        except Exception as exc:  # Any client or connection error fails open
+            self.failures += 1
+            logger.error("Rate limit backend unavailable, allowing request: %s", exc)
+            return True, 0.0
+        return bool(int(allowed)), float(retry_after)
+
+    async def close(self):
+        await self.client.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "redis", "failures": self.failures}
+
+# Backend for RATE_LIMIT_BACKEND: "memory" or "redis". Without a Redis URL or the redis
+# package, "redis" falls back to the in-process buckets, limiting each worker on its own.
+def create_rate_limit_backend(kind: str, redis_url: str = "", max_keys: int = 100000, shards: int = 16):
+    if kind == "redis":
+        if redis_url and redis_asyncio is not None:
+            return RedisRateLimitBackend(redis_asyncio.from_url(redis_url))
+        logger.warning(
+            "RATE_LIMIT_BACKEND=redis needs RATE_LIMIT_REDIS_URL and the redis package; limiting in process instead"
+        )
+    elif kind != "memory":
+        raise ValueError(f"Unknown rate limit backend {kind!r}")
+    return MemoryRateLimitBackend(max_keys=max_keys, shards=shards)
+
+# Applies rate limits through a backend and counts the outcomes per limit
+class RateLimiter:
+    def __init__(self, backend):
+        self.backend = backend
+        self.allowed = defaultdict(int)
+        self.limited = defaultdict(int)
+
+    async def hit(self, limit: RateLimit, key: str) -> Tuple[bool, float]:
+        allowed, retry_after = await self.backend.take(f"{limit.name}:{key}", limit)
+        if allowed:
+            self.allowed[limit.name] += 1
+        else:
+            self.limited[limit.name] += 1
+        return allowed, retry_after
+
+    async def close(self):
+        await self.backend.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.backend.stats(),
+            "allowed": dict(self.allowed),
+            "limited": dict(self.limited)
+        }
+
+# ASGI middleware applying per-IP and per-email limits to selected endpoints. `rules` maps
+# (method, path) to (ip_limit, email_limit); either may be None. The IP limit is checked
+# before the body is read; the email limit reads the JSON body's "email" (lowercased) and
+# replays the body to the endpoint. Over-limit requests get 429 with Retry-After and never
+# reach the endpoint, so a credential-stuffing burst costs no user lookup or hashing.
+class RateLimitMiddleware:
+    def __init__(self, app, limiter: RateLimiter, rules: dict, trust_forwarded_for: bool = False,
+                 trusted_proxies=("127.0.0.1", "::1"), max_body_bytes: int = 64 * 1024):
+        self.app = app
+        self.limiter = limiter
+        self.rules = rules
+        self.trust_forwarded_for = trust_forwarded_for
+        self.trusted_proxies = frozenset(trusted_proxies)
+        self.max_body_bytes = max_body_bytes
+
+    # Behind a trusted proxy (or any peer with trust_forwarded_for) the client is the address the
+    # proxy reports: X-Real-IP, else the last X-Forwarded-For entry, which is the hop the proxy
+    # appended. Earlier entries are supplied by the client and could be forged.
+    def _client_ip(self, scope) -> str:
+        client = scope.get("client")
+        peer = client[0] if client else "unknown"
+        if not self.trust_forwarded_for and peer not in self.trusted_proxies:
+            return peer
+        forwarded_for = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-real-ip" and value.strip():
+                return value.decode("latin-1").strip()
+            if name == b"x-forwarded-for":
+                forwarded_for = value.decode("latin-1")
+        if forwarded_for is not None:
+            last_hop = forwarded_for.rsplit(",", 1)[-1].strip()
+            if last_hop:
+                return last_hop
+        return peer
+
+    @staticmethod
+    def _too_many_requests(retry_after: float) -> JSONResponse:
+        return JSONResponse(
+            {"detail": "Too many attempts, please retry later"},
+            status_code=429,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+
+    async def __call__(self, scope, receive, send):
+        rule = self.rules.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+        if rule is None:
+            return await self.app(scope, receive, send)
+        ip_limit, email_limit = rule
+
+        if ip_limit is not None:
+            allowed, retry_after = await self.limiter.hit(ip_limit, self._client_ip(scope))
+            if not allowed:
+                return await self._too_many_requests(retry_after)(scope, receive, send)
+        if email_limit is None:
+            return await self.app(scope, receive, send)
+
+        chunks, size, more_body = [], 0, True
+        while more_body:
+            message = await receive()
+            if message["type"] != "http.request":
+                return await self.app(scope, receive, send)  # Client went away; let the app see it
+            chunks.append(message.get("body", b""))
+            size += len(chunks[-1])
+            more_body = message.get("more_body", False)
+            if size > self.max_body_bytes:
+                return await JSONResponse({"detail": "Request body too large"}, status_code=413)(scope, receive, send)
+        body = b"".join(chunks)
+
+        try:
+            email = json.loads(body).get("email")
+        except (ValueError, AttributeError):
+            email = None  # Malformed bodies are rejected by the endpoint's validation
+        if isinstance(email, str) and email:
+            allowed, retry_after = await self.limiter.hit(email_limit, email.strip().lower())
+            if not allowed:
+                return await self._too_many_requests(retry_after)(scope, receive, send)
+
+        replayed = False
+        async def replay():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+        await self.app(scope, replay, send)
+
+# Request latency per route template, recorded by the HTTP middleware
+request_latency = LatencyRecorder()
+
+def encode_token(data: dict, token_type: str, expires_delta: timedelta) -> str:
+    now = datetime.utcnow()
+    to_encode = data.copy()
+    to_encode.update({"typ": token_type, "jti": uuid.uuid4().hex, "iat": now, "exp": now + expires_delta})
+    return jwt.encode(to_encode, JWT_SECRET, algorithm="HS256")
+
+def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+    return encode_token(data, "access", expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+
+# Refresh tokens are only accepted by /api/auth/refresh
+def create_refresh_token(data: dict, expires_delta: Optional[timedelta] = None):
+    return encode_token(data, "refresh", expires_delta or timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS))
+
+# Decode and verify a JWT of the given type; raises jwt.PyJWTError if invalid
+def decode_token(token: str, token_type: str) -> dict:
+    payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
+    if payload.get("typ", "access") != token_type:  # Tokens issued before typ was added are access tokens
+        raise jwt.InvalidTokenError(f"Not a {token_type} token")
+    return payload
+
+# Bounded in-process cache with per-entry expiry and LRU eviction. Not shared between
+# workers, so entries are at most `ttl` seconds stale unless invalidated explicitly.
+class TTLCache:
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+# Coalesces counter increments in process and applies them in one bulk write, so a burst
+# of N enrollments in one course costs a single $inc. Increments still pending when a
+# worker dies are lost; counters that must be exact are rebuilt from their source.
+class CounterFlusher:
+    def __init__(self, collection, field: str, key_field: str = "id", interval: float = 1.0):
+        self.collection = collection
+        self.field = field
+        self.key_field = key_field
+        self.interval = interval
+        self._pending = defaultdict(int)
+        self._task = None
+        self.increments = 0
+        self.flushes = 0
+        self.documents_updated = 0
+        self.failures = 0
+
+    def add(self, key, amount: int = 1):
+        self._pending[key] += amount
+        self.increments += 1
+
+    async def flush(self) -> int:
+        pending = {key: amount for key, amount in self._pending.items() if amount}
+        self._pending = defaultdict(int)
+        if not pending:
+            return 0
+        try:
+            await self.collection.bulk_write([
+                UpdateOne({self.key_field: key}, {"$inc": {self.field: amount}})
+                for key, amount in pending.items()
+            ], ordered=False)
+        except Exception as exc:  # Any error, so buffered increments are never dropped
+            # Keep the increments for the next flush rather than dropping them
+            for key, amount in pending.items():
+                self._pending[key] += amount
+            self.failures += 1
+            logger.error("Could not flush %s increments: %s", self.field, exc)
+            return 0
+        self.flushes += 1
+        self.documents_updated += len(pending)
+        return len(pending)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:  # Keep flushing; a dead task would silently drop everything buffered after
+                logger.exception("Could not flush %s increments", self.field)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "field": self.field,
+            "pending_documents": len(self._pending),
+            "increments": self.increments,
+            "flushes": self.flushes,
+            "documents_updated": self.documents_updated,
+            "failures": self.failures,
+            "interval_seconds": self.interval
+        }
+
+# Coalesces playback heartbeats per (user_id, course_id): only the newest heartbeat of each
+# enrollment is kept between flushes and all of them are written in one bulk write. Each
+# update only applies if newer than what is stored, so out-of-order flushes from several
+# workers never move a position backwards. Flushed early once `max_entries` enrollments
+# are buffered; heartbeats pending when a worker dies are lost.
+class HeartbeatBuffer:
+    def __init__(self, collection, interval: float = 5.0, max_entries: int = 50000):
+        self.collection = collection
+        self.interval = interval
+        self.max_entries = max_entries
+        self._pending = {}
+        self._task = None
+        self.heartbeats = 0
+        self.flushes = 0
+        self.documents_updated = 0
+        self.failures = 0
+
+    async def record(self, user_id: str, course_id: str, lesson_id: str, position_seconds: int):
+        self._pending[(user_id, course_id)] = {
+            "last_accessed_at": datetime.utcnow(),
+            "last_lesson_id": lesson_id,
+            "last_position_seconds": position_seconds
+        }
+        self.heartbeats += 1
+        if len(self._pending) >= self.max_entries:
+            await self.flush()
+
+    def pending(self, user_id: str, course_id: str) -> Optional[dict]:
+        return self._pending.get((user_id, course_id))
+
+    async def flush(self) -> int:
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            await self.collection.bulk_write([
+                UpdateOne(
+                    {
+                        "user_id": user_id,
+                        "course_id": course_id,
+                        "payment_status": "completed",
+                        "$or": [
+                            {"last_accessed_at": None},
+                            {"last_accessed_at": {"$lt": fields["last_accessed_at"]}}
+                        ]
+                    },
+                    {"$set": fields}
+                )
+                for (user_id, course_id), fields in pending.items()
+            ], ordered=False)
+        except Exception as exc:  # Any error, so buffered heartbeats are never dropped
+            # Keep them for the next flush unless a newer heartbeat arrived meanwhile
+            for key, fields in pending.items():
+                self._pending.setdefault(key, fields)
+            self.failures += 1
+            logger.error("Could not flush heartbeats: %s", exc)
+            return 0
+        self.flushes += 1
+        self.documents_updated += len(pending)
+        return len(pending)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:  # Keep flushing; a dead task would silently drop everything buffered after
+                logger.exception("Could not flush heartbeats")
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending_enrollments": len(self._pending),
+            "heartbeats": self.heartbeats,
+            "flushes": self.flushes,
+            "documents_updated": self.documents_updated,
+            "failures": self.failures,
+            "interval_seconds": self.interval
+        }
+
+class GatewayError(Exception):
+    pass
+
+# Async SSLCommerz client sharing one pooled HTTP client across requests. Requests time
+# out after `timeout` seconds and are retried with exponential backoff and jitter on
+# connection errors, timeouts and 5xx responses, up to `max_retries` extra attempts.
+# An httpx transport (such as one wrapping the gateway stub) runs it without the network.
+class SSLCommerzClient:
+    def __init__(self, store_id: str, store_password: str, base_url: str, timeout: float = 10.0,
+                 max_retries: int = 2, backoff: float = 0.25, max_connections: int = 100, transport=None):
+        self.store_id = store_id
+        self.store_password = store_password
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=httpx.Timeout(timeout, connect=min(timeout, 5.0)),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            transport=transport
+        )
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+
+    async def _request(self, method: str, path: str, **kwargs) -> dict:
+        for attempt in range(self.max_retries + 1):
+            self.requests += 1
+            try:
+                response = await self._client.request(method, path, **kwargs)
+                if response.status_code < 500:
+                    response.raise_for_status()
+                    return response.json()
+                error = GatewayError(f"Gateway returned HTTP {response.status_code}")
+            except (httpx.TransportError, httpx.TimeoutException) as exc:
+                error = exc
+            except (httpx.HTTPStatusError, ValueError) as exc:
+                # 4xx or a body that is not JSON: retrying will not help
+                self.failures += 1
+                raise GatewayError(str(exc)) from exc
+            if attempt < self.max_retries:
+                self.retries += 1
+                await asyncio.sleep(self.backoff * (2 ** attempt) * (1 + random.random()))
+        self.failures += 1
+        logger.error("Gateway %s %s failed after %d attempts: %s", method, path, self.max_retries + 1, error)
+        raise GatewayError(str(error)) from error
+
+    async def create_session(self, fields: dict) -> dict:
+        data = {"store_id": self.store_id, "store_passwd": self.store_password, **fields}
+        session = await self._request("POST", "/gwprocess/v4/api.php", data=data)
+        if session.get("status") != "SUCCESS" or not session.get("GatewayPageURL"):
+            raise GatewayError(session.get("failedreason") or "Gateway refused the session")
+        return session
+
+    async def validate(self, val_id: str) -> dict:
+        return await self._request("GET", "/validator/api/validationserverAPI.php", params={
+            "val_id": val_id, "store_id": self.store_id, "store_passwd": self.store_password, "format": "json"
+        })
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"requests": self.requests, "retries": self.retries, "failures": self.failures}
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+# Serialized, precompressed catalog responses keyed by request parameters. Entries belong
+# to a catalog version kept in the `counters` collection: every course or lesson mutation
+# calls bump(), and other workers notice the new version within `version_poll_interval`
+# seconds. Entries also expire after `max_age` so figures like student_count converge.
+class CatalogCache:
+    VERSION_ID = "catalog_version"
+
+    def __init__(self, counters_collection, max_entries: int = 256, max_age: float = 60.0,
+                 version_poll_interval: float = 2.0):
+        self.counters = counters_collection
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.version_poll_interval = version_poll_interval
+        self.version = 0
+        self._version_checked_at = float("-inf")
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    async def current_version(self) -> int:
+        now = time.monotonic()
+        if now - self._version_checked_at >= self.version_poll_interval:
+            doc = await self.counters.find_one({"_id": self.VERSION_ID})
+            self._version_checked_at = now
+            self._set_version(doc["value"] if doc else 0)
+        return self.version
+
+    async def bump(self) -> int:
+        doc = await self.counters.find_one_and_update(
+            {"_id": self.VERSION_ID},
+            {"$inc": {"value": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self._version_checked_at = time.monotonic()
+        self._set_version(doc["value"])
+        return self.version
+
+    def _set_version(self, version: int):
+        if version != self.version:
+            self.version = version
+            self._entries.clear()
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["version"] != self.version or time.monotonic() - entry["created_at"] > self.max_age:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _put(self, key, payload) -> dict:
+        body = json.dumps(
+            jsonable_encoder(payload), ensure_ascii=False, allow_nan=False, separators=(",", ":")
+        ).encode("utf-8")
+        entry = {
+            "version": self.version,
+            "created_at": time.monotonic(),
+            "etag": f'"{self.version}-{hashlib.sha256(body).hexdigest()[:32]}"',
+            "identity": body,
+            "gzip": gzip.compress(body, compresslevel=6),
+            "br": brotli.compress(body) if brotli else None
+        }
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    # Serve `key` from cache (awaiting `load()` on a miss) with ETag/304 and compression
+    async def respond(self, request: Request, key, load) -> Response:
+        await self.current_version()
+        entry = self._get(key)
+        if entry is None:
+            self.misses += 1
+            entry = self._put(key, await load())
+        else:
+            self.hits += 1
+        
+        headers = {"ETag": entry["etag"], "Cache-Control": "public, no-cache", "Vary": "Accept-Encoding"}
+        if etag_matches(request.headers.get("if-none-match"), entry["etag"]):
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        
+        accept_encoding = request.headers.get("accept-encoding", "")
+        if entry["br"] is not None and "br" in accept_encoding:
+            headers["Content-Encoding"] = "br"
+            body = entry["br"]
+        elif "gzip" in accept_encoding:
+            headers["Content-Encoding"] = "gzip"
+            body = entry["gzip"]
+        else:
+            body = entry["identity"]
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified
+        }
+
+# User profiles (no password) keyed by user id, for the few endpoints that need more
+# than the token claims; invalidate on every user write
+principal_cache = TTLCache(maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL_SECONDS)
+
+# (token_version, is_active) keyed by user id. Tokens carry the version they were
+# issued at; bumping users.token_version (role or status change) rejects them on
+# every worker within the TTL without a database read per request.
+token_version_cache = TTLCache(maxsize=TOKEN_VERSION_CACHE_SIZE, ttl=TOKEN_VERSION_CACHE_TTL_SECONDS)
+
+# Individually revoked tokens (logout, used refresh tokens) by jti
+revocation_list = RevocationList(
+    db.revoked_tokens,
+    capacity=TOKEN_REVOCATION_BLOOM_CAPACITY,
+    error_rate=TOKEN_REVOCATION_BLOOM_ERROR_RATE,
+    max_entries=TOKEN_REVOCATION_MAX_ENTRIES,
+    refresh_interval=TOKEN_REVOCATION_REFRESH_INTERVAL_SECONDS
+)
+
+# Access and refresh tokens for a user document
+def issue_tokens(user: dict) -> dict:
+    claims = {
+        "sub": user["email"],
+        "uid": user["id"],
+        "role": user["role"],
+        "tv": user.get("token_version", 0),
+        "mv": user.get("membership_version", 0)
+    }
+    return {
+        "access_token": create_access_token(claims),
+        "refresh_token": create_refresh_token({"sub": user["email"], "uid": user["id"], "tv": claims["tv"]}),
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    }
+
+# The user's (token_version, is_active), or None if the user does not exist
+async def get_token_version(user_id: str):
+    state = token_version_cache.get(user_id)
+    if state is None:
+        user = await db.users.find_one({"id": user_id}, {"_id": 0, "token_version": 1, "is_active": 1})
+        if user is None:
+            return None
+        state = (user.get("token_version", 0), user.get("is_active", True))
+        token_version_cache.set(user_id, state)
+    return state
+
+# Drop cached state for a user after a write to their document
+def invalidate_user(user_id: str):
+    token_version_cache.invalidate(user_id)
+    principal_cache.invalidate(user_id)
+
+# The user's document without the password, for endpoints that need more than the claims
+async def get_user_profile(user_id: str) -> dict:
+    user = principal_cache.get(user_id)
+    if user is None:
+        user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0, "enrolled_courses": 0})
+        if user is None:
+            raise HTTPException(status_code=401, detail="User not found")
+        principal_cache.set(user_id, user)
+    return user
+
+# Password hashing and verification, off the event loop with bounded admission
+password_hasher = PasswordHasher(
+    workers=PASSWORD_HASH_WORKERS,
+    max_pending=PASSWORD_HASH_MAX_PENDING,
+    queue_timeout=PASSWORD_HASH_QUEUE_TIMEOUT_SECONDS
+)
+
+# Login and registration attempts per client IP and per email, enforced by RateLimitMiddleware
+# before the endpoints run
+rate_limiter = RateLimiter(create_rate_limit_backend(
+    RATE_LIMIT_BACKEND, redis_url=RATE_LIMIT_REDIS_URL, max_keys=RATE_LIMIT_MAX_KEYS, shards=RATE_LIMIT_SHARDS
+))
+
+AUTH_RATE_LIMITS = {
+    ("POST", "/api/auth/login"): (
+        RateLimit("login_ip", LOGIN_IP_PER_MINUTE, LOGIN_IP_BURST),
+        RateLimit("login_email", LOGIN_EMAIL_PER_MINUTE, LOGIN_EMAIL_BURST)
+    ),
+    ("POST", "/api/auth/register"): (
+        RateLimit("register_ip", REGISTER_IP_PER_MINUTE, REGISTER_IP_BURST),
+        RateLimit("register_email", REGISTER_EMAIL_PER_MINUTE, REGISTER_EMAIL_BURST)
+    )
+}
+
+if RATE_LIMIT_ENABLED:
+    app.add_middleware(
+        RateLimitMiddleware, limiter=rate_limiter, rules=AUTH_RATE_LIMITS, trust_forwarded_for=RATE_LIMIT_TRUST_FORWARDED_FOR,
+        trusted_proxies=RATE_LIMIT_TRUSTED_PROXIES
+    )
+
+# CORS middleware, added after the rate limiter so it wraps it and 429s carry CORS headers
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+def hasher_busy() -> HTTPException:
+    return HTTPException(status_code=503, detail="Too many sign-ins in progress, please retry", headers={"Retry-After": "1"})
+
+# Replace a legacy or outdated hash after a successful login, unless it changed meanwhile
+async def upgrade_password_hash(user_id: str, old_hash: str, password: str):
+    try:
+        new_hash = await password_hasher.hash(password)
+    except PasswordHasherBusy:
+        return  # Upgraded on a later login
+    result = await db.users.update_one({"id": user_id, "password": old_hash}, {"$set": {"password": new_hash}})
+    password_hasher.upgrades += result.modified_count
+
+# Course ids each user has a completed enrollment in, keyed by user id, with the
+# membership version they are known to be current for. The enrollments collection is the
+# source of truth (unique on user_id, course_id); every write that completes an enrollment
+# bumps users.membership_version and invalidates the local entry. Access tokens carry the
+# version they were issued at, so a token minted after an enrollment on another worker
+# reloads a stale entry instead of waiting out the TTL.
+membership_cache = TTLCache(maxsize=MEMBERSHIP_CACHE_SIZE, ttl=MEMBERSHIP_CACHE_TTL_SECONDS)
+
+# Set once this worker has moved legacy users.enrolled_courses arrays into enrollments
+# (backfill_enrolled_courses, run at startup); until then membership also reads the array
+enrolled_courses_migrated = False
+
+async def get_enrolled_course_ids(user_id: str, min_version: int = 0) -> frozenset:
+    cached = membership_cache.get(user_id)
+    if cached is not None and cached[0] >= min_version:
+        return cached[1]
+    enrollments = await db.enrollments.find(
+        {"user_id": user_id, "payment_status": "completed"}, {"_id": 0, "course_id": 1}
+    ).to_list(None)
+    course_ids = frozenset(enrollment["course_id"] for enrollment in enrollments)
+    if not enrolled_courses_migrated:
+        user = await db.users.find_one({"id": user_id}, {"_id": 0, "enrolled_courses": 1})
+        course_ids |= frozenset((user or {}).get("enrolled_courses") or [])
+    # Read after the token was issued, so current for (at least) its version
+    membership_cache.set(user_id, (min_version, course_ids))
+    return course_ids
+
+async def user_is_enrolled(user_id: str, course_id: str, min_version: int = 0) -> bool:
+    return course_id in await get_enrolled_course_ids(user_id, min_version)
+
+# Record that these users' completed enrollments changed, for tokens issued from now on
+async def bump_membership_versions(user_ids: List[str]):
+    if len(user_ids) == 1:
+        await db.users.update_one({"id": user_ids[0]}, {"$inc": {"membership_version": 1}})
+    elif user_ids:
+        await db.users.update_many({"id": {"$in": user_ids}}, {"$inc": {"membership_version": 1}})
+    for user_id in user_ids:
+        membership_cache.invalidate(user_id)
+
+# courses.student_count increments, coalesced per course and flushed periodically.
+# Recount from enrollments with `python -m backend.database.enrollments`.
+student_count_flusher = CounterFlusher(db.courses, "student_count", interval=COUNTER_FLUSH_INTERVAL_SECONDS)
+
+# Playback heartbeats, coalesced per enrollment and flushed periodically
+heartbeat_buffer = HeartbeatBuffer(
+    db.enrollments, interval=HEARTBEAT_FLUSH_INTERVAL_SECONDS, max_entries=HEARTBEAT_BUFFER_MAX_ENTRIES
+)
+
+PROGRESS_PROJECTION = {
+    "_id": 0,
+    "progress": 1,
+    "completed_lessons": 1,
+    "last_accessed_at": 1,
+    "last_lesson_id": 1,
+    "last_position_seconds": 1
+}
+
+# Mark a lesson completed and recompute progress in the same update: the size of
+# completed_lessons against the course's stored lesson_count, so no lessons are read.
+# None if the user has no completed enrollment.
+async def complete_lesson(user_id: str, course_id: str, lesson_id: str, lesson_count: int) -> Optional[dict]:
+    now = datetime.utcnow()
+    return await db.enrollments.find_one_and_update(
+        {"user_id": user_id, "course_id": course_id, "payment_status": "completed"},
+        [
+            {"$set": {
+                "completed_lessons": {"$setUnion": [{"$ifNull": ["$completed_lessons", []]}, [lesson_id]]},
+                "last_accessed_at": {"$max": ["$last_accessed_at", now]},
+                "last_lesson_id": lesson_id
+            }},
+            {"$set": {"progress": {"$min": [
+                100,
+                {"$multiply": [100, {"$divide": [{"$size": "$completed_lessons"}, max(lesson_count, 1)]}]}
+            ]}}},
+        ],
+        projection=PROGRESS_PROJECTION,
+        return_document=ReturnDocument.AFTER
+    )
+
+# Public catalog responses; bump on every course or lesson mutation
+catalog_cache = CatalogCache(db.counters, max_age=CATALOG_CACHE_MAX_AGE_SECONDS)
+
+# The current principal from the access token's claims: id, email, role, token_version
+# and membership_version. Load the full document with get_user_profile where it is needed.
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    try:
+        payload = decode_token(credentials.credentials, "access")
+    except jwt.PyJWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if "typ" not in payload:
+        return await get_legacy_principal(payload)
+    user_id = payload.get("uid")
+    if user_id is None or payload.get("sub") is None or payload.get("role") is None or payload.get("jti") is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if await revocation_list.is_revoked(payload["jti"]):
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    
+    state = await get_token_version(user_id)
+    if state is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    token_version, is_active = state
+    if not is_active:
+        raise HTTPException(status_code=401, detail="Account is disabled")
+    if payload.get("tv", 0) != token_version:
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    return {
+        "id": user_id,
+        "email": payload["sub"],
+        "role": payload["role"],
+        "token_version": token_version,
+        "membership_version": payload.get("mv", 0),
+        "jti": payload["jti"],
+        "expires_at": datetime.utcfromtimestamp(payload["exp"])
+    }
+
+# Principal for an access token issued before claims were added (only sub and exp),
+# resolved from the user record so deploying claims signs nobody out. Such tokens have no
+# jti or token_version: they cannot be revoked one by one and any token_version bump
+# rejects them. They are gone once the last one expires.
+async def get_legacy_principal(payload: dict) -> dict:
+    if not isinstance(payload.get("sub"), str) or "exp" not in payload:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    user = await db.users.find_one(
+        {"email": payload["sub"]},
+        {"_id": 0, "id": 1, "role": 1, "is_active": 1, "token_version": 1, "membership_version": 1}
+    )
+    if user is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    if not user.get("is_active", True):
+        raise HTTPException(status_code=401, detail="Account is disabled")
+    if user.get("token_version", 0) != 0:
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    return {
+        "id": user["id"],
+        "email": payload["sub"],
+        "role": user["role"],
+        "token_version": 0,
+        "membership_version": user.get("membership_version", 0),
+        "jti": None,
+        "expires_at": datetime.utcfromtimestamp(payload["exp"])
+    }
+
+# Completed enrollment count per user_id (or course_id), in one round trip instead of one per document
+async def get_completed_enrollment_counts(group_by: str = "user_id", ids: Optional[List[str]] = None) -> Dict[str, int]:
+    match = {"payment_status": "completed"}
+    if ids is not None:
+        match[group_by] = {"$in": ids}
+    pipeline = [
+        {"$match": match},
+        {"$group": {"_id": f"${group_by}", "enrollments": {"$sum": 1}}},
+    ]
+    return {row["_id"]: row["enrollments"] async for row in db.enrollments.aggregate(pipeline)}
+
+def course_revenue(course: dict, enrollments: int) -> float:
+    if course["course_type"] != "paid":
+        return 0
+    return (course.get("price") or 0) * enrollments
+
+def rollup_day(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, moment.day)
+
+class RollupRebuildRunning(RuntimeError):
+    pass
+
+async def get_rollup_rebuild_lease() -> Optional[dict]:
+    return await db.rollup_rebuild_leases.find_one({"_id": "daily_rollups", "expires_at": {"$gt": datetime.utcnow()}})
+
+# Daily enrollment/revenue buckets keyed by (day, course_id, course_type), maintained
+# incrementally by every write path that completes an enrollment, with the completed_at
+# it stamped, so dashboards read O(days) documents. While a rebuild holds the lease,
+# enrollments completed before its cutoff are left to the rebuild and later ones go to
+# daily_rollup_journal, which it replays once the rebuilt buckets are live.
+async def record_daily_rollup(course: dict, completed_at: Optional[datetime] = None, amount: Optional[float] = None,
+                              count: int = 1):
+    completed_at = completed_at or datetime.utcnow()
+    bucket = {"day": rollup_day(completed_at), "course_id": course["id"], "course_type": course["course_type"]}
+    increments = {
+        "enrollments": count,
+        "revenue": (amount if amount is not None else course_revenue(course, 1)) * count
+    }
+    lease = await get_rollup_rebuild_lease()
+    if lease is None:
+        await db.daily_rollups.update_one(bucket, {"$inc": increments}, upsert=True)
+    elif completed_at >= lease["cutoff"]:
+        await db.daily_rollup_journal.insert_one({**bucket, **increments})
+
+# Completed payments' amounts keyed by transaction id
+async def paid_amounts(transaction_ids: List[str]) -> Dict[str, float]:
+    if not transaction_ids:
+        return {}
+    payments = await db.payments.find(
+        {"transaction_id": {"$in": transaction_ids}, "status": "completed"},
+        {"_id": 0, "transaction_id": 1, "amount": 1}
+    ).to_list(None)
+    return {payment["transaction_id"]: payment["amount"] for payment in payments}
+
+# Revenue of one historical enrollment: its completed payment, else nothing for a bulk
+# grant, else the course price (paid enrollments older than their payment records)
+def rebuilt_revenue(course: dict, enrollment: dict, amounts: Dict[str, float]) -> float:
+    if enrollment.get("transaction_id") in amounts:
+        return amounts[enrollment["transaction_id"]]
+    if enrollment.get("bulk_job_id"):
+        return 0
+    return course_revenue(course, 1)
+
+async def replay_rollup_journal(batch_size: int = ROLLUP_BATCH_SIZE) -> int:
+    replayed = 0
+    while True:
+        entries = await db.daily_rollup_journal.find({}).limit(batch_size).to_list(None)
+        if not entries:
+            return replayed
+        buckets = defaultdict(lambda: {"enrollments": 0, "revenue": 0})
+        for entry in entries:
+            totals = buckets[(entry["day"], entry["course_id"], entry["course_type"])]
+            totals["enrollments"] += entry["enrollments"]
+            totals["revenue"] += entry["revenue"]
+        await db.daily_rollups.bulk_write([
+            UpdateOne({"day": day, "course_id": course_id, "course_type": course_type}, {"$inc": totals}, upsert=True)
+            for (day, course_id, course_type), totals in buckets.items()
+        ], ordered=False)
+        await db.daily_rollup_journal.delete_many({"_id": {"$in": [entry["_id"] for entry in entries]}})
+        replayed += len(entries)
+
+# Recompute daily_rollups from the enrollment history without losing live writes (also
+# `python -m backend.database.rollups`). The rebuild takes a lease whose cutoff is a grace
+# period ahead and waits until every enrollment completed before it has landed; those are
+# bucketed into a scratch collection by the day they were completed, while completions after
+# the cutoff are journaled. The scratch collection then atomically replaces the live one and
+# the journal is replayed into it until the lease has been released. Returns the bucket count.
+async def rebuild_daily_rollups(batch_size: int = ROLLUP_BATCH_SIZE, grace_seconds: Optional[float] = None) -> int:
+    grace = timedelta(seconds=ROLLUP_REBUILD_GRACE_SECONDS if grace_seconds is None else grace_seconds)
+    now = datetime.utcnow()
+    cutoff = now + grace
+    try:
+        await db.rollup_rebuild_leases.find_one_and_update(
+            {"_id": "daily_rollups", "expires_at": {"$lte": now}},
+            {"$set": {"cutoff": cutoff, "expires_at": now + timedelta(seconds=ROLLUP_REBUILD_LEASE_SECONDS)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        raise RollupRebuildRunning("Another daily_rollups rebuild is running")
+
+    try:
+        # Left behind by a rebuild that died, and recounted below; nothing is journaled
+        # against this lease before its cutoff
+        await db.daily_rollup_journal.delete_many({})
+        scratch = db.daily_rollups_rebuild
+        await scratch.drop()
+        await scratch.create_indexes(REQUIRED_INDEXES["daily_rollups"])
+        await asyncio.sleep((cutoff + grace - datetime.utcnow()).total_seconds())
+
+        courses = {}
+        batch = []
+
+        async def flush():
+            amounts = await paid_amounts([
+                enrollment["transaction_id"] for enrollment in batch if enrollment.get("transaction_id")
+            ])
+            buckets = defaultdict(lambda: {"enrollments": 0, "revenue": 0})
+            for enrollment in batch:
+                course = courses[enrollment["course_id"]]
+                totals = buckets[(
+                    rollup_day(enrollment.get("completed_at") or enrollment["enrolled_at"]),
+                    course["id"], course["course_type"]
+                )]
+                totals["enrollments"] += 1
+                totals["revenue"] += rebuilt_revenue(course, enrollment, amounts)
+            batch.clear()
+            if buckets:
+                await scratch.bulk_write([
+                    UpdateOne({"day": day, "course_id": course_id, "course_type": course_type}, {"$inc": totals}, upsert=True)
+                    for (day, course_id, course_type), totals in buckets.items()
+                ], ordered=False)
+            await db.rollup_rebuild_leases.update_one(
+                {"_id": "daily_rollups", "cutoff": cutoff},
+                {"$set": {"expires_at": datetime.utcnow() + timedelta(seconds=ROLLUP_REBUILD_LEASE_SECONDS)}}
+            )
+
+        cursor = db.enrollments.find(
+            {"payment_status": "completed", "$or": [{"completed_at": {"$lt": cutoff}}, {"completed_at": None}]},
+            {"_id": 0, "course_id": 1, "enrolled_at": 1, "completed_at": 1, "transaction_id": 1, "bulk_job_id": 1}
+        ).batch_size(batch_size)
+        async for enrollment in cursor:
+            course_id = enrollment["course_id"]
+            if course_id not in courses:
+                courses[course_id] = await db.courses.find_one(
+                    {"id": course_id}, {"_id": 0, "id": 1, "course_type": 1, "price": 1}
+                )
+            if courses[course_id] is None:
+                continue
+            batch.append(enrollment)
+            if len(batch) >= batch_size:
+                await flush()
+        await flush()
+
+        written = await scratch.count_documents({})
+        await scratch.rename("daily_rollups", dropTarget=True)
+        await replay_rollup_journal(batch_size)
+    finally:
+        await db.rollup_rebuild_leases.delete_one({"_id": "daily_rollups", "cutoff": cutoff})
+    # Writers that read the lease just before it was released journal after the first replay
+    await asyncio.sleep(grace.total_seconds())
+    await replay_rollup_journal(batch_size)
+    return written
+
+# Rebuild daily_rollups at startup when it is empty but completed enrollments exist
+async def backfill_daily_rollups():
+    try:
+        if await db.daily_rollups.find_one({}) is not None:
+            return
+        if await db.enrollments.find_one({"payment_status": "completed"}) is None:
+            return
+        written = await rebuild_daily_rollups()
+        logger.info("Backfilled daily_rollups: %d buckets", written)
+    except RollupRebuildRunning:
+        return
+    except PyMongoError as exc:
+        logger.error("Could not backfill daily_rollups: %s", exc)
+
+# Enroll a user in a free course with one atomic upsert keyed by the unique
+# (user_id, course_id) index: concurrent or retried requests settle on one enrollment
+# and only the request that completed it counts it. False if already enrolled.
+async def complete_free_enrollment(user_id: str, course: dict) -> bool:
+    enrollment = Enrollment(user_id=user_id, course_id=course["id"], payment_status="completed")
+    try:
+        await db.enrollments.update_one(
+            {"user_id": user_id, "course_id": course["id"], "payment_status": {"$ne": "completed"}},
+            {
+                "$set": {"payment_status": "completed", "completed_at": enrollment.enrolled_at},
+                "$setOnInsert": enrollment.dict(exclude={"user_id", "course_id", "payment_status", "completed_at"})
+            },
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Already completed, or a concurrent request inserted the enrollment first
+        return False
+    await bump_membership_versions([user_id])
+    student_count_flusher.add(course["id"])
+    await record_daily_rollup(course, enrollment.enrolled_at)
+    return True
+
+# Payment attempts that have not completed; reused by the next attempt, archived once expired
+OPEN_PAYMENT_STATUSES = ["pending", "failed"]
+
+# The user's open enrollment in a paid course, created if needed. One upsert keyed by the
+# unique (user_id, course_id) index reuses a pending or failed attempt and pushes its
+# expiry out, so repeated clicks never add rows. None if the enrollment is completed.
+async def open_pending_enrollment(user_id: str, course_id: str) -> Optional[dict]:
+    enrollment = Enrollment(user_id=user_id, course_id=course_id)
+    for _ in range(2):
+        expires_at = datetime.utcnow() + timedelta(seconds=PENDING_ENROLLMENT_TTL_SECONDS)
+        try:
+            return await db.enrollments.find_one_and_update(
+                {"user_id": user_id, "course_id": course_id, "payment_status": {"$in": OPEN_PAYMENT_STATUSES}},
+                {
+                    "$set": {"payment_status": "pending", "expires_at": expires_at},
+                    "$setOnInsert": enrollment.dict(exclude={"user_id", "course_id", "payment_status", "expires_at"})
+                },
+                projection={"_id": 0},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Either the enrollment is completed, or a concurrent click inserted the
+            # pending one first and the retry will match it
+            continue
+    return None
+
+def expired_enrollment_query(now: datetime) -> dict:
+    return {
+        "payment_status": {"$in": OPEN_PAYMENT_STATUSES},
+        "$or": [
+            {"expires_at": {"$lt": now}},
+            # Attempts created before expires_at was recorded
+            {"expires_at": None, "enrolled_at": {"$lt": now - timedelta(seconds=PENDING_ENROLLMENT_TTL_SECONDS)}},
+        ]
+    }
+
+# Move expired pending and failed enrollments into enrollments_archive so the hot
+# collection only holds meaningful rows. Each batch is copied before it is deleted and
+# the delete re-checks the expiry, so an attempt reopened or completed meanwhile stays
+# live (its archive copy is dropped). Safe to run from several workers at once.
+async def archive_expired_enrollments(batch_size: int = SWEEP_BATCH_SIZE) -> int:
+    archived = 0
+    while True:
+        now = datetime.utcnow()
+        batch = await db.enrollments.find(expired_enrollment_query(now), {"_id": 0}).limit(batch_size).to_list(None)
+        if not batch:
+            return archived
+        ids = [enrollment["id"] for enrollment in batch]
+        await db.enrollments_archive.bulk_write([
+            ReplaceOne({"id": enrollment["id"]}, {**enrollment, "archived_at": now}, upsert=True)
+            for enrollment in batch
+        ], ordered=False)
+        result = await db.enrollments.delete_many({**expired_enrollment_query(now), "id": {"$in": ids}})
+        if result.deleted_count < len(ids):
+            still_live = await db.enrollments.distinct("id", {"id": {"$in": ids}})
+            await db.enrollments_archive.delete_many({"id": {"$in": still_live}})
+        archived += result.deleted_count
+        if len(batch) < batch_size:
+            return archived
+
+# Give each course in a user's legacy enrolled_courses array a completed enrollment, then
+# unset the array, so an interrupted run can simply be repeated. Courses gaining students
+# are recounted. Runs in the background at startup; returns the number of users migrated.
+async def migrate_enrolled_courses(batch_size: int = MIGRATION_BATCH_SIZE) -> int:
+    migrated, recount = 0, set()
+    cursor = db.users.find(
+        {"enrolled_courses": {"$exists": True}}, {"_id": 0, "id": 1, "enrolled_courses": 1}
+    ).batch_size(batch_size)
+    async for user in cursor:
+        course_ids = user.get("enrolled_courses") or []
+        if course_ids:
+            try:
+                await db.enrollments.bulk_write([
+                    UpdateOne(
+                        {"user_id": user["id"], "course_id": course_id},
+                        {
+                            "$set": {"payment_status": "completed"},
+                            "$setOnInsert": {
+                                "id": str(uuid.uuid4()), "enrolled_at": datetime.utcnow(), "progress": 0.0, "completed_lessons": []
+                            }
+                        },
+                        upsert=True
+                    )
+                    for course_id in course_ids
+                ], ordered=False)
+            except BulkWriteError as exc:
+                # Another worker's backfill created the same enrollment
+                if any(error.get("code") != 11000 for error in exc.details.get("writeErrors", [])):
+                    raise
+            recount.update(course_ids)
+        await db.users.update_one({"id": user["id"]}, {"$unset": {"enrolled_courses": ""}})
+        migrated += 1
+    for course_id in recount:
+        students = await db.enrollments.count_documents({"course_id": course_id, "payment_status": "completed"})
+        await db.courses.update_one({"id": course_id}, {"$set": {"student_count": students}})
+    return migrated
+
+async def backfill_enrolled_courses():
+    global enrolled_courses_migrated
+    try:
+        migrated = await migrate_enrolled_courses()
+        if migrated:
+            logger.info("Moved enrolled_courses of %d users into enrollments", migrated)
+    except PyMongoError as exc:
+        logger.error("Could not move enrolled_courses into enrollments: %s", exc)
+        return
+    enrolled_courses_migrated = True
+
+async def run_enrollment_sweeper():
+    while True:
+        try:
+            archived = await archive_expired_enrollments()
+            if archived:
+                logger.info("Archived %d expired pending enrollments", archived)
+        except PyMongoError as exc:
+            logger.error("Could not archive expired enrollments: %s", exc)
+        await asyncio.sleep(PENDING_ENROLLMENT_SWEEP_INTERVAL_SECONDS)
+
+# Local stand-in for the SSLCommerz session and validation APIs, reached in process
+# through an httpx ASGI transport when PAYMENT_GATEWAY=stub. Every session it opens is
+# paid successfully; post `stub_ipn_payload(tran_id)` to the IPN endpoint to complete one.
+gateway_stub = FastAPI(title="Payment gateway stub")
+gateway_stub_sessions: Dict[str, dict] = {}
+
+def stub_ipn_payload(tran_id: str) -> Dict[str, str]:
+    session = gateway_stub_sessions[tran_id]
+    return {
+        "status": "VALID",
+        "tran_id": tran_id,
+        "val_id": f"stub-{tran_id}",
+        "amount": session["total_amount"],
+        "currency": session["currency"]
+    }
+
+@gateway_stub.post("/gwprocess/v4/api.php")
+async def stub_create_session(request: Request):
+    await asyncio.sleep(PAYMENT_STUB_LATENCY_SECONDS)
+    fields = dict(parse_qsl((await request.body()).decode()))
+    if not fields.get("tran_id") or not fields.get("total_amount"):
+        return {"status": "FAILED", "failedreason": "tran_id and total_amount are required"}
+    
+    session_key = uuid.uuid4().hex
+    gateway_stub_sessions[fields["tran_id"]] = {**fields, "sessionkey": session_key}
+    return {"status": "SUCCESS", "sessionkey": session_key, "GatewayPageURL": f"{request.base_url}pay/{session_key}"}
+
+@gateway_stub.get("/validator/api/validationserverAPI.php")
+async def stub_validate(val_id: str):
+    await asyncio.sleep(PAYMENT_STUB_LATENCY_SECONDS)
+    tran_id = val_id[len("stub-"):] if val_id.startswith("stub-") else None
+    session = gateway_stub_sessions.get(tran_id)
+    if session is None:
+        return {"status": "INVALID_TRANSACTION", "val_id": val_id}
+    return {
+        "status": "VALID",
+        "tran_id": tran_id,
+        "val_id": val_id,
+        "amount": session["total_amount"],
+        "currency": session["currency"],
+        "bank_tran_id": f"stub-bank-{session['sessionkey']}",
+        "card_type": session.get("multi_card_name") or "STUB"
+    }
+
+# What a client may see of a payment; the raw gateway responses stay server-side
+PAYMENT_PROJECTION = {"_id": 0, "gateway_response": 0, "idempotency_key": 0}
+
+_payment_gateway: Optional[SSLCommerzClient] = None
+
+# Shared gateway client, created on first use so its pool lives on the serving loop
+def get_gateway() -> SSLCommerzClient:
+    global _payment_gateway
+    if _payment_gateway is None:
+        transport, base_url = None, SSLCOMMERZ_BASE_URL
+        if PAYMENT_GATEWAY == "stub":
+            transport, base_url = httpx.ASGITransport(app=gateway_stub), "http://gateway-stub"
+        _payment_gateway = SSLCommerzClient(
+            SSLCOMMERZ_STORE_ID,
+            SSLCOMMERZ_STORE_PASSWORD,
+            base_url=base_url,
+            timeout=PAYMENT_GATEWAY_TIMEOUT_SECONDS,
+            max_retries=PAYMENT_GATEWAY_MAX_RETRIES,
+            max_connections=PAYMENT_GATEWAY_MAX_CONNECTIONS,
+            transport=transport
+        )
+    return _payment_gateway
+
+async def close_gateway():
+    global _payment_gateway
+    if _payment_gateway is not None:
+        await _payment_gateway.aclose()
+        _payment_gateway = None
+
+# Payments that can no longer be paid; their idempotency key may be reused for a retry
+RETRYABLE_PAYMENT_STATUSES = ("failed", "cancelled")
+
+# The payment made under an idempotency key, or None if there is none or it failed. A
+# failed payment is moved off the key so the retry can take it; of concurrent retries
+# only one inserts, the others find its payment.
+async def find_idempotent_payment(user_id: str, idempotency_key: str) -> Optional[dict]:
+    existing = await db.payments.find_one({"user_id": user_id, "idempotency_key": idempotency_key}, PAYMENT_PROJECTION)
+    if existing is None or existing["status"] not in RETRYABLE_PAYMENT_STATUSES:
+        return existing
+    await db.payments.update_one(
+        {"id": existing["id"], "idempotency_key": idempotency_key},
+        {"$set": {"idempotency_key": f"{idempotency_key}:retried:{existing['id']}"}}
+    )
+    return None
+
+# Open a gateway checkout session for a paid course. Payments are unique on
+# (user_id, idempotency_key): repeating a request with the same key returns the payment
+# it created instead of charging again, unless that payment failed. Without a key the
+# user's open enrollment is the key, so repeated calls share one payable payment.
+async def initiate_payment(user: dict, course: dict, payment_method: PaymentMethod,
+                           idempotency_key: Optional[str] = None) -> dict:
+    if idempotency_key:
+        existing = await find_idempotent_payment(user["id"], idempotency_key)
+        if existing:
+            return existing
+    
+    enrollment = await open_pending_enrollment(user["id"], course["id"])
+    if enrollment is None:
+        raise HTTPException(status_code=400, detail="Already enrolled in this course")
+    if not idempotency_key:
+        idempotency_key = f"enrollment:{enrollment['id']}"
+        existing = await find_idempotent_payment(user["id"], idempotency_key)
+        if existing:
+            return existing
+    
+    payment = Payment(
+        user_id=user["id"],
+        course_id=course["id"],
+        enrollment_id=enrollment["id"],
+        amount=course["price"],
+        payment_method=payment_method
+    )
+    payment.transaction_id = payment.id  # tran_id sent to the gateway
+    try:
+        await db.payments.insert_one({**payment.dict(), "idempotency_key": idempotency_key})
+    except DuplicateKeyError:
+        # A concurrent request with the same key got there first
+        return await db.payments.find_one({"user_id": user["id"], "idempotency_key": idempotency_key}, PAYMENT_PROJECTION)
+    
+    return_url = f"{PAYMENT_RETURN_URL}?payment_id={payment.id}"
+    try:
+        session = await get_gateway().create_session({
+            "total_amount": f"{payment.amount:.2f}",
+            "currency": payment.currency,
+            "tran_id": payment.transaction_id,
+            "success_url": return_url,
+            "fail_url": return_url,
+            "cancel_url": return_url,
+            "ipn_url": f"{PUBLIC_API_URL}/api/payments/ipn",
+            "multi_card_name": payment.payment_method.value,
+            "product_name": course.get("title", "Course"),
+            "product_category": "Education",
+            "product_profile": "non-physical-goods",
+            "shipping_method": "NO",
+            "cus_name": user.get("full_name", ""),
+            "cus_email": user.get("email", ""),
+            "cus_phone": user.get("phone") or "N/A",
+            "cus_add1": "N/A",
+            "cus_city": "N/A",
+            "cus_country": "Bangladesh",
+            "value_a": payment.enrollment_id
+        })
+    except GatewayError as exc:
+        await db.payments.update_one(
+            {"id": payment.id},
+            {"$set": {"status": "failed", "gateway_response": {"error": str(exc)}, "updated_at": datetime.utcnow()}}
+        )
+        raise HTTPException(status_code=502, detail="Payment gateway unavailable, please try again")
+    
+    await db.payments.update_one({"id": payment.id}, {"$set": {
+        "gateway_session_key": session.get("sessionkey"),
+        "gateway_url": session["GatewayPageURL"],
+        "updated_at": datetime.utcnow()
+    }})
+    return await db.payments.find_one({"id": payment.id}, PAYMENT_PROJECTION)
+
+# "failed" or "cancelled" if the gateway's validation answer says this payment did not go through
+def validated_failure(payment: dict, validation: dict) -> Optional[str]:
+    if validation.get("tran_id") != payment["transaction_id"]:
+        return None
+    return GATEWAY_FAILED_STATUSES.get(validation.get("status"))
+
+# Whether the gateway's validation answer confirms this payment as paid in full
+def validation_matches(payment: dict, validation: dict) -> bool:
+    try:
+        amount_matches = abs(float(validation.get("amount", 0)) - payment["amount"]) < 0.01
+    except (TypeError, ValueError):
+        return False
+    return (
+        validation.get("status") in GATEWAY_VALID_STATUSES
+        and validation.get("tran_id") == payment["transaction_id"]
+        and amount_matches
+        and validation.get("currency", payment["currency"]) == payment["currency"]
+    )
+
+# Worker pool draining the payment_callbacks inbox in batches. Each worker claims up to
+# `batch_size` due callbacks by pushing their available_at out by `lease_seconds`, so a
+# callback held by a worker that died is picked up again once its lease runs out; a batch
+# that raises is released for a retry straight away. A batch reads its payments with one
+# $in query, validates every callback with the gateway concurrently, and writes payments,
+# enrollments and the callbacks themselves with one bulk write each. Only the validation
+# answer changes a payment: a callback without a val_id, or whose validation neither
+# confirms nor fails the payment, is recorded as "unverified" and leaves the payment as
+# it was. Only enrollments not completed yet are counted. Callbacks whose validation
+# could not reach the gateway are retried later, up to `max_attempts` claims.
+class PaymentInbox:
+    def __init__(
+        self,
+        workers: int = 2,
+        batch_size: int = 100,
+        poll_interval: float = 1.0,
+        lease_seconds: float = 60.0,
+        max_attempts: int = 8,
+        retry_seconds: float = 30.0
+    ):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self.duplicates = 0
+        self.batches = 0
+        self.processed = 0
+        self.settled = 0
+        self.retried = 0
+        self.dead = 0
+        self.failures = 0
+    
+    # Wake the workers of this process instead of waiting for the next poll
+    def notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+    
+    async def claim(self) -> List[dict]:
+        now = datetime.utcnow()
+        due = {"status": {"$in": ["queued", "processing"]}, "available_at": {"$lte": now}}
+        candidates = await db.payment_callbacks.find(due, {"_id": 0, "id": 1}).sort(
+            "available_at", 1
+        ).limit(self.batch_size).to_list(None)
+        if not candidates:
+            return []
+        
+        token = uuid.uuid4().hex
+        await db.payment_callbacks.update_many(
+            {**due, "id": {"$in": [candidate["id"] for candidate in candidates]}},
+            {
+                "$set": {"status": "processing", "claim": token, "available_at": now + timedelta(seconds=self.lease_seconds)},
+                "$inc": {"attempts": 1}
+            }
+        )
+        return await db.payment_callbacks.find({"claim": token, "status": "processing"}, {"_id": 0}).to_list(None)
+    
+    # Settle one claimed batch; returns each callback's outcome by id
+    async def process(self, callbacks: List[dict]) -> Dict[str, str]:
+        now = datetime.utcnow()
+        payments = {
+            payment["transaction_id"]: payment
+            for payment in await db.payments.find(
+                {"transaction_id": {"$in": [callback["transaction_id"] for callback in callbacks]}}, {"_id": 0}
+            ).to_list(None)
+        }
+        
+        outcomes: Dict[str, str] = {}
+        failed: List[Tuple[dict, str, dict]] = []
+        to_validate: List[Tuple[dict, dict]] = []
+        resettled: List[Tuple[dict, None]] = []
+        for callback in callbacks:
+            payment = payments.get(callback["transaction_id"])
+            if payment is None:
+                outcomes[callback["id"]] = "unknown_transaction"
+            elif payment["status"] == "completed":
+                # A no-op unless an earlier attempt stopped before completing the enrollment
+                outcomes[callback["id"]] = "completed"
+                resettled.append((payment, None))
+            elif not callback["form"].get("val_id"):
+                outcomes[callback["id"]] = "unverified"
+            else:
+                to_validate.append((callback, payment))
+        
+        # The notification body is never trusted on its own, whatever status it claims
+        validations = await asyncio.gather(
+            *(get_gateway().validate(callback["form"].get("val_id", "")) for callback, _ in to_validate),
+            return_exceptions=True
+        )
+        settled: List[Tuple[dict, dict]] = []
+        retry: Dict[str, str] = {}
+        for (callback, payment), validation in zip(to_validate, validations):
+            if isinstance(validation, GatewayError):
+                retry[callback["id"]] = str(validation)
+            elif isinstance(validation, BaseException):
+                raise validation
+            elif validation_matches(payment, validation):
+                outcomes[callback["id"]] = "completed"
+                settled.append((payment, validation))
+            elif validated_failure(payment, validation):
+                outcomes[callback["id"]] = validated_failure(payment, validation)
+                failed.append((payment, outcomes[callback["id"]], validation))
+            else:
+                outcomes[callback["id"]] = "unverified"
+        
+        await self._write_payments(settled, failed, now)
+        await self._complete_enrollments(settled + resettled, now)
+        if failed:
+            await db.enrollments.update_many(
+                {"id": {"$in": [payment["enrollment_id"] for payment, _, _ in failed]}, "payment_status": "pending"},
+                {"$set": {"payment_status": "failed"}}
+            )
+        await self._write_callbacks(callbacks, outcomes, retry, now)
+        return outcomes
+    
+    async def _write_payments(self, settled, failed, now: datetime):
+        operations = [
+            UpdateOne(
+                {"id": payment["id"], "status": {"$ne": "completed"}},
+                {"$set": {
+                    "status": "completed",
+                    "gateway_transaction_id": validation.get("bank_tran_id") or validation.get("val_id"),
+                    "gateway_response": validation,
+                    "completed_at": now,
+                    "updated_at": now
+                }}
+            )
+            for payment, validation in settled
+        ] + [
+            UpdateOne(
+                {"id": payment["id"], "status": "pending"},
+                {"$set": {"status": status, "gateway_response": response, "updated_at": now}}
+            )
+            for payment, status, response in failed
+        ]
+        if operations:
+            await db.payments.bulk_write(operations, ordered=False)
+    
+    # Complete the enrollment of each settled payment, recreating one archived meanwhile
+    async def _complete_enrollments(self, settled, now: datetime):
+        if not settled:
+            return
+        operations = [
+            UpdateOne(
+                {"user_id": payment["user_id"], "course_id": payment["course_id"], "payment_status": {"$ne": "completed"}},
+                {
+                    "$set": {
+                        "payment_status": "completed",
+                        "completed_at": now,
+                        "transaction_id": payment["transaction_id"],
+                        "payment_method": payment["payment_method"]
+                    },
+                    "$unset": {"expires_at": ""},
+                    "$setOnInsert": {"id": payment["enrollment_id"], "enrolled_at": now, "progress": 0.0, "completed_lessons": []}
+                },
+                upsert=True
+            )
+            for payment, _ in settled
+        ]
+        already_completed = set()
+        try:
+            await db.enrollments.bulk_write(operations, ordered=False)
+        except BulkWriteError as exc:
+            # The upsert hits the unique (user_id, course_id) index when the
+            # enrollment is already completed
+            errors = exc.details.get("writeErrors", [])
+            if any(error.get("code") != 11000 for error in errors):
+                raise
+            already_completed = {error["index"] for error in errors}
+        
+        enrolled: Dict[Tuple[str, float], int] = defaultdict(int)
+        enrolled_users = set()
+        for index, (payment, _) in enumerate(settled):
+            if index in already_completed:
+                continue
+            enrolled_users.add(payment["user_id"])
+            student_count_flusher.add(payment["course_id"])
+            enrolled[(payment["course_id"], payment["amount"])] += 1
+        self.settled += sum(enrolled.values())
+        await bump_membership_versions(list(enrolled_users))
+        
+        courses = {
+            course["id"]: course
+            for course in await db.courses.find(
+                {"id": {"$in": list({course_id for course_id, _ in enrolled})}},
+                {"_id": 0, "id": 1, "course_type": 1, "price": 1}
+            ).to_list(None)
+        }
+        for (course_id, amount), count in enrolled.items():
+            if course_id in courses:
+                await record_daily_rollup(courses[course_id], now, amount=amount, count=count)
+    
+    async def _write_callbacks(self, callbacks, outcomes: Dict[str, str], retry: Dict[str, str], now: datetime):
+        operations = []
+        for callback in callbacks:
+            if callback["id"] in outcomes:
+                update = {"status": "processed", "outcome": outcomes[callback["id"]], "processed_at": now}
+            elif callback["attempts"] >= self.max_attempts:
+                update = {"status": "failed", "last_error": retry[callback["id"]], "processed_at": now}
+                self.dead += 1
+                logger.error("Giving up on payment callback for %s: %s", callback["transaction_id"], retry[callback["id"]])
+            else:
+                update = {
+                    "status": "queued",
+                    "last_error": retry[callback["id"]],
+                    "available_at": now + timedelta(seconds=self.retry_seconds * callback["attempts"])
+                }
+                self.retried += 1
+            operations.append(UpdateOne({"id": callback["id"], "claim": callback["claim"]}, {"$set": update}))
+        await db.payment_callbacks.bulk_write(operations, ordered=False)
+        self.processed += len(outcomes)
+    
+    # Queue a batch whose processing raised for a retry, counting the attempt
+    async def _release(self, callbacks, exc: Exception):
+        error = f"{type(exc).__name__}: {exc}"
+        try:
+            await self._write_callbacks(callbacks, {}, {callback["id"]: error for callback in callbacks}, datetime.utcnow())
+        except PyMongoError as release_error:
+            # They become due again once their lease runs out
+            logger.error("Could not release payment callbacks: %s", release_error)
+    
+    # Process batches until no callback is due; returns the callbacks processed
+    async def drain(self) -> int:
+        total = 0
+        while True:
+            callbacks = await self.claim()
+            if not callbacks:
+                return total
+            try:
+                await self.process(callbacks)
+            except Exception as exc:
+                await self._release(callbacks, exc)
+                raise
+            self.batches += 1
+            total += len(callbacks)
+    
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.drain()
+            except Exception as exc:  # The failed batch was released; keep the worker alive
+                self.failures += 1
+                logger.error("Could not process payment callbacks: %s", exc)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+    
+    # Start the worker pool on the running loop
+    def start(self) -> List[asyncio.Task]:
+        if not self._tasks:
+            self._wakeup = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            self._tasks = [loop.create_task(self._run()) for _ in range(self.workers)]
+        return self._tasks
+    
+    # Stop the workers; callbacks they held are retried after their lease
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._wakeup = None
+    
+    def stats(self) -> dict:
+        return {
+            "workers": len(self._tasks),
+            "duplicates": self.duplicates,
+            "batches": self.batches,
+            "processed": self.processed,
+            "settled": self.settled,
+            "retried": self.retried,
+            "dead": self.dead,
+            "failures": self.failures
+        }
+
+# Gateway notifications, acknowledged on receipt and settled by the workers
+payment_inbox = PaymentInbox(
+    workers=PAYMENT_INBOX_WORKERS,
+    batch_size=PAYMENT_INBOX_BATCH_SIZE,
+    poll_interval=PAYMENT_INBOX_POLL_INTERVAL_SECONDS,
+    lease_seconds=PAYMENT_INBOX_LEASE_SECONDS,
+    max_attempts=PAYMENT_INBOX_MAX_ATTEMPTS,
+    retry_seconds=PAYMENT_INBOX_RETRY_SECONDS
+)
+
+def callback_digest(form: Dict[str, str]) -> str:
+    return hashlib.sha256(json.dumps(form, sort_keys=True).encode()).hexdigest()
+
+# Append a gateway notification to the inbox; False if it is a duplicate. Callbacks are
+# unique on (transaction_id, body), so gateway retries of the same notification are
+# dropped here, as is anything for a transaction a callback already completed. A
+# different body for a transaction (a failed attempt, or a forged body, followed by the
+# genuine success) is queued as its own callback and validated on its own; none ever
+# replaces another, so a forged body cannot displace the genuine notification.
+async def record_callback(form: Dict[str, str]) -> bool:
+    callback = PaymentCallback(transaction_id=form["tran_id"], form_digest=callback_digest(form), form=form)
+    if await db.payment_callbacks.find_one(
+        {"transaction_id": callback.transaction_id, "outcome": "completed"}, {"_id": 1}
+    ) is not None:
+        payment_inbox.duplicates += 1
+        return False
+    try:
+        result = await db.payment_callbacks.update_one(
+            {"transaction_id": callback.transaction_id, "form_digest": callback.form_digest},
+            {"$setOnInsert": callback.dict(exclude={"transaction_id", "form_digest"})},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # A concurrent delivery of the same notification got there first
+        return False
+    if result.upserted_id is None:
+        payment_inbox.duplicates += 1
+        return False
+    
+    payment_inbox.notify()
+    return True
+
+# Split a streamed request body into text lines, holding only the current partial line
+async def iter_lines(chunks, max_line_bytes: int = MAX_LINE_BYTES):
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        if len(buffer) > max_line_bytes:
+            raise ValueError(f"Line longer than {max_line_bytes} bytes")
+        for line in lines:
+            yield line.decode("utf-8", errors="replace").rstrip("\r")
+    if buffer:
+        yield buffer.decode("utf-8", errors="replace").rstrip("\r")
+
+# (row_number, record) from CSV lines; a first line naming the `required` columns (all
+# of `columns` by default) is the header, otherwise values are taken in `columns` order.
+# Blank lines are skipped and not numbered.
+async def parse_csv_records(lines, columns: Tuple[str, ...] = ("email", "course_id"), required: Optional[List[str]] = None):
+    required = required or columns
+    header = None
+    row_number = 0
+    async for line in lines:
+        if not line.strip():
+            continue
+        values = next(csv.reader([line.lstrip("\ufeff")]))
+        if row_number == 0 and header is None:
+            names = [value.strip().lower() for value in values]
+            if set(required) <= set(names):
+                header = names
+                continue
+        row_number += 1
+        yield row_number, dict(zip(header or columns, values))
+
+# (row_number, record) from newline-delimited JSON objects; bad lines yield an empty record
+async def parse_ndjson_records(lines):
+    row_number = 0
+    async for line in lines:
+        if not line.strip():
+            continue
+        row_number += 1
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield row_number, record if isinstance(record, dict) else {}
+
+BULK_ROW_STATUSES = ["enrolled", "already_enrolled", "user_not_found", "course_not_found", "invalid"]
+
+# One cohort enrollment upload, processed a batch of rows at a time. Each batch resolves
+# its emails and unseen course ids with one $in query each and enrolls with one unordered
+# bulk_write of upserts keyed by the unique (user_id, course_id) index; a duplicate key
+# error marks a row whose enrollment was already completed. Result rows are written per
+# batch to bulk_enrollment_rows, so memory is bounded by the batch size and the number of
+# distinct courses. student_count and the daily rollups are updated once per course per
+# batch, and each enrollment records the job that granted it.
+class BulkEnrollment:
+    def __init__(self, job_id: str, batch_size: int = BULK_ENROLL_BATCH_SIZE):
+        self.job_id = job_id
+        self.batch_size = batch_size
+        self.created_at = datetime.utcnow()
+        self.counts = {status: 0 for status in BULK_ROW_STATUSES}
+        self.rows = 0
+        self._courses = {}
+
+    async def run(self, records) -> dict:
+        batch = []
+        async for row_number, record in records:
+            batch.append((row_number, record))
+            if len(batch) >= self.batch_size:
+                await self._process(batch)
+                batch = []
+        if batch:
+            await self._process(batch)
+        return {"job_id": self.job_id, "rows": self.rows, "results": self.counts}
+
+    async def _process(self, batch):
+        pairs = [
+            (row_number, str(record.get("email") or "").strip(), str(record.get("course_id") or "").strip())
+            for row_number, record in batch
+        ]
+        emails = list({email for _, email, course_id in pairs if email and course_id})
+        users = {
+            user["email"]: user["id"]
+            for user in await db.users.find({"email": {"$in": emails}}, {"_id": 0, "id": 1, "email": 1}).to_list(None)
+        }
+        unseen = list({course_id for _, _, course_id in pairs if course_id and course_id not in self._courses})
+        if unseen:
+            found = await db.courses.find(
+                {"id": {"$in": unseen}, "is_active": True}, {"_id": 0, "id": 1, "course_type": 1, "price": 1}
+            ).to_list(None)
+            self._courses.update({course_id: None for course_id in unseen})
+            self._courses.update({course["id"]: course for course in found})
+
+        completed_at = datetime.utcnow()
+        results = []
+        operations = []
+        pending = []
+        for row_number, email, course_id in pairs:
+            result = {
+                "job_id": self.job_id, "row": row_number, "email": email, "course_id": course_id,
+                "created_at": self.created_at
+            }
+            results.append(result)
+            if not email or not course_id:
+                result["status"] = "invalid"
+            elif email not in users:
+                result["status"] = "user_not_found"
+            elif self._courses.get(course_id) is None:
+                result["status"] = "course_not_found"
+            else:
+                enrollment = Enrollment(user_id=users[email], course_id=course_id, enrolled_at=self.created_at)
+                operations.append(UpdateOne(
+                    {"user_id": enrollment.user_id, "course_id": course_id, "payment_status": {"$ne": "completed"}},
+                    {
+                        "$set": {"payment_status": "completed", "completed_at": completed_at, "bulk_job_id": self.job_id},
+                        "$unset": {"expires_at": ""},
+                        "$setOnInsert": enrollment.dict(
+                            exclude={"user_id", "course_id", "payment_status", "expires_at", "completed_at", "bulk_job_id"}
+                        )
+                    },
+                    upsert=True
+                ))
+                pending.append((result, enrollment.user_id))
+
+        already_completed = set()
+        if operations:
+            try:
+                await db.enrollments.bulk_write(operations, ordered=False)
+            except BulkWriteError as exc:
+                errors = exc.details.get("writeErrors", [])
+                if any(error.get("code") != 11000 for error in errors):
+                    raise
+                already_completed = {error["index"] for error in errors}
+
+        enrolled_users = set()
+        enrolled_per_course = defaultdict(int)
+        for index, (result, user_id) in enumerate(pending):
+            if index in already_completed:
+                result["status"] = "already_enrolled"
+            else:
+                result["status"] = "enrolled"
+                enrolled_per_course[result["course_id"]] += 1
+                enrolled_users.add(user_id)
+        await bump_membership_versions(list(enrolled_users))
+        for course_id, enrolled in enrolled_per_course.items():
+            student_count_flusher.add(course_id, enrolled)
+            # Granted by an admin, so nothing was charged whatever the course's price
+            await record_daily_rollup(self._courses[course_id], completed_at, amount=0, count=enrolled)
+
+        for result in results:
+            self.counts[result["status"]] += 1
+        self.rows += len(results)
+        await db.bulk_enrollment_rows.insert_many(results)
+
+# Run a cohort upload as a job recorded in bulk_enrollment_jobs; the job is marked failed
+# (and the error re-raised) if the upload cannot be read to the end
+async def run_bulk_enrollment(records, created_by: str) -> dict:
+    job = BulkEnrollment(str(uuid.uuid4()))
+    await db.bulk_enrollment_jobs.insert_one({
+        "id": job.job_id, "created_by": created_by, "created_at": job.created_at, "status": "running"
+    })
+    try:
+        summary = await job.run(records)
+    except Exception as exc:
+        await db.bulk_enrollment_jobs.update_one(
+            {"id": job.job_id},
+            {"$set": {"status": "failed", "error": str(exc), "rows": job.rows, "results": job.counts}}
+        )
+        raise
+    await db.bulk_enrollment_jobs.update_one(
+        {"id": job.job_id},
+        {"$set": {"status": "completed", "finished_at": datetime.utcnow(), "rows": job.rows, "results": job.counts}}
+    )
+    return summary
+
+RECONCILIATION_BATCH_SIZE = 1000
+
+# Settlement files are CSV sorted by tran_id (e.g. `LC_ALL=C sort`), with a header naming
+# at least tran_id and amount, or headerless in this column order
+SETTLEMENT_COLUMNS = ["tran_id", "amount", "currency", "status"]
+SETTLEMENT_REQUIRED_COLUMNS = ["tran_id", "amount"]
+
+MISMATCH_KINDS = [
+    "invalid_settlement_row",      # no tran_id, or an amount that is not a number
+    "duplicate_transaction",       # a tran_id repeated in the file or in a collection
+    "unknown_transaction",         # settled by the gateway, no payment recorded
+    "payment_not_completed",       # settled by the gateway, payment still pending/failed
+    "payment_not_settled",         # payment completed, gateway reports another status
+    "missing_from_settlement",     # payment completed in the period, absent from the file
+    "amount_mismatch",             # gateway amount or currency differs from the payment
+    "enrollment_mismatch",         # enrollment of the transaction is for another user/course or not completed
+    "membership_missing",          # payment completed, user has no completed enrollment in the course
+    "duplicate_payment",           # payment completed, user enrolled through another transaction
+    "enrollment_without_payment",  # enrollment completed by a transaction with no completed payment
+]
+
+async def next_or_none(iterator):
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return None
+
+# Full outer join of (key, document) streams each sorted by a unique key: yields
+# (key, [document or None per source]) in key order, holding only each source's head
+async def merge_join(*sources):
+    heads = [await next_or_none(source) for source in sources]
+    while any(head is not None for head in heads):
+        key = min(head[0] for head in heads if head is not None)
+        documents: List[Optional[dict]] = []
+        for index, head in enumerate(heads):
+            if head is not None and head[0] == key:
+                documents.append(head[1])
+                heads[index] = await next_or_none(sources[index])
+            else:
+                documents.append(None)
+        yield key, documents
+
+# One run comparing payments and enrollments against a gateway settlement file. Payments
+# and enrollments are read as cursors sorted on their transaction_id indexes and
+# merge-joined with the sorted settlement rows, so memory stays constant whatever the
+# number of rows. Completed payments whose enrollment is not found by transaction id are
+# checked against the user's membership in batches of $in queries. Mismatches are written
+# to reconciliation_mismatches in batches. `since`/`until` bound the settlement period: a
+# completed payment missing from the file is only reported if it completed inside it.
+class Reconciliation:
+    def __init__(self, run_id: str, since: Optional[datetime] = None, until: Optional[datetime] = None):
+        self.run_id = run_id
+        self.since = since
+        self.until = until
+        self.created_at = datetime.utcnow()
+        self.counts = {"settlement_rows": 0, "payments": 0, "enrollments": 0}
+        self.mismatches: Dict[str, int] = defaultdict(int)
+        self._report: List[dict] = []
+        self._unmatched: List[dict] = []
+
+    async def report(self, kind: str, transaction_id: Optional[str], **details):
+        self.mismatches[kind] += 1
+        self._report.append({
+            "run_id": self.run_id, "kind": kind, "transaction_id": transaction_id,
+            "created_at": self.created_at, **details
+        })
+        if len(self._report) >= RECONCILIATION_BATCH_SIZE:
+            await self._flush_report()
+
+    async def _flush_report(self):
+        if self._report:
+            await db.reconciliation_mismatches.insert_many(self._report, ordered=False)
+            self._report = []
+
+    # Drop repeats of a key (reporting them) and check the source is sorted
+    async def _unique(self, source: str, items):
+        previous: Optional[str] = None
+        async for key, document in items:
+            if previous is not None and key < previous:
+                raise ValueError(f"{source} is not sorted by transaction id at {key!r}")
+            if key == previous:
+                await self.report("duplicate_transaction", key, source=source)
+                continue
+            previous = key
+            yield key, document
+
+    async def _settlement_rows(self, records):
+        async for row_number, record in records:
+            self.counts["settlement_rows"] += 1
+            tran_id = (record.get("tran_id") or "").strip()
+            try:
+                amount = float(record.get("amount") or "")
+            except ValueError:
+                amount = None
+            if not tran_id or amount is None:
+                await self.report("invalid_settlement_row", tran_id or None, row=row_number)
+                continue
+            yield tran_id, {
+                "row": row_number,
+                "amount": amount,
+                "currency": (record.get("currency") or "").strip() or None,
+                "status": (record.get("status") or "VALID").strip().upper()
+            }
+
+    async def _payments(self):
+        cursor = db.payments.find(
+            {"transaction_id": {"$type": "string"}},
+            {"_id": 0, "id": 1, "transaction_id": 1, "user_id": 1, "course_id": 1, "amount": 1, "currency": 1,
+             "status": 1, "completed_at": 1}
+        ).sort("transaction_id", 1).batch_size(RECONCILIATION_BATCH_SIZE)
+        async for payment in cursor:
+            self.counts["payments"] += 1
+            yield payment["transaction_id"], payment
+
+    async def _enrollments(self):
+        cursor = db.enrollments.find(
+            {"transaction_id": {"$type": "string"}},
+            {"_id": 0, "id": 1, "transaction_id": 1, "user_id": 1, "course_id": 1, "payment_status": 1}
+        ).sort("transaction_id", 1).batch_size(RECONCILIATION_BATCH_SIZE)
+        async for enrollment in cursor:
+            self.counts["enrollments"] += 1
+            yield enrollment["transaction_id"], enrollment
+
+    def _in_period(self, moment: Optional[datetime]) -> bool:
+        if moment is None:
+            return self.since is None and self.until is None
+        return (self.since is None or moment >= self.since) and (self.until is None or moment < self.until)
+
+    async def _compare(self, tran_id: str, payment, enrollment, settlement):
+        completed = payment is not None and payment["status"] == "completed"
+        ids = {"payment_id": payment["id"]} if payment else {}
+
+        if settlement is not None:
+            settled = settlement["status"] in GATEWAY_VALID_STATUSES
+            if payment is None:
+                if settled:
+                    await self.report("unknown_transaction", tran_id, row=settlement["row"], amount=settlement["amount"])
+            elif settled and not completed:
+                await self.report("payment_not_completed", tran_id, **ids, row=settlement["row"], status=payment["status"])
+            elif completed and not settled:
+                await self.report("payment_not_settled", tran_id, **ids, row=settlement["row"], status=settlement["status"])
+            if payment is not None and settled and (
+                abs(settlement["amount"] - payment["amount"]) >= 0.01
+                or (settlement["currency"] or payment["currency"]) != payment["currency"]
+            ):
+                await self.report(
+                    "amount_mismatch", tran_id, **ids, row=settlement["row"],
+                    expected={"amount": payment["amount"], "currency": payment["currency"]},
+                    actual={"amount": settlement["amount"], "currency": settlement["currency"]}
+                )
+        elif completed and self._in_period(payment.get("completed_at")):
+            await self.report("missing_from_settlement", tran_id, **ids, amount=payment["amount"])
+
+        if enrollment is not None:
+            if not completed:
+                await self.report(
+                    "enrollment_without_payment", tran_id, enrollment_id=enrollment["id"],
+                    user_id=enrollment["user_id"], course_id=enrollment["course_id"], **ids
+                )
+            elif (
+                (enrollment["user_id"], enrollment["course_id"]) != (payment["user_id"], payment["course_id"])
+                or enrollment["payment_status"] != "completed"
+            ):
+                await self.report(
+                    "enrollment_mismatch", tran_id, **ids, enrollment_id=enrollment["id"],
+                    expected={"user_id": payment["user_id"], "course_id": payment["course_id"], "payment_status": "completed"},
+                    actual={key: enrollment.get(key) for key in ("user_id", "course_id", "payment_status")}
+                )
+        elif completed:
+            self._unmatched.append(payment)
+            if len(self._unmatched) >= RECONCILIATION_BATCH_SIZE:
+                await self._check_membership()
+
+    # Resolve completed payments with no enrollment of their own against the user's membership
+    async def _check_membership(self):
+        payments, self._unmatched = self._unmatched, []
+        if not payments:
+            return
+        enrolled = {
+            (enrollment["user_id"], enrollment["course_id"])
+            for enrollment in await db.enrollments.find(
+                {
+                    "user_id": {"$in": list({payment["user_id"] for payment in payments})},
+                    "course_id": {"$in": list({payment["course_id"] for payment in payments})},
+                    "payment_status": "completed"
+                },
+                {"_id": 0, "user_id": 1, "course_id": 1}
+            ).to_list(None)
+        }
+        for payment in payments:
+            kind = "duplicate_payment" if (payment["user_id"], payment["course_id"]) in enrolled else "membership_missing"
+            await self.report(
+                kind, payment["transaction_id"], payment_id=payment["id"],
+                user_id=payment["user_id"], course_id=payment["course_id"]
+            )
+
+    async def run(self, records) -> dict:
+        joined = merge_join(
+            self._unique("payments", self._payments()),
+            self._unique("enrollments", self._enrollments()),
+            self._unique("settlement file", self._settlement_rows(records))
+        )
+        async for tran_id, (payment, enrollment, settlement) in joined:
+            await self._compare(tran_id, payment, enrollment, settlement)
+        await self._check_membership()
+        await self._flush_report()
+        return self.summary()
+
+    def summary(self) -> dict:
+        return {"run_id": self.run_id, **self.counts, "mismatches": dict(self.mismatches)}
+
+# Run a reconciliation recorded in reconciliation_runs; `records` are settlement rows from
+# parse_csv_records. The run is marked failed (and the error re-raised) if the file cannot
+# be read to the end or is not sorted; mismatches found until then stay in the report.
+async def run_reconciliation(records, created_by: Optional[str] = None, since: Optional[datetime] = None,
+                             until: Optional[datetime] = None) -> dict:
+    job = Reconciliation(str(uuid.uuid4()), since=since, until=until)
+    await db.reconciliation_runs.insert_one({
+        "id": job.run_id, "created_by": created_by, "created_at": job.created_at,
+        "since": since, "until": until, "status": "running"
+    })
+    try:
+        summary = await job.run(records)
+    except Exception as exc:
+        await job._flush_report()
+        await db.reconciliation_runs.update_one(
+            {"id": job.run_id}, {"$set": {"status": "failed", "error": str(exc), **job.summary()}}
+        )
+        raise
+    await db.reconciliation_runs.update_one(
+        {"id": job.run_id}, {"$set": {"status": "completed", "finished_at": datetime.utcnow(), **summary}}
+    )
+    return summary
+
+# Completed enrollments and revenue per course_id, summed from the daily rollups
+async def get_course_rollup_totals(course_ids: Optional[List[str]] = None) -> Dict[str, Dict[str, float]]:
+    pipeline = [
+        {"$match": {} if course_ids is None else {"course_id": {"$in": course_ids}}},
+        {"$group": {"_id": "$course_id", "enrollments": {"$sum": "$enrollments"}, "revenue": {"$sum": "$revenue"}}},
+    ]
+    return {
+        row["_id"]: {"enrollments": row["enrollments"], "revenue": row["revenue"]}
+        async for row in db.daily_rollups.aggregate(pipeline)
+    }
+
+EMPTY_ROLLUP = {"enrollments": 0, "revenue": 0}
+
+# Upper bound on ids per $in query so a single filter stays well under the BSON size limit
+LOADER_BATCH_SIZE = 1000
+
+# Batched replacement for one find_one per reference: resolves documents by `id`
+# with $in queries, memoizing hits and misses in `cache` for the whole request
+async def load_documents_by_id(collection, ids, projection=None, cache: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    cache = {} if cache is None else cache
+    wanted = list(dict.fromkeys(ids))
+    missing = [doc_id for doc_id in wanted if doc_id not in cache]
+    for start in range(0, len(missing), LOADER_BATCH_SIZE):
+        batch = missing[start:start + LOADER_BATCH_SIZE]
+        async for doc in collection.find({"id": {"$in": batch}}, projection):
+            cache[doc["id"]] = doc
+        for doc_id in batch:
+            cache.setdefault(doc_id, None)
+    return {doc_id: cache[doc_id] for doc_id in wanted}
+
+# Opaque keyset cursor for the position just after (sort_value, doc_id)
+def encode_cursor(sort_value: datetime, doc_id: str) -> str:
+    raw = json.dumps({"t": sort_value.isoformat(), "id": doc_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(data["t"]), str(data["id"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+# One keyset page ordered newest first by (sort_field, id): a bounded index range scan
+# continuing strictly after the cursor, so list endpoints never materialize a collection.
+# The total is only counted when asked for.
+async def paginate(collection, query: dict, sort_field: str, items_key: str, cursor: Optional[str] = None,
+                   limit: int = DEFAULT_PAGE_SIZE, include_total: bool = False, projection: Optional[dict] = None,
+                   stages: Optional[List[dict]] = None) -> Dict[str, Any]:
+    page_query = query
+    if cursor:
+        sort_value, last_id = decode_cursor(cursor)
+        page_query = {"$and": [query, {"$or": [
+            {sort_field: {"$lt": sort_value}},
+            {sort_field: sort_value, "id": {"$lt": last_id}}
+        ]}]}
+    
+    # Fetch one extra document to learn whether another page exists
+    pipeline = [
+        {"$match": page_query},
+        {"$sort": {sort_field: -1, "id": -1}},
+        {"$limit": limit + 1},
+        *(stages or []),  # e.g. a $lookup, run on the page only
+    ]
+    if projection:
+        # May hold aggregation expressions for derived fields, not just inclusions
+        pipeline.append({"$project": projection})
+    fetch = collection.aggregate(pipeline).to_list(None)
+    if include_total:
+        items, total = await asyncio.gather(fetch, collection.count_documents(query))
+    else:
+        items, total = await fetch, None
+    
+    has_more = len(items) > limit
+    items = items[:limit]
+    for item in items:
+        if '_id' in item:
+            item['_id'] = str(item['_id'])
+    page = {
+        items_key: items,
+        "next_cursor": encode_cursor(items[-1][sort_field], items[-1]["id"]) if has_more else None
+    }
+    if include_total:
+        page["total"] = total
+    return page
+
+def get_video_embed_url(url: str, video_type: str) -> str:
+    if video_type == 'youtube':
+        match = re.search(r'(?:youtube\.com\/watch\?v=|youtu\.be\/)([^&\n?#]+)', url)
+        return f"https://www.youtube.com/embed/{match.group(1)}" if match else url
+    if video_type == 'vimeo':
+        match = re.search(r'vimeo\.com\/(\d+)', url)
+        return f"https://player.vimeo.com/video/{match.group(1)}" if match else url
+    return url
+
+# Stored form of a lesson: its fields plus course_id and a precomputed embed_url
+def lesson_document(lesson: dict, course_id: str) -> dict:
+    return {**lesson, "embed_url": get_video_embed_url(lesson["video_url"], lesson["video_type"]), "course_id": course_id}
+
+def preview_entry(lesson_doc: dict) -> dict:
+    return {key: value for key, value in lesson_doc.items() if key not in ("_id", "course_id")}
+
+# Fold newly inserted lessons into the course's derived fields with one update
+async def apply_lessons_added(course_id: str, lesson_docs: List[dict]):
+    update = {"$inc": {
+        "lesson_count": len(lesson_docs),
+        "total_duration": sum(lesson.get("duration") or 0 for lesson in lesson_docs)
+    }}
+    previews = [preview_entry(lesson) for lesson in lesson_docs if lesson.get("is_preview")]
+    if previews:
+        update["$push"] = {"preview_lessons": {"$each": previews, "$sort": {"order": 1}}}
+    await db.courses.update_one({"id": course_id}, update)
+    lesson_ids_cache.invalidate(course_id)
+
+# Rebuild preview_lessons after a lesson edit, delete or reorder
+async def refresh_preview_lessons(course_id: str):
+    previews = await db.lessons.find(
+        {"course_id": course_id, "is_preview": True}, LESSON_PROJECTION
+    ).sort("order", 1).to_list(None)
+    await db.courses.update_one({"id": course_id}, {"$set": {"preview_lessons": previews}})
+
+# Lessons of one course in order; a course not migrated yet keeps its embedded array
+async def get_course_lessons(course: dict) -> List[dict]:
+    lessons = await db.lessons.find({"course_id": course["id"]}, LESSON_PROJECTION).sort("order", 1).to_list(None)
+    return lessons or course.get("lessons", [])
+
+# One lesson through the (course_id, id) index, or from the embedded array of a course
+# not migrated yet
+async def find_lesson(course_id: str, lesson_id: str) -> Optional[dict]:
+    lesson = await db.lessons.find_one({"course_id": course_id, "id": lesson_id}, LESSON_PROJECTION)
+    if lesson is not None:
+        return lesson
+    course = await db.courses.find_one(
+        {"id": course_id, "lessons.id": lesson_id}, {"_id": 0, "lessons": {"$elemMatch": {"id": lesson_id}}}
+    )
+    return course["lessons"][0] if course else None
+
+# Lesson ids of each course, so hot paths such as heartbeats check a lesson without a read.
+# Invalidated by this worker's lesson writes; an id missing from a cached set is re-read
+# before it is rejected, so a lesson added on another worker is found at once.
+lesson_ids_cache = TTLCache(maxsize=LESSON_IDS_CACHE_SIZE, ttl=LESSON_IDS_CACHE_TTL_SECONDS)
+
+async def course_has_lesson(course_id: str, lesson_id: str) -> bool:
+    lesson_ids = lesson_ids_cache.get(course_id)
+    if lesson_ids is not None and lesson_id in lesson_ids:
+        return True
+    stored = await db.lessons.distinct("id", {"course_id": course_id})
+    course = await db.courses.find_one({"id": course_id}, {"_id": 0, "lessons.id": 1})  # Not migrated yet
+    lesson_ids = frozenset(stored) | frozenset(lesson["id"] for lesson in (course or {}).get("lessons", []))
+    lesson_ids_cache.set(course_id, lesson_ids)
+    return lesson_id in lesson_ids
+
+# Fill `lessons` on each course with one query, keeping responses shaped as when embedded
+async def attach_lessons(courses: List[dict]) -> List[dict]:
+    if not courses:
+        return courses
+    by_course = {}
+    cursor = db.lessons.find(
+        {"course_id": {"$in": [course["id"] for course in courses]}}, {"_id": 0}
+    ).sort([("course_id", 1), ("order", 1)])
+    async for lesson in cursor:
+        by_course.setdefault(lesson.pop("course_id"), []).append(lesson)
+    for course in courses:
+        course["lessons"] = by_course.get(course["id"]) or course.get("lessons", [])
+    return courses
+
+# Order for a lesson appended to the course, read from the top of the (course_id, order) index
+async def next_lesson_order(course_id: str) -> int:
+    last = await db.lessons.find_one({"course_id": course_id}, {"_id": 0, "order": 1}, sort=[("order", -1)])
+    return last["order"] + 1 if last else 1
+
+def lesson_order_counter_id(course_id: str) -> str:
+    return f"lesson_order:{course_id}"
+
+# Atomically reserve `count` contiguous lesson orders from the course's sequence in
+# `counters` and return the first. A missing sequence is seeded from the highest order
+# in use; the unique _id makes a concurrent seed a no-op.
+async def reserve_lesson_orders(course_id: str, count: int = 1) -> int:
+    counter_id = lesson_order_counter_id(course_id)
+    counter = await db.counters.find_one_and_update(
+        {"_id": counter_id}, {"$inc": {"value": count}}, return_document=ReturnDocument.AFTER
+    )
+    if counter is None:
+        try:
+            await db.counters.insert_one({"_id": counter_id, "value": await next_lesson_order(course_id) - 1})
+        except DuplicateKeyError:
+            pass
+        counter = await db.counters.find_one_and_update(
+            {"_id": counter_id}, {"$inc": {"value": count}}, return_document=ReturnDocument.AFTER
+        )
+    return counter["value"] - count + 1
+
+# Move a course's embedded lessons into the lessons collection before its first lesson
+# write; otherwise that write would hide them and restart the order sequence. Embedded
+# lessons keep their orders, lessons already in the collection move after them and the
+# sequence is raised past both. Upserts and a shift limited to the embedded range make a
+# repeated move harmless; the embedded array is unset last.
+async def migrate_course_lessons(course_id: str) -> bool:
+    course = await db.courses.find_one(
+        {"id": course_id, "lessons.0": {"$exists": True}}, {"_id": 0, "lessons": 1}
+    )
+    if course is None:
+        return False
+    embedded = [
+        {**lesson, "order": lesson.get("order") or position}
+        for position, lesson in enumerate(course["lessons"], start=1)
+    ]
+    last_embedded = max(lesson["order"] for lesson in embedded)
+    await db.lessons.update_many(
+        {"course_id": course_id, "id": {"$nin": [lesson["id"] for lesson in embedded]}, "order": {"$lte": last_embedded}},
+        {"$inc": {"order": last_embedded}}
+    )
+    await db.lessons.bulk_write([
+        UpdateOne(
+            {"course_id": course_id, "id": lesson["id"]},
+            {"$setOnInsert": lesson_document(lesson, course_id)},
+            upsert=True
+        )
+        for lesson in embedded
+    ], ordered=False)
+    await db.counters.update_one(
+        {"_id": lesson_order_counter_id(course_id)}, {"$max": {"value": await next_lesson_order(course_id) - 1}}, upsert=True
+    )
+    lessons = await db.lessons.find({"course_id": course_id}, LESSON_PROJECTION).sort("order", 1).to_list(None)
+    await db.courses.update_one({"id": course_id}, {
+        "$set": {
+            "lesson_count": len(lessons),
+            "total_duration": sum(lesson.get("duration") or 0 for lesson in lessons),
+            "preview_lessons": [lesson for lesson in lessons if lesson.get("is_preview")]
+        },
+        "$unset": {"lessons": ""}
+    })
+    return True
 
-# MongoDB setup
-client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_URL)
-db = client.islamic_institute
+# Indexes every query path relies on, keyed by collection
+REQUIRED_INDEXES = {
+    "users": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at_id"),
+    ],
+    "courses": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel(
+            [("is_active", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+            name="is_active_created_at_id"
+        ),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at_id"),
+    ],
+    "enrollments": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("course_id", ASCENDING), ("payment_status", ASCENDING)], name="course_id_payment_status"),
+        IndexModel([("user_id", ASCENDING), ("payment_status", ASCENDING)], name="user_id_payment_status"),
+        IndexModel([("user_id", ASCENDING), ("course_id", ASCENDING)], name="user_id_course_id_unique", unique=True),
+        IndexModel([("payment_status", ASCENDING), ("enrolled_at", DESCENDING)], name="payment_status_enrolled_at"),
+        IndexModel([("enrolled_at", DESCENDING), ("id", DESCENDING)], name="enrolled_at_id"),
+        IndexModel([("payment_status", ASCENDING), ("expires_at", ASCENDING)], name="payment_status_expires_at"),
+        # Only paid enrollments carry a transaction_id; reconciliation scans them in its order
+        IndexModel(
+            [("transaction_id", ASCENDING)], name="transaction_id",
+            partialFilterExpression={"transaction_id": {"$type": "string"}}
+        ),
+    ],
+    "enrollments_archive": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    # Bulk enrollment reports expire after the retention period
+    "bulk_enrollment_jobs": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel(
+            [("created_at", ASCENDING)], name="created_at_ttl",
+            expireAfterSeconds=BULK_ENROLLMENT_REPORT_RETENTION_SECONDS
+        ),
+    ],
+    "bulk_enrollment_rows": [
+        IndexModel([("job_id", ASCENDING), ("row", ASCENDING)], name="job_id_row"),
+        IndexModel(
+            [("created_at", ASCENDING)], name="created_at_ttl",
+            expireAfterSeconds=BULK_ENROLLMENT_REPORT_RETENTION_SECONDS
+        ),
+    ],
+    "payments": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("transaction_id", ASCENDING)], name="transaction_id_unique", unique=True),
+        # Every payment stores a key (its own id when the client sent none)
+        IndexModel([("user_id", ASCENDING), ("idempotency_key", ASCENDING)], name="user_id_idempotency_key_unique", unique=True),
+    ],
+    # Reconciliation reports expire after the retention period
+    "reconciliation_runs": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel(
+            [("created_at", ASCENDING)], name="created_at_ttl",
+            expireAfterSeconds=RECONCILIATION_REPORT_RETENTION_SECONDS
+        ),
+    ],
+    "reconciliation_mismatches": [
+        IndexModel([("run_id", ASCENDING), ("kind", ASCENDING)], name="run_id_kind"),
+        IndexModel(
+            [("created_at", ASCENDING)], name="created_at_ttl",
+            expireAfterSeconds=RECONCILIATION_REPORT_RETENTION_SECONDS
+        ),
+    ],
+    # Gateway notification inbox: one callback per distinct body of a transaction, claimed by due time
+    "payment_callbacks": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel(
+            [("transaction_id", ASCENDING), ("form_digest", ASCENDING)], name="transaction_id_form_digest_unique", unique=True
+        ),
+        IndexModel([("status", ASCENDING), ("available_at", ASCENDING)], name="status_available_at"),
+        IndexModel(
+            [("processed_at", ASCENDING)], name="processed_at_ttl",
+            expireAfterSeconds=PAYMENT_INBOX_RETENTION_SECONDS
+        ),
+    ],
+    # Revoked token ids, kept until the token itself expires
+    "revoked_tokens": [
+        IndexModel([("jti", ASCENDING)], name="jti_unique", unique=True),
+        IndexModel([("token_type", ASCENDING), ("revoked_at", ASCENDING)], name="token_type_revoked_at"),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "lessons": [
+        IndexModel([("course_id", ASCENDING), ("order", ASCENDING)], name="course_id_order"),
+        IndexModel([("course_id", ASCENDING), ("id", ASCENDING)], name="course_id_id_unique", unique=True),
+    ],
+    "daily_rollups": [
+        IndexModel(
+            [("day", ASCENDING), ("course_id", ASCENDING), ("course_type", ASCENDING)],
+            name="day_course_id_course_type_unique",
+            unique=True
+        ),
+    ],
+}
 
-app = FastAPI(title="Islamic Institute Course Platform API")
+# Migrations that clean up existing data a unique index would reject. They change or
+# archive documents, so they are never run at startup; a failed build names the command.
+INDEX_MIGRATIONS = {
+    ("enrollments", "user_id_course_id_unique"): "python -m backend.database.enrollments",
+}
 
-# CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Indexes dropped at startup because a required index replaced them
+RETIRED_INDEXES = {
+    "payment_callbacks": ["transaction_id_unique"],
+}
 
-# Security
-security = HTTPBearer()
+# Create missing required indexes one at a time, so a failure (e.g. duplicate emails
+# blocking the unique index) is logged without stopping the others, even on the same
+# collection
+async def ensure_indexes():
+    for collection_name, indexes in REQUIRED_INDEXES.items():
+        try:
+            existing = await db[collection_name].index_information()
+        except PyMongoError as exc:
+            logger.error("Could not read indexes on %s: %s", collection_name, exc)
+            continue
+        for name in RETIRED_INDEXES.get(collection_name, []):
+            if name not in existing:
+                continue
+            try:
+                await db[collection_name].drop_index(name)
+                logger.info("Dropped retired index %s on %s", name, collection_name)
+            except PyMongoError as exc:
+                logger.error("Could not drop retired index %s on %s: %s", name, collection_name, exc)
+        for index in indexes:
+            name = index.document["name"]
+            if name in existing:
+                continue
+            try:
+                await db[collection_name].create_indexes([index])
+                logger.info("Created index %s on %s", name, collection_name)
+            except PyMongoError as exc:
+                logger.error("Could not create index %s on %s: %s", name, collection_name, exc)
+                migration = INDEX_MIGRATIONS.get((collection_name, name))
+                if migration is not None:
+                    logger.error("Run `%s` to migrate the data blocking index %s", migration, name)
 
-class UserRole(str, Enum):
-    STUDENT = "student"
-    INSTRUCTOR = "instructor"
-    ADMIN = "admin"
-    SUPER_ADMIN = "super_admin"
+# Required indexes that are missing, and existing ones never used since server start
+async def report_indexes() -> Dict[str, Dict[str, List[str]]]:
+    report = {}
+    for collection_name, indexes in REQUIRED_INDEXES.items():
+        try:
+            existing = await db[collection_name].index_information()
+            stats = await db[collection_name].aggregate([{"$indexStats": {}}]).to_list(None)
+        except PyMongoError as exc:
+            logger.error("Could not read index stats for %s: %s", collection_name, exc)
+            continue
+        missing = [index.document["name"] for index in indexes if index.document["name"] not in existing]
+        unused = [
+            stat["name"] for stat in stats
+            if stat["name"] != "_id_" and stat.get("accesses", {}).get("ops", 0) == 0
+        ]
+        report[collection_name] = {"missing": missing, "unused": unused}
+        if missing:
+            logger.warning("Missing indexes on %s: %s", collection_name, missing)
+        if unused:
+            logger.info("Unused indexes on %s: %s", collection_name, unused)
+    return report
 
-class CourseType(str, Enum):
-    FREE = "free"
-    PAID = "paid"
+async def bootstrap_indexes():
+    await ensure_indexes()
+    await report_indexes()
 
-# Pydantic Models
-class UserRegister(BaseModel):
-    full_name: str
-    email: str
-    password: str
-    phone: Optional[str] = None
+# API Routes
 
-class UserLogin(BaseModel):
-    email: str
-    password: str
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    request_latency.record(f"{request.method} {route.path if route else 'unmatched'}", time.perf_counter() - started)
+    return response
 
-class User(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    full_name: str
-    email: str
-    role: UserRole = UserRole.STUDENT
-    phone: Optional[str] = None
-    enrolled_courses: List[str] = []
-    created_at: datetime = Field(default_factory=datetime.utcnow)
-    is_active: bool = True
+@app.on_event("startup")
+async def start_index_bootstrap():
+    # Runs in the background so a slow index build never delays startup
+    app.state.index_bootstrap = asyncio.create_task(bootstrap_indexes())
 
-class Lesson(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    title: str
-    description: str
-    video_url: str  # YouTube/Vimeo URL
-    video_type: str  # "youtube" or "vimeo"
-    duration: Optional[int] = None  # in minutes
-    order: int
-    is_preview: bool = False  # First lesson should be preview
+@app.on_event("startup")
+async def start_enrolled_courses_backfill():
+    app.state.enrolled_courses_backfill = asyncio.create_task(backfill_enrolled_courses())
 
-class Course(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    title: str
-    description: str
-    instructor_name: str
-    course_type: CourseType
-    price: Optional[float] = None  # BDT
-    thumbnail_url: Optional[str] = None
-    lessons: List[Lesson] = []
-    total_duration: Optional[int] = None  # in minutes
-    student_count: int = 0
-    created_at: datetime = Field(default_factory=datetime.utcnow)
-    is_active: bool = True
+@app.on_event("startup")
+async def start_daily_rollups_backfill():
+    app.state.daily_rollups_backfill = asyncio.create_task(backfill_daily_rollups())
 
-class CourseCreate(BaseModel):
-    title: str
-    description: str
-    instructor_name: str
-    course_type: CourseType
-    price: Optional[float] = None
-    thumbnail_url: Optional[str] = None
+@app.on_event("startup")
+async def start_counter_flusher():
+    student_count_flusher.start()
 
-class LessonCreate(BaseModel):
-    title: str
-    description: str
-    video_url: str
-    video_type: str
-    duration: Optional[int] = None
-    is_preview: bool = False
+@app.on_event("startup")
+async def start_heartbeat_buffer():
+    heartbeat_buffer.start()
 
-class Enrollment(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    user_id: str
-    course_id: str
-    enrolled_at: datetime = Field(default_factory=datetime.utcnow)
-    payment_status: str = "pending"  # pending, completed, failed
-    transaction_id: Optional[str] = None
+@app.on_event("startup")
+async def start_enrollment_sweeper():
+    app.state.enrollment_sweeper = asyncio.create_task(run_enrollment_sweeper())
 
-# Utility Functions
-def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+@app.on_event("startup")
+async def start_payment_inbox():
+    payment_inbox.start()
 
-def verify_password(password: str, hashed: str) -> bool:
-    return hash_password(password) == hashed
+@app.on_event("startup")
+async def start_revocation_list():
+    revocation_list.start()
 
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(hours=24)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm="HS256")
-    return encoded_jwt
+@app.on_event("shutdown")
+async def stop_payment_inbox():
+    # Callbacks held by the workers are retried after their lease
+    await payment_inbox.stop()
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=["HS256"])
-        email: str = payload.get("sub")
-        if email is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        
-        user = await db.users.find_one({"email": email})
-        if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
-    except jwt.PyJWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+@app.on_event("shutdown")
+async def stop_counter_flusher():
+    # Write increments still buffered in this worker before it exits
+    await student_count_flusher.stop()
 
-# API Routes
+@app.on_event("shutdown")
+async def stop_heartbeat_buffer():
+    await heartbeat_buffer.stop()
+
+@app.on_event("shutdown")
+async def stop_enrollment_sweeper():
+    app.state.enrollment_sweeper.cancel()
+
+@app.on_event("shutdown")
+async def stop_revocation_list():
+    await revocation_list.stop()
+
+@app.on_event("shutdown")
+async def close_rate_limiter():
+    await rate_limiter.close()
+
+@app.on_event("shutdown")
+async def stop_password_hasher():
+    password_hasher.shutdown()
+
+@app.on_event("shutdown")
+async def close_payment_gateway():
+    await close_gateway()
 
 @app.get("/api/health")
 async def health_check():
@@ -167,17 +3264,20 @@ async def register_user(user_data: UserRegister):
     
     # Hash password and store separately
     user_dict = user.dict()
-    user_dict["password"] = hash_password(user_data.password)
-    
-    await db.users.insert_one(user_dict)
+    try:
+        user_dict["password"] = await password_hasher.hash(user_data.password)
+    except PasswordHasherBusy:
+        raise hasher_busy()
     
-    # Create access token
-    access_token = create_access_token(data={"sub": user.email})
+    try:
+        await db.users.insert_one(user_dict)
+    except DuplicateKeyError:
+        # A concurrent registration with the same email won the unique index
+        raise HTTPException(status_code=400, detail="Email already registered")
     
     return {
         "message": "User registered successfully",
-        "access_token": access_token,
-        "token_type": "bearer",
+        **issue_tokens(user_dict),
         "user": {
             "id": user.id,
             "full_name": user.full_name,
@@ -187,20 +3287,28 @@ async def register_user(user_data: UserRegister):
     }
 
 @app.post("/api/auth/login")
-async def login_user(login_data: UserLogin):
+async def login_user(login_data: UserLogin, background_tasks: BackgroundTasks):
     user = await db.users.find_one({"email": login_data.email})
-    if not user or not verify_password(login_data.password, user["password"]):
+    try:
+        if not user:
+            await password_hasher.verify_unknown(login_data.password)
+            raise HTTPException(status_code=401, detail="Invalid email or password")
+        valid, needs_rehash = await password_hasher.verify(login_data.password, user["password"])
+    except PasswordHasherBusy:
+        raise hasher_busy()
+    if not valid:
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
     if not user.get("is_active", True):
         raise HTTPException(status_code=401, detail="Account is disabled")
     
-    access_token = create_access_token(data={"sub": user["email"]})
+    if needs_rehash:
+        # After the response, so the upgrade never adds to this login's latency
+        background_tasks.add_task(upgrade_password_hash, user["id"], user["password"], login_data.password)
     
     return {
         "message": "Login successful",
-        "access_token": access_token,
-        "token_type": "bearer",
+        **issue_tokens(user),
         "user": {
             "id": user["id"],
             "full_name": user["full_name"],
@@ -209,25 +3317,83 @@ async def login_user(login_data: UserLogin):
         }
     }
 
+# Exchange a refresh token for a new access and refresh token pair. Refresh tokens are
+# single use: the presented one is revoked before the new pair is issued. The user is read
+# fresh, so the new access token carries their current role and versions; refresh tokens
+# from before a role or status change are rejected.
+@app.post("/api/auth/refresh")
+async def refresh_tokens(refresh_data: RefreshRequest):
+    try:
+        payload = decode_token(refresh_data.refresh_token, "refresh")
+    except jwt.PyJWTError:
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    if payload.get("jti") is None or not await revocation_list.revoke(
+        payload["jti"], payload.get("uid"), datetime.utcfromtimestamp(payload["exp"]), token_type="refresh"
+    ):
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    
+    user = await db.users.find_one(
+        {"id": payload.get("uid")},
+        {"_id": 0, "id": 1, "email": 1, "role": 1, "is_active": 1, "token_version": 1, "membership_version": 1}
+    )
+    if user is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    if not user.get("is_active", True):
+        raise HTTPException(status_code=401, detail="Account is disabled")
+    if payload.get("tv", 0) != user.get("token_version", 0):
+        raise HTTPException(status_code=401, detail="Token has been revoked")
+    return issue_tokens(user)
+
+# Revoke the presented access token, and the refresh token if one is sent
+@app.post("/api/auth/logout")
+async def logout_user(logout_data: Optional[LogoutRequest] = None, current_user: dict = Depends(get_current_user)):
+    if current_user["jti"] is not None:  # Tokens from before claims were added cannot be revoked
+        await revocation_list.revoke(current_user["jti"], current_user["id"], current_user["expires_at"])
+    if logout_data is not None and logout_data.refresh_token:
+        try:
+            payload = decode_token(logout_data.refresh_token, "refresh")
+        except jwt.PyJWTError:
+            raise HTTPException(status_code=400, detail="Invalid refresh token")
+        if payload.get("uid") != current_user["id"] or payload.get("jti") is None:
+            raise HTTPException(status_code=400, detail="Invalid refresh token")
+        await revocation_list.revoke(
+            payload["jti"], current_user["id"], datetime.utcfromtimestamp(payload["exp"]), token_type="refresh"
+        )
+    return {"message": "Logged out"}
+
 @app.get("/api/auth/me")
 async def get_current_user_info(current_user: dict = Depends(get_current_user)):
+    profile = await get_user_profile(current_user["id"])
     return {
         "id": current_user["id"],
-        "full_name": current_user["full_name"],
+        "full_name": profile["full_name"],
         "email": current_user["email"],
         "role": current_user["role"],
-        "enrolled_courses": current_user.get("enrolled_courses", [])
+        "enrolled_courses": sorted(await get_enrolled_course_ids(current_user["id"], current_user["membership_version"]))
     }
 
 # Course Routes
 @app.get("/api/courses")
-async def get_courses():
-    courses = await db.courses.find({"is_active": True}).to_list(None)
-    # Convert MongoDB ObjectId to string
-    for course in courses:
-        if '_id' in course:
-            course['_id'] = str(course['_id'])
-    return {"courses": courses}
+async def get_courses(request: Request, cursor: Optional[str] = None,
+                      limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                      include_total: bool = False, view: Literal["summary", "full"] = "summary"):
+    # Catalog cards only need the summary; view=full returns whole course documents
+    async def load_page():
+        if view == "summary":
+            return await paginate(
+                db.courses, {"is_active": True}, "created_at", "courses",
+                cursor=cursor, limit=limit, include_total=include_total,
+                projection=CATALOG_SUMMARY_PROJECTION
+            )
+        page = await paginate(
+            db.courses, {"is_active": True}, "created_at", "courses",
+            cursor=cursor, limit=limit, include_total=include_total,
+            projection={"preview_lessons": 0}
+        )
+        await attach_lessons(page["courses"])
+        return page
+    
+    return await catalog_cache.respond(request, (view, cursor, limit, include_total), load_page)
 
 @app.get("/api/courses/{course_id}")
 async def get_course(course_id: str, current_user: dict = Depends(get_current_user)):
@@ -238,13 +3404,19 @@ async def get_course(course_id: str, current_user: dict = Depends(get_current_us
     # Convert MongoDB ObjectId to string
     if '_id' in course:
         course['_id'] = str(course['_id'])
+    preview_lessons = course.pop("preview_lessons", None)
     
     # Check if user is enrolled
-    is_enrolled = course_id in current_user.get("enrolled_courses", [])
+    is_enrolled = await user_is_enrolled(current_user["id"], course_id, current_user["membership_version"])
     
-    # If not enrolled and course is paid, only show preview lessons
+    # If not enrolled and course is paid, only show the precomputed preview lessons
     if not is_enrolled and course["course_type"] == "paid":
-        course["lessons"] = [lesson for lesson in course.get("lessons", []) if lesson.get("is_preview", False)]
+        if preview_lessons is None:  # Course predates the precomputed preview subset
+            lessons = await get_course_lessons(course)
+            preview_lessons = [lesson for lesson in lessons if lesson.get("is_preview", False)]
+        course["lessons"] = preview_lessons
+    else:
+        course["lessons"] = await get_course_lessons(course)
     
     course["is_enrolled"] = is_enrolled
     return course
@@ -256,9 +3428,11 @@ async def create_course(course_data: CourseCreate, current_user: dict = Depends(
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
     course = Course(**course_data.dict())
-    course_dict = course.dict()
+    course_dict = course.dict(exclude={"lessons"})  # Lessons are stored in their own collection
+    course_dict["total_duration"] = 0
     
     await db.courses.insert_one(course_dict)
+    await catalog_cache.bump()
     return {"message": "Course created successfully", "course_id": course.id}
 
 @app.post("/api/courses/{course_id}/lessons")
@@ -267,43 +3441,108 @@ async def add_lesson_to_course(course_id: str, lesson_data: LessonCreate, curren
     if current_user["role"] not in ["admin", "super_admin", "instructor"]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
-    course = await db.courses.find_one({"id": course_id})
+    course = await db.courses.find_one({"id": course_id}, {"_id": 0, "id": 1})
     if not course:
         raise HTTPException(status_code=404, detail="Course not found")
+    await migrate_course_lessons(course_id)  # The course may still embed its lessons
     
     # Create lesson with order field
     lesson_dict = lesson_data.dict()
-    lesson_dict["order"] = len(course.get("lessons", [])) + 1
+    lesson_dict["order"] = await reserve_lesson_orders(course_id)
     lesson = Lesson(**lesson_dict)
     
-    # Update course with new lesson
-    await db.courses.update_one(
-        {"id": course_id},
-        {"$push": {"lessons": lesson.dict()}}
-    )
+    lesson_doc = lesson_document(lesson.dict(), course_id)
+    await db.lessons.insert_one(lesson_doc)
+    await apply_lessons_added(course_id, [lesson_doc])
+    await catalog_cache.bump()
     
     return {"message": "Lesson added successfully", "lesson_id": lesson.id}
 
+@app.post("/api/courses/{course_id}/lessons:bulk")
+async def bulk_add_lessons(course_id: str, lessons_data: List[LessonCreate], current_user: dict = Depends(get_current_user)):
+    # Check permissions
+    if current_user["role"] not in ["admin", "super_admin", "instructor"]:
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
+    
+    if not lessons_data:
+        raise HTTPException(status_code=400, detail="No lessons provided")
+    if len(lessons_data) > MAX_LESSON_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_LESSON_BATCH_SIZE} lessons per request")
+    
+    course = await db.courses.find_one({"id": course_id}, {"_id": 0, "id": 1})
+    if not course:
+        raise HTTPException(status_code=404, detail="Course not found")
+    await migrate_course_lessons(course_id)  # The course may still embed its lessons
+    
+    # Contiguous orders for the whole batch, then a single insert
+    first_order = await reserve_lesson_orders(course_id, len(lessons_data))
+    lessons = [
+        Lesson(**lesson_data.dict(), order=first_order + offset)
+        for offset, lesson_data in enumerate(lessons_data)
+    ]
+    lesson_docs = [lesson_document(lesson.dict(), course_id) for lesson in lessons]
+    await db.lessons.insert_many(lesson_docs)
+    await apply_lessons_added(course_id, lesson_docs)
+    await catalog_cache.bump()
+    
+    return {"message": f"{len(lessons)} lessons added successfully", "lesson_ids": [lesson.id for lesson in lessons]}
+
+@app.put("/api/courses/{course_id}/lessons:reorder")
+async def reorder_course_lessons(course_id: str, reorder_data: LessonReorder, current_user: dict = Depends(get_current_user)):
+    # Check permissions
+    if current_user["role"] not in ["admin", "super_admin", "instructor"]:
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
+    
+    course = await db.courses.find_one({"id": course_id}, {"_id": 0, "id": 1})
+    if not course:
+        raise HTTPException(status_code=404, detail="Course not found")
+    await migrate_course_lessons(course_id)  # The course may still embed its lessons
+    
+    lesson_ids = reorder_data.lesson_ids
+    existing = await db.lessons.distinct("id", {"course_id": course_id})
+    if len(lesson_ids) != len(set(lesson_ids)) or set(lesson_ids) != set(existing):
+        raise HTTPException(status_code=400, detail="lesson_ids must list every lesson of the course exactly once")
+    
+    # Rewrite orders 1..n in one pass
+    if lesson_ids:
+        await db.lessons.bulk_write([
+            UpdateOne({"course_id": course_id, "id": lesson_id}, {"$set": {"order": order}})
+            for order, lesson_id in enumerate(lesson_ids, start=1)
+        ], ordered=False)
+    await db.counters.update_one(
+        {"_id": lesson_order_counter_id(course_id)}, {"$max": {"value": len(lesson_ids)}}, upsert=True
+    )
+    await refresh_preview_lessons(course_id)
+    await catalog_cache.bump()
+    
+    return {"message": "Lessons reordered successfully"}
+
 @app.delete("/api/courses/{course_id}/lessons/{lesson_id}")
 async def delete_lesson_from_course(course_id: str, lesson_id: str, current_user: dict = Depends(get_current_user)):
     # Check permissions
     if current_user["role"] not in ["admin", "super_admin", "instructor"]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
-    course = await db.courses.find_one({"id": course_id})
+    course = await db.courses.find_one({"id": course_id}, {"_id": 0, "id": 1})
     if not course:
         raise HTTPException(status_code=404, detail="Course not found")
+    await migrate_course_lessons(course_id)  # The course may still embed its lessons
     
-    # Check if lesson exists
-    lesson_exists = any(lesson["id"] == lesson_id for lesson in course.get("lessons", []))
-    if not lesson_exists:
+    # Remove lesson from course
+    lesson = await db.lessons.find_one_and_delete(
+        {"course_id": course_id, "id": lesson_id}, projection={"duration": 1, "is_preview": 1}
+    )
+    if lesson is None:
         raise HTTPException(status_code=404, detail="Lesson not found")
     
-    # Remove lesson from course
     await db.courses.update_one(
         {"id": course_id},
-        {"$pull": {"lessons": {"id": lesson_id}}}
+        {"$inc": {"lesson_count": -1, "total_duration": -(lesson.get("duration") or 0)}}
     )
+    lesson_ids_cache.invalidate(course_id)
+    if lesson.get("is_preview"):
+        await refresh_preview_lessons(course_id)
+    await catalog_cache.bump()
     
     return {"message": "Lesson deleted successfully"}
 
@@ -313,29 +3552,77 @@ async def update_lesson_in_course(course_id: str, lesson_id: str, lesson_data: L
     if current_user["role"] not in ["admin", "super_admin", "instructor"]:
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
-    course = await db.courses.find_one({"id": course_id})
+    course = await db.courses.find_one({"id": course_id}, {"_id": 0, "id": 1})
     if not course:
         raise HTTPException(status_code=404, detail="Course not found")
+    await migrate_course_lessons(course_id)  # The course may still embed its lessons
+    
+    # Update lesson data while preserving id and order
+    updated_lesson = lesson_data.dict()
+    updated_lesson["embed_url"] = get_video_embed_url(updated_lesson["video_url"], updated_lesson["video_type"])
+    previous = await db.lessons.find_one_and_update(
+        {"course_id": course_id, "id": lesson_id},
+        {"$set": updated_lesson},
+        projection={"duration": 1, "is_preview": 1}
+    )
+    if previous is None:
+        raise HTTPException(status_code=404, detail="Lesson not found")
     
-    # Find the lesson and update it
-    lessons = course.get("lessons", [])
-    lesson_index = next((i for i, lesson in enumerate(lessons) if lesson["id"] == lesson_id), None)
+    duration_delta = (updated_lesson["duration"] or 0) - (previous.get("duration") or 0)
+    if duration_delta:
+        await db.courses.update_one({"id": course_id}, {"$inc": {"total_duration": duration_delta}})
+    if previous.get("is_preview") or updated_lesson["is_preview"]:
+        await refresh_preview_lessons(course_id)
+    await catalog_cache.bump()
     
-    if lesson_index is None:
+    return {"message": "Lesson updated successfully"}
+
+# Heartbeats are buffered in memory and written in periodic batches, so last_accessed_at
+# and the position may lag by the flush interval
+@app.post("/api/courses/{course_id}/lessons/{lesson_id}/heartbeat")
+async def record_lesson_heartbeat(course_id: str, lesson_id: str, heartbeat: LessonHeartbeat,
+                                  current_user: dict = Depends(get_current_user)):
+    if not await user_is_enrolled(current_user["id"], course_id, current_user["membership_version"]):
+        raise HTTPException(status_code=403, detail="Access denied. Please enroll in the course.")
+    if not await course_has_lesson(course_id, lesson_id):
         raise HTTPException(status_code=404, detail="Lesson not found")
     
-    # Update lesson data while preserving id and order
-    updated_lesson = lesson_data.dict()
-    updated_lesson["id"] = lesson_id
-    updated_lesson["order"] = lessons[lesson_index]["order"]
+    await heartbeat_buffer.record(current_user["id"], course_id, lesson_id, heartbeat.position_seconds)
+    return {"message": "Heartbeat recorded"}
+
+@app.post("/api/courses/{course_id}/lessons/{lesson_id}/complete")
+async def complete_course_lesson(course_id: str, lesson_id: str, current_user: dict = Depends(get_current_user)):
+    if not await user_is_enrolled(current_user["id"], course_id, current_user["membership_version"]):
+        raise HTTPException(status_code=403, detail="Access denied. Please enroll in the course.")
     
-    # Update the lesson in the array
-    await db.courses.update_one(
-        {"id": course_id, "lessons.id": lesson_id},
-        {"$set": {"lessons.$": updated_lesson}}
+    course = await db.courses.find_one(
+        {"id": course_id, "is_active": True}, {"_id": 0, "lesson_count": 1, "lessons.id": 1}
     )
+    if course is None:
+        raise HTTPException(status_code=404, detail="Course not found")
+    if not await find_lesson(course_id, lesson_id):
+        raise HTTPException(status_code=404, detail="Lesson not found")
     
-    return {"message": "Lesson updated successfully"}
+    # A course not migrated yet has no lesson_count, only its embedded lessons
+    lesson_count = course.get("lesson_count", len(course.get("lessons", [])))
+    progress = await complete_lesson(current_user["id"], course_id, lesson_id, lesson_count)
+    if progress is None:
+        raise HTTPException(status_code=403, detail="Access denied. Please enroll in the course.")
+    return progress
+
+# Stored progress, overlaid with this worker's heartbeat that is not flushed yet
+@app.get("/api/courses/{course_id}/progress")
+async def get_course_progress(course_id: str, current_user: dict = Depends(get_current_user)):
+    progress = await db.enrollments.find_one(
+        {"user_id": current_user["id"], "course_id": course_id, "payment_status": "completed"}, PROGRESS_PROJECTION
+    )
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Not enrolled in this course")
+    
+    pending = heartbeat_buffer.pending(current_user["id"], course_id)
+    if pending and pending["last_accessed_at"] > (progress.get("last_accessed_at") or datetime.min):
+        progress.update(pending)
+    return progress
 
 @app.post("/api/courses/{course_id}/enroll")
 async def enroll_in_course(course_id: str, current_user: dict = Depends(get_current_user)):
@@ -343,78 +3630,107 @@ async def enroll_in_course(course_id: str, current_user: dict = Depends(get_curr
     if not course:
         raise HTTPException(status_code=404, detail="Course not found")
     
-    # Check if already enrolled
-    if course_id in current_user.get("enrolled_courses", []):
-        raise HTTPException(status_code=400, detail="Already enrolled in this course")
+    already_enrolled = await user_is_enrolled(current_user["id"], course_id, current_user["membership_version"])
     
-    # For free courses, enroll immediately
+    # For free courses, enroll immediately; retries and double clicks are no-ops
     if course["course_type"] == "free":
-        # Update user's enrolled courses
-        await db.users.update_one(
-            {"id": current_user["id"]},
-            {"$push": {"enrolled_courses": course_id}}
-        )
-        
-        # Update course student count
-        await db.courses.update_one(
-            {"id": course_id},
-            {"$inc": {"student_count": 1}}
-        )
-        
-        # Create enrollment record
-        enrollment = Enrollment(
-            user_id=current_user["id"],
-            course_id=course_id,
-            payment_status="completed"
-        )
-        await db.enrollments.insert_one(enrollment.dict())
-        
+        if not already_enrolled:
+            await complete_free_enrollment(current_user["id"], course)
         return {"message": "Successfully enrolled in course", "enrollment_status": "completed"}
     
-    # For paid courses, create pending enrollment
-    enrollment = Enrollment(
-        user_id=current_user["id"],
-        course_id=course_id,
-        payment_status="pending"
-    )
-    await db.enrollments.insert_one(enrollment.dict())
+    # Check if already enrolled
+    if already_enrolled:
+        raise HTTPException(status_code=400, detail="Already enrolled in this course")
+    
+    # For paid courses, open a pending enrollment or reuse the one already open
+    enrollment = await open_pending_enrollment(current_user["id"], course_id)
+    if enrollment is None:
+        raise HTTPException(status_code=400, detail="Already enrolled in this course")
     
     return {
         "message": "Enrollment initiated. Please complete payment.",
-        "enrollment_id": enrollment.id,
+        "enrollment_id": enrollment["id"],
         "payment_required": True,
         "amount": course["price"]
     }
 
+# Payment Routes
+# Start paying for a course; returns the payment with the gateway_url to redirect to.
+# An Idempotency-Key header makes retries safe: the same key returns the same payment.
+# Without one, repeated calls return the open payment for the user's pending enrollment.
+@app.post("/api/payments/initiate")
+async def initiate_course_payment(payment_data: PaymentCreate, idempotency_key: Optional[str] = Header(None, max_length=128),
+                                  current_user: dict = Depends(get_current_user)):
+    course = await db.courses.find_one(
+        {"id": payment_data.course_id, "is_active": True}, {"_id": 0, "id": 1, "title": 1, "course_type": 1, "price": 1}
+    )
+    if not course:
+        raise HTTPException(status_code=404, detail="Course not found")
+    if course["course_type"] != "paid":
+        raise HTTPException(status_code=400, detail="Course is free, enroll directly")
+    if not isinstance(course.get("price"), (int, float)) or course["price"] <= 0:
+        raise HTTPException(status_code=400, detail="Course has no valid price")
+    if abs(payment_data.amount - course["price"]) >= 0.01:
+        raise HTTPException(status_code=400, detail="Amount does not match the course price")
+    
+    profile = await get_user_profile(current_user["id"])
+    return await initiate_payment(profile, course, payment_data.payment_method, idempotency_key)
+
+# Instant payment notification from the gateway (form encoded, unauthenticated). It is
+# only recorded in the payment_callbacks inbox and acknowledged; the inbox workers
+# validate and settle it shortly after.
+@app.post("/api/payments/ipn")
+async def payment_ipn(request: Request):
+    form = dict(parse_qsl((await request.body()).decode()))
+    if not form.get("tran_id"):
+        raise HTTPException(status_code=400, detail="tran_id is required")
+    queued = await record_callback(form)
+    return {"status": "queued" if queued else "duplicate"}
+
+@app.get("/api/payments/{payment_id}")
+async def get_payment_status(payment_id: str, current_user: dict = Depends(get_current_user)):
+    payment = await db.payments.find_one({"id": payment_id}, PAYMENT_PROJECTION)
+    if not payment:
+        raise HTTPException(status_code=404, detail="Payment not found")
+    if payment["user_id"] != current_user["id"] and current_user["role"] not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Access denied")
+    return payment
+
 # Admin Routes
 @app.get("/api/admin/dashboard")
 async def admin_dashboard(current_user: dict = Depends(get_current_user)):
     if current_user["role"] not in ["admin", "super_admin"]:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    total_courses = await db.courses.count_documents({"is_active": True})
-    total_students = await db.users.count_documents({"role": "student", "is_active": True})
-    total_enrollments = await db.enrollments.count_documents({"payment_status": "completed"})
-    total_instructors = await db.users.count_documents({"role": "instructor", "is_active": True})
+    total_courses, total_students, total_instructors, rollup_totals = await asyncio.gather(
+        db.courses.count_documents({"is_active": True}),
+        db.users.count_documents({"role": "student", "is_active": True}),
+        db.users.count_documents({"role": "instructor", "is_active": True}),
+        get_course_rollup_totals(),
+    )
+    total_enrollments = sum(totals["enrollments"] for totals in rollup_totals.values())
     
     # Get recent enrollments
     recent_enrollments = await db.enrollments.find(
         {"payment_status": "completed"}
     ).sort("enrolled_at", -1).limit(10).to_list(None)
+    for enrollment in recent_enrollments:
+        if '_id' in enrollment:
+            enrollment['_id'] = str(enrollment['_id'])
     
     # Get course performance data
     course_stats = []
-    courses = await db.courses.find({"is_active": True}).to_list(None)
+    courses = await db.courses.find(
+        {"is_active": True},
+        {"_id": 0, "id": 1, "title": 1, "price": 1, "course_type": 1}
+    ).to_list(None)
     for course in courses:
-        enrollments = await db.enrollments.count_documents({
-            "course_id": course["id"], 
-            "payment_status": "completed"
-        })
+        totals = rollup_totals.get(course["id"], EMPTY_ROLLUP)
         course_stats.append({
             "course_id": course["id"],
             "title": course["title"],
-            "enrollments": enrollments,
-            "revenue": course.get("price", 0) * enrollments if course["course_type"] == "paid" else 0
+            "enrollments": totals["enrollments"],
+            "revenue": totals["revenue"]
         })
     
     return {
@@ -427,22 +3743,21 @@ async def admin_dashboard(current_user: dict = Depends(get_current_user)):
     }
 
 @app.get("/api/admin/users")
-async def get_all_users(current_user: dict = Depends(get_current_user)):
+async def get_all_users(cursor: Optional[str] = None, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                        include_total: bool = False, current_user: dict = Depends(get_current_user)):
     if current_user["role"] not in ["admin", "super_admin"]:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    users = await db.users.find({}, {"password": 0}).to_list(None)
-    # Convert MongoDB ObjectId to string and add enrollment info
-    for user in users:
-        if '_id' in user:
-            user['_id'] = str(user['_id'])
-        # Count enrollments for each user
-        user["total_enrollments"] = await db.enrollments.count_documents({
-            "user_id": user["id"], 
-            "payment_status": "completed"
-        })
+    page = await paginate(
+        db.users, {}, "created_at", "users",
+        cursor=cursor, limit=limit, include_total=include_total, projection={"password": 0}
+    )
+    # Add enrollment info for the users on this page
+    enrollment_counts = await get_completed_enrollment_counts(ids=[user["id"] for user in page["users"]])
+    for user in page["users"]:
+        user["total_enrollments"] = enrollment_counts.get(user["id"], 0)
     
-    return {"users": users}
+    return page
 
 @app.put("/api/admin/users/{user_id}/role")
 async def update_user_role(user_id: str, role_data: dict, current_user: dict = Depends(get_current_user)):
@@ -461,10 +3776,12 @@ async def update_user_role(user_id: str, role_data: dict, current_user: dict = D
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
+    # Bumping the token version revokes tokens that carry the old role
     await db.users.update_one(
         {"id": user_id},
-        {"$set": {"role": new_role}}
+        {"$set": {"role": new_role}, "$inc": {"token_version": 1}}
     )
+    invalidate_user(user_id)
     
     return {"message": f"User role updated to {new_role}"}
 
@@ -485,34 +3802,35 @@ async def update_user_status(user_id: str, status_data: dict, current_user: dict
     if user_id == current_user["id"]:
         raise HTTPException(status_code=400, detail="Cannot change your own status")
     
+    # Bumping the token version revokes the user's tokens, including refresh tokens
     await db.users.update_one(
         {"id": user_id},
-        {"$set": {"is_active": is_active}}
+        {"$set": {"is_active": is_active}, "$inc": {"token_version": 1}}
     )
+    invalidate_user(user_id)
     
     return {"message": f"User {'activated' if is_active else 'deactivated'} successfully"}
 
 @app.get("/api/admin/courses")
-async def get_all_courses_admin(current_user: dict = Depends(get_current_user)):
+async def get_all_courses_admin(cursor: Optional[str] = None, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                                include_total: bool = False, current_user: dict = Depends(get_current_user)):
     if current_user["role"] not in ["admin", "super_admin"]:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    courses = await db.courses.find({}).to_list(None)
+    page = await paginate(
+        db.courses, {}, "created_at", "courses",
+        cursor=cursor, limit=limit, include_total=include_total
+    )
+    await attach_lessons(page["courses"])
+    rollup_totals = await get_course_rollup_totals([course["id"] for course in page["courses"]])
     # Add enrollment and revenue data
-    for course in courses:
-        if '_id' in course:
-            course['_id'] = str(course['_id'])
-        
-        # Count enrollments
-        enrollments = await db.enrollments.count_documents({
-            "course_id": course["id"], 
-            "payment_status": "completed"
-        })
-        course["total_enrollments"] = enrollments
-        course["revenue"] = course.get("price", 0) * enrollments if course["course_type"] == "paid" else 0
+    for course in page["courses"]:
+        totals = rollup_totals.get(course["id"], EMPTY_ROLLUP)
+        course["total_enrollments"] = totals["enrollments"]
+        course["revenue"] = totals["revenue"]
         course["lesson_count"] = len(course.get("lessons", []))
     
-    return {"courses": courses}
+    return page
 
 @app.delete("/api/admin/courses/{course_id}")
 async def delete_course(course_id: str, current_user: dict = Depends(get_current_user)):
@@ -533,6 +3851,10 @@ async def delete_course(course_id: str, current_user: dict = Depends(get_current
     
     # Delete the course
     await db.courses.delete_one({"id": course_id})
+    await db.lessons.delete_many({"course_id": course_id})
+    lesson_ids_cache.invalidate(course_id)
+    await db.counters.delete_one({"_id": lesson_order_counter_id(course_id)})
+    await catalog_cache.bump()
     
     return {"message": "Course deleted successfully"}
 
@@ -551,83 +3873,215 @@ async def update_course_admin(course_id: str, course_data: CourseCreate, current
         {"id": course_id},
         {"$set": update_data}
     )
+    await catalog_cache.bump()
     
     return {"message": "Course updated successfully"}
 
 @app.get("/api/admin/enrollments")
-async def get_all_enrollments(current_user: dict = Depends(get_current_user)):
+async def get_all_enrollments(cursor: Optional[str] = None, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                              include_total: bool = False, current_user: dict = Depends(get_current_user)):
     if current_user["role"] not in ["admin", "super_admin"]:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    enrollments = await db.enrollments.find({}).sort("enrolled_at", -1).to_list(None)
+    page = await paginate(
+        db.enrollments, {}, "enrolled_at", "enrollments",
+        cursor=cursor, limit=limit, include_total=include_total
+    )
+    enrollments = page["enrollments"]
     
-    # Enrich with user and course data
+    # Enrich with user and course data, resolved in batches rather than per enrollment
+    users = await load_documents_by_id(
+        db.users, (e["user_id"] for e in enrollments), {"_id": 0, "id": 1, "full_name": 1, "email": 1}
+    )
+    courses = await load_documents_by_id(
+        db.courses, (e["course_id"] for e in enrollments), {"_id": 0, "id": 1, "title": 1, "price": 1}
+    )
     for enrollment in enrollments:
-        if '_id' in enrollment:
-            enrollment['_id'] = str(enrollment['_id'])
-        
         # Get user info
-        user = await db.users.find_one({"id": enrollment["user_id"]}, {"password": 0})
+        user = users[enrollment["user_id"]]
         if user:
             enrollment["user_name"] = user["full_name"]
             enrollment["user_email"] = user["email"]
         
         # Get course info
-        course = await db.courses.find_one({"id": enrollment["course_id"]})
+        course = courses[enrollment["course_id"]]
         if course:
             enrollment["course_title"] = course["title"]
             enrollment["course_price"] = course.get("price", 0)
     
-    return {"enrollments": enrollments}
+    return page
+
+# Enroll a cohort from a streamed text/csv (optionally with an `email,course_id` header)
+# or application/x-ndjson body; per-row results are read back from .../{job_id}/rows
+@app.post("/api/admin/enrollments:bulk")
+async def bulk_enroll(request: Request, current_user: dict = Depends(get_current_user)):
+    if current_user["role"] not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    lines = iter_lines(request.stream())
+    content_type = request.headers.get("content-type") or ""
+    parse = parse_ndjson_records if "json" in content_type else parse_csv_records
+    try:
+        return await run_bulk_enrollment(parse(lines), created_by=current_user["id"])
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+@app.get("/api/admin/enrollments:bulk/{job_id}")
+async def get_bulk_enrollment_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    if current_user["role"] not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    job = await db.bulk_enrollment_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Bulk enrollment job not found")
+    return job
+
+# Per-row results of a bulk enrollment job as NDJSON, in input order
+@app.get("/api/admin/enrollments:bulk/{job_id}/rows")
+async def get_bulk_enrollment_rows(
+    job_id: str,
+    status: Optional[Literal["enrolled", "already_enrolled", "user_not_found", "course_not_found", "invalid"]] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    if current_user["role"] not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    query = {"job_id": job_id}
+    if status:
+        query["status"] = status
+    cursor = db.bulk_enrollment_rows.find(query, {"_id": 0, "job_id": 0, "created_at": 0}).sort("row", 1)
+    
+    async def stream_rows():
+        async for row in cursor:
+            yield json.dumps(jsonable_encoder(row)) + "\n"
+    
+    return StreamingResponse(stream_rows(), media_type="application/x-ndjson")
+
+# Reconcile payments and enrollments against a streamed settlement CSV sorted by tran_id;
+# `since`/`until` bound its settlement period. Mismatches are read back from
+# .../{run_id}/mismatches. The nightly job runs the same reconciliation with
+# `python -m backend.database.reconciliation`.
+@app.post("/api/admin/reconciliations")
+async def reconcile_payments(request: Request, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                             current_user: dict = Depends(get_current_user)):
+    if current_user["role"] not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    records = parse_csv_records(iter_lines(request.stream()), columns=SETTLEMENT_COLUMNS, required=SETTLEMENT_REQUIRED_COLUMNS)
+    try:
+        return await run_reconciliation(records, created_by=current_user["id"], since=since, until=until)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+@app.get("/api/admin/reconciliations/{run_id}")
+async def get_reconciliation(run_id: str, current_user: dict = Depends(get_current_user)):
+    if current_user["role"] not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    run = await db.reconciliation_runs.find_one({"id": run_id}, {"_id": 0})
+    if not run:
+        raise HTTPException(status_code=404, detail="Reconciliation run not found")
+    return run
+
+# Mismatches of a reconciliation run as NDJSON, grouped by kind
+@app.get("/api/admin/reconciliations/{run_id}/mismatches")
+async def get_reconciliation_mismatches(run_id: str, kind: Optional[str] = None,
+                                        current_user: dict = Depends(get_current_user)):
+    if current_user["role"] not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    if kind is not None and kind not in MISMATCH_KINDS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of {', '.join(MISMATCH_KINDS)}")
+    
+    query = {"run_id": run_id}
+    if kind:
+        query["kind"] = kind
+    cursor = db.reconciliation_mismatches.find(query, {"_id": 0, "run_id": 0, "created_at": 0})
+    
+    async def stream_mismatches():
+        async for mismatch in cursor:
+            yield json.dumps(jsonable_encoder(mismatch)) + "\n"
+    
+    return StreamingResponse(stream_mismatches(), media_type="application/x-ndjson")
+
+@app.get("/api/admin/indexes")
+async def get_index_report(current_user: dict = Depends(get_current_user)):
+    if current_user["role"] not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    return {"indexes": await report_indexes()}
+
+@app.get("/api/admin/metrics")
+async def get_metrics(current_user: dict = Depends(get_current_user)):
+    if current_user["role"] not in ["admin", "super_admin"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    
+    # Per-worker figures: each uvicorn worker keeps its own caches
+    return {
+        "principal_cache": principal_cache.stats(),
+        "token_version_cache": token_version_cache.stats(),
+        "revocation_list": revocation_list.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "membership_cache": membership_cache.stats(),
+        "catalog_cache": catalog_cache.stats(),
+        "student_count_flusher": student_count_flusher.stats(),
+        "heartbeat_buffer": heartbeat_buffer.stats(),
+        "payment_gateway": get_gateway().stats(),
+        "payment_inbox": payment_inbox.stats(),
+        "password_hasher": password_hasher.stats(),
+        "request_latency": request_latency.stats()
+    }
 
 @app.get("/api/admin/analytics")
 async def get_analytics(current_user: dict = Depends(get_current_user)):
     if current_user["role"] not in ["admin", "super_admin"]:
         raise HTTPException(status_code=403, detail="Admin access required")
     
-    # Monthly enrollment trends (last 6 months)
-    from datetime import datetime, timedelta
-    import calendar
-    
-    monthly_data = []
-    for i in range(6):
-        # Calculate start and end of month
-        target_date = datetime.now() - timedelta(days=30 * i)
-        start_of_month = target_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        if target_date.month == 12:
-            end_of_month = start_of_month.replace(year=start_of_month.year + 1, month=1) - timedelta(seconds=1)
-        else:
-            end_of_month = start_of_month.replace(month=start_of_month.month + 1) - timedelta(seconds=1)
-        
-        # Count enrollments in this month
-        enrollments = await db.enrollments.count_documents({
-            "enrolled_at": {"$gte": start_of_month, "$lte": end_of_month},
-            "payment_status": "completed"
-        })
-        
-        monthly_data.append({
-            "month": calendar.month_name[start_of_month.month],
-            "year": start_of_month.year,
-            "enrollments": enrollments
-        })
+    # Monthly enrollment trends (last 6 calendar months, oldest to newest)
+    now = datetime.utcnow()
+    month_starts = []
+    year, month = now.year, now.month
+    for _ in range(6):
+        month_starts.insert(0, datetime(year, month, 1))
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    
+    monthly_pipeline = [
+        {"$match": {"day": {"$gte": month_starts[0]}}},
+        {"$group": {
+            "_id": {"year": {"$year": "$day"}, "month": {"$month": "$day"}},
+            "enrollments": {"$sum": "$enrollments"}
+        }},
+    ]
     
-    # Revenue by course type
-    free_courses = await db.courses.count_documents({"course_type": "free", "is_active": True})
-    paid_courses = await db.courses.count_documents({"course_type": "paid", "is_active": True})
+    # Revenue by course type, monthly buckets and per-course counts in parallel
+    free_courses, paid_courses, monthly_rows, courses, rollup_totals = await asyncio.gather(
+        db.courses.count_documents({"course_type": "free", "is_active": True}),
+        db.courses.count_documents({"course_type": "paid", "is_active": True}),
+        db.daily_rollups.aggregate(monthly_pipeline).to_list(None),
+        db.courses.find(
+            {"is_active": True},
+            {"_id": 0, "id": 1, "title": 1, "price": 1, "course_type": 1}
+        ).to_list(None),
+        get_course_rollup_totals(),
+    )
+    
+    monthly_counts = {(row["_id"]["year"], row["_id"]["month"]): row["enrollments"] for row in monthly_rows}
+    monthly_data = [
+        {
+            "month": calendar.month_name[start.month],
+            "year": start.year,
+            "enrollments": monthly_counts.get((start.year, start.month), 0)
+        }
+        for start in month_starts
+    ]
     
     # Top performing courses
-    courses = await db.courses.find({"is_active": True}).to_list(None)
     course_performance = []
     for course in courses:
-        enrollments = await db.enrollments.count_documents({
-            "course_id": course["id"], 
-            "payment_status": "completed"
-        })
-        revenue = course.get("price", 0) * enrollments if course["course_type"] == "paid" else 0
+        totals = rollup_totals.get(course["id"], EMPTY_ROLLUP)
         course_performance.append({
             "title": course["title"],
-            "enrollments": enrollments,
-            "revenue": revenue,
+            "enrollments": totals["enrollments"],
+            "revenue": totals["revenue"],
             "type": course["course_type"]
         })
     
@@ -635,7 +4089,7 @@ async def get_analytics(current_user: dict = Depends(get_current_user)):
     course_performance.sort(key=lambda x: x["enrollments"], reverse=True)
     
     return {
-        "monthly_trends": list(reversed(monthly_data)),  # Oldest to newest
+        "monthly_trends": monthly_data,  # Oldest to newest
         "course_type_distribution": {
             "free_courses": free_courses,
             "paid_courses": paid_courses
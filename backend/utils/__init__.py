@@ -1,4 +1,15 @@
-from .auth import hash_password, verify_password, create_access_token
+from .auth import hash_password, verify_password, create_access_token, create_refresh_token, decode_token
 from .helpers import convert_objectid_to_string
+from .loaders import DocumentLoader
+from .cache import TTLCache
+from .latency import LatencyRecorder
+from .passwords import PasswordHasher, PasswordHasherBusy
+from .revocation import BloomFilter, RevocationList
+from .ratelimit import RateLimit, RateLimiter, RateLimitMiddleware, create_rate_limit_backend
 
-__all__ = ["hash_password", "verify_password", "create_access_token", "convert_objectid_to_string"]
\ No newline at end of file
+__all__ = [
+    "hash_password", "verify_password", "create_access_token", "create_refresh_token", "decode_token",
+    "convert_objectid_to_string", "DocumentLoader", "TTLCache",
+    "LatencyRecorder", "PasswordHasher", "PasswordHasherBusy", "BloomFilter", "RevocationList",
+    "RateLimit", "RateLimiter", "RateLimitMiddleware", "create_rate_limit_backend"
+]
\ No newline at end of file
@@ -1,25 +1,63 @@
+import base64
 import hashlib
+import hmac
+import os
+import uuid
 import jwt
 from datetime import datetime, timedelta
 from typing import Optional
 from ..config.settings import settings
 
+# Stored as scrypt$<n>$<r>$<p>$<salt>$<hash> (base64); legacy hashes are unsalted SHA-256 hex
+SCRYPT_SALT_BYTES = 16
+SCRYPT_HASH_BYTES = 32
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024, dklen=SCRYPT_HASH_BYTES
+    )
+
 def hash_password(password: str) -> str:
-    """Hash a password using SHA-256"""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Hash a password with salted scrypt (CPU and memory hard; run it off the event loop)"""
+    n, r, p = settings.password_scrypt_n, settings.password_scrypt_r, settings.password_scrypt_p
+    salt = os.urandom(SCRYPT_SALT_BYTES)
+    digest = _scrypt(password, salt, n, r, p)
+    return "$".join(["scrypt", str(n), str(r), str(p), base64.b64encode(salt).decode(), base64.b64encode(digest).decode()])
 
 def verify_password(password: str, hashed: str) -> bool:
-    """Verify a password against its hash"""
-    return hash_password(password) == hashed
+    """Verify a password against a scrypt hash or a legacy SHA-256 one"""
+    if not hashed.startswith("scrypt$"):
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), hashed)
+    try:
+        _, n, r, p, salt, digest = hashed.split("$")
+        expected = base64.b64decode(digest)
+        actual = _scrypt(password, base64.b64decode(salt), int(n), int(r), int(p))
+    except ValueError:
+        return False
+    return hmac.compare_digest(actual, expected)
 
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    """Create a JWT access token"""
+def password_needs_rehash(hashed: str) -> bool:
+    """Whether a stored hash is legacy SHA-256 or uses other scrypt parameters than configured"""
+    current = f"scrypt${settings.password_scrypt_n}${settings.password_scrypt_r}${settings.password_scrypt_p}$"
+    return not hashed.startswith(current)
+
+def _encode_token(data: dict, token_type: str, expires_delta: timedelta) -> str:
+    now = datetime.utcnow()
     to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(hours=settings.access_token_expire_hours)
-    
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, settings.jwt_secret, algorithm=settings.jwt_algorithm)
-    return encoded_jwt
\ No newline at end of file
+    to_encode.update({"typ": token_type, "jti": uuid.uuid4().hex, "iat": now, "exp": now + expires_delta})
+    return jwt.encode(to_encode, settings.jwt_secret, algorithm=settings.jwt_algorithm)
+
+def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+    """Create a short-lived JWT access token"""
+    return _encode_token(data, "access", expires_delta or timedelta(minutes=settings.access_token_expire_minutes))
+
+def create_refresh_token(data: dict, expires_delta: Optional[timedelta] = None):
+    """Create a long-lived JWT refresh token, only accepted by /auth/refresh"""
+    return _encode_token(data, "refresh", expires_delta or timedelta(days=settings.refresh_token_expire_days))
+
+def decode_token(token: str, token_type: str) -> dict:
+    """Decode and verify a JWT of the given type; raises jwt.PyJWTError if invalid"""
+    payload = jwt.decode(token, settings.jwt_secret, algorithms=[settings.jwt_algorithm])
+    if payload.get("typ", "access") != token_type:  # Tokens issued before typ was added are access tokens
+        raise jwt.InvalidTokenError(f"Not a {token_type} token")
+    return payload
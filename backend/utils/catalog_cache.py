@@ -0,0 +1,158 @@
+import gzip
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from pymongo import ReturnDocument
+
+try:
+    import brotli
+except ImportError:  # Optional: without it clients fall back to gzip
+    brotli = None
+
+CATALOG_VERSION_ID = "catalog_version"
+
+@dataclass
+class CatalogEntry:
+    version: int
+    created_at: float
+    etag: str
+    identity: bytes
+    gzip: bytes
+    br: Optional[bytes]
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Evaluate an If-None-Match header against a strong ETag"""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+class CatalogCache:
+    """Serialized, precompressed catalog responses keyed by request parameters.
+
+    Entries belong to a catalog version stored in the `counters` collection.
+    Every course or lesson mutation calls `bump()`, which increments it and
+    drops this worker's entries; other workers notice the new version within
+    `version_poll_interval` seconds. Entries also expire after `max_age`
+    seconds so denormalized figures such as student_count converge.
+    """
+
+    def __init__(
+        self,
+        counters_collection,
+        max_entries: int = 256,
+        max_age: float = 60.0,
+        version_poll_interval: float = 2.0
+    ):
+        self.counters = counters_collection
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.version_poll_interval = version_poll_interval
+        self.version = 0
+        self._version_checked_at = float("-inf")
+        self._entries: "OrderedDict[Hashable, CatalogEntry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    async def current_version(self) -> int:
+        """Catalog version, re-read from Mongo at most once per poll interval"""
+        now = time.monotonic()
+        if now - self._version_checked_at >= self.version_poll_interval:
+            doc = await self.counters.find_one({"_id": CATALOG_VERSION_ID})
+            self._version_checked_at = now
+            self._set_version(doc["value"] if doc else 0)
+        return self.version
+
+    async def bump(self) -> int:
+        """Invalidate every cached catalog response across all workers"""
+        doc = await self.counters.find_one_and_update(
+            {"_id": CATALOG_VERSION_ID},
+            {"$inc": {"value": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self._version_checked_at = time.monotonic()
+        self._set_version(doc["value"])
+        return self.version
+
+    def _set_version(self, version: int):
+        if version != self.version:
+            self.version = version
+            self._entries.clear()
+
+    def _get(self, key: Hashable) -> Optional[CatalogEntry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.version != self.version or time.monotonic() - entry.created_at > self.max_age:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _put(self, key: Hashable, payload: Any) -> CatalogEntry:
+        body = json.dumps(
+            jsonable_encoder(payload), ensure_ascii=False, allow_nan=False, separators=(",", ":")
+        ).encode("utf-8")
+        entry = CatalogEntry(
+            version=self.version,
+            created_at=time.monotonic(),
+            etag=f'"{self.version}-{hashlib.sha256(body).hexdigest()[:32]}"',
+            identity=body,
+            gzip=gzip.compress(body, compresslevel=6),
+            br=brotli.compress(body) if brotli else None
+        )
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    async def respond(
+        self,
+        request: Request,
+        key: Hashable,
+        load: Callable[[], Awaitable[Any]]
+    ) -> Response:
+        """Serve `key` from cache (calling `load` on a miss) with ETag/304 and compression"""
+        await self.current_version()
+        entry = self._get(key)
+        if entry is None:
+            self.misses += 1
+            entry = self._put(key, await load())
+        else:
+            self.hits += 1
+        
+        headers = {
+            "ETag": entry.etag,
+            "Cache-Control": "public, no-cache",
+            "Vary": "Accept-Encoding"
+        }
+        if etag_matches(request.headers.get("if-none-match"), entry.etag):
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        
+        accept_encoding = request.headers.get("accept-encoding", "")
+        if entry.br is not None and "br" in accept_encoding:
+            headers["Content-Encoding"] = "br"
+            body = entry.br
+        elif "gzip" in accept_encoding:
+            headers["Content-Encoding"] = "gzip"
+            body = entry.gzip
+        else:
+            body = entry.identity
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified
+        }
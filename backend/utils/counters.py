@@ -0,0 +1,92 @@
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Any, Dict, Hashable, Optional
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+class CounterFlusher:
+    """Coalesces counter increments in process and applies them in one bulk write.
+
+    Increments to the same document are summed between flushes, so a burst of
+    N enrollments in one course costs a single $inc instead of N. Pending
+    increments are lost if the worker dies before flushing; counters that must
+    be exact are rebuilt from their source collection.
+    """
+
+    def __init__(self, collection, field: str, key_field: str = "id", interval: float = 1.0):
+        self.collection = collection
+        self.field = field
+        self.key_field = key_field
+        self.interval = interval
+        self._pending: Dict[Hashable, int] = defaultdict(int)
+        self._task: Optional[asyncio.Task] = None
+        self.increments = 0
+        self.flushes = 0
+        self.documents_updated = 0
+        self.failures = 0
+
+    def add(self, key: Hashable, amount: int = 1):
+        self._pending[key] += amount
+        self.increments += 1
+
+    async def flush(self) -> int:
+        """Apply pending increments; returns the number of documents written"""
+        pending = {key: amount for key, amount in self._pending.items() if amount}
+        self._pending = defaultdict(int)
+        if not pending:
+            return 0
+
+        try:
+            await self.collection.bulk_write([
+                UpdateOne({self.key_field: key}, {"$inc": {self.field: amount}})
+                for key, amount in pending.items()
+            ], ordered=False)
+        except Exception as exc:  # Any error, so buffered increments are never dropped
+            # Keep the increments for the next flush rather than dropping them
+            for key, amount in pending.items():
+                self._pending[key] += amount
+            self.failures += 1
+            logger.error("Could not flush %s increments: %s", self.field, exc)
+            return 0
+
+        self.flushes += 1
+        self.documents_updated += len(pending)
+        return len(pending)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:  # Keep flushing; a dead task would silently drop everything buffered after
+                logger.exception("Could not flush %s increments", self.field)
+
+    def start(self) -> asyncio.Task:
+        """Start flushing every `interval` seconds on the running loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        """Stop the periodic flush and write whatever is still pending"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "field": self.field,
+            "pending_documents": len(self._pending),
+            "increments": self.increments,
+            "flushes": self.flushes,
+            "documents_updated": self.documents_updated,
+            "failures": self.failures,
+            "interval_seconds": self.interval
+        }
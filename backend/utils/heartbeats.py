@@ -0,0 +1,112 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+class HeartbeatBuffer:
+    """Coalesces playback heartbeats per (user_id, course_id) and flushes them in one bulk write.
+
+    Only the newest heartbeat of each enrollment is kept between flushes, so a
+    player reporting every few seconds costs one update per flush interval
+    instead of one per heartbeat. Each update only applies if it is newer than
+    what is stored, so workers flushing out of order never move a position
+    backwards. The buffer is flushed early once it holds `max_entries`
+    enrollments; heartbeats still pending when a worker dies are lost.
+    """
+
+    def __init__(self, collection, interval: float = 5.0, max_entries: int = 50000):
+        self.collection = collection
+        self.interval = interval
+        self.max_entries = max_entries
+        self._pending: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.heartbeats = 0
+        self.flushes = 0
+        self.documents_updated = 0
+        self.failures = 0
+
+    async def record(self, user_id: str, course_id: str, lesson_id: str, position_seconds: int):
+        self._pending[(user_id, course_id)] = {
+            "last_accessed_at": datetime.utcnow(),
+            "last_lesson_id": lesson_id,
+            "last_position_seconds": position_seconds
+        }
+        self.heartbeats += 1
+        if len(self._pending) >= self.max_entries:
+            await self.flush()
+
+    def pending(self, user_id: str, course_id: str) -> Optional[Dict[str, Any]]:
+        """The heartbeat of this worker not yet flushed for the enrollment, if any"""
+        return self._pending.get((user_id, course_id))
+
+    async def flush(self) -> int:
+        """Write buffered heartbeats; returns the number of enrollments written"""
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        try:
+            await self.collection.bulk_write([
+                UpdateOne(
+                    {
+                        "user_id": user_id,
+                        "course_id": course_id,
+                        "payment_status": "completed",
+                        "$or": [
+                            {"last_accessed_at": None},
+                            {"last_accessed_at": {"$lt": fields["last_accessed_at"]}}
+                        ]
+                    },
+                    {"$set": fields}
+                )
+                for (user_id, course_id), fields in pending.items()
+            ], ordered=False)
+        except Exception as exc:  # Any error, so buffered heartbeats are never dropped
+            # Keep them for the next flush unless a newer heartbeat arrived meanwhile
+            for key, fields in pending.items():
+                self._pending.setdefault(key, fields)
+            self.failures += 1
+            logger.error("Could not flush heartbeats: %s", exc)
+            return 0
+
+        self.flushes += 1
+        self.documents_updated += len(pending)
+        return len(pending)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:  # Keep flushing; a dead task would silently drop everything buffered after
+                logger.exception("Could not flush heartbeats")
+
+    def start(self) -> asyncio.Task:
+        """Start flushing every `interval` seconds on the running loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        """Stop the periodic flush and write whatever is still pending"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending_enrollments": len(self._pending),
+            "heartbeats": self.heartbeats,
+            "flushes": self.flushes,
+            "documents_updated": self.documents_updated,
+            "failures": self.failures,
+            "interval_seconds": self.interval
+        }
@@ -1,5 +1,26 @@
 from typing import Dict, Any, List, Union
 
+# Fields a catalog card needs, including the lesson aggregates maintained on the
+# course document, so lessons are never read or shipped for the listing
+CATALOG_SUMMARY_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "title": 1,
+    "description": 1,
+    "instructor_name": 1,
+    "course_type": 1,
+    "price": 1,
+    "thumbnail_url": 1,
+    "student_count": 1,
+    "rating": 1,
+    "rating_count": 1,
+    "category": 1,
+    "tags": 1,
+    "created_at": 1,
+    "lesson_count": {"$ifNull": ["$lesson_count", 0]},
+    "total_duration": 1,
+}
+
 def convert_objectid_to_string(data: Union[Dict[Any, Any], List[Dict[Any, Any]]]) -> Union[Dict[Any, Any], List[Dict[Any, Any]]]:
     """Convert MongoDB ObjectId to string in data"""
     if isinstance(data, list):
@@ -17,13 +38,17 @@ def format_course_response(course: Dict[Any, Any], is_enrolled: bool = False) ->
     """Format course response based on enrollment status"""
     course = convert_objectid_to_string(course)
     course['is_enrolled'] = is_enrolled
+    preview_lessons = course.pop("preview_lessons", None)
     
     # If not enrolled and course is paid, only show preview lessons
     if not is_enrolled and course.get("course_type") == "paid":
-        course["lessons"] = [
-            lesson for lesson in course.get("lessons", []) 
-            if lesson.get("is_preview", False)
-        ]
+        if preview_lessons is not None:
+            course["lessons"] = preview_lessons
+        else:  # Course predates the precomputed preview subset
+            course["lessons"] = [
+                lesson for lesson in course.get("lessons", [])
+                if lesson.get("is_preview", False)
+            ]
     
     return course
 
@@ -0,0 +1,77 @@
+import asyncio
+import csv
+import json
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+MAX_LINE_BYTES = 4096
+FILE_CHUNK_BYTES = 64 * 1024
+CSV_DEFAULT_COLUMNS = ("email", "course_id")
+
+async def iter_lines(chunks: AsyncIterator[bytes], max_line_bytes: int = MAX_LINE_BYTES) -> AsyncIterator[str]:
+    """Split a streamed request body into text lines without buffering the whole body.
+
+    Only the current partial line is held between chunks; a line longer than
+    `max_line_bytes` raises ValueError.
+    """
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        if len(buffer) > max_line_bytes:
+            raise ValueError(f"Line longer than {max_line_bytes} bytes")
+        for line in lines:
+            yield line.decode("utf-8", errors="replace").rstrip("\r")
+    if buffer:
+        yield buffer.decode("utf-8", errors="replace").rstrip("\r")
+
+async def read_file_chunks(path: str, chunk_bytes: int = FILE_CHUNK_BYTES) -> AsyncIterator[bytes]:
+    """Read a local file in chunks off the event loop, for feeding iter_lines"""
+    with open(path, "rb") as file:
+        while True:
+            chunk = await asyncio.to_thread(file.read, chunk_bytes)
+            if not chunk:
+                return
+            yield chunk
+
+async def parse_csv_records(
+    lines: AsyncIterator[str],
+    columns: Sequence[str] = CSV_DEFAULT_COLUMNS,
+    required: Optional[Sequence[str]] = None
+) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+    """Yield (row_number, record) from CSV lines.
+
+    A first line naming the `required` columns (all of `columns` by default,
+    e.g. `email,course_id`) is used as the header; otherwise values are taken
+    in `columns` order. Blank lines are skipped and not numbered.
+    """
+    required = required or columns
+    header: Optional[List[str]] = None
+    row_number = 0
+    async for line in lines:
+        if not line.strip():
+            continue
+        values = next(csv.reader([line.lstrip("\ufeff")]))
+        if row_number == 0 and header is None:
+            names = [value.strip().lower() for value in values]
+            if set(required) <= set(names):
+                header = names
+                continue
+        row_number += 1
+        yield row_number, dict(zip(header or columns, values))
+
+async def parse_ndjson_records(lines: AsyncIterator[str]) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+    """Yield (row_number, record) from newline-delimited JSON objects; bad lines yield an empty record"""
+    row_number = 0
+    async for line in lines:
+        if not line.strip():
+            continue
+        row_number += 1
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield row_number, record if isinstance(record, dict) else {}
+
+def is_ndjson(content_type: Optional[str]) -> bool:
+    """Whether a request Content-Type names newline-delimited JSON rather than CSV"""
+    return any(kind in (content_type or "") for kind in ("ndjson", "jsonl", "json"))
@@ -0,0 +1,62 @@
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Hashable
+
+class LatencyRecorder:
+    """Recent latencies per key (e.g. route), summarized as percentiles.
+
+    Keeps the last `window` samples of each key, for at most `max_keys` keys,
+    so memory stays bounded whatever the traffic.
+    """
+
+    def __init__(self, window: int = 1024, max_keys: int = 256):
+        self.window = window
+        self.max_keys = max_keys
+        self._samples: Dict[Hashable, Deque[float]] = {}
+        self._counts: Dict[Hashable, int] = {}
+
+    def record(self, key: Hashable, seconds: float):
+        samples = self._samples.get(key)
+        if samples is None:
+            if len(self._samples) >= self.max_keys:
+                return
+            samples = self._samples[key] = deque(maxlen=self.window)
+            self._counts[key] = 0
+        samples.append(seconds)
+        self._counts[key] += 1
+
+    def time(self, key: Hashable) -> "_Timer":
+        """Context manager recording the duration of its block under `key`"""
+        return _Timer(self, key)
+
+    @staticmethod
+    def _percentile(ordered, fraction: float) -> float:
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def stats(self) -> Dict[str, Any]:
+        summary = {}
+        for key, samples in self._samples.items():
+            ordered = sorted(samples)
+            summary[str(key)] = {
+                "count": self._counts[key],
+                "p50_ms": round(self._percentile(ordered, 0.50) * 1000, 2),
+                "p95_ms": round(self._percentile(ordered, 0.95) * 1000, 2),
+                "p99_ms": round(self._percentile(ordered, 0.99) * 1000, 2),
+                "max_ms": round(ordered[-1] * 1000, 2)
+            }
+        return summary
+
+class _Timer:
+    def __init__(self, recorder: LatencyRecorder, key: Hashable):
+        self.recorder = recorder
+        self.key = key
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.recorder.record(self.key, time.perf_counter() - self.started)
+
+# Request latency per route template, recorded by the HTTP middleware
+request_latency = LatencyRecorder()
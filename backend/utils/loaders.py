@@ -0,0 +1,35 @@
+from typing import Any, Dict, Iterable, Optional
+
+# Upper bound on ids per $in query so a single filter stays well under the BSON size limit
+LOADER_BATCH_SIZE = 1000
+
+class DocumentLoader:
+    """Per-request batched loader that resolves documents by their `id` field.
+
+    Ids are collected and fetched with `$in` queries instead of one `find_one`
+    per reference; results (including misses) are memoized for the lifetime of
+    the loader so repeated ids are never fetched twice.
+    """
+
+    def __init__(self, collection, projection: Optional[Dict[str, Any]] = None):
+        self.collection = collection
+        self.projection = projection
+        self._cache: Dict[str, Optional[Dict[Any, Any]]] = {}
+
+    async def load_many(self, ids: Iterable[str]) -> Dict[str, Optional[Dict[Any, Any]]]:
+        """Resolve ids to documents, returning None for ids that do not exist"""
+        wanted = list(dict.fromkeys(ids))
+        missing = [doc_id for doc_id in wanted if doc_id not in self._cache]
+        
+        for start in range(0, len(missing), LOADER_BATCH_SIZE):
+            batch = missing[start:start + LOADER_BATCH_SIZE]
+            async for doc in self.collection.find({"id": {"$in": batch}}, self.projection):
+                self._cache[doc["id"]] = doc
+            for doc_id in batch:
+                self._cache.setdefault(doc_id, None)
+        
+        return {doc_id: self._cache[doc_id] for doc_id in wanted}
+
+    async def load(self, doc_id: str) -> Optional[Dict[Any, Any]]:
+        """Resolve a single id through the same memo"""
+        return (await self.load_many([doc_id]))[doc_id]
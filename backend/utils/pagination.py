@@ -0,0 +1,79 @@
+import asyncio
+import base64
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from fastapi import HTTPException
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(sort_value: datetime, doc_id: str) -> str:
+    """Opaque cursor for the position just after (sort_value, doc_id)"""
+    raw = json.dumps({"t": sort_value.isoformat(), "id": doc_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Inverse of encode_cursor; raises ValueError for anything malformed"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(data["t"]), str(data["id"])
+    except (ValueError, KeyError, TypeError) as exc:
+        raise ValueError("Invalid cursor") from exc
+
+async def paginate(
+    collection,
+    query: Dict[str, Any],
+    sort_field: str,
+    items_key: str = "items",
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    include_total: bool = False,
+    projection: Optional[Dict[str, Any]] = None,
+    stages: Optional[List[Dict[str, Any]]] = None
+) -> Dict[str, Any]:
+    """Fetch one keyset page ordered newest first by (sort_field, id).
+
+    Each page is a bounded index range scan that continues strictly after the
+    cursor, so memory and latency do not grow with the collection. The page
+    is returned under `items_key` next to `next_cursor` (None on the last
+    page); `total` is only counted when asked for. Extra `stages` (such as a
+    $lookup) run on the page only, before the projection.
+    """
+    page_query = query
+    if cursor:
+        try:
+            sort_value, last_id = decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        page_query = {"$and": [query, {"$or": [
+            {sort_field: {"$lt": sort_value}},
+            {sort_field: sort_value, "id": {"$lt": last_id}}
+        ]}]}
+    
+    # Fetch one extra document to learn whether another page exists
+    pipeline = [
+        {"$match": page_query},
+        {"$sort": {sort_field: -1, "id": -1}},
+        {"$limit": limit + 1},
+        *(stages or []),
+    ]
+    if projection:
+        # May hold aggregation expressions for derived fields, not just inclusions
+        pipeline.append({"$project": projection})
+    fetch = collection.aggregate(pipeline).to_list(None)
+    if include_total:
+        items, total = await asyncio.gather(fetch, collection.count_documents(query))
+    else:
+        items, total = await fetch, None
+    
+    has_more = len(items) > limit
+    items = items[:limit]
+    page: Dict[str, Any] = {
+        items_key: items,
+        "next_cursor": encode_cursor(items[-1][sort_field], items[-1]["id"]) if has_more else None
+    }
+    if include_total:
+        page["total"] = total
+    return page
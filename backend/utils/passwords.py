@@ -0,0 +1,87 @@
+import asyncio
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+from .auth import hash_password, password_needs_rehash, verify_password
+from .latency import LatencyRecorder
+
+class PasswordHasherBusy(Exception):
+    """More password operations are queued than the hasher accepts"""
+
+class PasswordHasher:
+    """Runs password hashing and verification in a bounded thread pool.
+
+    scrypt releases the GIL while it runs, so `workers` threads hash in
+    parallel while the event loop keeps serving other requests. At most
+    `max_pending` operations are admitted (running or queued); a caller that
+    cannot be admitted within `queue_timeout` seconds gets PasswordHasherBusy
+    instead of piling more work onto an overloaded worker.
+    """
+
+    def __init__(self, workers: int = 4, max_pending: int = 256, queue_timeout: float = 5.0):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.pending = 0
+        self.rejected = 0
+        self.upgrades = 0
+        self.latency = LatencyRecorder()
+        self._dummy_hash: Optional[str] = None
+
+    def _admit(self) -> asyncio.Semaphore:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hasher")
+        return self._slots
+
+    async def _run(self, operation: str, function, *args):
+        slots = self._admit()
+        with self.latency.time(operation):
+            try:
+                await asyncio.wait_for(slots.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise PasswordHasherBusy(f"More than {self.max_pending} password operations pending")
+            self.pending += 1
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+            finally:
+                self.pending -= 1
+                slots.release()
+
+    async def hash(self, password: str) -> str:
+        return await self._run("hash", hash_password, password)
+
+    async def verify(self, password: str, hashed: str) -> Tuple[bool, bool]:
+        """Check a password; returns (valid, needs_rehash)"""
+        valid = await self._run("verify", verify_password, password, hashed)
+        return valid, valid and password_needs_rehash(hashed)
+
+    async def verify_unknown(self, password: str):
+        """Check a password for an unknown account against a hash of a random one.
+
+        Logins for an email that does not exist cost the same scrypt work as
+        logins for one that does, so their latency does not reveal which
+        emails are registered. The hash uses the configured parameters.
+        """
+        if self._dummy_hash is None or password_needs_rehash(self._dummy_hash):
+            self._dummy_hash = await self.hash(uuid.uuid4().hex)
+        await self._run("verify", verify_password, password, self._dummy_hash)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._slots = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "rejected": self.rejected,
+            "upgrades": self.upgrades,
+            "latency": self.latency.stats()
+        }
@@ -0,0 +1,261 @@
+import json
+import logging
+import math
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from starlette.responses import JSONResponse
+
+logger = logging.getLogger(__name__)
+
+class RateLimit:
+    """A token bucket: `burst` requests at once, refilled at `per_minute` per minute"""
+
+    def __init__(self, name: str, per_minute: float, burst: int):
+        self.name = name
+        self.rate = per_minute / 60.0
+        self.burst = burst
+
+class MemoryRateLimitBackend:
+    """Token buckets in this process, for a single worker or tests.
+
+    Buckets are spread over `shards` LRU maps by key hash and each holds at
+    most max_keys / shards buckets, so memory stays bounded however many
+    IPs or emails are seen and eviction only scans one small map. An evicted
+    bucket starts full again, which only errs towards allowing a request.
+    """
+
+    def __init__(self, max_keys: int = 100000, shards: int = 16):
+        self.shard_size = max(1, max_keys // shards)
+        self._shards: List["OrderedDict[str, List[float]]"] = [OrderedDict() for _ in range(shards)]
+        self.evictions = 0
+
+    async def take(self, key: str, limit: RateLimit) -> Tuple[bool, float]:
+        """Take one token; returns (allowed, seconds until one is available)"""
+        shard = self._shards[hash(key) % len(self._shards)]
+        now = time.monotonic()
+        bucket = shard.get(key)
+        if bucket is None:
+            bucket = shard[key] = [float(limit.burst), now]
+            if len(shard) > self.shard_size:
+                shard.popitem(last=False)
+                self.evictions += 1
+        else:
+            shard.move_to_end(key)
+            bucket[0] = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True, 0.0
+        return False, (1 - bucket[0]) / limit.rate
+
+    async def close(self):
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "memory",
+            "buckets": sum(len(shard) for shard in self._shards),
+            "max_buckets": self.shard_size * len(self._shards),
+            "evictions": self.evictions
+        }
+
+# Refill and take one token atomically on the Redis server, timed by its own clock so
+# workers on different hosts agree. Buckets expire once they would be full again.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return {allowed, tostring(retry_after)}
+"""
+
+class RedisRateLimitBackend:
+    """Token buckets in Redis, shared by every worker.
+
+    Each take is one EVAL of TOKEN_BUCKET_SCRIPT. If Redis cannot be reached
+    the request is allowed and counted as a failure: losing the limiter
+    must not lock everyone out of signing in.
+    """
+
+    def __init__(self, client, prefix: str = "ratelimit:"):
+        self.client = client
+        self.prefix = prefix
+        self.failures = 0
+
+    async def take(self, key: str, limit: RateLimit) -> Tuple[bool, float]:
+        try:
+            allowed, retry_after = await self.client.eval(
+                TOKEN_BUCKET_SCRIPT, 1, self.prefix + key, limit.rate, limit.burst
+            )
+        except Exception as exc:  # Any client or connection error fails open
+            self.failures += 1
+            logger.error("Rate limit backend unavailable, allowing request: %s", exc)
+            return True, 0.0
+        return bool(int(allowed)), float(retry_after)
+
+    async def close(self):
+        await self.client.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "redis", "failures": self.failures}
+
+def create_rate_limit_backend(kind: str, redis_url: str = "", max_keys: int = 100000, shards: int = 16):
+    """Backend for RATE_LIMIT_BACKEND: "memory" or "redis".
+
+    Without a Redis URL or the redis package, "redis" falls back to the
+    in-process buckets, limiting each worker on its own.
+    """
+    if kind == "redis":
+        try:
+            import redis.asyncio as redis_asyncio  # Optional: only needed for the shared backend
+        except ImportError:
+            redis_asyncio = None
+        if redis_url and redis_asyncio is not None:
+            return RedisRateLimitBackend(redis_asyncio.from_url(redis_url))
+        logger.warning(
+            "RATE_LIMIT_BACKEND=redis needs RATE_LIMIT_REDIS_URL and the redis package; limiting in process instead"
+        )
+    elif kind != "memory":
+        raise ValueError(f"Unknown rate limit backend {kind!r}")
+    return MemoryRateLimitBackend(max_keys=max_keys, shards=shards)
+
+class RateLimiter:
+    """Applies rate limits through a backend and counts the outcomes per limit"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.allowed: Dict[str, int] = defaultdict(int)
+        self.limited: Dict[str, int] = defaultdict(int)
+
+    async def hit(self, limit: RateLimit, key: str) -> Tuple[bool, float]:
+        allowed, retry_after = await self.backend.take(f"{limit.name}:{key}", limit)
+        if allowed:
+            self.allowed[limit.name] += 1
+        else:
+            self.limited[limit.name] += 1
+        return allowed, retry_after
+
+    async def close(self):
+        await self.backend.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.backend.stats(),
+            "allowed": dict(self.allowed),
+            "limited": dict(self.limited)
+        }
+
+class RateLimitMiddleware:
+    """ASGI middleware applying per-IP and per-email limits to selected endpoints.
+
+    `rules` maps (method, path) to (ip_limit, email_limit); either may be
+    None. The IP limit is checked before the body is read. The email limit
+    reads the JSON body's "email" (lowercased), then replays the body to the
+    endpoint. Over-limit requests get 429 with Retry-After and never reach
+    the endpoint, so a credential-stuffing burst costs no user lookup or
+    password hashing.
+
+    Requests from a peer in `trusted_proxies` (or from any peer with
+    `trust_forwarded_for`) are keyed on the address that proxy reports:
+    X-Real-IP, else the last X-Forwarded-For entry, which is the hop the
+    proxy appended. Earlier entries are supplied by the client and ignored.
+    """
+
+    def __init__(
+        self,
+        app,
+        limiter: RateLimiter,
+        rules: Dict[Tuple[str, str], Tuple[Optional[RateLimit], Optional[RateLimit]]],
+        trust_forwarded_for: bool = False,
+        trusted_proxies: Iterable[str] = ("127.0.0.1", "::1"),
+        max_body_bytes: int = 64 * 1024
+    ):
+        self.app = app
+        self.limiter = limiter
+        self.rules = rules
+        self.trust_forwarded_for = trust_forwarded_for
+        self.trusted_proxies = frozenset(trusted_proxies)
+        self.max_body_bytes = max_body_bytes
+
+    def _client_ip(self, scope) -> str:
+        client = scope.get("client")
+        peer = client[0] if client else "unknown"
+        if not self.trust_forwarded_for and peer not in self.trusted_proxies:
+            return peer
+        forwarded_for = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-real-ip" and value.strip():
+                return value.decode("latin-1").strip()
+            if name == b"x-forwarded-for":
+                forwarded_for = value.decode("latin-1")
+        if forwarded_for is not None:
+            last_hop = forwarded_for.rsplit(",", 1)[-1].strip()
+            if last_hop:
+                return last_hop
+        return peer
+
+    @staticmethod
+    def _too_many_requests(retry_after: float) -> JSONResponse:
+        return JSONResponse(
+            {"detail": "Too many attempts, please retry later"},
+            status_code=429,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+
+    async def __call__(self, scope, receive, send):
+        rule = self.rules.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+        if rule is None:
+            return await self.app(scope, receive, send)
+        ip_limit, email_limit = rule
+
+        if ip_limit is not None:
+            allowed, retry_after = await self.limiter.hit(ip_limit, self._client_ip(scope))
+            if not allowed:
+                return await self._too_many_requests(retry_after)(scope, receive, send)
+        if email_limit is None:
+            return await self.app(scope, receive, send)
+
+        chunks, size, more_body = [], 0, True
+        while more_body:
+            message = await receive()
+            if message["type"] != "http.request":
+                return await self.app(scope, receive, send)  # Client went away; let the app see it
+            chunks.append(message.get("body", b""))
+            size += len(chunks[-1])
+            more_body = message.get("more_body", False)
+            if size > self.max_body_bytes:
+                return await JSONResponse({"detail": "Request body too large"}, status_code=413)(scope, receive, send)
+        body = b"".join(chunks)
+
+        try:
+            email = json.loads(body).get("email")
+        except (ValueError, AttributeError):
+            email = None  # Malformed bodies are rejected by the endpoint's validation
+        if isinstance(email, str) and email:
+            allowed, retry_after = await self.limiter.hit(email_limit, email.strip().lower())
+            if not allowed:
+                return await self._too_many_requests(retry_after)(scope, receive, send)
+
+        replayed = False
+        async def replay():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+        await self.app(scope, replay, send)
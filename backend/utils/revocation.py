@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import math
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+class BloomFilter:
+    """Fixed-size set membership test with false positives but no false negatives.
+
+    Sized for `capacity` keys at `error_rate` false positives; adding more
+    keys than that raises the false positive rate, so callers rebuild it.
+    Probes are derived from Python's str hash, which is salted per process;
+    the filter is never shared between processes.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.probes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _probe(self, key: str):
+        digest = hash(key) & 0xFFFFFFFFFFFFFFFF
+        return digest & 0xFFFFFFFF, (digest >> 32) | 1
+
+    def add(self, key: str):
+        position, step = self._probe(key)
+        for _ in range(self.probes):
+            position %= self.size
+            self._bits[position >> 3] |= 1 << (position & 7)
+            position += step
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        # Inlined: this runs on every authenticated request and usually stops at the first probe
+        digest = hash(key) & 0xFFFFFFFFFFFFFFFF
+        position, step, size, bits = digest & 0xFFFFFFFF, (digest >> 32) | 1, self.size, self._bits
+        for _ in range(self.probes):
+            position %= size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+            position += step
+        return True
+
+class RevocationList:
+    """Revoked token ids (jti), persisted in Mongo and mirrored in process.
+
+    Every revocation is one document in `collection`, kept until the token
+    expires (TTL index on expires_at). Revoked access tokens are mirrored into
+    an exact set of at most `max_entries` ids plus a bloom filter, polled
+    incrementally every `refresh_interval` seconds, so checking a token costs
+    a set lookup and no I/O. Once the set has evicted ids, a miss is only
+    trusted if the bloom filter agrees; a bloom hit the set cannot confirm (a
+    false positive or an evicted id) falls back to one indexed read.
+    Revocations made in this process apply immediately; those made elsewhere
+    within `refresh_interval`.
+
+    Refresh tokens are only checked when they are used, against the
+    collection itself, so their revocations are not mirrored.
+    """
+
+    def __init__(
+        self,
+        collection,
+        capacity: int = 100000,
+        error_rate: float = 0.001,
+        max_entries: int = 100000,
+        refresh_interval: float = 1.0,
+        overlap: float = 5.0
+    ):
+        self.collection = collection
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.max_entries = max_entries
+        self.refresh_interval = refresh_interval
+        # Re-read this far back on every poll, for writes committed out of revoked_at order
+        self.overlap = timedelta(seconds=overlap)
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._exact: "OrderedDict[str, datetime]" = OrderedDict()
+        self._since: Optional[datetime] = None
+        self._overflowed = False
+        self._task: Optional[asyncio.Task] = None
+        self.loaded = False
+        self.lookups = 0
+        self.bloom_negatives = 0
+        self.exact_hits = 0
+        self.evictions = 0
+        self.database_checks = 0
+        self.rebuilds = 0
+        self.failures = 0
+
+    def _remember(self, jti: str, expires_at: datetime):
+        if jti in self._exact:
+            return
+        self._bloom.add(jti)
+        self._exact[jti] = expires_at
+        if len(self._exact) > self.max_entries:
+            self._exact.popitem(last=False)  # Still in the bloom filter; confirmed from the collection
+            self._overflowed = True
+            self.evictions += 1
+
+    async def revoke(self, jti: str, user_id: str, expires_at: datetime, token_type: str = "access") -> bool:
+        """Revoke a token until it expires; False if it was already revoked"""
+        try:
+            await self.collection.insert_one({
+                "jti": jti,
+                "token_type": token_type,
+                "user_id": user_id,
+                "expires_at": expires_at,
+                "revoked_at": datetime.utcnow()
+            })
+        except DuplicateKeyError:
+            return False
+        if token_type == "access":
+            self._remember(jti, expires_at)
+        return True
+
+    async def is_revoked(self, jti: str) -> bool:
+        """Whether an access token has been revoked"""
+        self.lookups += 1
+        if self.loaded:
+            if jti in self._exact:
+                self.exact_hits += 1
+                return True
+            if not self._overflowed:
+                return False
+            if jti not in self._bloom:
+                self.bloom_negatives += 1
+                return False
+        self.database_checks += 1
+        return await self.collection.find_one({"jti": jti}, {"_id": 1}) is not None
+
+    async def refresh(self):
+        """Mirror revocations made since the last refresh, rebuilding the filter when it is full"""
+        now = datetime.utcnow()
+        rebuild = not self.loaded or self._bloom.count >= self._bloom.capacity
+        query = {"token_type": "access", "expires_at": {"$gt": now}}
+        if not rebuild:
+            query["revoked_at"] = {"$gte": self._since - self.overlap}
+        try:
+            revoked = await self.collection.find(
+                query, {"_id": 0, "jti": 1, "expires_at": 1, "revoked_at": 1}
+            ).sort("revoked_at", ASCENDING).to_list(None)
+        except PyMongoError as exc:
+            self.failures += 1
+            logger.error("Could not refresh the token revocation list: %s", exc)
+            return
+
+        if rebuild:
+            # Expired ids are dropped here; the JWT expiry rejects those tokens anyway
+            self._bloom = BloomFilter(max(self.capacity, 2 * len(revoked)), self.error_rate)
+            self._exact = OrderedDict()
+            self._overflowed = False
+            self.rebuilds += 1
+        for entry in revoked:
+            self._remember(entry["jti"], entry["expires_at"])
+        if revoked:
+            self._since = max(revoked[-1]["revoked_at"], self._since or revoked[-1]["revoked_at"])
+        elif self._since is None:
+            self._since = now
+        while self._exact and next(iter(self._exact.values())) <= now:
+            self._exact.popitem(last=False)
+        self.loaded = True
+
+    async def _run(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self) -> asyncio.Task:
+        """Load the revocation list and keep polling it on the running loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "loaded": self.loaded,
+            "entries": len(self._exact),
+            "bloom_keys": self._bloom.count,
+            "bloom_bits": self._bloom.size,
+            "bloom_probes": self._bloom.probes,
+            "lookups": self.lookups,
+            "bloom_negatives": self.bloom_negatives,
+            "exact_hits": self.exact_hits,
+            "evictions": self.evictions,
+            "database_checks": self.database_checks,
+            "rebuilds": self.rebuilds,
+            "failures": self.failures
+        }
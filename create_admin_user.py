@@ -29,7 +29,6 @@ async def create_admin_user():
         "password": hashlib.sha256("Admin123!".encode()).hexdigest(),
         "role": "admin",
         "phone": "+1234567890",
-        "enrolled_courses": [],
         "created_at": datetime.utcnow(),
         "is_active": True
     }
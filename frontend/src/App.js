@@ -1,5 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import './App.css';
+import { fetchAllPages } from './utils/helpers';
 
 const API_BASE_URL = process.env.REACT_APP_BACKEND_URL || 'http://localhost:8001';
 
@@ -83,9 +84,7 @@ function App() {
 
   const fetchCourses = async () => {
     try {
-      const response = await fetch(`${API_BASE_URL}/api/courses`);
-      const data = await response.json();
-      setCourses(data.courses || []);
+      setCourses(await fetchAllPages(`${API_BASE_URL}/api/courses`, 'courses'));
     } catch (error) {
       console.error('Error fetching courses:', error);
     }
@@ -371,14 +370,10 @@ function App() {
     setAdminLoading(true);
     try {
       const token = localStorage.getItem('token');
-      const response = await fetch(`${API_BASE_URL}/api/admin/users`, {
+      const users = await fetchAllPages(`${API_BASE_URL}/api/admin/users`, 'users', {
         headers: { 'Authorization': `Bearer ${token}` }
       });
-      
-      if (response.ok) {
-        const data = await response.json();
-        setAdminData(prev => ({ ...prev, users: data.users }));
-      }
+      setAdminData(prev => ({ ...prev, users }));
     } catch (error) {
       console.error('Error fetching users:', error);
     } finally {
@@ -390,14 +385,10 @@ function App() {
     setAdminLoading(true);
     try {
       const token = localStorage.getItem('token');
-      const response = await fetch(`${API_BASE_URL}/api/admin/courses`, {
+      const courses = await fetchAllPages(`${API_BASE_URL}/api/admin/courses`, 'courses', {
         headers: { 'Authorization': `Bearer ${token}` }
       });
-      
-      if (response.ok) {
-        const data = await response.json();
-        setAdminData(prev => ({ ...prev, courses: data.courses }));
-      }
+      setAdminData(prev => ({ ...prev, courses }));
     } catch (error) {
       console.error('Error fetching admin courses:', error);
     } finally {
@@ -1,3 +1,5 @@
+import { fetchAllPages } from '../utils/helpers';
+
 const API_BASE_URL = process.env.REACT_APP_BACKEND_URL || 'http://localhost:8001';
 
 class AdminService {
@@ -14,15 +16,10 @@ class AdminService {
   }
 
   async getUsers(token) {
-    const response = await fetch(`${API_BASE_URL}/api/admin/users`, {
+    const users = await fetchAllPages(`${API_BASE_URL}/api/admin/users`, 'users', {
       headers: { 'Authorization': `Bearer ${token}` }
     });
-    
-    if (!response.ok) {
-      throw new Error('Failed to fetch users');
-    }
-    
-    return await response.json();
+    return { users };
   }
 
   async updateUserRole(userId, role, token) {
@@ -45,15 +42,10 @@ class AdminService {
   }
 
   async getEnrollments(token) {
-    const response = await fetch(`${API_BASE_URL}/api/admin/enrollments`, {
+    const enrollments = await fetchAllPages(`${API_BASE_URL}/api/admin/enrollments`, 'enrollments', {
       headers: { 'Authorization': `Bearer ${token}` }
     });
-    
-    if (!response.ok) {
-      throw new Error('Failed to fetch enrollments');
-    }
-    
-    return await response.json();
+    return { enrollments };
   }
 }
 
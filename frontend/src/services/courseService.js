@@ -1,15 +1,10 @@
+import { fetchAllPages } from '../utils/helpers';
+
 const API_BASE_URL = process.env.REACT_APP_BACKEND_URL || 'http://localhost:8001';
 
 class CourseService {
   async getCourses() {
-    const response = await fetch(`${API_BASE_URL}/api/courses`);
-    
-    if (!response.ok) {
-      throw new Error('Failed to fetch courses');
-    }
-    
-    const data = await response.json();
-    return data.courses || [];
+    return await fetchAllPages(`${API_BASE_URL}/api/courses`, 'courses');
   }
 
   async getCourse(courseId, token) {
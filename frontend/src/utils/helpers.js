@@ -81,4 +81,21 @@ export const debounce = (func, wait) => {
     clearTimeout(timeout);
     timeout = setTimeout(later, wait);
   };
-};
\ No newline at end of file
+};
+// Listings return one page plus next_cursor; follow it to collect every item under `key`
+export const fetchAllPages = async (url, key, options = {}) => {
+  const items = [];
+  let cursor = null;
+  do {
+    const separator = url.includes('?') ? '&' : '?';
+    const pageUrl = cursor ? `${url}${separator}cursor=${encodeURIComponent(cursor)}` : url;
+    const response = await fetch(pageUrl, options);
+    if (!response.ok) {
+      throw new Error(`Failed to fetch ${key}`);
+    }
+    const page = await response.json();
+    items.push(...(page[key] || []));
+    cursor = page.next_cursor;
+  } while (cursor);
+  return items;
+};
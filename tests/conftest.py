@@ -0,0 +1,91 @@
+import math
+import time
+import pytest
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
+import backend.server as server
+from .helpers import bearer, register, run
+
+class FakeRedis:
+    """In-process stand-in for the one Redis call RedisRateLimitBackend makes.
+
+    Runs the token bucket script's logic in Python over a dict, so the shared
+    backend can be exercised without a Redis server.
+    """
+
+    def __init__(self, script, clock=time):
+        self.script = script
+        self.clock = clock
+        self._buckets = {}
+
+    async def eval(self, script, numkeys, *keys_and_args):
+        if script != self.script or numkeys != 1:
+            raise NotImplementedError("FakeRedis only runs the token bucket script")
+        key, rate, burst = keys_and_args[0], float(keys_and_args[1]), float(keys_and_args[2])
+        now = self.clock.time()
+        tokens, updated, expires_at = self._buckets.get(key, (burst, now, math.inf))
+        if expires_at <= now:
+            tokens, updated = burst, now
+        tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+        allowed, retry_after = 0, 0.0
+        if tokens >= 1:
+            tokens -= 1
+            allowed = 1
+        else:
+            retry_after = (1 - tokens) / rate
+        self._buckets[key] = (tokens, now, now + math.ceil(burst / rate * 1000) / 1000)
+        return [allowed, str(retry_after)]
+
+    async def aclose(self):
+        pass
+
+@pytest.fixture
+def db(monkeypatch):
+    """backend.server wired to an empty in-memory database, with fresh in-process state"""
+    database = AsyncMongoMockClient().islamic_institute
+    monkeypatch.setattr(server, "db", database)
+    monkeypatch.setattr(server, "PASSWORD_SCRYPT_N", 2 ** 10)  # Fast hashes; the format is unchanged
+    monkeypatch.setattr(server, "principal_cache", server.TTLCache())
+    monkeypatch.setattr(server, "token_version_cache", server.TTLCache())
+    monkeypatch.setattr(server, "membership_cache", server.TTLCache())
+    monkeypatch.setattr(server, "lesson_ids_cache", server.TTLCache())
+    monkeypatch.setattr(server, "enrolled_courses_migrated", False)
+    monkeypatch.setattr(server, "password_hasher", server.PasswordHasher(workers=1))
+    monkeypatch.setattr(server, "revocation_list", server.RevocationList(database.revoked_tokens))
+    monkeypatch.setattr(server, "catalog_cache", server.CatalogCache(database.counters))
+    monkeypatch.setattr(server, "student_count_flusher", server.CounterFlusher(database.courses, "student_count"))
+    monkeypatch.setattr(server, "heartbeat_buffer", server.HeartbeatBuffer(database.enrollments))
+    monkeypatch.setattr(server, "payment_inbox", server.PaymentInbox(workers=1))
+    # The middleware keeps the limiter it was built with, so swap its backend instead
+    monkeypatch.setattr(server.rate_limiter, "backend", server.MemoryRateLimitBackend())
+    run(server.ensure_indexes())
+    return database
+
+@pytest.fixture
+def client(db):
+    return TestClient(server.app)
+
+@pytest.fixture
+def gateway(monkeypatch):
+    """The in-process gateway stub in place of SSLCommerz"""
+    monkeypatch.setattr(server, "PAYMENT_GATEWAY", "stub")
+    monkeypatch.setattr(server, "_payment_gateway", None)
+    monkeypatch.setattr(server, "gateway_stub_sessions", {})
+
+@pytest.fixture
+def checkout(client, db, gateway):
+    """A student and a paid course; returns a function initiating a payment for it"""
+    admin = register(client, "admin@example.com", role="admin", db=db)
+    student = register(client, "student@example.com")
+    course = {"title": "T", "description": "d", "instructor_name": "i", "course_type": "paid", "price": 500}
+    course_id = client.post("/api/courses", json=course, headers=bearer(admin)).json()["course_id"]
+
+    def initiate(idempotency_key=None, amount=500):
+        headers = bearer(student)
+        if idempotency_key:
+            headers["Idempotency-Key"] = idempotency_key
+        return client.post(
+            "/api/payments/initiate", json={"course_id": course_id, "payment_method": "bkash", "amount": amount}, headers=headers
+        )
+    initiate.course_id = course_id
+    return initiate
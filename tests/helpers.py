@@ -0,0 +1,22 @@
+import asyncio
+
+def run(coroutine):
+    """Run a coroutine to completion from a synchronous test"""
+    return asyncio.get_event_loop_policy().get_event_loop().run_until_complete(coroutine)
+
+def register(client, email, password="password", role=None, db=None):
+    """Register a user (optionally promoting them) and return the login response body"""
+    response = client.post("/api/auth/register", json={"full_name": email, "email": email, "password": password})
+    assert response.status_code == 200, response.text
+    if role is not None:
+        run(db.users.update_one({"email": email}, {"$set": {"role": role}}))
+    return login(client, email, password)
+
+def login(client, email, password="password"):
+    """Log in and return the response body; tokens carry the role and membership version at login"""
+    response = client.post("/api/auth/login", json={"email": email, "password": password})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+def bearer(tokens):
+    return {"Authorization": "Bearer " + tokens["access_token"]}
@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+import jwt
+import backend.server as server
+from .helpers import bearer, login, register, run
+
+def test_register_rejects_an_email_taken_between_check_and_insert(client, db, monkeypatch):
+    # The pre-check misses a concurrent registration; the unique index must still answer 400
+    original_find_one = db.users.find_one
+    async def find_nothing(query, *args, **kwargs):
+        if "email" in query:
+            return None
+        return await original_find_one(query, *args, **kwargs)
+    response = client.post("/api/auth/register", json={"full_name": "A", "email": "a@example.com", "password": "pw"})
+    assert response.status_code == 200
+    monkeypatch.setattr(db.users, "find_one", find_nothing)
+
+    response = client.post("/api/auth/register", json={"full_name": "B", "email": "a@example.com", "password": "pw"})
+
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Email already registered"}
+    assert run(db.users.count_documents({"email": "a@example.com"})) == 1
+
+def me(client, tokens):
+    return client.get("/api/auth/me", headers=bearer(tokens))
+
+def test_access_tokens_last_a_day_by_default(client, db):
+    tokens = register(client, "a@example.com")
+
+    assert tokens["expires_in"] == 24 * 60 * 60
+    assert set(tokens) >= {"access_token", "refresh_token"}
+
+def test_refresh_rotates_the_pair_and_each_refresh_token_is_single_use(client, db):
+    tokens = register(client, "a@example.com")
+
+    response = client.post("/api/auth/refresh", json={"refresh_token": tokens["refresh_token"]})
+    assert response.status_code == 200, response.text
+    rotated = response.json()
+    assert rotated["access_token"] != tokens["access_token"]
+    assert rotated["refresh_token"] != tokens["refresh_token"]
+    assert me(client, rotated).json()["email"] == "a@example.com"
+
+    replayed = client.post("/api/auth/refresh", json={"refresh_token": tokens["refresh_token"]})
+    assert replayed.status_code == 401
+    assert client.post("/api/auth/refresh", json={"refresh_token": tokens["access_token"]}).status_code == 401
+    assert client.post("/api/auth/refresh", json={"refresh_token": rotated["refresh_token"]}).status_code == 200
+
+def test_a_role_change_revokes_the_users_tokens(client, db):
+    admin = register(client, "admin@example.com", role="super_admin", db=db)
+    student = register(client, "student@example.com")
+    assert me(client, student).status_code == 200
+    user_id = me(client, student).json()["id"]
+
+    response = client.put(f"/api/admin/users/{user_id}/role", json={"role": "instructor"}, headers=bearer(admin))
+    assert response.status_code == 200
+
+    assert me(client, student).status_code == 401
+    assert client.post("/api/auth/refresh", json={"refresh_token": student["refresh_token"]}).status_code == 401
+    relogged = login(client, "student@example.com")
+    assert me(client, relogged).json()["role"] == "instructor"
+
+def test_deactivation_rejects_tokens_even_when_the_version_is_cached(client, db):
+    admin = register(client, "admin@example.com", role="super_admin", db=db)
+    student = register(client, "student@example.com")
+    user_id = me(client, student).json()["id"]  # Caches the token version
+
+    client.put(f"/api/admin/users/{user_id}/status", json={"is_active": False}, headers=bearer(admin))
+
+    assert me(client, student).status_code == 401
+
+def test_tokens_issued_before_claims_were_added_still_authenticate(client, db):
+    register(client, "a@example.com")
+    legacy = {"access_token": jwt.encode(
+        {"sub": "a@example.com", "exp": datetime.utcnow() + timedelta(hours=1)}, server.JWT_SECRET, algorithm="HS256"
+    )}
+
+    response = me(client, legacy)
+    assert response.status_code == 200
+    assert response.json()["email"] == "a@example.com"
+    assert client.post("/api/auth/logout", headers=bearer(legacy)).status_code == 200
+    assert client.post("/api/auth/refresh", json={"refresh_token": legacy["access_token"]}).status_code == 401
+
+    run(db.users.update_one({"email": "a@example.com"}, {"$inc": {"token_version": 1}}))
+    assert me(client, legacy).status_code == 401
+
+def test_unknown_emails_cost_the_same_scrypt_work_as_wrong_passwords(client, db):
+    register(client, "a@example.com")
+    before = server.password_hasher.latency.stats().get("verify", {}).get("count", 0)
+    verifications = lambda: server.password_hasher.latency.stats()["verify"]["count"] - before
+
+    wrong_password = client.post("/api/auth/login", json={"email": "a@example.com", "password": "wrong"})
+    assert (wrong_password.status_code, verifications()) == (401, 1)
+    for attempt in range(2):
+        unknown_email = client.post("/api/auth/login", json={"email": "b@example.com", "password": "wrong"})
+        assert unknown_email.status_code == 401
+        assert unknown_email.json() == wrong_password.json()
+        assert verifications() == 2 + attempt
+    assert server.password_hasher._dummy_hash.startswith(f"scrypt${server.PASSWORD_SCRYPT_N}$")
@@ -0,0 +1,90 @@
+from datetime import datetime
+import backend.server as server
+from backend.database import enrollments
+from .helpers import run
+
+def enrollment(enrollment_id, payment_status, day, user_id="user-1", course_id="course-1"):
+    return {
+        "id": enrollment_id, "user_id": user_id, "course_id": course_id,
+        "payment_status": payment_status, "enrolled_at": datetime(2024, 1, day)
+    }
+
+def test_duplicate_enrollments_block_only_their_unique_index_and_are_kept(db):
+    run(db.enrollments.drop())
+    run(db.enrollments.insert_many([enrollment("first", "completed", 1), enrollment("second", "completed", 2)]))
+
+    run(server.ensure_indexes())
+
+    assert run(db.enrollments.count_documents({})) == 2
+    existing = run(db.enrollments.index_information())
+    assert "user_id_course_id_unique" not in existing
+    assert {"id_unique", "user_id_payment_status"} <= set(existing)
+
+def test_the_migration_archives_and_merges_duplicate_enrollments(db, monkeypatch):
+    monkeypatch.setattr(enrollments, "database", db)
+    run(db.enrollments.drop())
+    run(db.enrollments.insert_many([
+        {**enrollment("pending-old", "pending", 1), "transaction_id": "t-pending"},
+        {
+            **enrollment("paid", "completed", 2), "transaction_id": "t-paid", "payment_method": "bkash",
+            "progress": 25.0, "completed_lessons": ["a"], "last_accessed_at": datetime(2024, 2, 1)
+        },
+        {
+            **enrollment("paid-again", "completed", 3), "progress": 50.0, "completed_lessons": ["b"],
+            "last_accessed_at": datetime(2024, 3, 1), "last_lesson_id": "b", "last_position_seconds": 90
+        },
+        enrollment("other-user", "completed", 1, user_id="user-2"),
+    ]))
+    run(db.payments.insert_one({"id": "payment-1", "enrollment_id": "paid-again", "transaction_id": "t-again"}))
+    run(db.courses.insert_one({"id": "course-1", "student_count": 3}))
+
+    merged, migrated, _ = run(enrollments.migrate())
+
+    assert (merged, migrated) == (2, 0)
+    kept = run(db.enrollments.find_one({"id": "paid"}, {"_id": 0}))
+    assert kept["transaction_id"] == "t-paid"
+    assert sorted(kept["completed_lessons"]) == ["a", "b"]
+    assert (kept["progress"], kept["last_lesson_id"], kept["last_position_seconds"]) == (50.0, "b", 90)
+    assert run(db.enrollments.count_documents({})) == 2
+    archived = run(db.enrollments_archive.find({}, {"_id": 0}).sort("id", 1).to_list(None))
+    assert [(row["id"], row["merged_into"], row.get("transaction_id")) for row in archived] == [
+        ("paid-again", "paid", None), ("pending-old", "paid", "t-pending")
+    ]
+    assert run(db.payments.find_one({"id": "payment-1"}))["enrollment_id"] == "paid"
+    assert run(db.courses.find_one({"id": "course-1"}))["student_count"] == 2
+
+    run(server.ensure_indexes())
+    assert "user_id_course_id_unique" in run(db.enrollments.index_information())
+
+def test_a_failing_index_does_not_block_the_rest_of_its_collection(db):
+    run(db.users.drop())
+    run(db.users.insert_many([{"id": "1", "email": "a@example.com"}, {"id": "2", "email": "a@example.com"}]))
+
+    run(server.ensure_indexes())
+
+    existing = run(db.users.index_information())
+    assert "email_unique" not in existing
+    assert {"id_unique", "created_at_id"} <= set(existing)
+
+def test_retired_indexes_are_dropped(db):
+    run(db.payment_callbacks.drop())
+    run(db.payment_callbacks.create_index("transaction_id", name="transaction_id_unique", unique=True))
+
+    run(server.ensure_indexes())
+
+    existing = run(db.payment_callbacks.index_information())
+    assert "transaction_id_unique" not in existing
+    assert "transaction_id_form_digest_unique" in existing
+
+def test_legacy_enrolled_courses_grant_access_before_and_after_the_backfill(db):
+    run(db.users.insert_one({"id": "user-1", "email": "a@example.com", "enrolled_courses": ["course-1"]}))
+    run(db.courses.insert_one({"id": "course-1", "student_count": 0}))
+    assert run(server.user_is_enrolled("user-1", "course-1")) is True
+
+    run(server.backfill_enrolled_courses())
+    server.membership_cache.invalidate("user-1")
+
+    assert server.enrolled_courses_migrated is True
+    assert "enrolled_courses" not in run(db.users.find_one({"id": "user-1"}))
+    assert run(server.user_is_enrolled("user-1", "course-1")) is True
+    assert run(db.courses.find_one({"id": "course-1"}))["student_count"] == 1
@@ -0,0 +1,47 @@
+import backend.server as server
+from .helpers import bearer, register, run
+
+def embedded_lesson(lesson_id, order, duration=10, is_preview=False):
+    return {
+        "id": lesson_id, "title": lesson_id, "description": "", "video_url": "https://youtu.be/abc",
+        "video_type": "youtube", "duration": duration, "is_preview": is_preview, "order": order
+    }
+
+def insert_unmigrated_course(db, lessons):
+    run(db.courses.insert_one({
+        "id": "course-1", "title": "Course", "description": "", "instructor": "I", "course_type": "free",
+        "price": None, "is_active": True, "lessons": lessons
+    }))
+
+def new_lesson(title):
+    return {"title": title, "description": "", "video_url": "https://youtu.be/xyz", "video_type": "youtube", "duration": 5}
+
+def test_adding_a_lesson_to_an_unmigrated_course_keeps_its_embedded_lessons(client, db):
+    insert_unmigrated_course(db, [embedded_lesson("a", 1), embedded_lesson("b", 2, is_preview=True)])
+    admin = register(client, "admin@example.com", role="admin", db=db)
+
+    response = client.post("/api/courses/course-1/lessons", json=new_lesson("c"), headers=bearer(admin))
+    assert response.status_code == 200, response.text
+
+    lessons = client.get("/api/courses/course-1", headers=bearer(admin)).json()["lessons"]
+    assert [(lesson["title"], lesson["order"]) for lesson in lessons] == [("a", 1), ("b", 2), ("c", 3)]
+    course = run(db.courses.find_one({"id": "course-1"}))
+    assert "lessons" not in course
+    assert course["lesson_count"] == 3
+    assert course["total_duration"] == 25
+    assert [lesson["id"] for lesson in course["preview_lessons"]] == ["b"]
+
+def test_migration_moves_lessons_already_in_the_collection_after_the_embedded_ones(client, db):
+    # A lesson written before migrate-on-write existed took order 1 alongside the embedded ones
+    insert_unmigrated_course(db, [embedded_lesson("a", 1), embedded_lesson("b", 2)])
+    run(db.lessons.insert_one({**embedded_lesson("stray", 1), "course_id": "course-1"}))
+    admin = register(client, "admin@example.com", role="admin", db=db)
+
+    response = client.post("/api/courses/course-1/lessons:bulk", json=[new_lesson("c"), new_lesson("d")], headers=bearer(admin))
+    assert response.status_code == 200, response.text
+
+    lessons = run(db.lessons.find({"course_id": "course-1"}).sort("order", 1).to_list(None))
+    assert [(lesson["title"], lesson["order"]) for lesson in lessons] == [
+        ("a", 1), ("b", 2), ("stray", 3), ("c", 4), ("d", 5)
+    ]
+    assert run(server.migrate_course_lessons("course-1")) is False
@@ -0,0 +1,113 @@
+from datetime import datetime
+from urllib.parse import urlencode
+import pytest
+import backend.server as server
+from .helpers import run
+
+FORM = {"content-type": "application/x-www-form-urlencoded"}
+PAST = datetime(2000, 1, 1)
+
+def post_ipn(client, form):
+    return client.post("/api/payments/ipn", content=urlencode(form), headers=FORM).json()["status"]
+
+def state(db, payment):
+    # The latest callback recorded for the transaction
+    callback = run(db.payment_callbacks.find_one({"transaction_id": payment["transaction_id"]}, sort=[("_id", -1)]))
+    stored = run(db.payments.find_one({"id": payment["id"]}))
+    enrollment = run(db.enrollments.find_one({"id": payment["enrollment_id"]}))
+    return callback, stored["status"], enrollment["payment_status"]
+
+def test_a_genuine_notification_completes_the_payment_once(checkout, client, db):
+    payment = checkout().json()
+    genuine = server.stub_ipn_payload(payment["transaction_id"])
+
+    assert post_ipn(client, genuine) == "queued"
+    assert post_ipn(client, genuine) == "duplicate"
+    run(server.payment_inbox.drain())
+
+    callback, payment_status, enrollment_status = state(db, payment)
+    assert (callback["status"], callback["outcome"]) == ("processed", "completed")
+    assert (payment_status, enrollment_status) == ("completed", "completed")
+    assert post_ipn(client, {**genuine, "status": "FAILED"}) == "duplicate"
+
+def test_unvalidated_failures_never_downgrade_a_payment(checkout, client, db):
+    payment = checkout().json()
+    tran_id = payment["transaction_id"]
+
+    post_ipn(client, {"tran_id": tran_id, "status": "FAILED"})
+    run(server.payment_inbox.drain())
+    callback, payment_status, enrollment_status = state(db, payment)
+    assert callback["outcome"] == "unverified"
+    assert (payment_status, enrollment_status) == ("pending", "pending")
+
+    post_ipn(client, {"tran_id": tran_id, "status": "VALID", "val_id": "forged"})
+    run(server.payment_inbox.drain())
+    callback, payment_status, _ = state(db, payment)
+    assert callback["outcome"] == "unverified"
+    assert payment_status == "pending"
+
+    # The genuine notification still settles it afterwards
+    post_ipn(client, server.stub_ipn_payload(tran_id))
+    run(server.payment_inbox.drain())
+    assert state(db, payment)[1:] == ("completed", "completed")
+
+def test_a_later_body_never_replaces_a_queued_notification(checkout, client, db):
+    payment = checkout().json()
+    tran_id = payment["transaction_id"]
+    genuine = server.stub_ipn_payload(tran_id)
+
+    assert post_ipn(client, genuine) == "queued"
+    assert post_ipn(client, {**genuine, "val_id": "forged"}) == "queued"
+    forms = [callback["form"] for callback in run(db.payment_callbacks.find({"transaction_id": tran_id}).to_list(None))]
+    assert forms == [genuine, {**genuine, "val_id": "forged"}]
+
+    run(server.payment_inbox.drain())
+    outcomes = {
+        callback["form"]["val_id"]: callback["outcome"]
+        for callback in run(db.payment_callbacks.find({"transaction_id": tran_id}).to_list(None))
+    }
+    assert outcomes == {genuine["val_id"]: "completed", "forged": "unverified"}
+    assert state(db, payment)[1:] == ("completed", "completed")
+    assert run(db.enrollments.count_documents({"payment_status": "completed"})) == 1
+
+def test_a_batch_that_raises_is_released_and_settles_on_retry(checkout, client, db, monkeypatch):
+    payment = checkout().json()
+    post_ipn(client, server.stub_ipn_payload(payment["transaction_id"]))
+    inbox = server.payment_inbox
+    complete_enrollments = inbox._complete_enrollments
+    async def crash(settled, now):
+        raise RuntimeError("worker crashed")
+    monkeypatch.setattr(inbox, "_complete_enrollments", crash)
+
+    with pytest.raises(RuntimeError):
+        run(inbox.drain())
+    callback, payment_status, enrollment_status = state(db, payment)
+    assert (callback["status"], callback["attempts"]) == ("queued", 1)
+    assert "worker crashed" in callback["last_error"]
+    assert (payment_status, enrollment_status) == ("completed", "pending")
+
+    # The payment was written before the crash; the retry still completes the enrollment
+    monkeypatch.setattr(inbox, "_complete_enrollments", complete_enrollments)
+    run(db.payment_callbacks.update_one({"id": callback["id"]}, {"$set": {"available_at": PAST}}))  # Skip the backoff
+    run(inbox.drain())
+    callback, payment_status, enrollment_status = state(db, payment)
+    assert (callback["status"], callback["outcome"]) == ("processed", "completed")
+    assert (payment_status, enrollment_status) == ("completed", "completed")
+
+def test_a_batch_that_keeps_raising_is_given_up_after_max_attempts(checkout, client, db, monkeypatch):
+    payment = checkout().json()
+    post_ipn(client, server.stub_ipn_payload(payment["transaction_id"]))
+    inbox = server.payment_inbox
+    inbox.max_attempts = 2
+    async def crash(callbacks):
+        raise RuntimeError("poison")
+    monkeypatch.setattr(inbox, "process", crash)
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            run(inbox.drain())
+        run(db.payment_callbacks.update_many({}, {"$set": {"available_at": PAST}}))
+
+    callback = state(db, payment)[0]
+    assert (callback["status"], callback["attempts"]) == ("failed", 2)
+    assert inbox.dead == 1
@@ -0,0 +1,38 @@
+import backend.server as server
+from .helpers import run
+
+class UnavailableGateway:
+    async def create_session(self, payload):
+        raise server.GatewayError("connection refused")
+
+def test_repeated_initiation_without_a_key_returns_the_open_payment(checkout, db):
+    first = checkout()
+    second = checkout()
+
+    assert first.status_code == second.status_code == 200
+    assert first.json()["id"] == second.json()["id"]
+    assert first.json()["gateway_url"]
+    assert run(db.payments.count_documents({})) == 1
+
+def test_a_failed_payment_is_retried_under_the_same_key(checkout, db, monkeypatch):
+    monkeypatch.setattr(server, "_payment_gateway", UnavailableGateway())
+    assert checkout("key-1").status_code == 502
+    monkeypatch.setattr(server, "_payment_gateway", None)
+
+    retried = checkout("key-1")
+    again = checkout("key-1")
+
+    assert retried.status_code == 200
+    assert retried.json()["status"] == "pending"
+    assert again.json()["id"] == retried.json()["id"]
+    statuses = sorted(payment["status"] for payment in run(db.payments.find().to_list(None)))
+    assert statuses == ["failed", "pending"]
+
+def test_a_paid_course_without_a_price_is_rejected(checkout, db):
+    run(db.courses.update_one({"id": checkout.course_id}, {"$set": {"price": None}}))
+
+    response = checkout(amount=0)
+
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Course has no valid price"}
+    assert run(db.payments.count_documents({})) == 0
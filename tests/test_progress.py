@@ -0,0 +1,71 @@
+import asyncio
+import backend.server as server
+from .helpers import bearer, login, register, run
+
+def test_heartbeats_are_only_buffered_for_lessons_of_the_course(client, db):
+    run(db.courses.insert_one({
+        "id": "course-1", "title": "Course", "description": "", "instructor": "I", "course_type": "free",
+        "price": None, "is_active": True,
+        "lessons": [{"id": "embedded", "title": "E", "description": "", "video_url": "", "video_type": "youtube", "order": 1}]
+    }))
+    run(db.courses.insert_one({
+        "id": "course-2", "title": "Other", "description": "", "instructor": "I", "course_type": "free",
+        "price": None, "is_active": True
+    }))
+    run(db.lessons.insert_one({"id": "elsewhere", "course_id": "course-2", "order": 1}))
+    student = register(client, "student@example.com")
+    assert client.post("/api/courses/course-1/enroll", headers=bearer(student)).status_code == 200
+    student = login(client, "student@example.com")  # Pick up the new membership
+
+    def heartbeat(lesson_id):
+        return client.post(
+            f"/api/courses/course-1/lessons/{lesson_id}/heartbeat", json={"position_seconds": 30}, headers=bearer(student)
+        )
+
+    assert heartbeat("embedded").status_code == 200
+    assert heartbeat("missing").status_code == 404
+    assert heartbeat("elsewhere").status_code == 404
+    response = client.post("/api/courses/course-1/lessons/embedded/complete", headers=bearer(student))
+    assert response.status_code == 200
+    assert response.json()["progress"] == 100
+
+def test_heartbeats_check_lessons_against_a_cached_set(client, db):
+    admin = register(client, "admin@example.com", role="admin", db=db)
+    course = {"title": "T", "description": "d", "instructor_name": "i", "course_type": "free"}
+    course_id = client.post("/api/courses", json=course, headers=bearer(admin)).json()["course_id"]
+    lesson = {"title": "L", "description": "", "video_url": "https://youtu.be/abc", "video_type": "youtube", "duration": 5}
+    lesson_id = client.post(f"/api/courses/{course_id}/lessons", json=lesson, headers=bearer(admin)).json()["lesson_id"]
+    student = register(client, "student@example.com")
+    client.post(f"/api/courses/{course_id}/enroll", headers=bearer(student))
+    student = login(client, "student@example.com")
+
+    def heartbeat():
+        return client.post(
+            f"/api/courses/{course_id}/lessons/{lesson_id}/heartbeat", json={"position_seconds": 30}, headers=bearer(student)
+        ).status_code
+
+    assert [heartbeat() for _ in range(3)] == [200, 200, 200]
+    assert server.lesson_ids_cache.stats()["hits"] == 2
+
+    client.delete(f"/api/courses/{course_id}/lessons/{lesson_id}", headers=bearer(admin))
+    assert heartbeat() == 404
+
+def test_buffers_keep_their_entries_and_keep_running_after_any_error(db, monkeypatch):
+    flusher, heartbeats = server.student_count_flusher, server.heartbeat_buffer
+    flusher.interval = heartbeats.interval = 0
+    async def broken(*args, **kwargs):
+        raise RuntimeError("not a PyMongoError")
+
+    async def scenario():
+        flusher.add("course-1")
+        await heartbeats.record("user-1", "course-1", "lesson-1", 30)
+        monkeypatch.setattr(flusher.collection, "bulk_write", broken)
+        monkeypatch.setattr(heartbeats.collection, "bulk_write", broken)
+        tasks = [flusher.start(), heartbeats.start()]
+        await asyncio.sleep(0.01)
+        assert not any(task.done() for task in tasks)
+        assert flusher.stats()["pending_documents"] == 1 and flusher.failures > 0
+        assert heartbeats.pending("user-1", "course-1")["last_position_seconds"] == 30
+        await flusher.stop()
+        await heartbeats.stop()
+    run(scenario())
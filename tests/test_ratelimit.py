@@ -0,0 +1,138 @@
+import pytest
+from fastapi.testclient import TestClient
+from starlette.responses import JSONResponse
+import backend.server as server
+from backend.utils import ratelimit
+from .conftest import FakeRedis
+from .helpers import run
+
+MODULES = pytest.mark.parametrize("module", [server, ratelimit], ids=["server", "utils"])
+
+class Clock:
+    """Stands in for the time module, advanced by hand"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+def backends(module, clock):
+    return [
+        module.MemoryRateLimitBackend(),
+        module.RedisRateLimitBackend(FakeRedis(module.TOKEN_BUCKET_SCRIPT, clock))
+    ]
+
+def take(backend, key, limit, times):
+    return [run(backend.take(key, limit))[0] for _ in range(times)]
+
+@MODULES
+def test_a_bucket_allows_its_burst_then_refills_at_its_rate(module, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(module, "time", clock)
+    limit = module.RateLimit("login_email", per_minute=6, burst=3)  # One token every 10 seconds
+
+    for backend in backends(module, clock):
+        assert take(backend, "a@example.com", limit, 4) == [True, True, True, False]
+        allowed, retry_after = run(backend.take("a@example.com", limit))
+        assert not allowed
+        assert retry_after == pytest.approx(10)
+
+        clock.now += 15  # One and a half tokens
+        assert take(backend, "a@example.com", limit, 2) == [True, False]
+        clock.now += 5
+        assert take(backend, "a@example.com", limit, 2) == [True, False]
+
+        clock.now += 3600  # Refills to the burst, never beyond it
+        assert take(backend, "a@example.com", limit, 4) == [True, True, True, False]
+
+@MODULES
+def test_buckets_are_independent_per_key(module, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(module, "time", clock)
+    limit = module.RateLimit("login_ip", per_minute=1, burst=1)
+
+    for backend in backends(module, clock):
+        assert take(backend, "10.0.0.1", limit, 2) == [True, False]
+        assert take(backend, "10.0.0.2", limit, 1) == [True]
+
+@MODULES
+def test_memory_buckets_stay_bounded(module):
+    backend = module.MemoryRateLimitBackend(max_keys=4, shards=2)
+    limit = module.RateLimit("login_ip", per_minute=1, burst=1)
+
+    for i in range(50):
+        run(backend.take(f"10.0.0.{i}", limit))
+
+    stats = backend.stats()
+    assert stats["buckets"] <= stats["max_buckets"] == 4
+    assert stats["evictions"] == 50 - stats["buckets"]
+
+def scope(peer, *headers):
+    return {"client": (peer, 50000), "headers": [(name.encode(), value.encode()) for name, value in headers]}
+
+@MODULES
+def test_redis_without_a_url_falls_back_to_memory(module):
+    assert isinstance(module.create_rate_limit_backend("redis", redis_url=""), module.MemoryRateLimitBackend)
+    with pytest.raises(ValueError):
+        module.create_rate_limit_backend("fake")
+
+@MODULES
+def test_forwarded_addresses_are_only_trusted_from_the_proxy(module):
+    middleware = module.RateLimitMiddleware(None, limiter=None, rules={})
+    client_ip = middleware._client_ip
+
+    assert client_ip(scope("203.0.113.9", ("x-real-ip", "198.51.100.1"))) == "203.0.113.9"
+    assert client_ip(scope("127.0.0.1")) == "127.0.0.1"
+    assert client_ip(scope("127.0.0.1", ("x-real-ip", "198.51.100.1"))) == "198.51.100.1"
+    # The client can prepend anything; only the hop nginx appended counts
+    assert client_ip(scope("127.0.0.1", ("x-forwarded-for", "1.2.3.4, 198.51.100.1"))) == "198.51.100.1"
+    assert client_ip(scope("::1", ("x-forwarded-for", "198.51.100.2"))) == "198.51.100.2"
+
+    everyone = module.RateLimitMiddleware(None, limiter=None, rules={}, trust_forwarded_for=True)
+    assert everyone._client_ip(scope("10.1.1.1", ("x-forwarded-for", "1.2.3.4, 198.51.100.3"))) == "198.51.100.3"
+
+def limited_client(module, ip_burst, email_burst):
+    async def endpoint(scope, receive, send):
+        await JSONResponse({"ok": True})(scope, receive, send)
+    rules = {("POST", "/login"): (
+        module.RateLimit("login_ip", per_minute=0.001, burst=ip_burst),
+        module.RateLimit("login_email", per_minute=0.001, burst=email_burst)
+    )}
+    limiter = module.RateLimiter(module.MemoryRateLimitBackend())
+    middleware = module.RateLimitMiddleware(endpoint, limiter=limiter, rules=rules, trusted_proxies=["testclient"])
+    return TestClient(middleware), limiter
+
+def login(client, email, ip):
+    return client.post("/login", json={"email": email}, headers={"X-Real-IP": ip}).status_code
+
+@MODULES
+def test_the_email_limit_holds_across_addresses(module):
+    client, limiter = limited_client(module, ip_burst=100, email_burst=2)
+
+    assert [login(client, "A@example.com", f"198.51.100.{i}") for i in range(3)] == [200, 200, 429]
+    assert login(client, " a@example.com ", "198.51.100.9") == 429  # Same account however it is typed
+    assert login(client, "b@example.com", "198.51.100.9") == 200
+    assert limiter.stats()["limited"] == {"login_email": 2}
+
+@MODULES
+def test_the_address_limit_holds_across_emails(module):
+    client, limiter = limited_client(module, ip_burst=2, email_burst=100)
+
+    assert [login(client, f"user{i}@example.com", "198.51.100.1") for i in range(3)] == [200, 200, 429]
+    assert login(client, "user9@example.com", "198.51.100.2") == 200
+    assert limiter.stats()["limited"] == {"login_ip": 1}
+    assert client.get("/login").status_code == 200  # Only the listed method and path are limited
+
+def test_login_is_limited_per_email_on_the_server(client, db, monkeypatch):
+    _, email_limit = server.AUTH_RATE_LIMITS[("POST", "/api/auth/login")]
+    monkeypatch.setattr(email_limit, "burst", 2)
+    attempt = {"email": "a@example.com", "password": "wrong"}
+
+    assert [client.post("/api/auth/login", json=attempt).status_code for _ in range(3)] == [401, 401, 429]
+    response = client.post("/api/auth/login", json=attempt)
+    assert int(response.headers["Retry-After"]) >= 1
+    assert client.post("/api/auth/login", json={**attempt, "email": "b@example.com"}).status_code == 401
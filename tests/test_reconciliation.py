@@ -0,0 +1,85 @@
+from datetime import datetime
+import pytest
+import backend.server as server
+from backend.database import reconciliation
+from .helpers import run
+
+async def stream(*keys):
+    for key in keys:
+        yield key, {"key": key}
+
+async def settlement(*records):
+    for row_number, record in enumerate(records, start=2):
+        yield row_number, record
+
+async def collect(iterator):
+    return [item async for item in iterator]
+
+def payment(tran_id):
+    return {
+        "id": f"payment-{tran_id}", "transaction_id": tran_id, "idempotency_key": tran_id, "user_id": "user-1",
+        "course_id": f"course-{tran_id}", "amount": 500.0, "currency": "BDT", "status": "completed",
+        "completed_at": datetime(2024, 1, 15)
+    }
+
+def enrollment(tran_id):
+    return {
+        "id": f"enrollment-{tran_id}", "transaction_id": tran_id, "user_id": "user-1", "course_id": f"course-{tran_id}",
+        "payment_status": "completed"
+    }
+
+MERGE_JOINS = pytest.mark.parametrize("merge_join", [server.merge_join, reconciliation.merge_join])
+
+@MERGE_JOINS
+def test_merge_join_pairs_keys_and_marks_the_missing_side(merge_join):
+    joined = run(collect(merge_join(stream("a", "c", "d"), stream("b", "c"))))
+
+    assert [(key, [document and document["key"] for document in documents]) for key, documents in joined] == [
+        ("a", ["a", None]), ("b", [None, "b"]), ("c", ["c", "c"]), ("d", ["d", None])
+    ]
+
+@MERGE_JOINS
+def test_merge_join_of_empty_streams_yields_nothing(merge_join):
+    assert run(collect(merge_join(stream(), stream()))) == []
+    assert [key for key, _ in run(collect(merge_join(stream(), stream("a"))))] == ["a"]
+
+def test_reconciliation_reports_each_kind_of_mismatch(db):
+    run(db.payments.insert_many([
+        payment("t1"),
+        payment("t2"),
+        payment("t3"),  # Missing from the settlement file
+        payment("t4"),  # No enrollment of its own
+    ]))
+    run(db.enrollments.insert_many([enrollment("t1"), enrollment("t2"), enrollment("t3")]))
+
+    summary = run(server.Reconciliation("run-1").run(settlement(
+        {"tran_id": "t0", "amount": "100"},  # Unknown to us
+        {"tran_id": "t1", "amount": "500.00", "currency": "BDT"},
+        {"tran_id": "t1", "amount": "500.00", "currency": "BDT"},  # Repeated row
+        {"tran_id": "t2", "amount": "450", "currency": "BDT"},
+        {"tran_id": "t4", "amount": "500"},
+        {"tran_id": "", "amount": "1"},
+    )))
+
+    assert summary["mismatches"] == {
+        "unknown_transaction": 1,
+        "duplicate_transaction": 1,
+        "amount_mismatch": 1,
+        "missing_from_settlement": 1,
+        "membership_missing": 1,
+        "invalid_settlement_row": 1,
+    }
+    reported = {
+        (row["kind"], row["transaction_id"])
+        for row in run(db.reconciliation_mismatches.find({"run_id": "run-1"}).to_list(None))
+    }
+    assert reported == {
+        ("unknown_transaction", "t0"), ("duplicate_transaction", "t1"), ("amount_mismatch", "t2"),
+        ("missing_from_settlement", "t3"), ("membership_missing", "t4"), ("invalid_settlement_row", None)
+    }
+
+def test_reconciliation_rejects_an_unsorted_settlement_file(db):
+    rows = settlement({"tran_id": "t2", "amount": "1"}, {"tran_id": "t1", "amount": "1"})
+
+    with pytest.raises(ValueError, match="not sorted"):
+        run(server.Reconciliation("run-1").run(rows))
@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta
+import pytest
+import backend.server as server
+from backend.utils import revocation
+from .helpers import run
+
+BLOOM_FILTERS = pytest.mark.parametrize("BloomFilter", [server.BloomFilter, revocation.BloomFilter])
+REVOCATION_LISTS = pytest.mark.parametrize("RevocationList", [server.RevocationList, revocation.RevocationList])
+
+def later(minutes=60):
+    return datetime.utcnow() + timedelta(minutes=minutes)
+
+@BLOOM_FILTERS
+def test_bloom_filter_is_sized_for_its_capacity_and_error_rate(BloomFilter):
+    # m = -n ln(p) / ln(2)^2 bits and k = m / n ln(2) probes
+    bloom = BloomFilter(1000, 0.001)
+    assert (bloom.size, bloom.probes) == (14377, 10)
+    assert len(bloom._bits) == (14377 + 7) // 8
+
+    assert (BloomFilter(1000, 0.01).size, BloomFilter(1000, 0.01).probes) == (9585, 7)
+    assert BloomFilter(1, 0.5).size == 8  # Never smaller than a byte
+    assert BloomFilter(1, 0.5).probes >= 1
+
+@BLOOM_FILTERS
+def test_bloom_filter_has_no_false_negatives_and_few_false_positives(BloomFilter):
+    bloom = BloomFilter(2000, 0.01)
+    added = [f"jti-{i}" for i in range(2000)]
+    for key in added:
+        bloom.add(key)
+
+    assert bloom.count == 2000
+    assert all(key in bloom for key in added)
+    false_positives = sum(f"other-{i}" in bloom for i in range(20000))
+    assert false_positives < 20000 * 0.01 * 2
+
+@REVOCATION_LISTS
+def test_revocations_apply_immediately_and_only_once(RevocationList, db):
+    revoked = RevocationList(db.revoked_tokens)
+    run(revoked.refresh())
+
+    assert run(revoked.revoke("a", "user-1", later())) is True
+    assert run(revoked.revoke("a", "user-1", later())) is False
+    assert run(revoked.is_revoked("a")) is True
+    assert run(revoked.is_revoked("b")) is False
+    assert revoked.database_checks == 0
+
+@REVOCATION_LISTS
+def test_refresh_tokens_are_checked_against_the_collection_only(RevocationList, db):
+    revoked = RevocationList(db.revoked_tokens)
+    run(revoked.refresh())
+    run(revoked.revoke("r", "user-1", later(), token_type="refresh"))
+
+    assert revoked.stats()["entries"] == 0
+    assert run(db.revoked_tokens.find_one({"jti": "r"}))["token_type"] == "refresh"
+
+@REVOCATION_LISTS
+def test_before_the_first_load_every_check_reads_the_collection(RevocationList, db):
+    run(db.revoked_tokens.insert_one({
+        "jti": "elsewhere", "token_type": "access", "user_id": "u", "expires_at": later(), "revoked_at": datetime.utcnow()
+    }))
+    revoked = RevocationList(db.revoked_tokens)
+
+    assert run(revoked.is_revoked("elsewhere")) is True
+    assert run(revoked.is_revoked("other")) is False
+    assert revoked.database_checks == 2
+
+@REVOCATION_LISTS
+def test_refresh_picks_up_revocations_made_by_other_processes(RevocationList, db):
+    here, elsewhere = RevocationList(db.revoked_tokens), RevocationList(db.revoked_tokens)
+    run(here.refresh())
+    run(elsewhere.revoke("a", "user-1", later()))
+    assert run(here.is_revoked("a")) is False  # Not seen until the next poll
+
+    run(here.refresh())
+    assert run(here.is_revoked("a")) is True
+    assert here.database_checks == 0
+
+@REVOCATION_LISTS
+def test_once_the_exact_set_overflows_bloom_hits_fall_back_to_the_collection(RevocationList, db):
+    revoked = RevocationList(db.revoked_tokens, max_entries=2)
+    run(revoked.refresh())
+    for jti in ("a", "b", "c"):
+        run(revoked.revoke(jti, "user-1", later()))
+
+    assert revoked.stats()["entries"] == 2
+    assert revoked.evictions == 1
+    # "a" was evicted from the set but is still in the bloom filter, so it is confirmed from Mongo
+    assert run(revoked.is_revoked("a")) is True
+    assert revoked.database_checks == 1
+    assert run(revoked.is_revoked("c")) is True
+    assert revoked.database_checks == 1
+
+    misses = [f"never-{i}" for i in range(200)]
+    assert not any(run(revoked.is_revoked(jti)) for jti in misses)
+    assert revoked.bloom_negatives + (revoked.database_checks - 1) == 200
+    assert revoked.bloom_negatives > 190
+
+@REVOCATION_LISTS
+def test_refresh_prunes_expired_ids_and_rebuilds_a_full_filter(RevocationList, db):
+    revoked = RevocationList(db.revoked_tokens, capacity=4)
+    run(revoked.refresh())
+    run(revoked.revoke("expiring", "user-1", later(-1)))
+    run(revoked.revoke("live", "user-1", later()))
+
+    run(revoked.refresh())
+    assert revoked.stats()["entries"] == 1
+    assert run(revoked.is_revoked("live")) is True
+
+    for jti in ("c", "d", "e"):
+        run(revoked.revoke(jti, "user-1", later()))
+    assert revoked.stats()["bloom_keys"] == 5
+    run(revoked.refresh())  # Over capacity: rebuilt from the unexpired revocations
+    stats = revoked.stats()
+    assert (stats["rebuilds"], stats["bloom_keys"], stats["entries"]) == (2, 4, 4)
+    assert all(run(revoked.is_revoked(jti)) for jti in ("live", "c", "d", "e"))
@@ -0,0 +1,128 @@
+from datetime import datetime, timedelta
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+import backend.server as server
+from backend.database import rollups
+from .helpers import bearer, register, run
+
+@pytest.fixture
+def rollup_db(monkeypatch):
+    database = AsyncMongoMockClient().islamic_institute
+    monkeypatch.setattr(rollups, "database", database)
+    return database
+
+def test_rebuild_credits_the_amount_charged_not_the_list_price(rollup_db):
+    run(rollup_db.courses.insert_many([
+        {"id": "paid", "course_type": "paid", "price": 100.0},
+        {"id": "free", "course_type": "free", "price": None},
+    ]))
+    day = datetime(2024, 3, 1, 9)
+    run(rollup_db.enrollments.insert_many([
+        {"id": "1", "course_id": "paid", "payment_status": "completed", "enrolled_at": day, "transaction_id": "t1"},
+        {"id": "2", "course_id": "paid", "payment_status": "completed", "enrolled_at": day, "bulk_job_id": "job"},
+        {"id": "3", "course_id": "free", "payment_status": "completed", "enrolled_at": day},
+        {"id": "4", "course_id": "paid", "payment_status": "pending", "enrolled_at": day, "transaction_id": "t2"},
+        # Older than payment records, so it is credited the list price
+        {"id": "5", "course_id": "paid", "payment_status": "completed", "enrolled_at": day},
+        # Paid on day one, completed the next
+        {
+            "id": "6", "course_id": "paid", "payment_status": "completed", "enrolled_at": day,
+            "completed_at": datetime(2024, 3, 2, 1), "transaction_id": "t3"
+        },
+    ]))
+    run(rollup_db.payments.insert_many([
+        {"transaction_id": "t1", "status": "completed", "amount": 80.0},
+        {"transaction_id": "t2", "status": "pending", "amount": 100.0},
+        {"transaction_id": "t3", "status": "completed", "amount": 90.0},
+    ]))
+
+    assert run(rollups.rebuild_daily_rollups(batch_size=1, grace_seconds=0)) == 3
+
+    buckets = run(rollup_db.daily_rollups.find({}, {"_id": 0}).sort([("day", 1), ("course_id", 1)]).to_list(None))
+    assert buckets == [
+        {"day": datetime(2024, 3, 1), "course_id": "free", "course_type": "free", "enrollments": 1, "revenue": 0},
+        {"day": datetime(2024, 3, 1), "course_id": "paid", "course_type": "paid", "enrollments": 3, "revenue": 180.0},
+        {"day": datetime(2024, 3, 2), "course_id": "paid", "course_type": "paid", "enrollments": 1, "revenue": 90.0},
+    ]
+    assert run(rollup_db.rollup_rebuild_leases.count_documents({})) == 0
+
+def test_rebuild_keeps_enrollments_completed_while_it_runs(rollup_db, monkeypatch):
+    course = {"id": "paid", "course_type": "paid", "price": 100.0}
+    run(rollup_db.courses.insert_one(course))
+    run(rollup_db.enrollments.insert_one(
+        {"id": "1", "course_id": "paid", "payment_status": "completed", "enrolled_at": datetime(2024, 3, 1)}
+    ))
+    read_payments = rollups.paid_amounts
+
+    async def settle_during_scan(transaction_ids):
+        # A payment settles after the cutoff, while the history is being read
+        completed_at = datetime.utcnow()
+        await rollup_db.enrollments.insert_one({
+            "id": "2", "course_id": "paid", "payment_status": "completed",
+            "enrolled_at": completed_at, "completed_at": completed_at
+        })
+        await rollups.record_enrollment_rollup(course, completed_at, amount=60.0)
+        return await read_payments(transaction_ids)
+
+    monkeypatch.setattr(rollups, "paid_amounts", settle_during_scan)
+    run(rollups.rebuild_daily_rollups(grace_seconds=0))
+
+    assert run(rollups.get_rollup_totals()) == {"enrollments": 2, "revenue": 160.0}
+    assert run(rollup_db.daily_rollup_journal.count_documents({})) == 0
+
+def test_rebuild_refuses_to_run_alongside_another(rollup_db):
+    run(rollup_db.rollup_rebuild_leases.insert_one(
+        {"_id": "daily_rollups", "cutoff": datetime.utcnow(), "expires_at": datetime.utcnow() + timedelta(minutes=5)}
+    ))
+
+    with pytest.raises(rollups.RollupRebuildRunning):
+        run(rollups.rebuild_daily_rollups(grace_seconds=0))
+
+def test_empty_rollups_are_backfilled_at_startup(rollup_db, monkeypatch):
+    monkeypatch.setattr(rollups, "ROLLUP_REBUILD_GRACE_SECONDS", 0)
+    run(rollup_db.courses.insert_one({"id": "paid", "course_type": "paid", "price": 100.0}))
+    run(rollup_db.enrollments.insert_one(
+        {"id": "1", "course_id": "paid", "payment_status": "completed", "enrolled_at": datetime(2024, 3, 1)}
+    ))
+
+    run(rollups.backfill_daily_rollups())
+    assert run(rollups.get_rollup_totals()) == {"enrollments": 1, "revenue": 100.0}
+
+    # Buckets that already exist are left alone
+    run(rollup_db.enrollments.insert_one(
+        {"id": "2", "course_id": "paid", "payment_status": "completed", "enrolled_at": datetime(2024, 3, 1)}
+    ))
+    run(rollups.backfill_daily_rollups())
+    assert run(rollups.get_rollup_totals()) == {"enrollments": 1, "revenue": 100.0}
+
+def test_server_rebuild_matches_the_live_rollups(client, db, monkeypatch):
+    monkeypatch.setattr(server, "ROLLUP_REBUILD_GRACE_SECONDS", 0)
+    admin = register(client, "admin@example.com", role="admin", db=db)
+    register(client, "student@example.com")
+    course = {"title": "T", "description": "d", "instructor_name": "i", "course_type": "paid", "price": 50}
+    course_id = client.post("/api/courses", json=course, headers=bearer(admin)).json()["course_id"]
+    client.post(
+        "/api/admin/enrollments:bulk", content=f"student@example.com,{course_id}\n",
+        headers={**bearer(admin), "content-type": "text/csv"}
+    )
+    live = run(db.daily_rollups.find({}, {"_id": 0}).to_list(None))
+
+    run(db.daily_rollups.delete_many({}))
+    run(server.backfill_daily_rollups())
+
+    assert run(db.daily_rollups.find({}, {"_id": 0}).to_list(None)) == live
+
+def test_bulk_enrollment_into_a_paid_course_adds_no_revenue(client, db):
+    admin = register(client, "admin@example.com", role="admin", db=db)
+    register(client, "student@example.com")
+    course = {"title": "T", "description": "d", "instructor_name": "i", "course_type": "paid", "price": 50}
+    course_id = client.post("/api/courses", json=course, headers=bearer(admin)).json()["course_id"]
+
+    response = client.post(
+        "/api/admin/enrollments:bulk", content=f"student@example.com,{course_id}\n",
+        headers={**bearer(admin), "content-type": "text/csv"}
+    )
+    assert response.json()["results"]["enrolled"] == 1
+
+    buckets = run(db.daily_rollups.find({}, {"_id": 0, "enrollments": 1, "revenue": 1}).to_list(None))
+    assert buckets == [{"enrollments": 1, "revenue": 0}]